@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import numpy as np
+from singlecellmultiomics.utils.storeFolder import store_lock, write_store_folder
+
+# Increment when the layout of the cache changes, caches with another version are rebuilt
+ALLELE_CACHE_VERSION = 1
+
+ALLELE_CACHE_ARRAYS = ('positions', 'base_ids', 'sample_set_ids')
+
+
+def get_allele_cache_key(vcf_path, select_samples=None, phased=True, ignore_conversions=None):
+    """Obtain the settings which determine the contents of an allele cache
+
+    Args:
+        vcf_path (str) : path to the VCF file
+
+        select_samples (list) : samples selected from the VCF file
+
+        phased (bool) : the variants are phased
+
+        ignore_conversions (set) : ignored conversions {(ref, alt), ..}
+
+    Returns:
+        key (dict) : the cache is valid only when the key of the cache matches
+    """
+    stat = os.stat(vcf_path)
+    return {
+        'version': ALLELE_CACHE_VERSION,
+        'vcf': os.path.abspath(vcf_path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'select_samples': None if select_samples is None else sorted(select_samples),
+        'phased': bool(phased),
+        'ignore_conversions': None if ignore_conversions is None else sorted(map(list, ignore_conversions))
+    }
+
+
+def get_allele_cache_path(key, contig):
+    """Obtain the path of the allele cache of a contig, the cache is stored next to the VCF file
+
+    Args:
+        key (dict) : key obtained from get_allele_cache_key
+
+        contig (str) : contig
+
+    Returns:
+        path (str)
+    """
+    name = contig
+    if key['select_samples'] is not None:
+        name += '_' + '-'.join(key['select_samples'])
+    # Caches for other settings can co-exist
+    settings = hashlib.sha1(json.dumps(
+        [key['phased'], key['ignore_conversions']]).encode()).hexdigest()[:10]
+    return f"{key['vcf']}_allele_cache/{name}.{settings}.alleles"
+
+
+def allele_cache_lock(path):
+    """Hold an exclusive lock on an allele cache, used to let a single process create the cache.
+
+    Args:
+        path (str) : path of the cache
+    """
+    return store_lock(path)
+
+
+def write_allele_cache(path, key, positions, base_ids, sample_set_ids, bases, sample_sets):
+    """Write an allele cache, the cache is written to a temporary folder which is renamed when complete.
+    A valid cache for the same key is kept as is.
+
+    Args:
+        path (str) : path of the cache
+
+        key (dict) : key obtained from get_allele_cache_key
+
+        positions (np.ndarray) : sorted zero based position of every entry
+
+        base_ids (np.ndarray) : index into bases for every entry
+
+        sample_set_ids (np.ndarray) : index into sample_sets for every entry
+
+        bases (list) : base table
+
+        sample_sets (list) : table of sets of samples
+    """
+    def write(temp_path):
+        for name, values in zip(ALLELE_CACHE_ARRAYS, (positions, base_ids, sample_set_ids)):
+            np.save(f'{temp_path}/{name}.npy', values)
+        with open(f'{temp_path}/tables.json', 'w') as f:
+            json.dump({'key': key,
+                       'bases': list(bases),
+                       'sample_sets': [sorted(samples) for samples in sample_sets]}, f)
+
+    write_store_folder(path, write, is_valid=lambda path: open_allele_cache(path, key) is not None)
+
+
+class AlleleCache():
+    """Read access to an allele cache written by write_allele_cache.
+    The arrays are memory mapped, processes using the same cache share it through the page cache.
+    """
+
+    def __init__(self, path):
+        """Open an allele cache
+
+        Args:
+            path (str) : path of the cache
+        """
+        self.path = path
+        for name in ALLELE_CACHE_ARRAYS:
+            setattr(self, name, np.load(f'{path}/{name}.npy', mmap_mode='r'))
+        with open(f'{path}/tables.json') as f:
+            tables = json.load(f)
+        self.key = tables['key']
+        self.bases = tables['bases']
+        self.sample_sets = [frozenset(samples) for samples in tables['sample_sets']]
+
+    def region(self, start=None, end=None):
+        """Select the entries of a region
+
+        Args:
+            start (int) : zero based start of the region, None to select from the start of the contig
+
+            end (int) : zero based end of the region (exclusive), None to select up to the end of the contig
+
+        Returns:
+            positions, base_ids, sample_set_ids (np.ndarray) : memory mapped views of the entries of the region
+        """
+        first = 0 if start is None else np.searchsorted(self.positions, start, 'left')
+        last = len(self.positions) if end is None else np.searchsorted(self.positions, end, 'left')
+        return self.positions[first:last], self.base_ids[first:last], self.sample_set_ids[first:last]
+
+
+# path -> AlleleCache, caches opened by this process
+_opened_caches = {}
+
+
+def open_allele_cache(path, key):
+    """Open an allele cache
+
+    Args:
+        path (str) : path of the cache
+
+        key (dict) : key obtained from get_allele_cache_key
+
+    Returns:
+        cache (AlleleCache) or None when the cache does not exist or was written for another key
+    """
+    cache = _opened_caches.get(path)
+    if cache is not None and cache.key == key:
+        return cache
+    try:
+        cache = AlleleCache(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    if cache.key != key:
+        return None
+    _opened_caches[path] = cache
+    return cache
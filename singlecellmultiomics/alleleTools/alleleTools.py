@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import pysam
-import argparse
+import array
 import collections
-import functools
-import gzip
-import os
+import sys
+import numpy as np
 from singlecellmultiomics.utils import Prefetcher
+from singlecellmultiomics.alleleTools.alleleCache import get_allele_cache_key, get_allele_cache_path, \
+    allele_cache_lock, write_allele_cache, open_allele_cache
+
+# Size of the regions which are loaded by lazy lookups outside of a prefetched region
+LAZY_REGION_SIZE = 5_000_000
+# Amount of lazily loaded regions kept in memory per contig
+LAZY_REGION_CACHE_SIZE = 4
 
 def get_allele_dict():
     return collections.defaultdict(nested_set_defaultdict)
@@ -15,6 +21,118 @@ def nested_set_defaultdict():
 def set_defaultdict():
     return collections.defaultdict (set)
 
+
+class RegionAlleleStore():
+    """Compact store of the variants of a region of a single contig.
+
+    Every (position, base) combination is an entry, the entries are sorted by position.
+    Bases and sets of samples are interned in small tables, every distinct set of samples is stored once.
+    """
+
+    def __init__(self, contig, start, end, positions, base_ids, sample_set_ids, bases, sample_sets):
+        """Initialise RegionAlleleStore, use RegionAlleleStore.from_variants to build a store
+
+        Args:
+            contig (str) : contig of the region
+
+            start (int) : start of the region (zero based, inclusive)
+
+            end (int) : end of the region (zero based, exclusive)
+
+            positions (np.ndarray) : sorted position of every entry
+
+            base_ids (np.ndarray) : index into bases for every entry
+
+            sample_set_ids (np.ndarray) : index into sample_sets for every entry
+
+            bases (list) : base table
+
+            sample_sets (list) : table of frozensets of samples
+        """
+        self.contig = contig
+        self.start = start
+        self.end = end
+        self.positions = positions
+        self.base_ids = base_ids
+        self.sample_set_ids = sample_set_ids
+        self.bases = bases
+        self.base_lookup = {base: i for i, base in enumerate(bases)}
+        self.sample_sets = sample_sets
+
+    @classmethod
+    def from_variants(cls, contig, start, end, variants):
+        """Build a store
+
+        Args:
+            contig (str) : contig of the region
+
+            start (int) : start of the region (zero based, inclusive)
+
+            end (int) : end of the region (zero based, exclusive)
+
+            variants (iterable) : (position, {base: samples}) tuples sorted by position,
+                a repeated position replaces the previous one
+
+        Returns:
+            store (RegionAlleleStore)
+        """
+        positions = array.array('q')
+        base_ids = array.array('i')
+        sample_set_ids = array.array('i')
+        bases = {}
+        sample_sets = {}
+        for position, bases_to_alleles in variants:
+            while len(positions) and positions[-1] == position:
+                positions.pop()
+                base_ids.pop()
+                sample_set_ids.pop()
+            for base, samples in bases_to_alleles.items():
+                positions.append(position)
+                base_ids.append(bases.setdefault(base, len(bases)))
+                sample_set_ids.append(sample_sets.setdefault(frozenset(samples), len(sample_sets)))
+
+        positions = np.frombuffer(positions, dtype=np.int64)
+        base_ids = np.frombuffer(base_ids, dtype=np.int32)
+        sample_set_ids = np.frombuffer(sample_set_ids, dtype=np.int32)
+        if len(positions) and (np.diff(positions) < 0).any():
+            order = np.argsort(positions, kind='stable')
+            positions, base_ids, sample_set_ids = positions[order], base_ids[order], sample_set_ids[order]
+        return cls(contig, start, end,
+                   positions,
+                   base_ids.astype(np.uint8 if len(bases) < 256 else np.int32),
+                   sample_set_ids,
+                   list(bases),
+                   list(sample_sets))
+
+    def __contains__(self, position):
+        i = np.searchsorted(self.positions, position)
+        return i < len(self.positions) and self.positions[i] == position
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, position, base):
+        """Obtain the samples associated to a base at a position
+
+        Args:
+            position (int) : zero based position
+
+            base (str) : base
+
+        Returns:
+            samples (frozenset) or None when the base at the position is not associated to any sample
+        """
+        base_id = self.base_lookup.get(base)
+        if base_id is None:
+            return None
+        i = int(np.searchsorted(self.positions, position))
+        while i < len(self.positions) and self.positions[i] == position:
+            if self.base_ids[i] == base_id:
+                return self.sample_sets[self.sample_set_ids[i]]
+            i += 1
+        return None
+
+
 class AlleleResolver(Prefetcher):
 
     def clean_vcf_name(self, vcffile):
@@ -39,7 +157,7 @@ class AlleleResolver(Prefetcher):
 
 
                  # When this flag is true a cache file is generated containing
-                 # usable SNPs for every chromosome in gzipped format
+                 # usable SNPs for every chromosome in a memory mappable format
                  ):
         """Initialise AlleleResolver
 
@@ -58,7 +176,8 @@ class AlleleResolver(Prefetcher):
 
             select_samples (list) : Use only these samples from the VCF file
 
-            use_cache (bool) : When this flag is true a cache file is generated containing usable SNPs for every chromosome in gzipped format
+            use_cache (bool) : When this flag is true a cache is generated containing usable SNPs for every chromosome in a memory mappable format,
+                the caches are stored next to the vcf file and are shared by all processes using the same vcf file and settings
 
             ignore_conversions(set) : conversions to ignore {(ref, alt), ..} , for example set( ('C','T'), ('G','A') )
 
@@ -75,18 +194,22 @@ class AlleleResolver(Prefetcher):
         self.phased = phased
         self.verbose = verbose
         self.locationToAllele = get_allele_dict()  # chrom -> pos-> base -> sample(s)
+        # chrom -> RegionAlleleStore, used when lazy loading
+        self.alleleStores = {}
+        # chrom -> OrderedDict(block start -> RegionAlleleStore), blocks loaded by lookups outside of the store of the contig
+        self.lazyAlleleStores = {}
         self.select_samples = select_samples
         self.region_start = region_start
         self.region_end = region_end
 
+        self.use_cache = use_cache
+        if use_cache:
+            lazyLoad = True
         self.lazyLoad = lazyLoad
 
         if vcffile is None:
             return
         self.vcffile = self.clean_vcf_name(vcffile)
-        self.use_cache = use_cache
-        if use_cache:
-            lazyLoad = True
 
         try:
             with pysam.VariantFile(vcffile) as f:
@@ -106,6 +229,7 @@ class AlleleResolver(Prefetcher):
                 raise NotImplementedError(
                     "Sample selection is not implemented for non proper VCF")
             lazyLoad = False
+            self.lazyLoad = False
 
         # collections.defaultdict(set) ) #(chrom, pos)-> base -> sample(s)
 
@@ -141,6 +265,59 @@ class AlleleResolver(Prefetcher):
     def addAlleleInfoOneBased(self, chromosome, location, base, alleleName):
         self.locationToAllele[chromosome][location][base].add(alleleName)
 
+    def get_cache_path(self, chrom):
+        """Obtain the path of the allele cache of a contig
+
+        Args:
+            chrom (str):  contig/chromosome
+
+        Returns:
+            path (str) : path of the allele cache, None when no cache is used for the contig
+        """
+        if (chrom.startswith('KN') or chrom.startswith('KZ') or chrom.startswith(
+                'chrUn') or chrom.endswith('_random') or 'ERCC' in chrom):
+            return None
+        return get_allele_cache_path(self.get_cache_key(), chrom)
+
+    def get_cache_key(self):
+        """Obtain the key of the allele caches of the vcf file, see alleleCache.get_allele_cache_key"""
+        return get_allele_cache_key(self.vcffile, select_samples=self.select_samples,
+                                    phased=self.phased, ignore_conversions=self.ignore_conversions)
+
+    def get_allele_cache(self, chrom):
+        """Open the allele cache of a contig, the cache is created when it does not exist or when it is outdated.
+        When multiple processes require the same cache, one process creates it while the other processes wait.
+
+        Args:
+            chrom (str):  contig/chromosome
+
+        Returns:
+            cache (AlleleCache) or None when no cache is used for the contig or it could not be created
+        """
+        path = self.get_cache_path(chrom)
+        if path is None:
+            return None
+        key = self.get_cache_key()
+        cache = open_allele_cache(path, key)
+        if cache is not None:
+            return cache
+        try:
+            with allele_cache_lock(path):
+                # The cache could have been created while waiting for the lock
+                cache = open_allele_cache(path, key)
+                if cache is None:
+                    if self.verbose:
+                        print(f"Creating allele cache at {path}")
+                    store = RegionAlleleStore.from_variants(chrom, 0, sys.maxsize, self.iter_variants(chrom))
+                    write_allele_cache(path, key, store.positions, store.base_ids, store.sample_set_ids,
+                                       store.bases, store.sample_sets)
+                    cache = open_allele_cache(path, key)
+        except OSError as e:
+            if self.verbose:
+                print(f"Exception writing cache: {e}")
+            return None
+        return cache
+
     def write_cache(self, path, chrom):
         """Write to cache file, this will make later lookups to the chromosome faster
 
@@ -149,13 +326,12 @@ class AlleleResolver(Prefetcher):
 
             chrom (str):  contig/chromosome to write cache file for (every contig has it's own cache)
         """
-        temp_path = path + '.unfinished'
-        with gzip.open(temp_path, 'wt') as f:
-            for position in sorted(list(self.locationToAllele[chrom].keys())):
-                for base in self.locationToAllele[chrom][position]:
-                    f.write(
-                        f'{position}\t{base}\t{",".join(sorted(list(self.locationToAllele[chrom][position][base])))}\n')
-        os.rename(temp_path, path)
+        store = RegionAlleleStore.from_variants(chrom, 0, sys.maxsize, (
+            (position, self.locationToAllele[chrom][position])
+            for position in sorted(self.locationToAllele[chrom]) if position >= 0))
+        with allele_cache_lock(path):
+            write_allele_cache(path, self.get_cache_key(), store.positions, store.base_ids,
+                               store.sample_set_ids, store.bases, store.sample_sets)
 
     def read_cached(self, path, chrom):
         """Read cache file
@@ -164,37 +340,146 @@ class AlleleResolver(Prefetcher):
             path (str):  path of the cache file
             chrom (str):  contig/chromosome
         """
-        with gzip.open(path, 'rt') as f:
-            for line in f:
-                position, base, samples = line.strip().split('\t', 3)
-                position = int(position)
-                if self.region_start is not None and position<self.region_start:
-                    continue
-                if self.region_end is not None and position>self.region_end:
-                    break
-
-                self.locationToAllele[chrom][position][base] = set(samples.split(','))
-
+        cache = open_allele_cache(path, self.get_cache_key())
+        if cache is None:
+            raise ValueError(f'{path} is not a valid allele cache for {self.vcffile}')
+        positions, base_ids, sample_set_ids = cache.region(
+            self.region_start, None if self.region_end is None else self.region_end + 1)
+        for position, base_id, sample_set_id in zip(positions.tolist(), base_ids.tolist(), sample_set_ids.tolist()):
+            self.locationToAllele[chrom][position][cache.bases[base_id]] = set(cache.sample_sets[sample_set_id])
 
 
     def instance(self, arg_update):
         if 'self' in self.args:
             del self.args['self']
-        clone = AlleleResolver(**self.args)
+        clone = AlleleResolver(**{**self.args, **arg_update})
         return clone
 
 
     def prefetch(self, contig, start, end):
+        """Obtain a resolver which holds only the variants of the supplied region in memory
+
+        Args:
+            contig (str) : contig to prefetch
+
+            start (int) : zero based start of the region, None to prefetch the whole contig
+
+            end (int) : zero based end of the region (exclusive)
+
+        Returns:
+            resolver (AlleleResolver)
+        """
+        if not self.lazyLoad or contig is None:
+            # All variants are already in memory
+            return self
 
         clone = self.instance({'region_start':start, 'region_end':end})
+        clone.load_region_store(contig, start, end)
+        return clone
+
+    def fetchRegion(self, chrom, start=None, end=None, lazy=False):
+        """Load the variants of a region into a RegionAlleleStore,
+        the store replaces the previously loaded store of the contig.
+
+        Args:
+            chrom (str) : contig/chromosome
+
+            start (int) : zero based start of the region, None to load from the start of the contig
+
+            end (int) : zero based end of the region (exclusive), None to load up to the end of the contig
+
+            lazy (bool) : the region is a block loaded by a lookup, the store is kept next to the store of the contig
+                in a cache of the LAZY_REGION_CACHE_SIZE most recently used blocks
+
+        Returns:
+            store (RegionAlleleStore)
+        """
+        cache = self.get_allele_cache(chrom) if self.use_cache else None
+        if cache is not None:
+            # The store refers to the memory mapped cache
+            store = RegionAlleleStore(
+                chrom, 0 if start is None else start, sys.maxsize if end is None else end,
+                *cache.region(start, end), cache.bases, cache.sample_sets)
+        else:
+            store = RegionAlleleStore.from_variants(
+                chrom, 0 if start is None else start, sys.maxsize if end is None else end,
+                self.iter_variants(chrom, start, end))
+        if self.verbose:
+            print(f'{len(store)} variants loaded for {chrom}:{start}-{end}')
+        return self.add_region_store(store, lazy=lazy)
+
+    def add_region_store(self, store, lazy=False):
+        """Use a RegionAlleleStore for lookups
+
+        Args:
+            store (RegionAlleleStore) : store to add
+
+            lazy (bool) : the store is a block loaded by a lookup, the block is cached next to the store
+                of the contig, otherwise the store replaces the store of the contig
+
+        Returns:
+            store (RegionAlleleStore)
+        """
+        if lazy:
+            blocks = self.lazyAlleleStores.setdefault(store.contig, collections.OrderedDict())
+            blocks[store.start] = store
+            if len(blocks) > LAZY_REGION_CACHE_SIZE:
+                blocks.popitem(last=False)
+        else:
+            self.alleleStores[store.contig] = store
+        return store
+
+    def load_region_store(self, chrom, start=None, end=None, lazy=False):
+        """Load the variants of a region using fetchRegion, when the contig is not available an empty store is used
 
-        #print(f'Prefetching {contig}:{start}-{end}')
+        Args:
+            chrom (str) : contig/chromosome
+
+            start (int) : zero based start of the region, None to load from the start of the contig
+
+            end (int) : zero based end of the region (exclusive), None to load up to the end of the contig
+
+            lazy (bool) : the region is a block loaded by a lookup, see fetchRegion
+
+        Returns:
+            store (RegionAlleleStore)
+        """
         try:
-            self.fetchChromosome(self.vcffile, contig, True)
-        except ValueError:
-            # This means the chromosome is not available
-            pass
-        return clone
+            return self.fetchRegion(chrom, start, end, lazy=lazy)
+        except Exception as e:
+            if 'fetch requires an index' in str(e):
+                raise Exception('The variant file used for allele resolving does not have an index file. Use bcftools index, or vcftools index to generate an index')
+            if 'invalid contig' not in str(e):
+                print('ERROR, in load_region_store (Allele Resolver):', e)
+            # Do not retry loading the region, a failed lazy block leaves the store of the contig in place
+            if lazy:
+                return self.add_region_store(RegionAlleleStore.from_variants(chrom, start, end, []), lazy=True)
+            return self.add_region_store(RegionAlleleStore.from_variants(chrom, 0, sys.maxsize, []))
+
+    def get_region_store(self, chrom, pos):
+        """Obtain the RegionAlleleStore holding the variants at pos, when the position is not
+        loaded yet the block of LAZY_REGION_SIZE bases containing the position is loaded.
+        The store of the contig (for example the prefetched region) is kept, the loaded blocks are cached next to it.
+
+        Args:
+            chrom (str) : contig/chromosome
+
+            pos (int) : zero based position
+
+        Returns:
+            store (RegionAlleleStore) or None when the variants are not lazy loaded
+        """
+        store = self.alleleStores.get(chrom)
+        if store is not None and store.start <= pos < store.end:
+            return store
+        if not self.lazyLoad or chrom in self.locationToAllele:
+            return None
+        start = pos - pos % LAZY_REGION_SIZE
+        blocks = self.lazyAlleleStores.get(chrom)
+        if blocks is not None and start in blocks:
+            blocks.move_to_end(start)
+            return blocks[start]
+        return self.load_region_store(chrom, start, start + LAZY_REGION_SIZE, lazy=True)
 
     def fetchChromosome(self, vcffile, chrom, clear=False):
         if clear:
@@ -203,121 +488,114 @@ class AlleleResolver(Prefetcher):
         vcffile = self.clean_vcf_name(vcffile)
         # allocate:
 
-        # Decide if this is an allele we would may be cache?
-        write_cache_file_flag = False
-        if self.use_cache:
-            if (chrom.startswith('KN') or chrom.startswith('KZ') or chrom.startswith(
-                    'chrUn') or chrom.endswith('_random') or 'ERCC' in chrom):
-                write_cache_file_flag = False
-            else:
-                write_cache_file_flag = True
-
-        if self.use_cache and write_cache_file_flag:
-            allele_dir = f'{os.path.abspath(vcffile)}_allele_cache/'
-            if not os.path.exists(allele_dir):
-                os.makedirs(allele_dir)
-            cache_file_name = f'{allele_dir}/{chrom}'
-            if self.select_samples is not None:
-                sample_list_id = '-'.join(sorted(list(self.select_samples)))
-                cache_file_name = cache_file_name + '_' + sample_list_id
-            cache_file_name += '.tsv.gz'
-            if os.path.exists(cache_file_name):
-                if self.verbose:
-                    print(f"Cached file exists at {cache_file_name}")
-                self.read_cached(cache_file_name, chrom)
-                return
-            if self.verbose:
-                print(
-                    f"Cache enabled, but file is not available, creating cache file at {cache_file_name}")
+        # Read the variants from the allele cache, the cache is created when it is not available
+        if self.use_cache and self.get_allele_cache(chrom) is not None:
+            self.read_cached(self.get_cache_path(chrom), chrom)
+            return
 
         self.locationToAllele[chrom][-1]['N'].add('Nop')
 
-        unTrusted = []
         added = 0
         if self.verbose:
             print(f'Reading variants for {chrom} ', end='')
         with pysam.VariantFile(vcffile) as v:
-            try:
-                for rec in v.fetch(chrom, start=self.region_start, stop=self.region_end):
-                    used = False
-                    bad = False
-                    bases_to_alleles = collections.defaultdict(
-                        set)  # base -> samples
-
-                    if self.phased:  # variants are phased, assign a random allele
-
-                        if len(rec.samples)==0: # File without samples
-
-                            bases_to_alleles[rec.ref]=set('r')
-                            bases_to_alleles[rec.alts[0]]=set('a')
-                            self.locationToAllele[rec.chrom][rec.pos - 1]=bases_to_alleles
-
-                        else:
-                            samples_assigned = set()
-                            most_assigned_base = 0
-                            monomorphic=False
-                            for sample, sampleData in rec.samples.items():
-
-                                if self.select_samples is not None and sample not in self.select_samples:
-                                    continue
-                                for base in sampleData.alleles:
-                                    if base is None:
-                                        # This site is monomorphic:
-                                        monomorphic=True
-                                        continue
-                                    if len(base) == 1:
-                                        bases_to_alleles[base].add(sample)
-                                        used = True
-                                        samples_assigned.add(sample)
-                                    else:  # This location cannot be trusted:
-                                        bad = True
-                            # We can prune this site if all samples are associated
-                            # with the same base
-                            if self.select_samples is not None and used:
-                                if len(samples_assigned) != len(
-                                        self.select_samples):
-                                    # The site is not informative
-                                    bad = True
-                            if monomorphic and len(bases_to_alleles)>0:
-                                bad=False
-                            elif len(bases_to_alleles) < 2:
-                                bad = True
-                                # The site is not informative
-                    else:  # not phased
-                        if not all(
-                                len(allele) == 1 for allele in rec.alleles):  # only select SNVs
-                            bad = True
-                        else:
-                            bad = False
-                            for allele, base in zip('UVWXYZ', rec.alleles):
-                                bases_to_alleles[base].add(allele)
-                                used = True
-
-                    if not bad and self.ignore_conversions is not None:  # prune conversions which are banned
-                        bad = any(
-                            ((rec.ref, base) in self.ignore_conversions for base in bases_to_alleles))
-
-                    if used and not bad:
-                        self.locationToAllele[rec.chrom][rec.pos -
-                                                         1] = bases_to_alleles
-                        added += 1
-            except Exception as e:
-                raise
-        # for t in unTrusted:
-        #    if t in self.locationToAllele:
-        #        del self.locationToAllele[t[0]][t[1]]
-        #del unTrusted
+            for rec in v.fetch(chrom, start=self.region_start, stop=self.region_end):
+                bases_to_alleles = self.get_variant_alleles(rec)
+                if bases_to_alleles is not None:
+                    self.locationToAllele[rec.chrom][rec.pos - 1] = bases_to_alleles
+                    added += 1
         if self.verbose:
             print(f'{added} variants [OK]')
-        if self.use_cache and write_cache_file_flag:
-            if self.verbose:
-                print("writing cache file")
-            try:
-                self.write_cache(cache_file_name, chrom)
-            except Exception as e:
-                if self.verbose:
-                    print(f"Exception writing cache: {e}")
-                pass  # @todo
+
+    def iter_variants(self, chrom, start=None, end=None):
+        """Read the usable variants of a region from the VCF file
+
+        Args:
+            chrom (str) : contig/chromosome
+
+            start (int) : zero based start of the region
+
+            end (int) : zero based end of the region (exclusive)
+
+        Yields:
+            position (int), bases_to_alleles (dict) : zero based position, base -> samples
+        """
+        with pysam.VariantFile(self.vcffile) as v:
+            for rec in v.fetch(chrom, start=start, stop=end):
+                bases_to_alleles = self.get_variant_alleles(rec)
+                if bases_to_alleles is not None:
+                    yield rec.pos - 1, bases_to_alleles
+
+    def get_variant_alleles(self, rec):
+        """Obtain the bases of a variant and the samples (or alleles) associated to them
+
+        Args:
+            rec (pysam.VariantRecord) : variant
+
+        Returns:
+            bases_to_alleles (dict) : base -> samples, None when the variant is not usable
+        """
+        used = False
+        bad = False
+        bases_to_alleles = collections.defaultdict(
+            set)  # base -> samples
+
+        if self.phased:  # variants are phased, assign a random allele
+
+            if len(rec.samples)==0: # File without samples
+
+                bases_to_alleles[rec.ref]=set('r')
+                bases_to_alleles[rec.alts[0]]=set('a')
+                return bases_to_alleles
+
+            else:
+                samples_assigned = set()
+                most_assigned_base = 0
+                monomorphic=False
+                for sample, sampleData in rec.samples.items():
+
+                    if self.select_samples is not None and sample not in self.select_samples:
+                        continue
+                    for base in sampleData.alleles:
+                        if base is None:
+                            # This site is monomorphic:
+                            monomorphic=True
+                            continue
+                        if len(base) == 1:
+                            bases_to_alleles[base].add(sample)
+                            used = True
+                            samples_assigned.add(sample)
+                        else:  # This location cannot be trusted:
+                            bad = True
+                # We can prune this site if all samples are associated
+                # with the same base
+                if self.select_samples is not None and used:
+                    if len(samples_assigned) != len(
+                            self.select_samples):
+                        # The site is not informative
+                        bad = True
+                if monomorphic and len(bases_to_alleles)>0:
+                    bad=False
+                elif len(bases_to_alleles) < 2:
+                    bad = True
+                    # The site is not informative
+        else:  # not phased
+            if not all(
+                    len(allele) == 1 for allele in rec.alleles):  # only select SNVs
+                bad = True
+            else:
+                bad = False
+                for allele, base in zip('UVWXYZ', rec.alleles):
+                    bases_to_alleles[base].add(allele)
+                    used = True
+
+        if not bad and self.ignore_conversions is not None:  # prune conversions which are banned
+            bad = any(
+                ((rec.ref, base) in self.ignore_conversions for base in bases_to_alleles))
+
+        if used and not bad:
+            return bases_to_alleles
+        return None
 
     def getAllele(self, reads):
         alleles = set()
@@ -334,33 +612,18 @@ class AlleleResolver(Prefetcher):
 
     # @functools.lru_cache(maxsize=1000) not necessary anymore... complete data is already saved in dict
     def has_location(self, chrom ,pos):
-        if self.lazyLoad and chrom not in self.locationToAllele:
-            try:
-                self.fetchChromosome(self.vcffile, chrom, clear=True)
-            except Exception as e:
-                if 'invalid contig' in str(e):
-                    # The contig does not exists
-                    return True
-                if 'fetch requires an index' in str(e):
-                    raise Exception('The variant file used for allele resolving does not have an index file. Use bcftools index, or vcftools index to generate an index')
-                print('ERROR, in has_location (Allele Resolver):', e)
-                pass
+        store = self.get_region_store(chrom, pos)
+        if store is not None:
+            return pos in store
         if chrom not in self.locationToAllele or pos not in self.locationToAllele[chrom]:
             return False
         return True
 
 
     def getAllelesAt(self, chrom, pos, base):
-        if self.lazyLoad and chrom not in self.locationToAllele:
-            try:
-                self.fetchChromosome(self.vcffile, chrom, clear=True)
-            except Exception as e:
-                if 'fetch requires an index' in str(e):
-                    raise Exception('The variant file used for allele resolving does not have an index file. Use bcftools index, or vcftools index to generate an index')
-
-                print('ERROR, in getAllelesAt:', e)
-                pass
-
+        store = self.get_region_store(chrom, pos)
+        if store is not None:
+            return store.get(pos, base)
 
         if chrom not in self.locationToAllele or pos not in self.locationToAllele[chrom]:
             return None
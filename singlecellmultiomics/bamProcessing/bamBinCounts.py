@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
+import array
 import pysam
 import numpy as np
 import os
@@ -14,14 +15,16 @@ from datetime import datetime
 from itertools import chain
 from more_itertools import windowed
 from typing import Generator
-from singlecellmultiomics.methylation import MethylationCountMatrix
+from singlecellmultiomics.methylation import MethylationCountMatrix, SparseMethylationCountMatrix
 from pysamiterators import CachedFasta
 from pysam import FastaFile
 from singlecellmultiomics.utils import reverse_complement
 from collections import defaultdict, Counter
 from itertools import product
 from singlecellmultiomics.bamProcessing.bamFunctions import mate_iter
+from singlecellmultiomics.bamProcessing.cutSiteIndex import CutSiteIndex
 from multiprocessing import Pool
+from singlecellmultiomics.utils.binning import coordinates_to_sliding_bin_ids
 
 def _generate_count_dict(args):
     """
@@ -187,23 +190,30 @@ def get_binned_counts_prefixed(bam_dict, bin_size, regions=None, ta=False) -> pd
     return pd.DataFrame(cut_counts).T
 
 
-def get_binned_counts(bams, bin_size, regions=None):
-
-    fs = 1000
+def _get_fetch_regions(bams, regions=None, fs=1000):
+    """
+    Obtain (contig, start, end) regions to fetch, all contigs of the first bam file when regions is None.
+    Regions are supplied as contig or (contig, start, end), the start is extended by fs to include fragments
+    starting before the region.
+    """
     if regions is None:
-        regions = [(c,None,None) for c in get_contig_sizes(bams[0]).keys()]
+        return [(c,None,None) for c in get_contig_sizes(bams[0]).keys()]
 
-    else:
-        for i,r in enumerate(regions):
-            if type(r)==str:
-                regions[i] = (r,None,None)
-            else:
-                contig, start, end =r
-                if type(start)==int:
-                    start = max(0,start-fs)
+    for i,r in enumerate(regions):
+        if type(r)==str:
+            regions[i] = (r,None,None)
+        else:
+            contig, start, end =r
+            if type(start)==int:
+                start = max(0,start-fs)
 
-                regions[i] = (contig,start,end)
+            regions[i] = (contig,start,end)
+    return regions
+
+
+def get_binned_counts(bams, bin_size, regions=None):
 
+    regions = _get_fetch_regions(bams, regions)
     jobs = [(bam_path, bin_size, *region) for region, bam_path in product(regions, bams)]
 
 
@@ -220,6 +230,287 @@ def get_binned_counts(bams, bin_size, regions=None):
     return pd.DataFrame(cut_counts).T
 
 
+def _collect_cut_positions(args):
+    """
+    Obtain the cut position and sample of every read for a bam path and region,
+    using the same read selection as _generate_count_dict
+
+    args:
+        args (tuple) : bam_path, contig, start, stop
+
+    Returns:
+        contig (str), samples (list), sample_ids (np.ndarray), positions (np.ndarray)
+    """
+    bam_path, contig, start, stop = args
+
+    samples = {}
+    sample_ids = array.array('i')
+    positions = array.array('i')
+    with pysam.AlignmentFile(bam_path) as alignments:
+
+        for R1,R2 in mate_iter(alignments, contig=contig, start=start, stop=stop):
+
+            if R1 is None or R1.is_duplicate or R1.is_qcfail:
+                continue
+
+            if not R1.has_tag('DS'):
+                cut_pos = R1.reference_end if  R1.is_reverse else R1.reference_start
+            else:
+                cut_pos = int(R1.get_tag('DS'))
+
+            if cut_pos is None:
+                continue
+
+            if R1.has_tag('SM'):
+                sample = R1.get_tag('SM')
+            else:
+                sample = 'No_Sample'
+
+            try:
+                sample_id = samples[sample]
+            except KeyError:
+                sample_id = samples[sample] = len(samples)
+            sample_ids.append(sample_id)
+            positions.append(cut_pos)
+
+    return contig, list(samples), np.frombuffer(sample_ids, dtype=np.int32), np.frombuffer(positions, dtype=np.int32)
+
+
+class CutPositions():
+    """
+    Cut position (DS tag or R1 start) and sample of every read, stored per contig in compact integer arrays.
+    The bam files are read once, counts for any amount of (sliding) bin sizes are derived from the positions.
+
+    Example:
+        >>> cuts = CutPositions.from_bams(['./data/mini_nla_test.bam'])
+        >>> cuts.write('./cut_positions.npz')
+        >>> counts = CutPositions.read('./cut_positions.npz').get_binned_counts(250_000)
+    """
+
+    def __init__(self):
+        self.samples = {}  # sample -> sample id
+        self.sample_ids = {}  # contig -> np.ndarray
+        self.positions = {}  # contig -> np.ndarray
+
+    @classmethod
+    def from_bams(cls, bams, regions=None, threads=None):
+        """
+        Collect the cut positions of one or more bam files
+
+        Args:
+            bams (list) : paths to bam files
+
+            regions (list) : contigs or (contig, start, end) tuples to collect, all contigs when None
+
+            threads (int) : amount of worker processes, all available cpus when None
+
+        Returns:
+            cut_positions (CutPositions)
+        """
+        regions = _get_fetch_regions(bams, regions)
+        jobs = [(bam_path, *region) for region, bam_path in product(regions, bams)]
+
+        cut_positions = cls()
+        with multiprocessing.Pool(threads) as workers:
+            for contig, samples, sample_ids, positions in workers.imap(_collect_cut_positions, jobs):
+                cut_positions.add(contig, samples, sample_ids, positions)
+        return cut_positions
+
+    @classmethod
+    def from_cut_site_index(cls, index_path, regions=None, bam_path=None):
+        """
+        Obtain the cut positions of the molecules in a cut site index, without reading the bam file
+
+        Args:
+            index_path (str) : path to a cut site index written by cutSiteIndex.write_cut_site_index
+
+            regions (list) : contigs or (contig, start, end) tuples to collect, all contigs when None
+
+            bam_path (str) : BAM file the index was written for, used to check the index is up to date, see CutSiteIndex
+
+        Returns:
+            cut_positions (CutPositions)
+        """
+        index = CutSiteIndex(index_path, bam_path)
+        if regions is None:
+            regions = index.get_contigs()
+
+        cut_positions = cls()
+        for region in regions:
+            contig, start, end = (region, None, None) if type(region) == str else region
+            rows = index.fetch(contig, start, end, dedup=True, ignore_qcfail=True, columns=['position', 'sample'])
+            cut_positions.add(contig, index.samples, rows['sample'], rows['position'])
+        return cut_positions
+
+    def add(self, contig, samples, sample_ids, positions):
+        """
+        Add cut positions
+
+        Args:
+            contig (str) : contig of the positions
+
+            samples (list) : sample for every sample id used in sample_ids
+
+            sample_ids (np.ndarray) : sample id of every position
+
+            positions (np.ndarray) : cut positions
+        """
+        sample_map = np.array([self.samples.setdefault(sample, len(self.samples)) for sample in samples],
+                              dtype=np.int32)
+        sample_ids = sample_map[sample_ids] if len(sample_ids) else np.zeros(0, dtype=np.int32)
+        if contig in self.positions:
+            sample_ids = np.concatenate([self.sample_ids[contig], sample_ids])
+            positions = np.concatenate([self.positions[contig], positions])
+        self.sample_ids[contig] = sample_ids
+        self.positions[contig] = np.asarray(positions, dtype=np.int32)
+
+    def get_contigs(self):
+        """Contigs in order of collection"""
+        return list(self.positions)
+
+    def __len__(self):
+        """Amount of collected cut positions"""
+        return sum(len(positions) for positions in self.positions.values())
+
+    def get_bin_counts(self, contig, bin_size, sliding_increment=None):
+        """
+        Count the cut positions of a contig per bin and sample
+
+        Args:
+            contig (str) : contig to count
+
+            bin_size (int) : bin size
+
+            sliding_increment (int) : increment between the starts of overlapping bins, when None the bins do not overlap.
+                Bins which start before the start of the contig are not counted.
+
+        Returns:
+            bin_starts (np.ndarray) : start coordinate of every bin with at least one count
+
+            counts (np.ndarray) : bins x samples count matrix
+        """
+        positions = self.positions.get(contig, np.zeros(0, dtype=np.int32)).astype(np.int64)
+        sample_ids = self.sample_ids.get(contig, np.zeros(0, dtype=np.int32)).astype(np.int64)
+
+        if sliding_increment is None:
+            bin_ids = positions // bin_size
+            increment = bin_size
+        else:
+            # Every position is counted in all overlapping sliding bins
+            start_ids, end_ids = coordinates_to_sliding_bin_ids(positions, bin_size, sliding_increment)
+            start_ids = np.maximum(start_ids, 0)
+            lengths = np.maximum(end_ids - start_ids + 1, 0)
+            offsets = np.cumsum(lengths) - lengths
+            bin_ids = np.repeat(start_ids - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+            sample_ids = np.repeat(sample_ids, lengths)
+            increment = sliding_increment
+
+        n_samples = len(self.samples)
+        if len(bin_ids) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, n_samples), dtype=np.int64)
+        keys, inverse = np.unique(bin_ids * n_samples + sample_ids, return_inverse=True)
+        observed_bins, rows = np.unique(keys // n_samples, return_inverse=True)
+        counts = np.zeros((len(observed_bins), n_samples), dtype=np.int64)
+        counts[rows, keys % n_samples] = np.bincount(inverse.ravel(), minlength=len(keys))
+        return observed_bins * increment, counts
+
+    def get_binned_counts(self, bin_size, sliding_increment=None) -> pd.DataFrame:
+        """
+        Obtain the counts per bin, the same table as get_binned_counts(bams, bin_size)
+
+        Args:
+            bin_size (int) : bin size
+
+            sliding_increment (int) : increment between the starts of overlapping bins, when None the bins do not overlap
+
+        Returns:
+            pd.DataFrame : (contig, bin start) x samples, bins without counts in a sample are NaN
+        """
+        index = []
+        blocks = []
+        for contig in self.positions:
+            bin_starts, counts = self.get_bin_counts(contig, bin_size, sliding_increment)
+            index += [(contig, bin_start) for bin_start in bin_starts.tolist()]
+            blocks.append(counts)
+        if len(index) == 0:
+            return pd.DataFrame()
+        counts = np.concatenate(blocks).astype(np.float64)
+        counts[counts == 0] = np.nan
+        return pd.DataFrame(counts, index=pd.MultiIndex.from_tuples(index), columns=list(self.samples))
+
+    def write(self, path):
+        """
+        Write the cut positions to a .npz file, which can be loaded using CutPositions.read
+
+        Args:
+            path (str) : path to write to
+        """
+        contigs = self.get_contigs()
+        contig_offsets = np.zeros(len(contigs) + 1, dtype=np.int64)
+        np.cumsum([len(self.positions[contig]) for contig in contigs], out=contig_offsets[1:])
+        np.savez_compressed(
+            path,
+            samples=np.array([str(sample) for sample in self.samples]),
+            contigs=np.array(contigs, dtype=str),
+            contig_offsets=contig_offsets,
+            sample_ids=np.concatenate([self.sample_ids[contig] for contig in contigs] + [np.zeros(0, dtype=np.int32)]),
+            positions=np.concatenate([self.positions[contig] for contig in contigs] + [np.zeros(0, dtype=np.int32)]))
+
+    @classmethod
+    def read(cls, path):
+        """
+        Load cut positions written by CutPositions.write
+
+        Args:
+            path (str) : path to the .npz file
+
+        Returns:
+            cut_positions (CutPositions)
+        """
+        cut_positions = cls()
+        with np.load(path) as stored:
+            cut_positions.samples = {sample: i for i, sample in enumerate(stored['samples'].tolist())}
+            contig_offsets = stored['contig_offsets']
+            sample_ids = stored['sample_ids']
+            positions = stored['positions']
+            for i, contig in enumerate(stored['contigs'].tolist()):
+                cut_positions.sample_ids[contig] = sample_ids[contig_offsets[i]:contig_offsets[i + 1]]
+                cut_positions.positions[contig] = positions[contig_offsets[i]:contig_offsets[i + 1]]
+        return cut_positions
+
+
+def get_multi_binned_counts(bams, bin_sizes, regions=None, sliding_increment=None, cut_positions_path=None, threads=None) -> dict:
+    """
+    Obtain binned counts for multiple bin sizes, reading the bam files only once
+
+    Args:
+        bams (list) : paths to bam files
+
+        bin_sizes (list) : bin sizes to count
+
+        regions (list) : contigs or (contig, start, end) tuples to count, all contigs when None
+
+        sliding_increment (int) : increment between the starts of overlapping bins, when None the bins do not overlap
+
+        cut_positions_path (str) : path to a .npz file to store the cut positions in. When the file exists
+            the counts are obtained from the stored cut positions and the bam files are not read.
+
+        threads (int) : amount of worker processes used to read the bam files
+
+    Returns:
+        counts (dict) : bin_size -> pd.DataFrame, see get_binned_counts
+    """
+    if cut_positions_path is not None and os.path.exists(cut_positions_path):
+        cut_positions = CutPositions.read(cut_positions_path)
+    else:
+        cut_positions = CutPositions.from_bams(bams, regions=regions, threads=threads)
+        if cut_positions_path is not None:
+            cut_positions.write(cut_positions_path)
+
+    return {bin_size: cut_positions.get_binned_counts(bin_size, sliding_increment=sliding_increment)
+            for bin_size in bin_sizes}
+
+
 def fill_range(start, end, step):
     """
     range iterator from start to end with stepsize step
@@ -464,7 +755,226 @@ def obtain_approximate_reference_cut_position(site: int, contig: str, alt_spans:
     return contig, site + alt_start
 
 
-def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_interval=3, threads=4, count_function=None):
+def _count_blocks(args):
+    """
+    Run a count function and convert the resulting {bin_id: {sample: count}} dictionary to blocks of arrays,
+    the conversion is performed in the worker instead of in the process merging the counts
+
+    args:
+        args (tuple) : count_function, command generated by generate_commands
+
+    Returns:
+        blocks (dict) : (prefix, contig) -> (bin_size, samples, rows, bin_starts, bin_ends, sample_indices, counts),
+            the prefix contains the key_tags values of the bin_id. The counts are integers (np.int64),
+            or floats (np.float64) when any of the counts is not an integer
+    """
+    count_function, command = args
+    bin_size = command[1]
+
+    grouped = {}
+    for bin_id, sample_counts in count_function(command).items():
+        *prefix, contig, bin_start, bin_end = bin_id
+        key = (tuple(prefix), contig)
+        if not key in grouped:
+            grouped[key] = ({}, [], [], [], [], [])
+        samples, rows, bin_starts, bin_ends, sample_indices, counts = grouped[key]
+        for sample, count in sample_counts.items():
+            rows.append(bin_start // bin_size)
+            bin_starts.append(bin_start)
+            bin_ends.append(bin_end)
+            sample_indices.append(samples.setdefault(sample, len(samples)))
+            counts.append(count)
+
+    blocks = {}
+    for key, (samples, *arrays, counts) in grouped.items():
+        counts = np.array(counts)
+        blocks[key] = (bin_size, list(samples), *(np.array(values, dtype=np.int64) for values in arrays),
+                       counts.astype(np.int64 if counts.dtype.kind in 'biu' else np.float64))
+    return blocks
+
+
+class BinnedCounts():
+    """
+    Counts per bin and sample, stored in a preallocated bins x samples matrix for every contig.
+    Blocks of counts are added in place, the matrices grow when new samples are observed.
+    The matrices hold integers, all matrices are converted to floats as soon as a block with fractional counts is added.
+
+    Example:
+        >>> counts = BinnedCounts(contig_sizes={'chr1': 5000})
+        >>> counts.add_blocks(_count_blocks((count_fragments_binned, command)))
+        >>> counts.to_dataframe()
+    """
+
+    def __init__(self, contig_sizes=None):
+        """
+        Args:
+            contig_sizes (dict) : contig -> length, used to allocate all bins of a contig at once
+        """
+        self.contig_sizes = {} if contig_sizes is None else contig_sizes
+        self.samples = {}  # sample -> column
+        self.sample_totals = np.zeros(0, dtype=np.int64)
+        self.dtype = np.int32  # dtype of the matrices
+        self.matrices = {}  # (prefix, contig) -> bins x samples np.ndarray
+        self.bin_starts = {}  # (prefix, contig) -> start of every bin
+        self.bin_ends = {}  # (prefix, contig) -> end of every bin
+
+    def _reserve(self, key, bin_size, n_rows):
+        """Make sure the matrix of key has at least n_rows rows and a column for every sample"""
+        n_samples = len(self.samples)
+        if key not in self.matrices:
+            if key[1] in self.contig_sizes:
+                n_rows = max(n_rows, -(-self.contig_sizes[key[1]] // bin_size))
+            self.matrices[key] = np.zeros((n_rows, max(n_samples, 1)), dtype=self.dtype)
+            self.bin_starts[key] = np.zeros(n_rows, dtype=np.int64)
+            self.bin_ends[key] = np.zeros(n_rows, dtype=np.int64)
+
+        matrix = self.matrices[key]
+        if matrix.shape[0] < n_rows or matrix.shape[1] < n_samples:
+            # Double the amount of columns, to prevent growing the matrix for every new sample
+            grown = np.zeros((max(matrix.shape[0], n_rows),
+                              matrix.shape[1] if matrix.shape[1] >= n_samples else max(n_samples, 2 * matrix.shape[1])),
+                             dtype=matrix.dtype)
+            grown[:matrix.shape[0], :matrix.shape[1]] = matrix
+            self.matrices[key] = grown
+            for coordinates in (self.bin_starts, self.bin_ends):
+                if len(coordinates[key]) < grown.shape[0]:
+                    coordinates[key] = np.concatenate([
+                        coordinates[key], np.zeros(grown.shape[0] - len(coordinates[key]), dtype=np.int64)])
+        return self.matrices[key]
+
+    def add_blocks(self, blocks):
+        """
+        Add the counts of blocks generated by _count_blocks
+
+        Args:
+            blocks (dict) : (prefix, contig) -> (bin_size, samples, rows, bin_starts, bin_ends, sample_indices, counts)
+        """
+        for key, (bin_size, samples, rows, bin_starts, bin_ends, sample_indices, counts) in blocks.items():
+            if counts.dtype.kind == 'f' and self.dtype != np.float64:
+                self.dtype = np.float64
+                self.sample_totals = self.sample_totals.astype(np.float64)
+                for matrix_key, matrix in self.matrices.items():
+                    self.matrices[matrix_key] = matrix.astype(np.float64)
+            columns = np.array([self.samples.setdefault(sample, len(self.samples)) for sample in samples],
+                               dtype=np.int64)
+            if len(self.sample_totals) < len(self.samples):
+                self.sample_totals = np.concatenate([
+                    self.sample_totals, np.zeros(len(self.samples) - len(self.sample_totals), dtype=self.sample_totals.dtype)])
+            if len(rows) == 0:
+                continue
+            matrix = self._reserve(key, bin_size, int(rows.max()) + 1)
+            columns = columns[sample_indices]
+            np.add.at(matrix, (rows, columns), counts)
+            np.add.at(self.sample_totals, columns, counts)
+            self.bin_starts[key][rows] = bin_starts
+            self.bin_ends[key][rows] = bin_ends
+
+    def get_matrix(self, key):
+        """
+        Obtain the counts of a contig
+
+        Args:
+            key (tuple) : (prefix, contig), the prefix is () when no key tags are used
+
+        Returns:
+            bin_starts (np.ndarray) : start of every observed bin
+
+            bin_ends (np.ndarray) : end of every observed bin
+
+            matrix (np.ndarray) : observed bins x samples view of the count matrix
+        """
+        matrix = self._reserve(key, None, 0)[:, :len(self.samples)]
+        observed = np.flatnonzero(matrix.any(axis=1))
+        return self.bin_starts[key][observed], self.bin_ends[key][observed], matrix[observed]
+
+    def get_top_samples(self, n):
+        """Obtain the column indices of the n samples with the most counts, in ascending order of counts"""
+        return np.argsort(self.sample_totals, kind='stable')[-n:]
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Obtain the counts as bins x samples dataframe, bins without counts are not included
+
+        Returns:
+            pd.DataFrame : the index contains the bin ids, (*key_tag_values, contig, bin_start, bin_end)
+        """
+        index = []
+        blocks = []
+        for key in self.matrices:
+            bin_starts, bin_ends, matrix = self.get_matrix(key)
+            index += [(*key[0], key[1], bin_start, bin_end)
+                      for bin_start, bin_end in zip(bin_starts.tolist(), bin_ends.tolist())]
+            blocks.append(matrix)
+        if len(index) == 0:
+            return pd.DataFrame()
+        return pd.DataFrame(np.concatenate(blocks).astype(np.int64 if self.dtype == np.int32 else np.float64), index=pd.MultiIndex.from_tuples(index),
+                            columns=list(self.samples))
+
+    def to_dict(self) -> dict:
+        """
+        Obtain the counts as dictionary
+
+        Returns:
+            counts (dict) : {bin_id: {sample: count}}, only counts larger than zero are included
+        """
+        samples = list(self.samples)
+        counts = {}
+        for key in self.matrices:
+            bin_starts, bin_ends, matrix = self.get_matrix(key)
+            for bin_start, bin_end, row in zip(bin_starts.tolist(), bin_ends.tolist(), matrix):
+                columns = np.flatnonzero(row)
+                counts[(*key[0], key[1], bin_start, bin_end)] = dict(
+                    zip([samples[column] for column in columns.tolist()], row[columns].tolist()))
+        return counts
+
+
+def _plot_binned_counts(counts, key, top_cells, cell_plots):
+    """Plot the counts of the top cells on the contig of key, scaled to the 99th percentile of the contig"""
+    bin_starts, bin_ends, matrix = counts.get_matrix(key)
+    if len(bin_starts) == 0:
+        return
+    x = (bin_starts + bin_ends) / 2
+    values = matrix[:, top_cells].astype(float)
+    scale = np.percentile(values, 99, axis=0)
+    values = np.clip(values / np.where(scale > 0, scale, 1), 0, 2)
+    samples = list(counts.samples)
+    for cell_index, column in enumerate(top_cells.tolist()):
+        gplot = cell_plots[cell_index]['plot']
+        gplot.reset_axis(key[1])
+        fig = cell_plots[cell_index]['fig']
+        fig.suptitle(samples[column])
+        gplot[key[1]].scatter(x, values[:, cell_index], s=0.1, c='k')
+        fig.canvas.draw()
+
+
+def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_interval=3, threads=4, count_function=None, as_frame=False):
+    """
+    Run count commands in parallel and merge the results
+
+    The workers return the counts as blocks of arrays which are added in place to
+    preallocated per-contig bins x samples matrices (BinnedCounts)
+
+    Args:
+        commands (iterable) : commands generated by generate_commands
+
+        reference (pysam.FastaFile) : reference, used to allocate the bins of every contig and to show the live plot
+
+        live_update (bool) : show a plot of the counts of the cells with the most counts while counting
+
+        show_n_cells (int) : amount of cells to show in the live plot
+
+        update_interval (float) : seconds between live plot updates
+
+        threads (int) : amount of worker processes
+
+        count_function (function) : function returning {bin_id: {sample: count}} for a command,
+            count_fragments_binned by default
+
+        as_frame (bool) : return a bins x samples pd.DataFrame instead of a dictionary
+
+    Returns:
+        counts (dict) : {bin_id: {sample: count}}, or pd.DataFrame when as_frame is set
+    """
     if count_function is None:
         count_function = count_fragments_binned
 
@@ -480,10 +990,8 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
 
         plt.pause(0.01)
 
-    # import random
-    # random.shuffle(commands)
-
-    counts = {}
+    counts = BinnedCounts(
+        contig_sizes=None if reference is None else dict(zip(reference.references, reference.lengths)))
 
     prev = None
 
@@ -491,70 +999,37 @@ def obtain_counts(commands, reference, live_update=True, show_n_cells=4, update_
 
     start_time = datetime.now()
 
-    update_method = 'partial_df'
-
     with multiprocessing.Pool(threads) as workers:
 
-        for i, result in enumerate(workers.imap_unordered(count_function,
-                                                          commands)):
-            # Result is of the format: counts[bin_id][sample] = obs (int)
-            #counts.update(result)
-            for bin_id, sample_dict in result.items():
-                if not bin_id in counts:
-                    counts[bin_id] =  sample_dict
-                else:
-                    counts[bin_id].update(sample_dict)
-
+        for i, blocks in enumerate(workers.imap_unordered(_count_blocks,
+                                                          ((count_function, command) for command in commands))):
+            counts.add_blocks(blocks)
 
-
-            if live_update and update_method == 'partial_df':
+            if live_update:
                 if (datetime.now() - start_time).total_seconds() > 2 and (
                         prev is None or (datetime.now() - prev).total_seconds() >= update_interval):
-                    if len(result) == 0:
-                        continue
-
-                    df = pd.DataFrame(counts).T
-                    if df.sum().sum() == 0:
+                    if len(blocks) == 0 or counts.sample_totals.sum() == 0:
                         continue
                     prev = datetime.now()
 
                     if top_cells is None:
-                        top_cells = df.sum().sort_values()[-show_n_cells:]
-
-                    df = df[top_cells.index].fillna(0)
-                    df = np.clip(0, 2, df / np.percentile(df, 99, axis=0))
+                        top_cells = counts.get_top_samples(show_n_cells)
 
-                    for contig in [list(result.keys())[0][0]]:
-                        x = np.array([(stop + start) / 2 for start, stop in df.loc[contig].index.values])
-
-                        for cell_index, (cell, row) in enumerate(df.loc[contig].T.iterrows()):
-                            gplot = cell_plots[cell_index]['plot']
-                            gplot.reset_axis(contig)
-                            fig = cell_plots[cell_index]['fig']
-                            fig.suptitle(cell)
-                            gplot[contig].scatter(x, row.values, s=0.1, c='k')
-                            fig.canvas.draw()
+                    _plot_binned_counts(counts, next(iter(blocks)), top_cells, cell_plots)
                     plt.pause(0.001)
 
     # Show final result
     if live_update:
-        df = pd.DataFrame(counts).T
-        df = df[top_cells.index].fillna(0)
-        df = np.clip(0, 2, df / np.percentile(df, 99, axis=0))
-
+        if top_cells is None:
+            top_cells = counts.get_top_samples(show_n_cells)
         for contig in cell_plots[0]['plot'].contigs:
-            x = np.array([(stop + start) / 2 for start, stop in df.loc[contig].index.values])
-
-            for cell_index, (cell, row) in enumerate(df.loc[contig].T.iterrows()):
-                gplot = cell_plots[cell_index]['plot']
-                gplot.reset_axis(contig)
-                fig = cell_plots[cell_index]['fig']
-                fig.suptitle(cell)
-                gplot[contig].scatter(x, row.values, s=0.1, c='k')
-                fig.canvas.draw()
+            if ((), contig) in counts.matrices:
+                _plot_binned_counts(counts, ((), contig), top_cells, cell_plots)
         plt.pause(0.001)
 
-    return counts
+    if as_frame:
+        return counts.to_dataframe()
+    return counts.to_dict()
 
 
 def read_counts(read, min_mq, dedup=True, read1_only=False,ignore_mp=False, ignore_qcfail=False, verbose=False):
@@ -717,7 +1192,10 @@ def count_methylation_binned(args):
 
     min_counts_per_bin = kwargs.get('min_counts_per_bin',10) # Min measurements across all cells
     # Cant use defaultdict because of pickles :\
-    met_counts = MethylationCountMatrix(threads=kwargs.get('threads', None))  # Sample->(contig,bin_start,bin_end)-> [methylated_counts, unmethylated]
+    if kwargs.get('sparse', False):
+        met_counts = SparseMethylationCountMatrix(threads=kwargs.get('threads', None))
+    else:
+        met_counts = MethylationCountMatrix(threads=kwargs.get('threads', None))  # Sample->(contig,bin_start,bin_end)-> [methylated_counts, unmethylated]
 
     if count_reads:
         read_count_dict = defaultdict(Counter)  # location > sample > read_obs
@@ -870,7 +1348,7 @@ def count_methylation_binned(args):
 
 
                 if final_call is not None:
-                    met_counts[sample, bin_id][final_call]+=1
+                    met_counts.add(sample, bin_id, final_call)
 
     met_counts.prune(min_samples=kwargs.get('min_samples',0), min_variance=kwargs.get('min_variance',0))
     if reference is not None:
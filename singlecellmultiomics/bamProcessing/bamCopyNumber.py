@@ -200,7 +200,7 @@ def filter_segment_size(segment_bounds, min_segment_size):
             final_segments.append( (chrom,seg) )
     return final_segments
 
-def generate_intitial_clustering(copy_mat, plot_directory, MAXCP=4, chrom_order=None, cn_difference_threshold=0.7, hand_picked_thresholds={}, max_cluster_count=30, seed=42, threshold_offset = 0 ):
+def generate_intitial_clustering(copy_mat, plot_directory, MAXCP=4, chrom_order=None, cn_difference_threshold=0.7, hand_picked_thresholds={}, max_cluster_count=30, seed=42, threshold_offset = 0, threads=None ):
 
     if plot_directory is not None and not os.path.exists(plot_directory):
         os.makedirs(plot_directory)
@@ -211,7 +211,7 @@ def generate_intitial_clustering(copy_mat, plot_directory, MAXCP=4, chrom_order=
     random.seed(seed)
     segment_bounds = collections.defaultdict(set)
     segment_calls = []
-    for chromosome in chrom_order:
+    for chromosome_index, chromosome in enumerate(chrom_order):
         d = copy_mat[chromosome].clip(0,MAXCP)
         L = linkage(d, method='ward')
         scores = []
@@ -294,18 +294,16 @@ def generate_intitial_clustering(copy_mat, plot_directory, MAXCP=4, chrom_order=
         else:
             axes = [None]*len(set(assignments))
 
-        for ax_col,clust in zip(axes, sorted(list(set(assignments)))):
+        # Segment the median profile of all clusters at once
+        clusters = sorted(list(set(assignments)))
+        cluster_profiles = [d[assignments==clust].median().sort_index(0) for clust in clusters]
+        segmentations = segment_profiles([data.values for data in cluster_profiles], p=0.005,
+                                         threads=threads, seed=[seed, chromosome_index])
+
+        for ax_col, clust, data, (L, S) in zip(axes, clusters, cluster_profiles, segmentations):
             if plot_directory is not None:
                 ax = ax_col[0]
 
-            data = d[assignments==clust].median().sort_index(0)
-            p = 0.005
-            sample = data.values
-            L = segment(  sample,p=p )
-
-            # Copy number per segment:
-            S = validate(sample, L,p=p)
-
             if plot_directory is not None:
                 ax.set_ylim(0, MAXCP+0.5)
 
@@ -368,6 +366,26 @@ def generate_intitial_clustering(copy_mat, plot_directory, MAXCP=4, chrom_order=
 
 
 
+# Maximum amount of values in a matrix of permutations which is evaluated at once
+PERMUTATION_BATCH_VALUES = 4_000_000
+
+
+def get_random_state(random_state=None):
+    '''Obtain a np.random.Generator, random_state can be a seed, a np.random.SeedSequence or a Generator'''
+    if isinstance(random_state, np.random.Generator):
+        return random_state
+    return np.random.default_rng(random_state)
+
+
+def permutation_batches(x, shuffles, random_state):
+    '''Yield matrices in which every row is a random permutation of x, until shuffles permutations are generated'''
+    batch_size = max(1, min(shuffles, PERMUTATION_BATCH_VALUES // max(len(x), 1)))
+    for first in range(0, shuffles, batch_size):
+        # Generator.permuted requires numpy 1.20, sorting random keys permutes every row independently
+        keys = random_state.random((min(batch_size, shuffles - first), len(x)))
+        yield np.take_along_axis(np.tile(x, (len(keys), 1)), keys.argsort(axis=1), axis=1)
+
+
 def cbs_stat(x):
     '''Given x, Compute the subinterval x[i0:i1] with the maximal segmentation statistic t.
     Returns t, i0, i1'''
@@ -380,6 +398,17 @@ def cbs_stat(x):
     return (s1-s0)**2*n/(i1-i0+1)/(n+1-i1+i0), i0, i1+1
 
 
+def cbs_stat_batch(X):
+    '''Compute the maximal segmentation statistic t (see cbs_stat) for every row of the matrix X'''
+    n = X.shape[1]
+    y = np.cumsum(X - X.mean(axis=1, keepdims=True), axis=1)
+    e0, e1 = np.argmin(y, axis=1), np.argmax(y, axis=1)
+    i0, i1 = np.minimum(e0, e1), np.maximum(e0, e1)
+    rows = np.arange(len(y))
+    s0, s1 = y[rows, i0], y[rows, i1]
+    return (s1-s0)**2*n/(i1-i0+1)/(n+1-i1+i0)
+
+
 def tstat(x, i):
     '''Return the segmentation statistic t testing if i is a (one-sided)  breakpoint in x'''
     n = len(x)
@@ -388,14 +417,19 @@ def tstat(x, i):
     return (n-i)*i/n*(s0-s1)**2
 
 
+def tstat_batch(X, i):
+    '''Compute the segmentation statistic t testing if i is a breakpoint (see tstat) for every row of the matrix X'''
+    n = X.shape[1]
+    s0 = X[:, :i].mean(axis=1)
+    s1 = X[:, i:].mean(axis=1)
+    return (n-i)*i/n*(s0-s1)**2
 
 
-
-
-def cbs(x, shuffles=1000, p=.05):
+def cbs(x, shuffles=1000, p=.05, random_state=None):
     '''Given x, find the interval x[i0:i1] with maximal segmentation statistic t. Test that statistic against
     given (shuffles) number of random permutations with significance p.  Return True/False, t, i0, i1; True if
-    interval is significant, false otherwise.'''
+    interval is significant, false otherwise.
+    The permutations are evaluated in batches, the test stops as soon as the interval can not be significant anymore.'''
 
     max_t, max_start, max_end = cbs_stat(x)
     if max_end-max_start == len(x):
@@ -406,59 +440,52 @@ def cbs(x, shuffles=1000, p=.05):
         max_end = len(x)
     thresh_count = 0
     alpha = shuffles*p
-    xt = x.copy()
-    for i in range(shuffles):
-        np.random.shuffle(xt)
-        threshold, s0, e0 = cbs_stat(xt)
-        if threshold >= max_t:
-            thresh_count += 1
+    for permutations in permutation_batches(x, shuffles, get_random_state(random_state)):
+        thresh_count += np.count_nonzero(cbs_stat_batch(permutations) >= max_t)
         if thresh_count > alpha:
             return False, max_t, max_start, max_end
     return True, max_t, max_start, max_end
 
 
-def rsegment(x, start, end, L=[], shuffles=1000, p=.05):
+def rsegment(x, start, end, L=[], shuffles=1000, p=.05, random_state=None):
     '''Recursively segment the interval x[start:end] returning a list L of pairs (i,j) where each (i,j) is a significant segment.
     '''
-    threshold, t, s, e = cbs(x[start:end], shuffles=shuffles, p=p)
+    random_state = get_random_state(random_state)
+    threshold, t, s, e = cbs(x[start:end], shuffles=shuffles, p=p, random_state=random_state)
     if (not threshold) | (e-s < 5) | (e-s == end-start):
         L.append((start, end))
     else:
         if s > 0:
-            rsegment(x, start, start+s, L)
+            rsegment(x, start, start+s, L, random_state=random_state)
         if e-s > 0:
-            rsegment(x, start+s, start+e, L)
+            rsegment(x, start+s, start+e, L, random_state=random_state)
         if start+e < end:
-            rsegment(x, start+e, end, L)
+            rsegment(x, start+e, end, L, random_state=random_state)
     return L
 
 
-def segment(x, shuffles=1000, p=.05):
+def segment(x, shuffles=1000, p=.05, random_state=None):
     '''Segment the array x, using significance test based on shuffles rearrangements and significance level p
     '''
     start = 0
     end = len(x)
     L = []
-    rsegment(x, start, end, L, shuffles=shuffles, p=p)
+    rsegment(x, start, end, L, shuffles=shuffles, p=p, random_state=random_state)
     return L
 
 
-def validate(x, L, shuffles=1000, p=.01):
+def validate(x, L, shuffles=1000, p=.01, random_state=None):
+    random_state = get_random_state(random_state)
     S = [x[0] for x in L]+[len(x)]
     SV = [0]
     left = 0
     for test, s in enumerate(S[1:-1]):
         t = tstat(x[S[left]:S[test+2]], S[test+1]-S[left])
-        threshold = 0
         thresh_count = 0
         site = S[test+1]-S[left]
-        xt = x[S[left]:S[test+2]].copy()
         flag = True
-        for k in range(shuffles):
-            np.random.shuffle(xt)
-            threshold = tstat(xt, site)
-            if threshold > t:
-                thresh_count += 1
+        for permutations in permutation_batches(x[S[left]:S[test+2]], shuffles, random_state):
+            thresh_count += np.count_nonzero(tstat_batch(permutations, site) > t)
             if thresh_count >= p*shuffles:
                 flag = False
                 break
@@ -469,22 +496,55 @@ def validate(x, L, shuffles=1000, p=.01):
     return SV
 
 
-def get_segment_calls(copy_series, p_value=0.01,  shuffles=10000, plot=None):
+def _segment_profile(args):
+    x, shuffles, p, seed = args
+    random_state = get_random_state(seed)
+    L = segment(x, shuffles=shuffles, p=p, random_state=random_state)
+    return L, validate(x, L, shuffles=shuffles, p=p, random_state=random_state)
+
+
+def segment_profiles(profiles, shuffles=1000, p=.05, threads=None, seed=42):
+    '''Segment and validate multiple copy number profiles, in parallel when threads is larger than one
+
+    Args:
+        profiles (list) : list of np.ndarray, copy number profiles to segment
+
+        shuffles (int) : amount of permutations used to test every segment
+
+        p (float) : significance level
+
+        threads (int) : amount of worker processes
+
+        seed (int) : every profile is segmented using a random state derived from this seed, the results
+            do not depend on the amount of threads
+
+    Returns:
+        segmentations (list) : (segment(profile), validate(profile, segments)) for every profile
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(len(profiles))
+    jobs = [(np.asarray(x), shuffles, p, s) for x, s in zip(profiles, seeds)]
+    if threads is not None and threads > 1 and len(jobs) > 1:
+        with Pool(threads) as workers:
+            return workers.map(_segment_profile, jobs)
+    return list(map(_segment_profile, jobs))
+
+
+def get_segment_calls(copy_series, p_value=0.01,  shuffles=10000, plot=None, threads=None, seed=42):
 
     calls = {}
-    for contig in set(copy_series.columns.get_level_values(0)):
+    contigs = sorted(set(copy_series.columns.get_level_values(0)))
+    copy_vectors = [copy_series[contig].median().sort_index() for contig in contigs]
+    # Segment all contigs at once
+    segmentations = segment_profiles([copy_vector.values for copy_vector in copy_vectors],
+                                     shuffles=shuffles, p=p_value, threads=threads, seed=seed)
+    for contig, copy_vector, (l, s_calls) in zip(contigs, copy_vectors, segmentations):
         calls[contig] = []
-        copy_vector = copy_series[contig].median().sort_index()
 
         x = [ 0.5*(s+e) for s,e in copy_vector.index ]
 
         if plot is not None:
             plot.axis[contig].scatter(x, copy_vector.values, c='grey', s=1)
 
-        l = segment( copy_vector.values, p=p_value, shuffles=shuffles)
-
-        s_calls = validate(copy_vector.values, l, p=p_value, shuffles=shuffles)
-
         if s_calls[-1]!=len(copy_vector.values):
             s_calls.append(len(copy_vector.values))
 
@@ -540,7 +600,7 @@ def get_segment_calls(copy_series, p_value=0.01,  shuffles=10000, plot=None):
 
     return calls
 
-def bulk_trace(pdf_path, copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating,segmented_matrix ):
+def bulk_trace(pdf_path, copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating,segmented_matrix, threads=None ):
     with PdfPages(pdf_path,
                   metadata={'Creator': f'SingleCellMultiOmics {singlecellmultiomics.__version__}', 'Author': 'SCMO',
                             'Title': 'Traces for assigned clusters'}) as pdf:
@@ -549,7 +609,7 @@ def bulk_trace(pdf_path, copy_mat, cell_cluster_names, cell_order,segmented_matr
         for cluster in set(cell_cluster_names):
             fig = h.get_figure()
             cells_in_cluster = np.array(cell_order)[np.array(cell_cluster_names)==cluster]
-            get_segment_calls(copy_mat.loc[cells_in_cluster][chrom_order], plot=h, p_value=0.01,  shuffles=10000)
+            get_segment_calls(copy_mat.loc[cells_in_cluster][chrom_order], plot=h, p_value=0.01,  shuffles=10000, threads=threads)
             plt.suptitle(f'Cluster {cluster}, {len(cells_in_cluster)} cells,  {len(cells_in_cluster)*100/len(cell_cluster_names):.2f}% of total')
             pdf.savefig(fig)
             plt.close()
@@ -669,7 +729,8 @@ if __name__ == '__main__':
                             threads=threads,
                             live_update=False,
                             show_n_cells=None,
-                            update_interval=None )
+                            update_interval=None,
+                            as_frame=True )
 
     print(f"\rCreating count matrix [ {Fore.GREEN}OK{Style.RESET_ALL} ] ")
 
@@ -677,7 +738,7 @@ if __name__ == '__main__':
 
     if histplot is not None:
         print("Creating molecule histogram ... ",end="")
-        df = pd.DataFrame(counts).T.fillna(0)
+        df = counts
         fig, ax = plt.subplots()
         cell_sums = df.sum()
         cell_sums.name = 'Frequency'
@@ -693,7 +754,7 @@ if __name__ == '__main__':
 
     # Convert the count dictionary to a dataframe
 
-    df = pd.DataFrame(counts).T.fillna(0)
+    df = counts
 
     if df.shape[0]==0:
         raise ValueError('Resulting count matrix is empty. Is this file correctly tagged? Try adding the --ignore_mp flag')
@@ -843,8 +904,7 @@ if __name__ == '__main__':
                              chrom_order=chrom_order,
                              hand_picked_thresholds=hand_picked_thresholds,
                              cn_difference_threshold=args.cn_difference_threshold,
-
-
+                             threads=threads,
                              seed=42 )
 
         # Filter for segment size
@@ -855,7 +915,7 @@ if __name__ == '__main__':
                                                                                   MAXCP=MAXCP,
                                                                                    min_cells_per_cluster=min_cells_per_cluster,
                                                                                    min_segment_size=min_segment_size)
-        bulk_trace(f'{clustering_plot_folder}/segments_wo_variance_filter.pdf', copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating, segmented_matrix)
+        bulk_trace(f'{clustering_plot_folder}/segments_wo_variance_filter.pdf', copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating, segmented_matrix, threads=threads)
 
         cell_annot_df = pd.DataFrame([cell_cluster_names, [cell.split('_')[0] for cell in cell_order]],
                                      columns=cell_order).T
@@ -902,4 +962,4 @@ if __name__ == '__main__':
         segmented_matrix_f.to_pickle(f'{args.clustering_output_folder}/segmented_matrix.pickle.gz')
 
         # Create bulk trace plot:
-        bulk_trace(f'{clustering_plot_folder}/segments.pdf', copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating,segmented_matrix_f)
+        bulk_trace(f'{clustering_plot_folder}/segments.pdf', copy_mat, cell_cluster_names, cell_order,segmented_matrix_floating,segmented_matrix_f, threads=threads)
@@ -2,8 +2,10 @@ import os
 import pysam
 import time
 import contextlib
-from shutil import which, move
+from shutil import which, move, copyfileobj
+from copy import copy
 from singlecellmultiomics.utils import BlockZip, Prefetcher
+from singlecellmultiomics.bamProcessing.mappabilityStore import MappabilityStore, is_mappability_store
 import uuid
 import os
 from collections import defaultdict, Counter
@@ -13,6 +15,9 @@ import pandas as pd
 from typing import Generator
 from multiprocessing import Pool
 
+# Empty BGZF block which marks the end of a bam file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
 def get_index_path(bam_path: str):
     """
     Obtain path to bam index
@@ -153,7 +158,7 @@ def merge_bams( bams: list, output_path: str, threads: int=4 ):
     else:
         assert all((os.path.exists(bams[0]+'.bai') for bam in bams)), 'Only indexed files can be merged'
         if which('samtools') is None:
-            pysam.merge(output_path, *bams, f'-@ {threads} -f -p -c') #-c to only keep the same id once
+            pysam.merge('-@', str(threads), '-f', '-p', '-c', output_path, *bams) #-c to only keep the same id once
         else:
             # This above command can have issues...
             os.system(f'samtools merge {output_path} {" ".join(bams)} -@ {threads} -f -p -c')
@@ -695,13 +700,28 @@ def sort_and_index(
 class MapabilityReader(Prefetcher):
 
     def __init__(self, mapability_safe_file_path, read_all=False, dont_open=True):
+        """Obtain if restriction sites are uniquely mappable
+
+        Args:
+            mapability_safe_file_path (str) : path to a *.safe.bgzf file or to a mappability store
+                (*.mappability.store), both can be created using createMappabilityIndex.py
+
+            read_all (bool) : read the complete *.safe.bgzf file into memory, not used for mappability stores
+
+            dont_open (bool) : open the file when the first site is looked up
+        """
         self.args = locals().copy()
         self.handle = None
         del self.args['self']
         self.mapability_safe_file_path = mapability_safe_file_path
+        self.is_store = is_mappability_store(mapability_safe_file_path)
         if not dont_open:
-            self.handle = BlockZip(mapability_safe_file_path, 'r')
+            self.handle = self._open()
 
+    def _open(self):
+        if self.is_store:
+            return MappabilityStore(self.mapability_safe_file_path)
+        return BlockZip(self.mapability_safe_file_path, 'r')
 
     def instance(self, arg_update=None):
 
@@ -711,27 +731,36 @@ class MapabilityReader(Prefetcher):
         if arg_update is not None:
             self.args.update(arg_update)
 
-        clone = MapabilityReader(**self.args, dont_open=False)
+        clone = MapabilityReader(**dict(self.args, dont_open=False))
         return clone
 
         # Todo: exit statements
     def prefetch(self, contig, start, end):
-        clone = self.instance()
-        clone.handle.read_contig_to_cache( contig, region_start=start, region_end=end)
-        return clone
+        if self.is_store:
+            # The region shares the memory mapped arrays of the store, sites outside the region are still found
+            clone = copy(self)
+            if self.handle is None:
+                self.handle = self._open()
+            clone.handle = self.handle.region(contig, start, end)
+            return clone
+        # BlockZip caches complete contigs, a partially cached contig would report
+        # the sites of molecules extending outside of the region as not mappable
+        return self.instance()
 
 
     def __getitem__(self, contig_ds_strand):
         if self.handle is None:
-            self.handle = BlockZip(self.mapability_safe_file_path, 'r')
+            self.handle = self._open()
 
         contig, ds, strand = contig_ds_strand
+        if self.is_store:
+            return 'ok' if self.handle.site_is_mapable(contig, ds, strand) else None
         return self.handle[contig, ds, strand]
 
     def site_is_mapable(self, contig, ds, strand):
 
         if self.handle is None:
-            self.handle = BlockZip(self.mapability_safe_file_path, 'r')
+            self.handle = self._open()
 
         """ Obtain if a restriction site is mapable or not
         Args:
@@ -742,6 +771,8 @@ class MapabilityReader(Prefetcher):
         Returns:
             site_is_mapable (bool) : True when the site is uniquely mapable, False otherwise
         """
+        if self.is_store:
+            return self.handle.site_is_mapable(contig, ds, strand)
         if self.handle[contig, ds, strand] == 'ok':
             return True
         return False
@@ -991,6 +1022,45 @@ def replace_bam_header(origin_bam_path, header, target_bam_path=None, header_wri
 
 
 
+def write_bam_header_to_body(header, body_path, body_offset, target_path, remove_body=True):
+    """ Write a bam file consisting of the supplied header followed by the compressed records of an other bam file.
+
+    The BGZF blocks of the body are copied without decompressing them. This is used to set the
+    header of a bam file after writing the records, for example when the read groups are only
+    known after all records have been written.
+
+    Args:
+        header (dict or pysam.AlignmentHeader) : header to write
+
+        body_path (str) : path to bam file to copy the records from
+
+        body_offset (int) : compressed offset of the first record in body_path. When a
+            pysam.AlignmentFile is opened for writing, the header is written in separate
+            BGZF blocks and this offset is obtained by calling handle.tell()>>16 directly after opening the file.
+
+        target_path (str) : path to write the bam file to
+
+        remove_body (bool) : remove body_path afterwards
+
+    """
+    with pysam.AlignmentFile(target_path, 'wb', header=header):
+        pass
+
+    # Remove the end of file marker from the header-only bam file
+    # and append the blocks of the body, which end with an end of file marker
+    with open(target_path, 'r+b') as target, open(body_path, 'rb') as body:
+        target.seek(-len(BGZF_EOF), os.SEEK_END)
+        if target.read() != BGZF_EOF:
+            raise ValueError(f'{target_path} does not end with a BGZF end of file marker')
+        target.seek(-len(BGZF_EOF), os.SEEK_END)
+        target.truncate()
+        body.seek(body_offset)
+        copyfileobj(body, target)
+
+    if remove_body:
+        os.remove(body_path)
+
+
 def add_readgroups_to_header(
         origin_bam_path,
         readgroups_in,
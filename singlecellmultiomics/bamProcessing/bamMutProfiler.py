@@ -75,12 +75,13 @@ if __name__ == '__main__':
                             threads=threads,
                             live_update=False,
                             show_n_cells=None,
-                            update_interval=None )
+                            update_interval=None,
+                            as_frame=True )
     print(f"\rCreating count matrix [ {Fore.GREEN}OK{Style.RESET_ALL} ] ")
 
     if histplot is not None:
         print("Creating molecule histogram ... ",end="")
-        df = pd.DataFrame(counts).T.fillna(0)
+        df = counts
         fig, ax = plt.subplots()
         cell_sums = df.sum()
         cell_sums.name = 'Frequency'
@@ -95,7 +96,7 @@ if __name__ == '__main__':
 
     # Convert the count dictionary to a dataframe
     print("Filtering count matrix ... ", end="")
-    df = pd.DataFrame(counts).T.fillna(0)
+    df = counts
     # remove cells were the median is zero
     if args.norm_method=='median':
         try:
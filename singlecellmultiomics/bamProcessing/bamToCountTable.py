@@ -9,10 +9,15 @@ import argparse
 import pandas as pd
 import numpy as np
 import itertools
+import multiprocessing
 import singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods
+from singlecellmultiomics.countTableProcessing.sparseCountTable import SparseCountTable, is_sparse_count_table_path
 import gzip  # for loading blacklist bedfiles
 TagDefinitions = singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods.TagDefinitions
 
+# Contigs are split into shards of at most this size when counting in parallel
+SHARD_SIZE = 50_000_000
+
 
 def coordinate_to_sliding_bin_locations(dp, bin_size, sliding_increment):
     """
@@ -213,8 +218,8 @@ def assignReads(
         else:
             countToAdd = countToAdd
 
-    # Define what counts to add to what samples
-    # [ (sample, feature, increment), .. ]
+    # Define what counts to add to the sample
+    # [ (key, features, increment), .. ]
     count_increment = []
 
     feature_dict = {}
@@ -258,12 +263,7 @@ def assignReads(
                         'By value is not implemented for --splitFeatures')
 
                 else:
-                    count_increment.append({
-                        'key': tuple(joined_feature),
-                        'features': feature_dict,
-                        'samples': [sample],
-                        'increment': countToAdd})
-                    joined_feature[0]
+                    count_increment.append((tuple(joined_feature), feature_dict, countToAdd))
         else:
             if args.byValue is not None:
 
@@ -272,18 +272,10 @@ def assignReads(
                 except ValueError:
                     add = 0
 
-                count_increment.append({
-                    'key': tuple(joined_feature),
-                    'features': feature_dict,
-                    'samples': [sample],
-                    'increment': add})
+                count_increment.append((tuple(joined_feature), feature_dict, add))
 
             else:
-                count_increment.append({
-                    'key': tuple(joined_feature),
-                    'features': feature_dict,
-                    'samples': [sample],
-                    'increment': countToAdd})
+                count_increment.append((tuple(joined_feature), feature_dict, countToAdd))
     else:
         if args.bin is not None:
             raise NotImplementedError('Try using -joinedFeatureTags')
@@ -296,45 +288,24 @@ def assignReads(
                 except ValueError:
                     add = 0
 
-                count_increment.append({
-                    'key': tuple(joined_feature),
-                    'features': feature_dict,
-                    'samples': [sample],
-                    'increment': add})
+                count_increment.append((tuple(joined_feature), feature_dict, add))
 
             elif args.splitFeatures:
                 for f in value.split(args.featureDelimiter):
-                    count_increment.append({
-                        'key': (f),
-                        'features': {feature: f},
-                        'samples': [sample],
-                        'increment': countToAdd
-                    })
+                    count_increment.append(((f), {feature: f}, countToAdd))
 
             else:
-                count_increment.append({
-                    'key': (value, ),
-                    'features': {feature: value},
-                    'samples': [sample],
-                    'increment': countToAdd})
+                count_increment.append(((value, ), {feature: value}, countToAdd))
 
     """
-    Now we have a list of dicts:
-    {
-    'key':feature,
-    'features':{feature:value},
-    'samples':[sample],
-    'increment':countToAdd})
-    }
+    Now we have a list of tuples:
+    (feature, {feature:value}, countToAdd)
     """
 
     # increment the count table accordingly:
     if args.bin is not None:
-        for dtable in count_increment:
-            key = dtable['key']
-            countToAdd = dtable['increment']
-            samples = dtable['samples']
-            value_to_be_binned = dtable['features'].get(args.binTag, None)
+        for key, features, countToAdd in count_increment:
+            value_to_be_binned = features.get(args.binTag, None)
 
             if value_to_be_binned is None or value_to_be_binned == 'None':
                 continue
@@ -345,43 +316,127 @@ def assignReads(
                 if not args.keepOverBounds and (
                         start < 0 or end > args.ref_lengths[read.reference_name]):
                     continue
-                for sample in samples:
-                    countTable[sample][tuple(
-                        list(key) + [start, end])] += countToAdd
+                countTable.add(sample, tuple(list(key) + [start, end]), countToAdd)
 
     elif args.bedfile is not None:
 
-        for dtable in count_increment:
+        for key, features, countToAdd in count_increment:
             if args.byValue:
                 key = [args.byValue]
-            else:
-                key = dtable['key']
-            countToAdd = dtable['increment']
-            samples = dtable['samples']
 
             # Get features from bedfile
             start, end, bname = more_args[0], more_args[1], more_args[2]
             jfeat = tuple(list(key) + [start, end, bname])
             if len(key):
-                countTable[sample][jfeat] += countToAdd
+                countTable.add(sample, jfeat, countToAdd)
             # else: this will also emit non assigned reads
-            #    countTable[sample][ 'None' ] += countToAdd
+            #    countTable.add(sample, 'None', countToAdd)
 
     else:
-        for dtable in count_increment:
-            key = dtable['key']
-            countToAdd = dtable['increment']
-            samples = dtable['samples']
-
-            for sample in samples:
-                if len(key) == 1:
-                    countTable[sample][key[0]] += countToAdd
-                else:
-                    countTable[sample][key] += countToAdd
+        for key, features, countToAdd in count_increment:
+            if len(key) == 1:
+                countTable.add(sample, key[0], countToAdd)
+            else:
+                countTable.add(sample, key, countToAdd)
 
     return assigned
 
 
+def get_count_shards(args):
+    """Split the counting of the alignment files into shards, counting all shards in order
+    and adding the counts up yields exactly the same table as counting the files at once
+
+    Args:
+        args (argparse.Namespace) : create_count_table arguments
+
+    Returns:
+        shards (list) : [(bam path, contig, start, end, bed rows), ..], bed rows is None when no bed file is used.
+            Unmapped reads are never counted (see read_should_be_counted), the unmapped reads without
+            coordinate at the end of the files are not part of any shard
+    """
+    shards = []
+    for bamFile in args.alignmentfiles:
+        if args.bedfile is not None:
+            # Consecutive bed rows of the same contig, in order of the bed file
+            with open(args.bedfile, "r") as bfile:
+                rows = []
+                for row in bfile:
+                    parts = row.strip().split()
+                    chromo, start, end, bname = parts[0], int(float(
+                        parts[1])), int(float(parts[2])), parts[3]
+                    if args.contig is not None and chromo != args.contig:
+                        continue
+                    if len(rows) and rows[-1][0] != chromo:
+                        shards.append((bamFile, rows[0][0], None, None, rows))
+                        rows = []
+                    rows.append((chromo, start, end, bname))
+                if len(rows):
+                    shards.append((bamFile, rows[0][0], None, None, rows))
+            continue
+
+        with pysam.AlignmentFile(bamFile) as f:
+            mapped = {stat.contig: stat.mapped for stat in f.get_index_statistics()}
+            for contig, length in zip(f.references, f.lengths):
+                if (args.contig is not None and contig != args.contig) or mapped.get(contig, 1) == 0:
+                    continue
+                for start in range(0, length, SHARD_SIZE):
+                    shards.append((bamFile, contig, start, min(length, start + SHARD_SIZE), None))
+    return shards
+
+
+def count_shard(shard, args, joinFeatures, featureTags, sampleTags, blacklist_dic=None):
+    """Count the reads of a shard obtained from get_count_shards
+
+    Args:
+        shard (tuple) : (bam path, contig, start, end, bed rows)
+
+        args (argparse.Namespace) : create_count_table arguments
+
+    Returns:
+        countTable (SparseCountTable) : counts of the shard
+
+        assigned (int) : amount of assigned reads
+    """
+    bamFile, contig, shard_start, shard_end, bed_rows = shard
+    countTable = SparseCountTable()
+    assigned = 0
+    with pysam.AlignmentFile(bamFile) as f:
+        if args.bin:
+            args.ref_lengths = {
+                r: f.get_reference_length(r) for r in f.references}
+        if bed_rows is None:
+            for read in f.fetch(contig, shard_start, shard_end):
+                # Reads overlapping the start of the shard are counted by the previous shard
+                if read.reference_start < shard_start:
+                    continue
+                assigned += assignReads(read,
+                                        countTable,
+                                        args,
+                                        joinFeatures,
+                                        featureTags,
+                                        sampleTags,
+                                        blacklist_dic=blacklist_dic)
+        else:
+            for chromo, start, end, bname in bed_rows:
+                for read in f.fetch(chromo, start, end):
+                    assigned += assignReads(read,
+                                            countTable,
+                                            args,
+                                            joinFeatures,
+                                            featureTags,
+                                            sampleTags,
+                                            more_args=[start,
+                                                       end,
+                                                       bname],
+                                            blacklist_dic=blacklist_dic)
+    countTable.consolidate()
+    return countTable, assigned
+
+
+def _count_shard(job):
+    return count_shard(*job)
+
+
 def create_count_table(args, return_df=False):
 
     if len(args.alignmentfiles) == 0:
@@ -461,8 +516,7 @@ def create_count_table(args, return_df=False):
             "No features supplied! Please supply -featureTags -joinedFeatureTags and or -binTag")
 
     sampleTags = args.sampleTags.split(',')
-    countTable = collections.defaultdict(
-        collections.Counter)  # cell->feature->count
+    countTable = SparseCountTable()  # cell->feature->count
 
     if args.blacklist is not None:
         # create blacklist dictionary {chromosome : [ (start1, end1), ..., (startN, endN) ]}
@@ -483,97 +537,118 @@ def create_count_table(args, return_df=False):
         blacklist_dic = None
 
     assigned = 0
-    for bamFile in args.alignmentfiles:
-
-        with pysam.AlignmentFile(bamFile) as f:
-            i = 0  # make sure i is defined
-            if args.bin:
-                # Obtain the reference sequence lengths
-                ref_lengths = {
-                    r: f.get_reference_length(r) for r in f.references}
-                args.ref_lengths = ref_lengths
-            if args.bedfile is None:
-                # for adding counts associated with a tag OR with binning
-                if args.contig is not None:
-                    pysam_iterator = f.fetch(args.contig)
-                else:
-                    pysam_iterator = f
-
-                for i, read in enumerate(pysam_iterator):
-                    if i % 1_000_000 == 0:
-                        print(
-                            f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-
-                    if args.head is not None and i > args.head:
-                        break
-
-                    assigned += assignReads(read,
-                                            countTable,
-                                            args,
-                                            joinFeatures,
-                                            featureTags,
-                                            sampleTags,
-                                            blacklist_dic = blacklist_dic)
-            else:  # args.bedfile is not None
-                # for adding counts associated with a bedfile
-                with open(args.bedfile, "r") as bfile:
-                    #breader = csv.reader(bfile, delimiter = "\t")
-                    for row in bfile:
-
-                        parts = row.strip().split()
-                        chromo, start, end, bname = parts[0], int(float(
-                            parts[1])), int(float(parts[2])), parts[3]
-                        if args.contig is not None and chromo != args.contig:
-                            continue
-                        for i, read in enumerate(f.fetch(chromo, start, end)):
-                            if i % 1_000_000 == 0:
-                                print(
-                                    f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
-                            assigned += assignReads(read,
-                                                    countTable,
-                                                    args,
-                                                    joinFeatures,
-                                                    featureTags,
-                                                    sampleTags,
-                                                    more_args=[start,
-                                                               end,
-                                                               bname],
-                                                    blacklist_dic = blacklist_dic)
-
-                            if args.head is not None and i > args.head:
-                                break
+    threads = getattr(args, 't', None)
+    if threads is not None and threads > 1 and args.head is None:
+        # Count shards of the alignment files in parallel, the partial tables are merged in shard order
+        shards = get_count_shards(args)
+        with multiprocessing.Pool(threads) as workers:
+            for i, (shard_table, shard_assigned) in enumerate(workers.imap(
+                    _count_shard,
+                    ((shard, args, joinFeatures, featureTags, sampleTags, blacklist_dic) for shard in shards))):
+                countTable.update(shard_table)
+                assigned += shard_assigned
+                bamFile, contig, start, end, _ = shards[i]
+                print(f"{bamFile} Finished shard {i + 1}/{len(shards)} {contig}:{start}-{end}, assigned {assigned}")
+    else:
+        for bamFile in args.alignmentfiles:
 
-            print(
-                f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
+            with pysam.AlignmentFile(bamFile) as f:
+                i = 0  # make sure i is defined
+                if args.bin:
+                    # Obtain the reference sequence lengths
+                    ref_lengths = {
+                        r: f.get_reference_length(r) for r in f.references}
+                    args.ref_lengths = ref_lengths
+                if args.bedfile is None:
+                    # for adding counts associated with a tag OR with binning
+                    if args.contig is not None:
+                        pysam_iterator = f.fetch(args.contig)
+                    else:
+                        pysam_iterator = f
+
+                    for i, read in enumerate(pysam_iterator):
+                        if i % 1_000_000 == 0:
+                            print(
+                                f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+
+                        if args.head is not None and i > args.head:
+                            break
+
+                        assigned += assignReads(read,
+                                                countTable,
+                                                args,
+                                                joinFeatures,
+                                                featureTags,
+                                                sampleTags,
+                                                blacklist_dic = blacklist_dic)
+                else:  # args.bedfile is not None
+                    # for adding counts associated with a bedfile
+                    with open(args.bedfile, "r") as bfile:
+                        #breader = csv.reader(bfile, delimiter = "\t")
+                        for row in bfile:
+
+                            parts = row.strip().split()
+                            chromo, start, end, bname = parts[0], int(float(
+                                parts[1])), int(float(parts[2])), parts[3]
+                            if args.contig is not None and chromo != args.contig:
+                                continue
+                            for i, read in enumerate(f.fetch(chromo, start, end)):
+                                if i % 1_000_000 == 0:
+                                    print(
+                                        f"{bamFile} Processed {i} reads, assigned {assigned}, completion:{100*(i/(0.001+f.mapped+f.unmapped+f.nocoordinate))}%")
+                                assigned += assignReads(read,
+                                                        countTable,
+                                                        args,
+                                                        joinFeatures,
+                                                        featureTags,
+                                                        sampleTags,
+                                                        more_args=[start,
+                                                                   end,
+                                                                   bname],
+                                                        blacklist_dic = blacklist_dic)
+
+                                if args.head is not None and i > args.head:
+                                    break
+
+                print(
+                    f"Finished: {bamFile} Processed {i} reads, assigned {assigned}")
     print(f"Finished counting, now exporting to {args.o}")
-    df = pd.DataFrame.from_dict(countTable)
 
-    # Set names of indices
+    # Names of indices
+    column_names, index_names = None, None
     if not args.noNames:
-        df.columns.set_names([tagToHumanName(t, TagDefinitions)
-                              for t in sampleTags], inplace=True)
+        column_names = [tagToHumanName(t, TagDefinitions) for t in sampleTags]
+        if args.bin is not None:
+            index_names = [tagToHumanName(
+                t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end']
+        elif args.bedfile is not None:
+            index_names = [tagToHumanName(
+                t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end', 'bname']
+        elif joinFeatures:
+            index_names = [
+                tagToHumanName(
+                    t, TagDefinitions) for t in featureTags]
+        else:
+            index_names = ','.join(
+                [tagToHumanName(t, TagDefinitions) for t in featureTags])
+        print(index_names)
 
+    if not return_df and is_sparse_count_table_path(args.o):
+        # Write sparse output, the dense table is never constructed
         try:
-            if args.bin is not None:
-                index_names = [tagToHumanName(
-                    t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end']
-                df.index.set_names(index_names, inplace=True)
-            elif args.bedfile is not None:
-                index_names = [tagToHumanName(
-                    t, TagDefinitions) for t in featureTags if t != args.binTag] + ['start', 'end', 'bname']
-                df.index.set_names(index_names, inplace=True)
-            elif joinFeatures:
-                index_names = [
-                    tagToHumanName(
-                        t, TagDefinitions) for t in featureTags]
-                df.index.set_names(index_names, inplace=True)
-            else:
-                index_names = ','.join(
-                    [tagToHumanName(t, TagDefinitions) for t in featureTags])
-                df.index.set_names(index_names, inplace=True)
+            countTable.write(args.o, index_names=index_names, column_names=column_names)
+        except (ValueError, TypeError):
+            # The names do not match the levels of the features
+            countTable.write(args.o)
+        return args.o
+
+    df = countTable.to_dataframe()
+    if not args.noNames:
+        df.columns.set_names(column_names, inplace=True)
+        try:
+            df.index.set_names(index_names, inplace=True)
         except Exception as e:
             pass
-        print(index_names)
 
     if return_df:
         return df
@@ -593,7 +668,7 @@ if __name__ == '__main__':
     argparser.add_argument(
         '-o',
         type=str,
-        help="output csv path, or pandas dataframe if path ends with pickle.gz",
+        help="output csv path, or pandas dataframe if path ends with pickle.gz. Sparse outputs are written when the path ends with .npz, .mtx, .mtx.gz or .h5ad",
         required=False)
     argparser.add_argument(
         '-featureTags',
@@ -615,6 +690,10 @@ if __name__ == '__main__':
         '-head',
         type=int,
         help='Run the algorithm only on the first N reads to check if the result looks like what you expect.')
+    argparser.add_argument(
+        '-t',
+        type=int,
+        help='Amount of processes to count with, the alignment files are split per contig (or per contig in the bed file) which requires the alignment files to be indexed. Not used in combination with -head')
 
 
     argparser.add_argument(
@@ -12,7 +12,8 @@ from singlecellmultiomics.bamProcessing.bamBinCounts import generate_commands, c
 import argparse
 from colorama import Fore, Style
 from singlecellmultiomics.utils.export import dataframe_to_wig
-from singlecellmultiomics.methylation import MethylationCountMatrix
+from singlecellmultiomics.methylation import MethylationCountMatrix, SparseMethylationCountMatrix
+from singlecellmultiomics.methylation.methylationTable import MethylationTableWriter
 from singlecellmultiomics.bamProcessing.bamFunctions import get_reference_from_pysam_alignmentFile
 from colorama import Fore,Style
 
@@ -43,6 +44,9 @@ def get_methylation_count_matrix(bam_path,
                                  head: int=None,
                                  threads: int = None,
                                  count_reads: bool = True,
+                                 sparse: bool = False,
+                                 table_path: str = None,
+                                 accumulate: bool = True,
                                  **kwargs
                                  ):
 
@@ -53,7 +57,8 @@ def get_methylation_count_matrix(bam_path,
             'min_samples':min_samples,
             'min_variance':min_variance,
             'threads':threads,
-            'count_reads':count_reads
+            'count_reads':count_reads,
+            'sparse':sparse
             }
 
     all_kwargs.update(kwargs)
@@ -70,26 +75,39 @@ def get_methylation_count_matrix(bam_path,
     )
 
 
-    count_mat = MethylationCountMatrix()
+    count_mat = SparseMethylationCountMatrix() if sparse else MethylationCountMatrix()
     read_count_mat = dict()
 
+    # The jobs are generated in coordinate order, the results of every job are written to the table when available
+    table_writer = None if table_path is None else MethylationTableWriter(table_path)
+
     if threads==1:
         for command in commands:
             result, result_read_counts = count_methylation_binned(command)
             #result.prune(min_samples=min_samples, min_variance=min_variance)
-            count_mat.update( result )
+            if table_writer is not None:
+                table_writer.write_matrix(result)
+            if accumulate:
+                count_mat.update( result )
             if count_reads:
                 read_count_mat.update(result_read_counts)
 
     else:
         with multiprocessing.Pool(threads) as workers:
 
-            for result,result_read_counts in workers.imap_unordered(count_methylation_binned, commands):
+            for result,result_read_counts in (workers.imap_unordered if table_writer is None else workers.imap)(
+                    count_methylation_binned, commands):
                 #result.prune(min_samples=min_samples, min_variance=min_variance)
-                count_mat.update(result)
+                if table_writer is not None:
+                    table_writer.write_matrix(result)
+                if accumulate:
+                    count_mat.update(result)
                 if count_reads:
                     read_count_mat.update(result_read_counts)
 
+    if table_writer is not None:
+        table_writer.close()
+
     return count_mat, read_count_mat
 
 
@@ -108,6 +126,7 @@ if __name__ == '__main__':
 
     argparser.add_argument('--mirror_cpg_dyad',action='store_true', help='Count CpG methylation of a single dyad as one position')
     argparser.add_argument('--stranded',action='store_true', help='Perform strand specific methylation calls')
+    argparser.add_argument('--sparse',action='store_true', help='Store the methylation calls in sparse arrays instead of dictionaries, uses far less memory for large matrices, for example when -bin_size is 1')
 
 
     fi = argparser.add_argument_group("Filters")
@@ -136,6 +155,8 @@ if __name__ == '__main__':
     og.add_argument('-bismark_tabfile', type=str, help='Tabulated file to write to, contains: chr | start | end | unmethylated_counts | methylated_counts | beta_value')
     og.add_argument('-tabfile', type=str,
                     help='Tabulated file to write to, contains: chr | start | end | unmethylated_counts | methylated_counts | beta_value | variance | n_samples')
+    og.add_argument('-long_table', type=str,
+                    help='BGZF compressed, tabix indexed file to write the calls of every cell to, one row per location and cell: contig | pos | strand | cell | met | unmet. The calls are written while counting, for example calls.tsv.gz')
     og.add_argument('-distmat', type=str, help='CSV or pickle file to write single cell distance matrix to')
     og.add_argument('-distmat_plot', type=str, help='.PNG file to write distance matrix image to')
 
@@ -181,7 +202,13 @@ if __name__ == '__main__':
                                           reference_path=args.reference,
                                           dyad_mode=args.mirror_cpg_dyad,
                                           stranded=args.stranded,
-                                          count_reads=args.capture_read_depth is not None
+                                          count_reads=args.capture_read_depth is not None,
+                                          sparse=args.sparse,
+                                          table_path=args.long_table,
+                                          # Only keep all counts in memory when an output requires the matrix
+                                          accumulate=args.long_table is None or any(output is not None for output in (
+                                              args.betas, args.wig_beta, args.wig_n_samples, args.distmat,
+                                              args.distmat_plot, args.bismark_tabfile, args.tabfile))
 
     )
     print(f" [ {Fore.GREEN}OK{Style.RESET_ALL} ] ")
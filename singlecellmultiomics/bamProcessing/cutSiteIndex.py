@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import array
+import json
+import os
+import pysam
+import numpy as np
+from multiprocessing import Pool
+from singlecellmultiomics.utils.storeFolder import store_lock, write_store_folder
+
+# Increment when the layout of the index changes
+CUT_SITE_INDEX_VERSION = 1
+
+# Column name -> dtype, every row describes the first read (R1 or unpaired read) of a fragment
+CUT_SITE_COLUMNS = {
+    'position': np.int32,  # DS tag, or the start of R1 when the DS tag is missing
+    'strand': np.int8,  # 0: forward, 1: reverse
+    'sample': np.int32,  # index into the samples table
+    'flags': np.uint8,  # combination of FLAG_DUPLICATE, FLAG_QCFAIL and FLAG_MULTIMAPPED
+    'mapping_quality': np.uint8,
+    'allele': np.int32,  # index into the alleles table, -1 when no allele is assigned
+    'umi_count': np.int32  # amount of fragments associated to the molecule (af tag), 0 when unknown
+}
+
+FLAG_DUPLICATE = 1
+FLAG_QCFAIL = 2
+FLAG_MULTIMAPPED = 4
+
+# Maximum amount of rows in a single chunk
+CUT_SITE_CHUNK_SIZE = 500_000
+
+
+def get_cut_site_index_path(bam_path):
+    """Default location of the cut site index of a BAM file"""
+    return f'{bam_path}.cutsites'
+
+
+def _get_bam_stamp(bam_path):
+    stat = os.stat(bam_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _write_chunk(index_path, name, columns):
+    """Sort the rows of a chunk by position and write them compressed, returns the chunk description"""
+    rows = {column: np.frombuffer(values, dtype=CUT_SITE_COLUMNS[column]) if len(values) else
+            np.zeros(0, dtype=CUT_SITE_COLUMNS[column])
+            for column, values in columns.items()}
+    order = np.argsort(rows['position'], kind='stable')
+    np.savez_compressed(f'{index_path}/{name}.npz', **{column: values[order] for column, values in rows.items()})
+    return {'file': f'{name}.npz',
+            'rows': len(order),
+            'start': int(rows['position'][order[0]]),
+            'end': int(rows['position'][order[-1]]) + 1}
+
+
+def _new_chunk_columns():
+    return {column: array.array(np.dtype(dtype).char) for column, dtype in CUT_SITE_COLUMNS.items()}
+
+
+def _index_contig(args):
+    """
+    Write the chunks of a single contig
+
+    args:
+        args (tuple) : bam_path, index_path, contig, contig_index, chunk_size
+
+    Returns:
+        contig (str), description (dict) : chunks, samples and alleles of the contig
+    """
+    bam_path, index_path, contig, contig_index, chunk_size = args
+
+    samples = {}
+    alleles = {}
+    chunks = []
+    columns = _new_chunk_columns()
+    with pysam.AlignmentFile(bam_path) as alignments:
+        for read in alignments.fetch(contig):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                continue
+            if read.is_paired and not read.is_read1:
+                continue
+
+            if read.has_tag('DS'):
+                position = int(read.get_tag('DS'))
+            else:
+                position = read.reference_end if read.is_reverse else read.reference_start
+            if position is None:
+                continue
+
+            sample = read.get_tag('SM') if read.has_tag('SM') else 'No_Sample'
+            try:
+                sample_id = samples[sample]
+            except KeyError:
+                sample_id = samples[sample] = len(samples)
+
+            if read.has_tag('DA'):
+                allele = read.get_tag('DA')
+                try:
+                    allele_id = alleles[allele]
+                except KeyError:
+                    allele_id = alleles[allele] = len(alleles)
+            else:
+                allele_id = -1
+
+            flags = 0
+            if read.is_duplicate:
+                flags |= FLAG_DUPLICATE
+            if read.is_qcfail:
+                flags |= FLAG_QCFAIL
+            if read.has_tag('mp') and read.get_tag('mp') != 'unique':
+                flags |= FLAG_MULTIMAPPED
+
+            columns['position'].append(position)
+            columns['strand'].append(read.is_reverse)
+            columns['sample'].append(sample_id)
+            columns['flags'].append(flags)
+            columns['mapping_quality'].append(min(read.mapping_quality, 255))
+            columns['allele'].append(allele_id)
+            columns['umi_count'].append(read.get_tag('af') if read.has_tag('af') else 0)
+
+            if len(columns['position']) >= chunk_size:
+                chunks.append(_write_chunk(index_path, f'{contig_index}_{len(chunks)}', columns))
+                columns = _new_chunk_columns()
+
+    if len(columns['position']):
+        chunks.append(_write_chunk(index_path, f'{contig_index}_{len(chunks)}', columns))
+
+    return contig, {'chunks': chunks, 'samples': list(samples), 'alleles': list(alleles)}
+
+
+def write_cut_site_index(bam_path, index_path=None, threads=None, chunk_size=CUT_SITE_CHUNK_SIZE):
+    """
+    Write a columnar cut site index of a tagged BAM file, with one row per fragment:
+    the cut site, strand, sample, duplicate/qcfail/multimapping flags, mapping quality, allele and umi count.
+    Rows without FLAG_DUPLICATE are the molecules.
+
+    The index is a folder with the rows of every contig in compressed chunks sorted by position,
+    the position range of every chunk is stored in index.json. The index is written to a temporary folder which
+    is renamed when complete.
+
+    Args:
+        bam_path (str) : path to coordinate sorted and indexed BAM file
+
+        index_path (str) : path to write the index to, defaults to get_cut_site_index_path(bam_path)
+
+        threads (int) : amount of contigs to index in parallel
+
+        chunk_size (int) : maximum amount of rows per chunk
+
+    Returns:
+        index_path (str)
+    """
+    if index_path is None:
+        index_path = get_cut_site_index_path(bam_path)
+
+    with pysam.AlignmentFile(bam_path) as alignments:
+        contigs = [stat.contig for stat in alignments.get_index_statistics() if stat.mapped > 0]
+
+    def write(temp_path):
+        jobs = [(bam_path, temp_path, contig, contig_index, chunk_size)
+                for contig_index, contig in enumerate(contigs)]
+        if threads is not None and threads > 1:
+            with Pool(threads) as workers:
+                indexed = dict(workers.imap(_index_contig, jobs))
+        else:
+            indexed = dict(map(_index_contig, jobs))
+
+        with open(f'{temp_path}/index.json', 'w') as f:
+            json.dump({'version': CUT_SITE_INDEX_VERSION,
+                       'bam': _get_bam_stamp(bam_path),
+                       'contigs': {contig: indexed[contig] for contig in contigs if len(indexed[contig]['chunks'])}}, f)
+
+    write_store_folder(index_path, write)
+    return index_path
+
+
+class CutSiteIndex():
+    """Read access to a cut site index written by write_cut_site_index.
+
+    Example:
+        >>> index = CutSiteIndex('./tagged.bam.cutsites')
+        >>> rows = index.fetch('chr1', 0, 1_000_000, dedup=True)
+        >>> np.bincount(rows['sample'], minlength=len(index.samples))
+    """
+
+    def __init__(self, index_path, bam_path=None):
+        """Open a cut site index
+
+        Args:
+            index_path (str) : path to the index folder
+
+            bam_path (str) : BAM file the index was written for, a ValueError is raised when the BAM file
+                changed after writing the index. Defaults to the BAM file next to an index at the default location
+        """
+        self.index_path = index_path
+        with open(f'{index_path}/index.json') as f:
+            self.index = json.load(f)
+        if self.index.get('version') != CUT_SITE_INDEX_VERSION:
+            raise ValueError(f'{index_path} was written by an incompatible version, please re-create the index')
+
+        if bam_path is None and index_path.endswith('.cutsites') and \
+                os.path.exists(index_path[:-len('.cutsites')]):
+            bam_path = index_path[:-len('.cutsites')]
+        if bam_path is not None and self.index.get('bam') != _get_bam_stamp(bam_path):
+            raise ValueError(f'{bam_path} changed after writing {index_path}, please re-create the index')
+
+        # Samples and alleles are numbered per contig in the chunks, and share a single table for the whole index
+        sample_ids = {}
+        allele_ids = {}
+        self.sample_maps = {}
+        self.allele_maps = {}
+        for contig, description in self.index['contigs'].items():
+            self.sample_maps[contig] = np.array(
+                [sample_ids.setdefault(sample, len(sample_ids)) for sample in description['samples']], dtype=np.int32)
+            # The last element maps the missing allele (-1) to itself
+            self.allele_maps[contig] = np.array(
+                [allele_ids.setdefault(allele, len(allele_ids)) for allele in description['alleles']] + [-1],
+                dtype=np.int32)
+        self.samples = list(sample_ids)
+        self.alleles = list(allele_ids)
+
+    def get_contigs(self):
+        """Contigs with rows, in BAM order"""
+        return list(self.index['contigs'])
+
+    def fetch(self, contig, start=None, end=None, dedup=False, ignore_qcfail=False, min_mq=None,
+              unique_only=False, columns=None):
+        """
+        Obtain the rows of a contig or region, sorted by position
+
+        Args:
+            contig (str) : contig to fetch
+
+            start (int) : zero based start of the region, None to start at the start of the contig
+
+            end (int) : zero based end of the region (exclusive), None to fetch up to the end of the contig
+
+            dedup (bool) : only return molecules, rows flagged as duplicate are skipped
+
+            ignore_qcfail (bool) : skip rows flagged as qcfail
+
+            min_mq (int) : skip rows with a lower mapping quality
+
+            unique_only (bool) : skip rows flagged as multimapping
+
+            columns (list) : columns to return, all columns when None
+
+        Returns:
+            rows (dict) : column -> np.ndarray, the sample and allele columns index self.samples and self.alleles
+        """
+        if columns is None:
+            columns = list(CUT_SITE_COLUMNS)
+
+        description = self.index['contigs'].get(contig)
+        chunks = [] if description is None else [
+            chunk for chunk in description['chunks']
+            if (start is None or chunk['end'] > start) and (end is None or chunk['start'] < end)]
+
+        excluded_flags = (FLAG_DUPLICATE if dedup else 0) | (FLAG_QCFAIL if ignore_qcfail else 0) | \
+                         (FLAG_MULTIMAPPED if unique_only else 0)
+
+        selected = {column: [] for column in columns}
+        for chunk in chunks:
+            with np.load(f"{self.index_path}/{chunk['file']}") as stored:
+                positions = stored['position']
+                first = 0 if start is None else np.searchsorted(positions, start, 'left')
+                last = len(positions) if end is None else np.searchsorted(positions, end, 'left')
+                keep = np.ones(last - first, dtype=bool)
+                if excluded_flags:
+                    keep &= (stored['flags'][first:last] & excluded_flags) == 0
+                if min_mq is not None:
+                    keep &= stored['mapping_quality'][first:last] >= min_mq
+                for column in columns:
+                    selected[column].append(stored[column][first:last][keep])
+
+        rows = {column: np.concatenate(values) if len(values) else np.zeros(0, dtype=CUT_SITE_COLUMNS[column])
+                for column, values in selected.items()}
+
+        # Chunks are sorted, but the chunks can overlap
+        if len(chunks) > 1 and 'position' in rows:
+            order = np.argsort(rows['position'], kind='stable')
+            rows = {column: values[order] for column, values in rows.items()}
+
+        # Map the contig local sample and allele numbers to the tables of the index
+        if description is not None:
+            if 'sample' in rows:
+                rows['sample'] = self.sample_maps[contig][rows['sample']]
+            if 'allele' in rows:
+                rows['allele'] = self.allele_maps[contig][rows['allele']]
+        return rows
+
+
+def open_cut_site_index(bam_path, index_path=None, create=True, threads=None):
+    """Open the cut site index of a BAM file, the index is (re)built when it does not exist,
+    or when the BAM file changed after writing the index.
+
+    Args:
+        bam_path (str) : path to coordinate sorted and indexed BAM file
+
+        index_path (str) : path of the index, defaults to get_cut_site_index_path(bam_path)
+
+        create (bool) : build the index when it is missing or outdated, otherwise the error is raised
+
+        threads (int) : amount of contigs to index in parallel when building the index
+
+    Returns:
+        index (CutSiteIndex)
+    """
+    if index_path is None:
+        index_path = get_cut_site_index_path(bam_path)
+    try:
+        return CutSiteIndex(index_path, bam_path)
+    except (OSError, ValueError):
+        if not create:
+            raise
+    with store_lock(index_path):
+        # Another process could have built the index while waiting for the lock
+        try:
+            return CutSiteIndex(index_path, bam_path)
+        except (OSError, ValueError):
+            write_cut_site_index(bam_path, index_path, threads=threads)
+    return CutSiteIndex(index_path, bam_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Write a columnar cut site index of a tagged bam file')
+    argparser.add_argument('bamfile', type=str)
+    argparser.add_argument('-o', type=str, help='Output folder, defaults to the bam path with the extension .cutsites')
+    argparser.add_argument('-t', type=int, default=None, help='Threads')
+    args = argparser.parse_args()
+    write_cut_site_index(args.bamfile, args.o, threads=args.t)
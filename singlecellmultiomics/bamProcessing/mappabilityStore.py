@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import copy
+import json
+import os
+import numpy as np
+from singlecellmultiomics.utils.storeFolder import write_store_folder
+
+# Increment when the layout of the store changes
+MAPPABILITY_STORE_VERSION = 1
+
+# Mappability codes, stored in the upper bits of every code, the lowest bit is the strand
+MAPPABILITY_NOT_UNIQUE = 0
+MAPPABILITY_UNIQUE = 1
+
+
+def is_mappability_store(path):
+    """Check if path is a mappability store written by write_mappability_store"""
+    return os.path.isfile(f'{path}/index.json')
+
+
+def write_mappability_store(store_path, sites):
+    """
+    Write a mappability store: per contig the sorted positions of the restriction sites,
+    with for every site a code which packs the strand and the mappability of the site.
+    The store is a folder of .npy files which are memory mapped when reading,
+    it is written to a temporary folder which is renamed when complete.
+
+    Args:
+        store_path (str) : path to write the store to, for example simulated_CATG_single_69.mappability.store
+
+        sites (dict) : contig -> (positions, strands, codes), positions (np.ndarray) are zero based,
+            strands (np.ndarray) are booleans (False: FWD, True: REV), codes (np.ndarray) are
+            MAPPABILITY_UNIQUE or MAPPABILITY_NOT_UNIQUE. The contigs are stored in the order of the dictionary
+
+    Returns:
+        store_path (str)
+    """
+    contig_offsets = {}
+    all_positions = []
+    all_codes = []
+    offset = 0
+    for contig, (positions, strands, codes) in sites.items():
+        positions = np.asarray(positions, dtype=np.int64)
+        packed = (np.asarray(codes, dtype=np.uint8) << 1) | np.asarray(strands, dtype=np.uint8)
+        order = np.lexsort((packed & 1, positions))
+        all_positions.append(positions[order])
+        all_codes.append(packed[order])
+        contig_offsets[contig] = [offset, offset + len(order)]
+        offset += len(order)
+
+    def write(temp_path):
+        np.save(f'{temp_path}/positions.npy',
+                np.concatenate(all_positions) if all_positions else np.zeros(0, dtype=np.int64))
+        np.save(f'{temp_path}/codes.npy', np.concatenate(all_codes) if all_codes else np.zeros(0, dtype=np.uint8))
+        with open(f'{temp_path}/index.json', 'w') as f:
+            json.dump({'version': MAPPABILITY_STORE_VERSION, 'contigs': contig_offsets}, f)
+
+    write_store_folder(store_path, write)
+    return store_path
+
+
+def blockzip_to_mappability_store(safe_path, store_path):
+    """
+    Convert a *.safe.bgzf mappability file written by BlockZip to a mappability store,
+    all sites in the file are uniquely mappable
+
+    Args:
+        safe_path (str) : path to the *.safe.bgzf file
+
+        store_path (str) : path to write the store to
+
+    Returns:
+        store_path (str)
+    """
+    from singlecellmultiomics.utils import BlockZip
+    sites = {}
+    with BlockZip(safe_path, 'r') as safe:
+        for line in safe:
+            if len(line) == 0:
+                continue
+            contig, position, strand, value = safe.read_file_line(line)
+            if contig not in sites:
+                sites[contig] = ([], [])
+            sites[contig][0].append(position)
+            sites[contig][1].append(strand)
+    return write_mappability_store(store_path, {
+        contig: (positions, strands, np.full(len(positions), MAPPABILITY_UNIQUE))
+        for contig, (positions, strands) in sites.items()})
+
+
+class MappabilityStore():
+    """Read access to a mappability store written by write_mappability_store.
+    The arrays are memory mapped, a lookup is a binary search on the positions of the contig.
+
+    Example:
+        >>> store = MappabilityStore('./simulated_CATG_single_69.mappability.store')
+        >>> store.site_is_mapable('chr1', 3_000_592, False)
+        True
+    """
+
+    def __init__(self, store_path):
+        """Open a mappability store
+
+        Args:
+            store_path (str) : path to the store folder
+        """
+        self.store_path = store_path
+        with open(f'{store_path}/index.json') as f:
+            index = json.load(f)
+        if index.get('version') != MAPPABILITY_STORE_VERSION:
+            raise ValueError(f'{store_path} was written by an incompatible version, please re-create the store')
+        self.positions = np.load(f'{store_path}/positions.npy', mmap_mode='r')
+        self.codes = np.load(f'{store_path}/codes.npy', mmap_mode='r')
+        self.contig_offsets = {contig: tuple(offsets) for contig, offsets in index['contigs'].items()}
+        # Store of which this store is a region, used for look ups outside of the region
+        self.parent = None
+        self.contig = None
+        self.start = None
+        self.end = None
+
+    def __getstate__(self):
+        # The memory mapped arrays are opened again instead of copied when sending the store to another process
+        return {'store_path': self.store_path,
+                'region': None if self.parent is None else (self.contig, self.start, self.end)}
+
+    def __setstate__(self, state):
+        if state['region'] is None:
+            self.__init__(state['store_path'])
+        else:
+            self.__dict__.update(MappabilityStore(state['store_path']).region(*state['region']).__dict__)
+
+    def get_contigs(self):
+        """Contigs in the store"""
+        return list(self.contig_offsets)
+
+    def region(self, contig, start, end):
+        """Obtain a store limited to a region, which shares the memory mapped arrays with this store.
+        Sites outside of the region are looked up in the complete store.
+
+        Args:
+            contig (str) : contig of the region
+
+            start (int) : zero based start of the region
+
+            end (int) : zero based end of the region (exclusive)
+
+        Returns:
+            store (MappabilityStore)
+        """
+        if self.parent is not None:
+            # This store only holds the sites of its own region
+            return self.parent.region(contig, start, end)
+        first, last = self.contig_offsets.get(contig, (0, 0))
+        positions = self.positions[first:last]
+        first += int(np.searchsorted(positions, start, 'left'))
+        last = first + int(np.searchsorted(self.positions[first:last], end, 'left'))
+
+        region = copy.copy(self)
+        region.parent = self
+        region.positions = self.positions[first:last]
+        region.codes = self.codes[first:last]
+        region.contig_offsets = {contig: (0, last - first)}
+        region.contig = contig
+        region.start = start
+        region.end = end
+        return region
+
+    def get_code(self, contig, position, strand):
+        """
+        Obtain the mappability code of a site
+
+        Args:
+            contig (str) : contig of site to look up
+
+            position (int) : zero based coordinate of site to look up
+
+            strand (bool) : strand of site to look up (False: FWD, True: REV)
+
+        Returns:
+            code (int) : MAPPABILITY_UNIQUE or MAPPABILITY_NOT_UNIQUE, None when the site is not in the store
+        """
+        if position is None:
+            return None
+        if self.parent is not None and (contig not in self.contig_offsets or not self.start <= position < self.end):
+            return self.parent.get_code(contig, position, strand)
+        if contig not in self.contig_offsets:
+            return None
+        first, last = self.contig_offsets[contig]
+        i = first + int(np.searchsorted(self.positions[first:last], position, 'left'))
+        # Both strands of a site are stored next to each other
+        while i < last and self.positions[i] == position:
+            code = int(self.codes[i])
+            if (code & 1) == strand:
+                return code >> 1
+            i += 1
+        return None
+
+    def site_is_mapable(self, contig, position, strand):
+        """ Obtain if a restriction site is mapable or not
+        Args:
+            contig (str) : contig of site to look up
+            position (int) : zero based coordinate of site to look up
+            strand (bool) : strand of site to look up (False: FWD, True: REV)
+
+        Returns:
+            site_is_mapable (bool) : True when the site is uniquely mapable, False otherwise
+        """
+        return self.get_code(contig, position, strand) == MAPPABILITY_UNIQUE
+
+
+if __name__ == '__main__':
+    import argparse
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Convert a *.safe.bgzf mappability file to a memory mappable mappability store')
+    argparser.add_argument('safe_bgzf', type=str)
+    argparser.add_argument('-o', type=str, help='Output folder, defaults to the input path with the extension .store')
+    args = argparser.parse_args()
+    blockzip_to_mappability_store(args.safe_bgzf, args.o if args.o is not None else f'{args.safe_bgzf}.store')
@@ -1,307 +1,607 @@
-#!/usr/bin/env python3
-# -*- coding: utf-8 -*-
-import glob
-import logging
-from colorama import Fore
-from colorama import Back
-from colorama import Style
-import os
-import collections
-import itertools
-
-
-# http://codereview.stackexchange.com/questions/88912/create-a-list-of-all-strings-within-hamming-distance-of-a-reference-string-with
-def hamming_circle(s, n, alphabet):
-    for positions in itertools.combinations(range(len(s)), n):
-        for replacements in itertools.product(
-                range(len(alphabet) - 1), repeat=n):
-            cousin = list(s)
-            for p, r in zip(positions, replacements):
-                if cousin[p] == alphabet[r]:
-                    cousin[p] = alphabet[-1]
-                else:
-                    cousin[p] = alphabet[r]
-            yield ''.join(cousin)
-
-
-class BarcodeParser():
-
-    def __init__(
-            self,
-            barcodeDirectory='barcodes',
-            hammingDistanceExpansion=0,
-            spaceFill=False):
-
-        barcodeDirectory = os.path.join(
-            os.path.dirname(
-                os.path.realpath(__file__)),
-            barcodeDirectory)
-        barcode_files = list(glob.glob(f'{barcodeDirectory}/*'))
-
-        self.spaceFill = spaceFill
-        self.hammingDistanceExpansion = hammingDistanceExpansion
-        self.barcodes = collections.defaultdict(
-            dict)  # alias -> barcode -> index
-        # alias -> barcode -> (index, hammingDistance)
-        self.extendedBarcodes = collections.defaultdict(dict)
-
-        for barcodeFile in barcode_files:
-            barcodeFileAlias = os.path.splitext(
-                os.path.basename(barcodeFile))[0]
-            logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
-
-            # Decide the file type (index first or name first)
-            indexNotFirst = False
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        pass
-                    elif len(parts) == 2:
-                        indexFirst = not all((c in 'ATCGNX') for c in parts[0])
-                        if not indexFirst:
-                            indexNotFirst = True
-                        # print(parts[1],indexFirst)
-
-            with open(barcodeFile) as f:
-                for i, line in enumerate(f):
-                    parts = line.strip().split()
-                    if len(parts) == 1 and ' ' in line:
-                        parts = line.strip().split(' ')
-                    if len(parts) == 1:
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=parts[0], index=i)
-                        #self.barcodes[barcodeFileAlias][parts[0]] = i
-                        logging.info(
-                            f"\t{parts[0]}:{i} (No index specified in file)")
-                    elif len(parts) == 2:
-                        if indexNotFirst:
-                            barcode, index = parts
-                        else:
-                            index, barcode = parts
-                        #self.barcodes[barcodeFileAlias][barcode] = index
-
-                        # When the index is only digits, convert to integer
-                        try:
-                            if int(index)==int(str(int(index))):
-                                index = int(index)
-                            else:
-                                pass
-                        except Exception as e:
-                            pass
-                        self.addBarcode(
-                            barcodeFileAlias, barcode=barcode, index=index)
-                        logging.info(
-                            f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
-                    else:
-                        e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
-                        logging.error(e)
-                        raise ValueError(e)
-
-        if hammingDistanceExpansion > 0:
-            for alias in list(self.barcodes.keys()):
-                # print(alias)
-                self.expand(hammingDistanceExpansion, alias=alias)
-
-    def getTargetCount(self, barcodeFileAlias):
-        return(len(self.barcodes[barcodeFileAlias]), len(self.extendedBarcodes[barcodeFileAlias]))
-
-    def expand(
-            self,
-            hammingDistanceExpansion,
-            alias,
-            reportCollisions=True,
-            spaceFill=None):
-
-        barcodes = self.barcodes[alias]
-        # hammingBarcode -> ( ( distance,origin) )
-        hammingSpace = collections.defaultdict(list)
-        for barcode in barcodes:
-
-            for hammingDistance in range(0, hammingDistanceExpansion + 1):
-                for hammingInstance in hamming_circle(
-                        barcode, hammingDistance, 'ACTGN'):
-                    hammingSpace[hammingInstance].append(
-                        (hammingDistance, barcode))
-        # Resolve all
-        for hammingBarcode in hammingSpace:
-
-            # Check if there is a closest origin:
-            sortedDistances = sorted(hammingSpace[hammingBarcode])
-            if len(sortedDistances) > 1 and (
-                    sortedDistances[0][0] == sortedDistances[1][0]):
-                # We cannot resolve this, two or more origins are at the same distance:
-                #print('Cannot resolve %s' % hammingBarcode)
-                continue
-
-            hammingDistance, origin = sortedDistances[0]
-
-            self.addBarcode(
-                alias,
-                barcode=hammingBarcode,
-                index=self.barcodes[alias][origin],
-                hammingDistance=hammingDistance,
-                originBarcode=origin)
-
-    # Space fill fills all hamming instances, even if they are not resolvable
-    def expand_old(
-            self,
-            hammingDistanceExpansion,
-            alias,
-            reportCollisions=True,
-            spaceFill=None):
-
-        if spaceFill is None:
-            spaceFill = self.spaceFill
-        #print("Expanding Hamming distance %s" % alias)
-        hammingMatrix = {}
-        collisions = collections.Counter()
-        collisionsPerBarcode = {}
-        barcodes = self.barcodes[alias]
-
-        # Iterate all barcodes
-        for barcode in barcodes:
-            k = barcodes[barcode]
-            # Perform iteration per hamming distance
-            for hammingDistance in range(0, hammingDistanceExpansion + 1):
-                for hammingInstance in hamming_circle(
-                        barcode, hammingDistance, 'ACTGN'):
-                    if spaceFill:
-                        self.addBarcode(
-                            alias,
-                            barcode=hammingInstance,
-                            index=k,
-                            hammingDistance=hammingDistance,
-                            originBarcode=barcode)
-                        continue
-                    # The hamming instance is a hammingDistance mutation of the
-                    # current barcode
-                    if hammingInstance not in hammingMatrix:
-                        # The hamming Matrix contains [ mutatedBarcode ] = [
-                        # targetIndex, distance, [(originBarcode, targetIndex),
-                        # ... ], originBarcode]
-                        hammingMatrix[hammingInstance] = [
-                            k, hammingDistance, [(k, barcode)], barcode]
-                    else:
-                        # The means another barcode was already assigned to
-                        # this mutated version
-                        if k != hammingMatrix[hammingInstance][0]:
-                            collisions[hammingInstance] += 1
-                            hammingMatrix[hammingInstance][2].append(
-                                (k, barcode))
-                        else:  # There is no collision
-                            raise ValueError('This should never happen')
-                            continue
-                        # Getting here means there is a collision
-                        if hammingMatrix[hammingInstance][1] == hammingDistance:  # Collision
-                            # set collision
-                            hammingMatrix[hammingInstance][0] = None
-                        # Maybe there is a collision, but one barcode is
-                        # further away than the other:
-                        elif hammingMatrix[hammingInstance][1] > hammingDistance:
-
-                            hammingMatrix[hammingInstance][0] = k
-                            hammingMatrix[hammingInstance][1] = hammingDistance
-                            hammingMatrix[hammingInstance][3] = barcode
-
-        if sum(collisions.values()) > 0 and reportCollisions:
-            print("%s%s collisions for %s in Hamming space: %s" %
-                  (Fore.RED, sum(collisions.values()), alias, Style.RESET_ALL))
-            # for hammingDistance in range(0, args.hd+1):
-            #    print("%s %s collisions" % (hammingDistance,collisions[hammingDistance]))
-            showCollisions = 20
-            shown = 0
-            totalCollisions = 0
-            for idx, hammingInstance in enumerate(hammingMatrix):
-                assignedSample, hammingDistance, collidingSamples, origin = hammingMatrix[
-                    hammingInstance]
-                if len(collidingSamples) > 1:
-                    if shown < showCollisions:
-                        print(
-                            "%s\t%sat%s %s %sdistance%s %s" %
-                            (",".join(
-                                [
-                                    "%s%s[%s]%s" %
-                                    (Fore.GREEN if x[0] is assignedSample else Fore.RED,
-                                     x[0],
-                                        x[1],
-                                        Style.RESET_ALL) for x in collidingSamples]),
-                                Style.DIM,
-                                Style.RESET_ALL,
-                                hammingInstance,
-                                Style.DIM,
-                                Style.RESET_ALL,
-                                hammingDistance))
-                        shown += 1
-                    totalCollisions += 1
-            if totalCollisions > showCollisions:
-                print(('%s more ...\n' % (totalCollisions - shown)))
-
-        if not spaceFill:
-            mapping = {}  # @todo: we don't need this variable anymore
-            for sequence in hammingMatrix:
-                if hammingMatrix[sequence][0] is not None:
-                    mapping[sequence] = hammingMatrix[sequence][0]
-                    self.addBarcode(
-                        alias,
-                        barcode=sequence,
-                        index=hammingMatrix[sequence][0],
-                        hammingDistance=hammingMatrix[sequence][1],
-                        originBarcode=hammingMatrix[sequence][3])
-
-        # Show a couple of barcodes
-        if False:
-            print(('\n%s hamming extended barcodes will be used for demultiplexing strategy %s' % (
-                len(mapping), alias)))
-            if len(mapping):
-                showBarcodes = 7
-                for bcId in list(mapping.keys())[:showBarcodes]:
-                    print(('%s%s%s → %s%s' % (Fore.GREEN, bcId,
-                                              Fore.WHITE, mapping[bcId], Style.RESET_ALL)))
-                if len(mapping) > showBarcodes:
-                    print(('%s more ...\n' % (len(mapping) - showBarcodes)))
-
-    def addBarcode(
-            self,
-            barcodeFileAlias,
-            barcode,
-            index,
-            hammingDistance=0,
-            originBarcode=None):
-        if hammingDistance == 0:
-            self.barcodes[barcodeFileAlias][barcode] = index
-        else:
-            if originBarcode is None:
-                raise ValueError()
-            self.extendedBarcodes[barcodeFileAlias][barcode] = (
-                index, originBarcode, hammingDistance)
-
-    # get index and hamming distance to barcode  returns none if not Available
-    def getIndexCorrectedBarcodeAndHammingDistance(self, barcode, alias):
-        if barcode in self.barcodes[alias]:
-            return (self.barcodes[alias][barcode], barcode, 0)
-        if barcode in self.extendedBarcodes[alias]:
-            return self.extendedBarcodes[alias][barcode]
-        return (None, None, None)
-
-    def list(self, showBarcodes=5):  # showBarcodes=None show all
-        for barcodeAlias, mapping in self.barcodes.items():
-            print(
-                f'{len(mapping)} barcodes{Style.DIM} obtained from {Style.RESET_ALL}{barcodeAlias}')
-            if len(mapping):
-                for bcId in list(mapping.keys())[:showBarcodes]:
-                    try:
-                        print(('%s%s%s%s%s%s' % (Fore.GREEN, bcId,
-                                                 Fore.WHITE, '→', mapping[bcId], Style.RESET_ALL)))
-                    except Exception as e:
-                        print(('%s%s%s%s%s%s' % (Fore.GREEN, bcId,
-                                                 Fore.WHITE, '->', mapping[bcId], Style.RESET_ALL)))
-                if showBarcodes is not None and len(mapping) > showBarcodes:
-                    print(
-                        f'{Style.DIM} %s more ...\n{Style.RESET_ALL}' %
-                        (len(mapping) - showBarcodes))
-
-    def getBarcodeMapping(self):
-        return self.barcodes
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import glob
+import hashlib
+import logging
+from colorama import Fore
+from colorama import Back
+from colorama import Style
+import os
+import collections
+import itertools
+import numpy as np
+
+# Barcodes are packed into integers using 3 bits per base, the codes start at 1
+# so barcodes of different lengths never share a packed value
+# Characters which int() would accept are made invalid
+_NON_BASE_CHARACTERS = '01234567+-_ \t\r\n'
+BARCODE_PACK_TRANSLATION = str.maketrans(
+    'ACGTN' + _NON_BASE_CHARACTERS, '12345' + 'x' * len(_NON_BASE_CHARACTERS))
+MAX_PACKED_BARCODE_LENGTH = 21  # 63 bits
+# Maximum amount of looked up sequences memoized per correction index
+LOOKUP_CACHE_SIZE = 1_000_000
+
+
+def get_default_cache_directory():
+    """Folder in the user cache directory in which the barcode correction indices are stored"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                        'singlecellmultiomics', 'barcode_indices')
+
+
+# http://codereview.stackexchange.com/questions/88912/create-a-list-of-all-strings-within-hamming-distance-of-a-reference-string-with
+def hamming_circle(s, n, alphabet):
+    for positions in itertools.combinations(range(len(s)), n):
+        for replacements in itertools.product(
+                range(len(alphabet) - 1), repeat=n):
+            cousin = list(s)
+            for p, r in zip(positions, replacements):
+                if cousin[p] == alphabet[r]:
+                    cousin[p] = alphabet[-1]
+                else:
+                    cousin[p] = alphabet[r]
+            yield ''.join(cousin)
+
+
+def pack_barcode(barcode):
+    """Pack a barcode into an integer, 3 bits per base (A:1, C:2, G:3, T:4, N:5)
+
+    Args:
+        barcode (str) : barcode sequence
+
+    Returns:
+        packed (int) : packed barcode or None when the barcode contains other characters than ACGTN or is too long
+    """
+    if len(barcode) > MAX_PACKED_BARCODE_LENGTH:
+        return None
+    try:
+        return int(barcode.translate(BARCODE_PACK_TRANSLATION), 8)
+    except ValueError:
+        return None
+
+
+class BarcodeCorrectionIndex():
+    """Sorted array of all sequences within a Hamming distance of a set of barcodes.
+
+    Every sequence in the Hamming space is stored once as a packed integer together
+    with its closest origin barcode, the distance to that barcode and an ambiguity flag
+    which is set when two or more origin barcodes are at the same distance.
+    This is equivalent to BarcodeParser.expand, but is built vectorised and can be
+    stored to and loaded from disk.
+    """
+
+    def __init__(self, barcodes, keys, origins, distances, ambiguous):
+        """Initialise BarcodeCorrectionIndex, use BarcodeCorrectionIndex.build to construct an index
+
+        Args:
+            barcodes (list) : origin barcodes
+
+            keys (np.ndarray) : sorted packed sequences (uint64)
+
+            origins (np.ndarray) : index into barcodes of the closest origin per key
+
+            distances (np.ndarray) : Hamming distance to the closest origin per key
+
+            ambiguous (np.ndarray) : boolean, True when the key can not be resolved to a single origin
+        """
+        self.barcodes = list(barcodes)
+        self.keys = keys
+        self.origins = origins
+        self.distances = distances
+        self.ambiguous = ambiguous
+        # Memoization of looked up sequences, at most LOOKUP_CACHE_SIZE sequences are kept
+        self.cache = {}
+
+    @classmethod
+    def build(cls, barcodes, hammingDistanceExpansion):
+        """Build the correction index
+
+        Args:
+            barcodes (iterable) : barcode sequences, can only contain ACGTN
+
+            hammingDistanceExpansion (int) : maximum Hamming distance to expand to
+
+        Returns:
+            index (BarcodeCorrectionIndex) or None when not all barcodes can be packed
+        """
+        barcodes = list(barcodes)
+        if any(pack_barcode(barcode) is None for barcode in barcodes):
+            return None
+
+        # Replacement codes for every code: all codes of ACGTN except itself
+        replacements = np.array([[0, 0, 0, 0]] + [
+            [r for r in range(1, 6) if r != code] for code in range(1, 6)],
+            dtype=np.int64)
+
+        keys, origins, distances = [], [], []
+        by_length = collections.defaultdict(list)
+        for origin, barcode in enumerate(barcodes):
+            by_length[len(barcode)].append(origin)
+
+        for length, length_origins in by_length.items():
+            length_origins = np.array(length_origins, dtype=np.int64)
+            codes = np.array([
+                [int(c) for c in barcodes[origin].translate(BARCODE_PACK_TRANSLATION)]
+                for origin in length_origins], dtype=np.int64).reshape(-1, length)
+            shifts = 3 * np.arange(length - 1, -1, -1, dtype=np.int64)
+            packed = (codes << shifts).sum(1)
+
+            for hammingDistance in range(0, min(hammingDistanceExpansion, length) + 1):
+                for positions in itertools.combinations(range(length), hammingDistance):
+                    positions = list(positions)
+                    # Difference in packed value for every replacement at every position
+                    deltas = [(replacements[codes[:, p]] - codes[:, p, None]) << shifts[p]
+                              for p in positions]
+                    for replacement in itertools.product(range(4), repeat=hammingDistance):
+                        key = packed.copy()
+                        for delta, r in zip(deltas, replacement):
+                            key += delta[:, r]
+                        keys.append(key)
+                        origins.append(length_origins)
+                        distances.append(np.full(len(key), hammingDistance, dtype=np.uint8))
+
+        if len(keys) == 0:
+            empty = np.zeros(0, dtype=np.uint64)
+            return cls(barcodes, empty, empty.astype(np.int32), empty.astype(np.uint8), empty.astype(bool))
+
+        keys = np.concatenate(keys).astype(np.uint64)
+        origins = np.concatenate(origins).astype(np.int32)
+        distances = np.concatenate(distances)
+
+        # Sort on key, then distance, the first entry of every key is the closest origin
+        order = np.lexsort((distances, keys))
+        keys, origins, distances = keys[order], origins[order], distances[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        # Ambiguous when the next entry has the same key and the same distance
+        tie = np.zeros(len(keys), dtype=bool)
+        tie[:-1] = (keys[1:] == keys[:-1]) & (distances[1:] == distances[:-1])
+
+        return cls(barcodes, keys[first], origins[first], distances[first], tie[first])
+
+    def lookup(self, barcode):
+        """Obtain the closest origin barcode
+
+        Args:
+            barcode (str) : sequence to correct
+
+        Returns:
+            origin (str) : closest origin barcode, None when not in the Hamming space or ambiguous
+
+            hammingDistance (int) : distance to the origin barcode, None when not resolved
+        """
+        try:
+            return self.cache[barcode]
+        except KeyError:
+            pass
+
+        result = (None, None)
+        key = pack_barcode(barcode)
+        if key is not None:
+            i = np.searchsorted(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key and not self.ambiguous[i]:
+                result = (self.barcodes[self.origins[i]], int(self.distances[i]))
+        if len(self.cache) >= LOOKUP_CACHE_SIZE:
+            # Forget the sequence which was looked up first
+            del self.cache[next(iter(self.cache))]
+        self.cache[barcode] = result
+        return result
+
+    def extended_count(self):
+        """Amount of resolvable sequences which are not an exact barcode"""
+        return int(((self.distances > 0) & ~self.ambiguous).sum())
+
+    def write(self, path):
+        """Write the index to a .npz file, the file is replaced atomically
+
+        Args:
+            path (str) : path to write to, should end with .npz
+        """
+        temp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temp_path,
+                 barcodes=np.array(self.barcodes, dtype=str),
+                 keys=self.keys,
+                 origins=self.origins,
+                 distances=self.distances,
+                 ambiguous=self.ambiguous)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def read(cls, path, barcodes=None):
+        """Read an index written by BarcodeCorrectionIndex.write
+
+        Args:
+            path (str) : path to read from
+
+            barcodes (list) : when supplied, the index is only returned when it was built for exactly these barcodes
+
+        Returns:
+            index (BarcodeCorrectionIndex) or None when the index does not match the barcodes
+        """
+        with np.load(path) as data:
+            stored_barcodes = data['barcodes'].tolist()
+            if barcodes is not None and stored_barcodes != list(barcodes):
+                return None
+            return cls(stored_barcodes, data['keys'], data['origins'], data['distances'], data['ambiguous'])
+
+
+class BarcodeMapping(dict):
+    """alias -> barcode -> index mapping of a BarcodeParser, the barcode file
+    of an alias is parsed when the alias is first accessed"""
+
+    def __init__(self, barcodeParser):
+        dict.__init__(self)
+        self.barcodeParser = barcodeParser
+
+    def __missing__(self, alias):
+        self[alias] = {}
+        if alias in self.barcodeParser.barcodeFiles:
+            self.barcodeParser.parseBarcodeFile(alias)
+        return self[alias]
+
+
+class BarcodeParser():
+
+    def __init__(
+            self,
+            barcodeDirectory='barcodes',
+            hammingDistanceExpansion=0,
+            spaceFill=False,
+            cacheDirectory=None):
+        """Initialise BarcodeParser
+
+        Args:
+            barcodeDirectory (str) : folder with barcode files, relative to the folder of this module
+
+            hammingDistanceExpansion (int) : maximum Hamming distance to correct barcodes for
+
+            spaceFill (bool) : see expand_old
+
+            cacheDirectory (str) : folder to store the correction indices in, defaults to get_default_cache_directory()
+        """
+
+        barcodeDirectory = os.path.join(
+            os.path.dirname(
+                os.path.realpath(__file__)),
+            barcodeDirectory)
+        barcode_files = list(glob.glob(f'{barcodeDirectory}/*'))
+
+        self.spaceFill = spaceFill
+        self.hammingDistanceExpansion = hammingDistanceExpansion
+        # alias -> barcode -> index, barcode files are parsed on first access of their alias
+        self.barcodes = BarcodeMapping(self)
+        # alias -> barcode -> (index, hammingDistance)
+        self.extendedBarcodes = collections.defaultdict(dict)
+        # alias -> BarcodeCorrectionIndex, built on first use of the alias
+        self.correctionIndices = {}
+        self.cacheDirectory = get_default_cache_directory() if cacheDirectory is None else cacheDirectory
+        # alias -> path of the barcode file
+        self.barcodeFiles = {}
+        for barcodeFile in barcode_files:
+            barcodeFileAlias = os.path.splitext(
+                os.path.basename(barcodeFile))[0]
+            self.barcodeFiles[barcodeFileAlias] = barcodeFile
+
+        # The Hamming expansion of the aliases is performed lazily, see getCorrectionIndex
+
+    def parseBarcodeFile(self, barcodeFileAlias):
+        """Parse the barcode file of barcodeFileAlias. This is performed
+        automatically when the alias is first accessed in self.barcodes
+
+        Args:
+            barcodeFileAlias (str) : alias of the barcode file
+        """
+        barcodeFile = self.barcodeFiles[barcodeFileAlias]
+        logging.info(f"Parsing {barcodeFile}, alias {barcodeFileAlias}")
+
+        # Decide the file type (index first or name first)
+        indexNotFirst = False
+        with open(barcodeFile) as f:
+            for i, line in enumerate(f):
+                parts = line.strip().split()
+                if len(parts) == 1 and ' ' in line:
+                    parts = line.strip().split(' ')
+                if len(parts) == 1:
+                    pass
+                elif len(parts) == 2:
+                    indexFirst = not all((c in 'ATCGNX') for c in parts[0])
+                    if not indexFirst:
+                        indexNotFirst = True
+                    # print(parts[1],indexFirst)
+
+        with open(barcodeFile) as f:
+            for i, line in enumerate(f):
+                parts = line.strip().split()
+                if len(parts) == 1 and ' ' in line:
+                    parts = line.strip().split(' ')
+                if len(parts) == 1:
+                    self.addBarcode(
+                        barcodeFileAlias, barcode=parts[0], index=i)
+                    #self.barcodes[barcodeFileAlias][parts[0]] = i
+                    logging.info(
+                        f"\t{parts[0]}:{i} (No index specified in file)")
+                elif len(parts) == 2:
+                    if indexNotFirst:
+                        barcode, index = parts
+                    else:
+                        index, barcode = parts
+                    #self.barcodes[barcodeFileAlias][barcode] = index
+
+                    # When the index is only digits, convert to integer
+                    try:
+                        if int(index)==int(str(int(index))):
+                            index = int(index)
+                        else:
+                            pass
+                    except Exception as e:
+                        pass
+                    self.addBarcode(
+                        barcodeFileAlias, barcode=barcode, index=index)
+                    logging.info(
+                        f"\t{barcode}:{index} (index was specified in file, {'index' if indexFirst else 'barcode'} on first column)")
+                else:
+                    e = f'The barcode file {barcodeFile} contains more than two columns. Failed to parse!'
+                    logging.error(e)
+                    raise ValueError(e)
+
+    def getCorrectionIndex(self, alias):
+        """Obtain the Hamming correction index for the barcodes of alias, the index
+        is built on first use and stored in self.cacheDirectory, subsequent runs load the stored index.
+
+        Args:
+            alias (str) : barcode file alias
+
+        Returns:
+            index (BarcodeCorrectionIndex) or None when no Hamming expansion is performed
+        """
+        if self.hammingDistanceExpansion <= 0:
+            return None
+        if alias in self.correctionIndices:
+            return self.correctionIndices[alias]
+
+        barcodes = list(self.barcodes[alias].keys())
+        index = None
+        cachePath = None
+        if alias in self.barcodeFiles:
+            barcodeFile = os.path.abspath(self.barcodeFiles[alias])
+            # Barcode files with the same name in other folders get their own index
+            folder = hashlib.sha1(os.path.dirname(barcodeFile).encode()).hexdigest()[:10]
+            cachePath = os.path.join(
+                self.cacheDirectory,
+                f'{os.path.basename(barcodeFile)}.{folder}.hd{self.hammingDistanceExpansion}.npz')
+            if os.path.exists(cachePath):
+                try:
+                    index = BarcodeCorrectionIndex.read(cachePath, barcodes=barcodes)
+                except Exception as e:
+                    logging.warning(f'Failed to read {cachePath}: {e}')
+
+        if index is None:
+            index = BarcodeCorrectionIndex.build(barcodes, self.hammingDistanceExpansion)
+            if index is None:
+                # The barcodes contain other characters than ACGTN
+                self.expand(self.hammingDistanceExpansion, alias=alias)
+            elif cachePath is not None:
+                try:
+                    os.makedirs(self.cacheDirectory, exist_ok=True)
+                    index.write(cachePath)
+                except OSError as e:
+                    logging.info(f'Not storing the barcode correction index at {cachePath}: {e}')
+
+        self.correctionIndices[alias] = index
+        return index
+
+    def getTargetCount(self, barcodeFileAlias):
+        index = self.getCorrectionIndex(barcodeFileAlias)
+        return(len(self.barcodes[barcodeFileAlias]),
+               len(self.extendedBarcodes[barcodeFileAlias]) + (0 if index is None else index.extended_count()))
+
+    def expand(
+            self,
+            hammingDistanceExpansion,
+            alias,
+            reportCollisions=True,
+            spaceFill=None):
+
+        barcodes = self.barcodes[alias]
+        # hammingBarcode -> ( ( distance,origin) )
+        hammingSpace = collections.defaultdict(list)
+        for barcode in barcodes:
+
+            for hammingDistance in range(0, hammingDistanceExpansion + 1):
+                for hammingInstance in hamming_circle(
+                        barcode, hammingDistance, 'ACTGN'):
+                    hammingSpace[hammingInstance].append(
+                        (hammingDistance, barcode))
+        # Resolve all
+        for hammingBarcode in hammingSpace:
+
+            # Check if there is a closest origin:
+            sortedDistances = sorted(hammingSpace[hammingBarcode])
+            if len(sortedDistances) > 1 and (
+                    sortedDistances[0][0] == sortedDistances[1][0]):
+                # We cannot resolve this, two or more origins are at the same distance:
+                #print('Cannot resolve %s' % hammingBarcode)
+                continue
+
+            hammingDistance, origin = sortedDistances[0]
+
+            self.addBarcode(
+                alias,
+                barcode=hammingBarcode,
+                index=self.barcodes[alias][origin],
+                hammingDistance=hammingDistance,
+                originBarcode=origin)
+
+    # Space fill fills all hamming instances, even if they are not resolvable
+    def expand_old(
+            self,
+            hammingDistanceExpansion,
+            alias,
+            reportCollisions=True,
+            spaceFill=None):
+
+        if spaceFill is None:
+            spaceFill = self.spaceFill
+        #print("Expanding Hamming distance %s" % alias)
+        hammingMatrix = {}
+        collisions = collections.Counter()
+        collisionsPerBarcode = {}
+        barcodes = self.barcodes[alias]
+
+        # Iterate all barcodes
+        for barcode in barcodes:
+            k = barcodes[barcode]
+            # Perform iteration per hamming distance
+            for hammingDistance in range(0, hammingDistanceExpansion + 1):
+                for hammingInstance in hamming_circle(
+                        barcode, hammingDistance, 'ACTGN'):
+                    if spaceFill:
+                        self.addBarcode(
+                            alias,
+                            barcode=hammingInstance,
+                            index=k,
+                            hammingDistance=hammingDistance,
+                            originBarcode=barcode)
+                        continue
+                    # The hamming instance is a hammingDistance mutation of the
+                    # current barcode
+                    if hammingInstance not in hammingMatrix:
+                        # The hamming Matrix contains [ mutatedBarcode ] = [
+                        # targetIndex, distance, [(originBarcode, targetIndex),
+                        # ... ], originBarcode]
+                        hammingMatrix[hammingInstance] = [
+                            k, hammingDistance, [(k, barcode)], barcode]
+                    else:
+                        # The means another barcode was already assigned to
+                        # this mutated version
+                        if k != hammingMatrix[hammingInstance][0]:
+                            collisions[hammingInstance] += 1
+                            hammingMatrix[hammingInstance][2].append(
+                                (k, barcode))
+                        else:  # There is no collision
+                            raise ValueError('This should never happen')
+                            continue
+                        # Getting here means there is a collision
+                        if hammingMatrix[hammingInstance][1] == hammingDistance:  # Collision
+                            # set collision
+                            hammingMatrix[hammingInstance][0] = None
+                        # Maybe there is a collision, but one barcode is
+                        # further away than the other:
+                        elif hammingMatrix[hammingInstance][1] > hammingDistance:
+
+                            hammingMatrix[hammingInstance][0] = k
+                            hammingMatrix[hammingInstance][1] = hammingDistance
+                            hammingMatrix[hammingInstance][3] = barcode
+
+        if sum(collisions.values()) > 0 and reportCollisions:
+            print("%s%s collisions for %s in Hamming space: %s" %
+                  (Fore.RED, sum(collisions.values()), alias, Style.RESET_ALL))
+            # for hammingDistance in range(0, args.hd+1):
+            #    print("%s %s collisions" % (hammingDistance,collisions[hammingDistance]))
+            showCollisions = 20
+            shown = 0
+            totalCollisions = 0
+            for idx, hammingInstance in enumerate(hammingMatrix):
+                assignedSample, hammingDistance, collidingSamples, origin = hammingMatrix[
+                    hammingInstance]
+                if len(collidingSamples) > 1:
+                    if shown < showCollisions:
+                        print(
+                            "%s\t%sat%s %s %sdistance%s %s" %
+                            (",".join(
+                                [
+                                    "%s%s[%s]%s" %
+                                    (Fore.GREEN if x[0] is assignedSample else Fore.RED,
+                                     x[0],
+                                        x[1],
+                                        Style.RESET_ALL) for x in collidingSamples]),
+                                Style.DIM,
+                                Style.RESET_ALL,
+                                hammingInstance,
+                                Style.DIM,
+                                Style.RESET_ALL,
+                                hammingDistance))
+                        shown += 1
+                    totalCollisions += 1
+            if totalCollisions > showCollisions:
+                print(('%s more ...\n' % (totalCollisions - shown)))
+
+        if not spaceFill:
+            mapping = {}  # @todo: we don't need this variable anymore
+            for sequence in hammingMatrix:
+                if hammingMatrix[sequence][0] is not None:
+                    mapping[sequence] = hammingMatrix[sequence][0]
+                    self.addBarcode(
+                        alias,
+                        barcode=sequence,
+                        index=hammingMatrix[sequence][0],
+                        hammingDistance=hammingMatrix[sequence][1],
+                        originBarcode=hammingMatrix[sequence][3])
+
+        # Show a couple of barcodes
+        if False:
+            print(('\n%s hamming extended barcodes will be used for demultiplexing strategy %s' % (
+                len(mapping), alias)))
+            if len(mapping):
+                showBarcodes = 7
+                for bcId in list(mapping.keys())[:showBarcodes]:
+                    print(('%s%s%s → %s%s' % (Fore.GREEN, bcId,
+                                              Fore.WHITE, mapping[bcId], Style.RESET_ALL)))
+                if len(mapping) > showBarcodes:
+                    print(('%s more ...\n' % (len(mapping) - showBarcodes)))
+
+    def addBarcode(
+            self,
+            barcodeFileAlias,
+            barcode,
+            index,
+            hammingDistance=0,
+            originBarcode=None):
+        if hammingDistance == 0:
+            self.barcodes[barcodeFileAlias][barcode] = index
+            # The correction index needs to be rebuilt
+            self.correctionIndices.pop(barcodeFileAlias, None)
+        else:
+            if originBarcode is None:
+                raise ValueError()
+            self.extendedBarcodes[barcodeFileAlias][barcode] = (
+                index, originBarcode, hammingDistance)
+
+    # get index and hamming distance to barcode  returns none if not Available
+    def getIndexCorrectedBarcodeAndHammingDistance(self, barcode, alias):
+        if barcode in self.barcodes[alias]:
+            return (self.barcodes[alias][barcode], barcode, 0)
+        if barcode in self.extendedBarcodes[alias]:
+            return self.extendedBarcodes[alias][barcode]
+        index = self.getCorrectionIndex(alias)
+        if index is not None:
+            origin, hammingDistance = index.lookup(barcode)
+            if origin is not None:
+                return (self.barcodes[alias][origin], origin, hammingDistance)
+        return (None, None, None)
+
+    def loadAll(self):
+        """Parse the barcode files of all aliases which have not been accessed yet"""
+        for alias in self.barcodeFiles:
+            self.barcodes[alias]
+
+    def list(self, showBarcodes=5):  # showBarcodes=None show all
+        self.loadAll()
+        for barcodeAlias, mapping in self.barcodes.items():
+            print(
+                f'{len(mapping)} barcodes{Style.DIM} obtained from {Style.RESET_ALL}{barcodeAlias}')
+            if len(mapping):
+                for bcId in list(mapping.keys())[:showBarcodes]:
+                    try:
+                        print(('%s%s%s%s%s%s' % (Fore.GREEN, bcId,
+                                                 Fore.WHITE, '→', mapping[bcId], Style.RESET_ALL)))
+                    except Exception as e:
+                        print(('%s%s%s%s%s%s' % (Fore.GREEN, bcId,
+                                                 Fore.WHITE, '->', mapping[bcId], Style.RESET_ALL)))
+                if showBarcodes is not None and len(mapping) > showBarcodes:
+                    print(
+                        f'{Style.DIM} %s more ...\n{Style.RESET_ALL}' %
+                        (len(mapping) - showBarcodes))
+
+    def getBarcodeMapping(self):
+        self.loadAll()
+        return self.barcodes
@@ -1 +1,2 @@
 from .downsampleDataFrame import *
+from .sparseCountTable import *
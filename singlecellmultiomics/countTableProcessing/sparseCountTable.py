@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+import scipy.io
+import scipy.sparse
+
+
+class SparseCountTable():
+    """Accumulates counts per (sample, feature) without nested dictionaries.
+
+    Samples and features are encoded as integer ids in order of appearance, the increments are appended to
+    growable coordinate (COO) lists which are periodically consolidated into arrays of unique (feature, sample) entries.
+    Only the pending increments are sorted when consolidating, they are merged into the sorted consolidated entries.
+
+    Example:
+        >>> table = SparseCountTable()
+        >>> table.add(('cell_1',), 'chr1', 1)
+        >>> table.add(('cell_1',), 'chr1', 0.5)
+        >>> table.to_dataframe()
+               cell_1
+        chr1      1.5
+    """
+
+    def __init__(self, consolidate_every=1_000_000):
+        """Initialise SparseCountTable
+
+        Args:
+            consolidate_every (int) : amount of increments after which the pending increments are summed,
+                the amount grows to a quarter of the amount of consolidated entries
+        """
+        self.samples = {}  # sample -> sample id
+        self.features = {}  # feature -> feature id
+        self.float_samples = set()  # ids of samples which received non-integer increments
+        self.consolidate_every = consolidate_every
+
+        # Increments which are not consolidated yet, the key is (feature id << 32) | sample id
+        self.pending_keys = []
+        self.pending_values = []
+        self.increments = 0  # amount of consolidated increments
+
+        # Consolidated entries, order is the index of the first increment of the entry
+        self.entry_features = np.zeros(0, dtype=np.int64)
+        self.entry_samples = np.zeros(0, dtype=np.int64)
+        self.entry_values = np.zeros(0, dtype=np.float64)
+        self.entry_order = np.zeros(0, dtype=np.int64)
+
+    def add(self, sample, feature, value):
+        """Add value to the count of feature in sample
+
+        Args:
+            sample (hashable) : sample, for example a tuple of tag values
+
+            feature (hashable) : feature, for example a tuple of tag values
+
+            value (int or float) : increment
+        """
+        try:
+            sample_id = self.samples[sample]
+        except KeyError:
+            sample_id = self.samples[sample] = len(self.samples)
+        try:
+            feature_id = self.features[feature]
+        except KeyError:
+            feature_id = self.features[feature] = len(self.features)
+        if type(value) is not int and not isinstance(value, np.integer):
+            self.float_samples.add(sample_id)
+        self.pending_keys.append((feature_id << 32) | sample_id)
+        self.pending_values.append(value)
+        if len(self.pending_values) >= self.consolidate_every and \
+                len(self.pending_values) >= (len(self.entry_values) >> 2):
+            self.consolidate()
+
+    def __len__(self):
+        """Amount of (feature, sample) entries"""
+        self.consolidate()
+        return len(self.entry_values)
+
+    def consolidate(self):
+        """Sum the pending increments into the consolidated entries"""
+        if len(self.pending_values) == 0:
+            return
+        # Sum the pending increments per key, the first index of every key is the first increment of the entry
+        keys, first, inverse = np.unique(np.array(self.pending_keys, dtype=np.int64),
+                                         return_index=True, return_inverse=True)
+        values = np.bincount(inverse.ravel(), weights=np.array(self.pending_values, dtype=np.float64),
+                             minlength=len(keys))
+        order = first + self.increments
+        self.increments += len(self.pending_values)
+
+        # Merge into the sorted consolidated entries, these are earlier than the pending increments
+        entry_keys = (self.entry_features << 32) | self.entry_samples
+        positions = np.searchsorted(entry_keys, keys)
+        found = positions < len(entry_keys)
+        found[found] = entry_keys[positions[found]] == keys[found]
+        self.entry_values[positions[found]] += values[found]
+
+        new = ~found
+        if new.any():
+            positions = positions[new]
+            entry_keys = np.insert(entry_keys, positions, keys[new])
+            self.entry_features = entry_keys >> 32
+            self.entry_samples = entry_keys & 0xffffffff
+            self.entry_values = np.insert(self.entry_values, positions, values[new])
+            self.entry_order = np.insert(self.entry_order, positions, order[new])
+
+        self.pending_keys = []
+        self.pending_values = []
+
+    def update(self, other):
+        """Add all counts of another SparseCountTable to this table
+
+        Args:
+            other (SparseCountTable) : table to add, the samples and features of other are appended
+                in their order of appearance in other
+        """
+        other.consolidate()
+        self.consolidate()
+        sample_map = np.array([self.samples.setdefault(sample, len(self.samples))
+                               for sample in other.samples], dtype=np.int64)
+        feature_map = np.array([self.features.setdefault(feature, len(self.features))
+                                for feature in other.features], dtype=np.int64)
+        self.float_samples.update(sample_map[list(other.float_samples)].tolist())
+        order = np.argsort(other.entry_order, kind='stable')
+        self.pending_keys = ((feature_map[other.entry_features[order]] << 32)
+                             | sample_map[other.entry_samples[order]]).tolist()
+        self.pending_values = other.entry_values[order].tolist()
+        self.consolidate()
+
+    def get_feature_order(self):
+        """Obtain the feature order of pd.DataFrame.from_dict({sample: {feature: count}}):
+        the features of the first sample in order of appearance, followed by the not yet seen features of the next samples
+
+        Returns:
+            feature_order (np.ndarray) : feature ids
+        """
+        self.consolidate()
+        by_sample = np.lexsort((self.entry_order, self.entry_samples))
+        features, first = np.unique(self.entry_features[by_sample], return_index=True)
+        return features[np.argsort(first)]
+
+    def to_sparse(self):
+        """Obtain the counts as sparse matrix
+
+        Returns:
+            matrix (scipy.sparse.csr_matrix) : features x samples, ordered as in to_dataframe
+
+            features (list) : feature for every row
+
+            samples (list) : sample for every column
+        """
+        feature_order = self.get_feature_order()
+        rows = np.empty(len(self.features), dtype=np.int64)
+        rows[feature_order] = np.arange(len(feature_order))
+        matrix = scipy.sparse.csr_matrix(
+            (self.entry_values, (rows[self.entry_features], self.entry_samples)),
+            shape=(len(self.features), len(self.samples)))
+        features = list(self.features)
+        return matrix, [features[i] for i in feature_order.tolist()], list(self.samples)
+
+    def to_dataframe(self):
+        """Obtain the counts as dense pd.DataFrame, equal to pd.DataFrame.from_dict({sample: Counter(feature: count)})
+
+        Returns:
+            df (pd.DataFrame) : features x samples, counts of features not seen in a sample are NaN
+        """
+        if len(self.samples) == 0:
+            return pd.DataFrame()
+        feature_order = self.get_feature_order()
+        rows = np.empty(len(self.features), dtype=np.int64)
+        rows[feature_order] = np.arange(len(feature_order))
+        matrix = np.full((len(self.features), len(self.samples)), np.nan)
+        matrix[rows[self.entry_features], self.entry_samples] = self.entry_values
+
+        features = list(self.features)
+        index = pd.Index([features[i] for i in feature_order.tolist()])
+        columns = pd.Index(list(self.samples))
+
+        # Columns only holding integer counts are integers, as long as no feature is missing
+        integer_samples = np.bincount(self.entry_samples, minlength=len(self.samples)) == len(self.features)
+        integer_samples[list(self.float_samples)] = False
+        if not integer_samples.any():
+            return pd.DataFrame(matrix, index=index, columns=columns)
+        df = pd.DataFrame({i: (matrix[:, i].astype(np.int64) if integer_samples[i] else matrix[:, i])
+                           for i in range(len(self.samples))}, index=index)
+        df.columns = columns
+        return df
+
+    def write(self, path, index_names=None, column_names=None):
+        """Write the counts to a sparse file format, selected by the extension of path:
+
+            .npz : scipy.sparse.save_npz compatible csr matrix, features x samples
+            .mtx or .mtx.gz : MatrixMarket file, features x samples
+            .h5ad : AnnData file, samples x features, requires the anndata package
+
+        For .npz and .mtx files the features and samples are written to {prefix}.features.tsv and {prefix}.samples.tsv
+
+        Args:
+            path (str) : path to write to
+
+            index_names (list) : names of the levels of the features
+
+            column_names (list) : names of the levels of the samples
+
+        Returns:
+            written (list) : paths of the written files
+        """
+        matrix, features, samples = self.to_sparse()
+        features = pd.Index(features, tupleize_cols=True)
+        samples = pd.Index(samples, tupleize_cols=True)
+        if index_names is not None:
+            features = features.set_names(index_names)
+        if column_names is not None:
+            samples = samples.set_names(column_names)
+
+        if path.endswith('.h5ad'):
+            try:
+                import anndata
+            except ImportError:
+                raise ImportError('Writing .h5ad files requires the anndata package')
+            adata = anndata.AnnData(
+                matrix.T.tocsr(),
+                obs=_index_to_frame(samples),
+                var=_index_to_frame(features))
+            adata.write(path)
+            return [path]
+
+        if path.endswith('.npz'):
+            prefix = path[:-len('.npz')]
+            scipy.sparse.save_npz(path, matrix)
+        elif path.endswith('.mtx') or path.endswith('.mtx.gz'):
+            prefix = path[:-len('.mtx')] if path.endswith('.mtx') else path[:-len('.mtx.gz')]
+            if path.endswith('.gz'):
+                import gzip
+                with gzip.open(path, 'wb') as f:
+                    scipy.io.mmwrite(f, matrix)
+            else:
+                scipy.io.mmwrite(path, matrix)
+        else:
+            raise ValueError(f'Unknown sparse output format for {path}, use .npz, .mtx(.gz) or .h5ad')
+
+        written = [path]
+        for name, index in (('features', features), ('samples', samples)):
+            table_path = f'{prefix}.{name}.tsv'
+            index.to_frame(index=False).to_csv(table_path, sep='\t', index=False)
+            written.append(table_path)
+        return written
+
+
+def _index_to_frame(index):
+    """Convert an index to an AnnData obs/var frame, indexed by the joined levels"""
+    frame = index.to_frame(index=False)
+    frame.columns = [str(column) for column in frame.columns]
+    frame.index = ['_'.join(map(str, value)) if isinstance(value, tuple) else str(value) for value in index]
+    return frame
+
+
+def is_sparse_count_table_path(path):
+    """Check if the supplied path should be written using SparseCountTable.write"""
+    return path is not None and os.path.basename(path).endswith(('.npz', '.mtx', '.mtx.gz', '.h5ad'))
@@ -5,11 +5,232 @@ import collections
 import numpy as np
 import re
 import more_itertools
-import gzip
 import argparse
 import uuid
 import os
+import shutil
+from multiprocessing import Pool
 from singlecellmultiomics.utils import BlockZip
+from singlecellmultiomics.fastqProcessing.bgzfWriter import BgzfWriter
+from singlecellmultiomics.bamProcessing.mappabilityStore import write_mappability_store, MAPPABILITY_UNIQUE, MAPPABILITY_NOT_UNIQUE
+
+
+def seq_to_fastq(seq, header):
+    return f'@{header}\n{seq}\n+\n{"E"*len(seq)}\n'
+
+
+def digest_sequence(seq, digest_sequence, minlen, maxlen, head=None):
+    """
+    In silico digest a sequence, and generate the reads of every fragment from both ends
+
+    Args:
+        seq (str) : uppercase sequence to digest
+
+        digest_sequence (str) : recognition sequence of the restriction enzyme, for example CATG
+
+        minlen (int) : minimum read length
+
+        maxlen (int) : maximum read length
+
+        head (int) : only digest the first head fragments
+
+    Yields:
+        strand (str) : 'fwd' or 'rev'
+
+        ds (int) : zero based start of the recognition site the read originates from
+
+        read (str) : read sequence
+    """
+    for i, (start, end_excluding_catg) in enumerate(more_itertools.windowed(
+            (m.start() for m in re.finditer(digest_sequence, seq)), 2)):
+        if end_excluding_catg is None or head is not None and i >= (head - 1):
+            continue
+        end = end_excluding_catg + len(digest_sequence)
+
+        forward_read = seq[start:end][:maxlen]
+        if len(forward_read) >= minlen:
+            yield 'fwd', start, forward_read
+        reverse_read = singlecellmultiomics.utils.reverse_complement(seq[start:end])[:maxlen]
+        if len(reverse_read) >= minlen:
+            yield 'rev', end_excluding_catg, reverse_read
+
+
+def _digest_contig(args):
+    """Write the simulated reads of a single contig for all digest sequences to a BGZF compressed FASTQ shard"""
+    fasta_path, contig, digest_sequences, minlen, maxlen, head, shard_path = args
+    with pysam.FastaFile(fasta_path) as reference:
+        seq = reference.fetch(contig).upper()
+    written = 0
+    with BgzfWriter(shard_path, threads=1) as out:
+        for digest in digest_sequences:
+            for strand, ds, read in digest_sequence(seq, digest, minlen, maxlen, head):
+                out.write(seq_to_fastq(read, f'DR:{strand};ct:{contig};ds:{ds};qn:{len(read)};mt:{digest}'))
+                written += 1
+    return contig, written
+
+
+def digest_genome(fasta_path, fastq_path, digest_sequences, minlen, maxlen, head=None, contigs=None, threads=1):
+    """
+    In silico digest a genome and write the simulated reads to a FASTQ file.
+    Every contig is digested by a separate process into a BGZF shard,
+    the shards are concatenated in contig order.
+
+    Args:
+        fasta_path (str) : path to indexed fasta file
+
+        fastq_path (str) : path to write the (BGZF compressed) simulated reads to
+
+        digest_sequences (list) : recognition sequences to digest with, the reads of every recognition sequence
+            are marked in the read name with mt:{digest_sequence}
+
+        minlen, maxlen (int) : minimum and maximum read length
+
+        head (int) : only digest the first head fragments of every contig
+
+        contigs (set) : contigs to digest, all contigs when None
+
+        threads (int) : amount of contigs to digest in parallel
+
+    Returns:
+        written (int) : amount of simulated reads
+    """
+    with pysam.FastaFile(fasta_path) as reference:
+        selected = [(contig, contig_len) for contig, contig_len in zip(reference.references, reference.lengths)
+                    if contigs is None or contig in contigs]
+
+    shard_folder = f'{fastq_path}.shards'
+    os.makedirs(shard_folder, exist_ok=True)
+    jobs = [(fasta_path, contig, digest_sequences, minlen, maxlen, head, f'{shard_folder}/{i}.fastq.gz')
+            for i, (contig, contig_len) in enumerate(selected)]
+
+    written = 0
+    with open(fastq_path, 'wb') as out:
+        if threads is not None and threads > 1:
+            with Pool(threads) as workers:
+                results = list(workers.imap(_digest_contig, jobs))
+        else:
+            results = list(map(_digest_contig, jobs))
+        # A concatenation of BGZF files is a valid BGZF file
+        for (contig, contig_written), (_, contig_len), job in zip(results, selected, jobs):
+            print(f'{contig}\t{contig_len}')
+            with open(job[-1], 'rb') as shard:
+                shutil.copyfileobj(shard, out)
+            written += contig_written
+    shutil.rmtree(shard_folder)
+    return written
+
+
+def _get_contig_site_statistics(args):
+    """
+    Obtain the site statistics of the simulated reads mapped to a single contig, or of the unmapped reads (contig '*')
+
+    Returns:
+        sites (dict) : digest sequence -> (contig, pos, strand) -> [correct, lost, wrong_gain]
+    """
+    bam_path, contig = args
+    sites = collections.defaultdict(lambda: collections.defaultdict(lambda: [0, 0, 0]))
+    with pysam.AlignmentFile(bam_path) as ref_reads:
+        for read in ref_reads.fetch(contig):
+            if read.is_supplementary:
+                continue
+
+            kv = {kv.split(':')[0]: kv.split(':')[1]
+                  for kv in read.query_name.split(';')}
+            digest = kv['mt']
+            key = (kv['ct'], int(kv['ds']), kv['DR'] == 'rev')
+
+            if read.is_unmapped:
+                # Assign a missing count to the origin site:
+                sites[digest][key][1] += 1
+                continue
+
+            read_site = read.reference_end - len(digest) if read.is_reverse else read.reference_start
+            key_mapped = (read.reference_name, read_site, read.is_reverse)
+
+            if key == key_mapped:  # Correct assignment
+                sites[digest][key][0] += 1
+            else:
+                # Assign a missing count to the origin site:
+                sites[digest][key][1] += 1
+                # Assign a wrong annotation to the target site:
+                sites[digest][key_mapped][2] += 1
+    return {digest: dict(digest_sites) for digest, digest_sites in sites.items()}
+
+
+def get_site_statistics(bam_path, threads=1):
+    """
+    Obtain for every restriction site how often simulated reads were mapped back correctly,
+    how many reads were lost to other locations and how many reads originating elsewhere were gained.
+    The reads of every contig are processed by a separate process.
+
+    Args:
+        bam_path (str) : path to sorted and indexed BAM file with the mapped simulated reads
+
+        threads (int) : amount of contigs to process in parallel
+
+    Returns:
+        sites (dict) : digest sequence -> (contig, pos, strand) -> [correct, lost, wrong_gain]
+    """
+    with pysam.AlignmentFile(bam_path) as ref_reads:
+        jobs = [(bam_path, contig) for contig in ref_reads.references] + [(bam_path, '*')]
+
+    sites = collections.defaultdict(dict)
+    if threads is not None and threads > 1:
+        with Pool(threads) as workers:
+            results = list(workers.imap_unordered(_get_contig_site_statistics, jobs))
+    else:
+        results = list(map(_get_contig_site_statistics, jobs))
+
+    # Reads mapped to one contig can originate from a site on another contig, sum the statistics
+    for result in results:
+        for digest, digest_sites in result.items():
+            merged = sites[digest]
+            for key, measured in digest_sites.items():
+                if key in merged:
+                    merged[key] = [a + b for a, b in zip(merged[key], measured)]
+                else:
+                    merged[key] = measured
+    return dict(sites)
+
+
+def write_mappability_index(sites, prefix, contig_order):
+    """
+    Write the site statistics and the uniquely mappable sites to BlockZip files, and all sites to a mappability store
+
+    Args:
+        sites (dict) : (contig, pos, strand) -> [correct, lost, wrong_gain]
+
+        prefix (str) : prefix of the output files, for example simulated_CATG_single_69
+
+        contig_order (list) : order in which the contigs are written
+    """
+    contig_rank = {contig: i for i, contig in enumerate(contig_order)}
+    keys = sorted(
+        (key for key in sites.keys() if key[0] is not None),
+        key=lambda key: (contig_rank.get(key[0], len(contig_rank)), key[0], key[1], key[2]))
+
+    store_sites = {}  # contig -> (positions, strands, codes)
+    with BlockZip(f'{prefix}.mappability.stats.bgzf', 'w') as stats, \
+            BlockZip(f'{prefix}.mappability.safe.bgzf', 'w') as safe:
+        for (contig, pos, strand) in keys:
+            correct, lost, wrong_gain = sites[(contig, pos, strand)]
+            stats.write(
+                contig,
+                pos,
+                strand,
+                f'{correct}\t{lost}\t{wrong_gain}')
+
+            unique = wrong_gain == 0 and lost == 0 and correct == 1
+            if unique:
+                safe.write(contig, pos, strand, 'ok')
+
+            if contig not in store_sites:
+                store_sites[contig] = ([], [], [])
+            store_sites[contig][0].append(pos)
+            store_sites[contig][1].append(strand)
+            store_sites[contig][2].append(MAPPABILITY_UNIQUE if unique else MAPPABILITY_NOT_UNIQUE)
+
+    write_mappability_store(f'{prefix}.mappability.store', store_sites)
 
 
 if __name__ == '__main__':
@@ -31,124 +252,43 @@ if __name__ == '__main__':
         type=int,
         default=69,
         help='maximum read length')
-    argparser.add_argument('-digest_sequence', type=str, default='CATG')
+    argparser.add_argument('-digest_sequence', type=str, default='CATG',
+                           help='Recognition sequence of the restriction enzyme, supply multiple comma separated sequences (for example CATG,CCGG) to create an index for every sequence in one run')
     argparser.add_argument('-head', type=int)
     argparser.add_argument(
         '-contigs',
         type=str,
         default=None,
         help='Comma separated contigs to run analysis for, when None specified all contigs are used')
+    argparser.add_argument('-t', type=int, default=4,
+                           help='Amount of threads, used to digest contigs in parallel, for mapping and for processing the mapped reads')
     args = argparser.parse_args()
 
     r1_read_length = args.maxlen
     minlen = args.minlen
-
-    ref = pysam.FastaFile(args.fasta)
-
-    def seq_to_fastq(seq, header):
-        return f'@{header}\n{seq}\n+\n{"E"*len(seq)}\n'
+    digest_sequences = args.digest_sequence.split(',')
 
     selected_contigs = None if args.contigs is None else set(
         args.contigs.split(','))
 
-    fastq_path = f'simulated_{args.digest_sequence}_single_{r1_read_length}_{uuid.uuid4()}.fastq.gz'
+    name = '_'.join(digest_sequences)
+    fastq_path = f'simulated_{name}_single_{r1_read_length}_{uuid.uuid4()}.fastq.gz'
 
-    outbam = f'simulated_{args.digest_sequence}_single_{r1_read_length}.bam'
+    outbam = f'simulated_{name}_single_{r1_read_length}.bam'
 
-    with gzip.open(fastq_path, 'wt') as out:
-        processed = 0
-
-        for contig, contig_len in zip(ref.references, ref.lengths):
-            if selected_contigs is not None and contig not in selected_contigs:
-                continue
-            print(f'{contig}\t{contig_len}')
-            seq = ref.fetch(contig).upper()
-            frag_locations = np.diff(
-                [m.start() for m in re.finditer(args.digest_sequence, seq)])
-            # Generate fragments:
-            for i, (start, end_excluding_catg) in enumerate(more_itertools.windowed(
-                    (m.start() for m in re.finditer(args.digest_sequence, seq)), 2)):
-                if end_excluding_catg is None or args.head is not None and i >= (
-                        args.head - 1):
-                    continue
-                end = end_excluding_catg + len(args.digest_sequence)
-
-                forward_read = seq[start:end][:r1_read_length]
-                if len(forward_read) >= minlen:
-                    out.write(
-                        seq_to_fastq(
-                            forward_read,
-                            f'DR:fwd;ct:{contig};ds:{start};qn:{len(forward_read)}'))
-                reverse_read = singlecellmultiomics.utils.reverse_complement(seq[start:end])[
-                    :r1_read_length]
-                if len(reverse_read) >= minlen:
-                    out.write(
-                        seq_to_fastq(
-                            reverse_read,
-                            f'DR:rev;ct:{contig};ds:{end_excluding_catg};qn:{len(reverse_read)}'))
-
-            processed += contig_len
+    digest_genome(args.fasta, fastq_path, digest_sequences, minlen, r1_read_length,
+                  head=args.head, contigs=selected_contigs, threads=args.t)
 
     # Map the fastq file:
     print("Now mapping ...")
-    os.system(f"bwa mem -t 4 {args.fasta} {fastq_path} | samtools view -b - > ./{outbam}.unsorted.bam; samtools sort -T ./temp_sort -@ 4 ./{outbam}.unsorted.bam > ./{outbam}.unfinished.bam ; mv ./{outbam}.unfinished.bam ./{outbam} ; samtools index ./{outbam} & rm {fastq_path}")
+    os.system(f"bwa mem -t {args.t} {args.fasta} {fastq_path} | samtools view -b - > ./{outbam}.unsorted.bam; samtools sort -T ./temp_sort -@ {args.t} ./{outbam}.unsorted.bam > ./{outbam}.unfinished.bam ; mv ./{outbam}.unfinished.bam ./{outbam} ; samtools index ./{outbam} ; rm {fastq_path}")
 
     print("Creating site database ...")
-    # Create site dictionary:
-    sites = {}  # site-> wrongly_assinged_to, correctly_assigned, lost
-
-    ref_reads = pysam.AlignmentFile(outbam)
-    # Perform site detection:
-    for read in ref_reads:
-
-        if read.is_supplementary:
-            continue
-        # Check if there is reads mapping to this site
-
-        kv = {kv.split(':')[0]: kv.split(':')[1]
-              for kv in read.query_name.split(';')}
-
-        site_pos = int(kv['ds'])
-        site_chrom = kv['ct']
-        strand = (kv['DR'] == 'rev')
-
-        read_site = read.reference_end - 4 if read.is_reverse else read.reference_start
-        read_contig = read.reference_name
-
-        key = (site_chrom, site_pos, strand)
-        key_mapped = (read_contig, read_site, read.is_reverse)
-
-        if key not in sites:
-            sites[key] = {'correct': 0, 'wrong_gain': 0, 'lost': 0}
-
-        if read_site == site_pos and site_chrom == read_contig and read.is_reverse == strand:  # Correct assignment
-            sites[key]['correct'] += 1
-        else:
-            # Assign a missing count to the origin site:
-            sites[key]['lost'] += 1
+    sites = get_site_statistics(outbam, threads=args.t)
 
-            # Assing a wrong annotation to the target site:
-            if key_mapped not in sites:
-                sites[key_mapped] = {'correct': 0, 'wrong_gain': 0, 'lost': 0}
-            sites[key_mapped]['wrong_gain'] += 1
+    with pysam.FastaFile(args.fasta) as reference:
+        contig_order = list(reference.references)
 
     print("Writing site statistics ...")
-    outtab = f'simulated_{args.digest_sequence}_single_{r1_read_length}.mappability.stats.bgzf'
-    outtabsafe = f'simulated_{args.digest_sequence}_single_{r1_read_length}.mappability.safe.bgzf'
-
-    keys = sorted(
-    [(contig, pos, strand)
-     for  (contig, pos, strand) in sites.keys()
-     if contig is not None])
-
-    with BlockZip(outtab, 'w') as stats, BlockZip(outtabsafe, 'w') as safe:
-        for (contig, pos, strand) in keys:
-            measured= sites[(contig, pos, strand)]
-            stats.write(
-                contig,
-                pos,
-                strand,
-                f'{measured["correct"]}\t{measured["lost"]}\t{measured["wrong_gain"]}')
-
-            if measured['wrong_gain'] == 0 and measured['lost'] == 0 and measured['correct'] == 1:
-                safe.write(contig, pos, strand, 'ok')
+    for digest in digest_sequences:
+        write_mappability_index(sites.get(digest, {}), f'simulated_{digest}_single_{r1_read_length}', contig_order)
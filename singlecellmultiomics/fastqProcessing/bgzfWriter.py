@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import collections
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum amount of uncompressed bytes in a BGZF block, the same value as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+# Empty BGZF block which marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def compress_bgzf_block(data, compresslevel=1):
+    """Compress bytes into a single BGZF block
+
+    Args:
+        data (bytes) : data to compress, at most BGZF_BLOCK_SIZE bytes
+
+        compresslevel (int) : zlib compression level
+
+    Returns:
+        block (bytes) : BGZF block, a gzip member with the BGZF extra field
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    # 18 bytes of header and 8 bytes of footer
+    header = struct.pack('<4BI2BH2BHH',
+                         0x1f, 0x8b, 8, 4,  # gzip magic, deflate, FEXTRA
+                         0, 0, 0xff,  # mtime, xfl, os
+                         6, ord('B'), ord('C'), 2,  # extra field with block size
+                         len(deflated) + 25)
+    return header + deflated + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+class BgzfWriter():
+    """Writes BGZF (block gzip) compressed files, blocks are compressed in a thread pool.
+    The output can be read by any gzip reader.
+
+    Example:
+        >>> with BgzfWriter('reads.fastq.gz', threads=4) as handle:
+        >>>     handle.write('@read\\nACGT\\n+\\nAAAA\\n')
+    """
+
+    def __init__(self, path, threads=4, compresslevel=1, mode='wb'):
+        """Initialise BgzfWriter
+
+        Args:
+            path (str) : path to write to
+
+            threads (int) : amount of compression threads, when 1 the blocks are compressed in the calling thread
+
+            compresslevel (int) : zlib compression level
+
+            mode (str) : 'wb' to write a new file, 'ab' to append to an existing file
+        """
+        self.path = path
+        self.compresslevel = compresslevel
+        self.handle = open(path, mode)
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.max_pending = max(1, threads) * 4
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """Write text or bytes
+
+        Args:
+            data (str or bytes) : data to write
+
+        Returns:
+            written (int) : amount of characters or bytes written
+        """
+        self.buffer += data.encode() if isinstance(data, str) else data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self._submit(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def _submit(self, data):
+        if self.pool is None:
+            self.handle.write(compress_bgzf_block(data, self.compresslevel))
+            return
+        self.pending.append(self.pool.submit(compress_bgzf_block, data, self.compresslevel))
+        # Write finished blocks in order, limit the amount of blocks held in memory
+        while len(self.pending) > self.max_pending or (len(self.pending) and self.pending[0].done()):
+            self.handle.write(self.pending.popleft().result())
+
+    def flush(self):
+        """Compress and write all buffered data"""
+        if len(self.buffer):
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while len(self.pending):
+            self.handle.write(self.pending.popleft().result())
+        self.handle.flush()
+
+    def close(self):
+        """Write all buffered data, the BGZF end of file marker and close the file"""
+        if self.handle.closed:
+            return
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
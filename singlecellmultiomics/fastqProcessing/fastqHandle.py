@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import gzip
 from singlecellmultiomics.pyutils.handlelimiter import HandleLimiter
+from singlecellmultiomics.fastqProcessing.bgzfWriter import BgzfWriter
 
 
 class FastqHandle:
@@ -10,23 +10,37 @@ class FastqHandle:
             path,
             pairedEnd=False,
             single_cell=False,
-            maxHandles=500):
+            maxHandles=500,
+            threads=4):
+        """Initialise FastqHandle
+
+        Args:
+            path (str) : prefix of the output files
+
+            pairedEnd (bool) : write R1 and R2 files
+
+            single_cell (bool) : write a separate file for every cell
+
+            maxHandles (int) : maximum amount of simultaneously opened files (single_cell mode)
+
+            threads (int) : amount of BGZF compression threads per output file
+        """
         self.pe = pairedEnd
         self.sc = single_cell
         self.path = path
         if not self.sc:
             if pairedEnd:
                 self.handles = [
-                    gzip.open(
+                    BgzfWriter(
                         path +
                         'R1.fastq.gz',
-                        'wt',compresslevel=1),
-                    gzip.open(
+                        threads=threads, compresslevel=1),
+                    BgzfWriter(
                         path +
                         'R2.fastq.gz',
-                        'wt',compresslevel=1)]
+                        threads=threads, compresslevel=1)]
             else:
-                self.handles = [gzip.open(path + 'reads.fastq.gz', 'wt')]
+                self.handles = [BgzfWriter(path + 'reads.fastq.gz', threads=threads, compresslevel=9)]
         else:
 
             self.handles = HandleLimiter(
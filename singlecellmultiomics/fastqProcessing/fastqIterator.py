@@ -1,53 +1,208 @@
-# Fastq iterator class, Buys de Barbanson
-import collections
-import gzip
-import os
-
-FastqRecord = collections.namedtuple(
-    'FastqRecord', 'header sequence plus qual')
-
-
-class FastqIterator():
-    """FastqIterator, iterates over one or more fastq files."""
-
-    def __init__(self, *args):
-        """Initialise  FastqIterator.
-
-        Argument(s):
-        path to fastq file, path to fastq file 2 , ...
-        example: for rec1, rec2 in FastqIterator('./R1.fastq', './R2.fastq'):
-        """
-
-        self.handles = tuple(
-            gzip.open(path, 'rt')
-            # Load as GZIP when the extension is .gz
-            if os.path.splitext(path)[1] == '.gz' else open(path, 'r')
-            for path in args
-        )
-        self.readIndex = 0
-
-    def _readFastqRecord(self, handle):
-        # Read four lines and load them into a FastqRecord
-        return(
-            #FastqRecord(*tuple(handle.readline().rstrip() for i in range(4)))
-            FastqRecord(
-                handle.readline().rstrip(),
-                handle.readline().rstrip(),
-                handle.readline().rstrip(),
-                handle.readline().rstrip()
-            )
-        )
-
-    def __iter__(self):
-        """Exectuted upon generator initiation."""
-        return(self)
-
-    def __next__(self):
-        """Obtain the next fastq record for all opened files."""
-        self.readIndex += 1  # Increment the current read counter
-        records = tuple(self._readFastqRecord(handle)
-                        for handle in self.handles)
-        # Stop when empty records are being returned; the file end is reached
-        if any((len(rec.header) == 0 for rec in records)):
-            raise StopIteration
-        return(records)
+# Fastq iterator class, Buys de Barbanson
+import collections
+import gzip
+import os
+import queue
+import subprocess
+import threading
+from shutil import which
+
+FastqRecord = collections.namedtuple(
+    'FastqRecord', 'header sequence plus qual')
+
+# Decompression tools which are used to offload decompression of gzipped
+# files to a subprocess, in order of preference
+DECOMPRESSION_TOOLS = ('pigz', 'bgzip', 'gzip')
+
+
+class ThreadedBlockReader():
+    """Reads large blocks from a binary stream in a background thread.
+    Decompression of gzip streams releases the GIL, this allows the decompression
+    to run concurrently with the parsing of the records.
+    """
+
+    def __init__(self, stream, block_size=4 * 1024 * 1024, max_queued_blocks=8, process=None):
+        """Initialise ThreadedBlockReader
+
+        Args:
+            stream (file) : binary stream to read from
+
+            block_size (int) : amount of bytes to read at once
+
+            max_queued_blocks (int) : maximum amount of blocks which are read ahead
+
+            process (subprocess.Popen) : process writing to the stream, its exit code is checked at the end of the stream
+        """
+        self.stream = stream
+        self.block_size = block_size
+        self.process = process
+        self.queue = queue.Queue(maxsize=max_queued_blocks)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _read(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.stream.read(self.block_size)
+                if not block:
+                    break
+                self._put(block)
+            if self.process is not None and not self.stopped.is_set():
+                exit_code = self.process.wait()
+                if exit_code != 0:
+                    raise IOError(f'Decompression of {self.process.args[-1]} failed, exit code {exit_code}')
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def close(self):
+        """Stop reading and release the stream (and process), the reading thread and the process are joined"""
+        self.stopped.set()
+        if self.process is not None and self.process.poll() is None:
+            # Unblocks a read of the thread waiting for output of the process
+            self.process.terminate()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.process is not None:
+            self.process.wait()
+        self.stream.close()
+
+
+def open_block_reader(path, decompressor='auto', block_size=4 * 1024 * 1024):
+    """Open a (gzipped) file for block-wise reading
+
+    Args:
+        path (str) : path to the file, files with the extension .gz are decompressed
+
+        decompressor (str) : 'auto' : use the first available tool of DECOMPRESSION_TOOLS, or decompress in a thread when none is available.
+            'thread' : decompress in a thread, or the name of a (pigz/bgzip compatible) decompression tool
+
+        block_size (int) : amount of bytes to read at once
+
+    Returns:
+        reader (ThreadedBlockReader)
+    """
+    process = None
+    if os.path.splitext(path)[1] == '.gz':
+        tool = None
+        if decompressor == 'auto':
+            tool = next((tool for tool in DECOMPRESSION_TOOLS if which(tool) is not None), None)
+        elif decompressor != 'thread':
+            tool = decompressor
+
+        if tool is not None:
+            process = subprocess.Popen([tool, '-dc', path], stdout=subprocess.PIPE)
+            stream = process.stdout
+        else:
+            stream = gzip.open(path, 'rb')
+    else:
+        stream = open(path, 'rb')
+    return ThreadedBlockReader(stream, block_size=block_size, process=process)
+
+
+def iterate_fastq_blocks(blocks):
+    """Parse FastqRecords from an iterable of blocks of bytes
+
+    Args:
+        blocks (iterable) : blocks of bytes, a block does not need to end at a record boundary
+
+    Yields:
+        record (FastqRecord)
+    """
+    pending_lines = []
+    tail = b''
+    for block in blocks:
+        block = tail + block
+        end = block.rfind(b'\n') + 1
+        tail = block[end:]
+        lines = block[:end].decode().split('\n')
+        lines.pop()  # Empty string after the last newline
+        if pending_lines:
+            lines = pending_lines + lines
+        complete = len(lines) - (len(lines) % 4)
+        stripped = map(str.rstrip, lines[:complete])
+        yield from map(FastqRecord._make, zip(stripped, stripped, stripped, stripped))
+        pending_lines = lines[complete:]
+
+    if tail:
+        pending_lines.append(tail.decode())
+    if pending_lines:
+        # Incomplete last record
+        pending_lines += [''] * (4 - len(pending_lines))
+        yield FastqRecord(*(line.rstrip() for line in pending_lines))
+
+
+class FastqIterator():
+    """FastqIterator, iterates over one or more fastq files."""
+
+    def __init__(self, *args, decompressor='auto', block_size=4 * 1024 * 1024):
+        """Initialise  FastqIterator.
+
+        Argument(s):
+        path to fastq file, path to fastq file 2 , ...
+        decompressor: how to decompress gzipped files, see open_block_reader
+        block_size: amount of bytes to read at once
+        example: for rec1, rec2 in FastqIterator('./R1.fastq', './R2.fastq'):
+        """
+
+        self.handles = tuple(
+            open_block_reader(path, decompressor=decompressor, block_size=block_size)
+            for path in args
+        )
+        # Yields a tuple with a record of every file, stops at the end of the shortest file
+        self.records = zip(*(iterate_fastq_blocks(handle) for handle in self.handles))
+        self.readIndex = 0
+
+    def __iter__(self):
+        """Exectuted upon generator initiation."""
+        return(self)
+
+    def __next__(self):
+        """Obtain the next fastq record for all opened files."""
+        self.readIndex += 1  # Increment the current read counter
+        try:
+            records = next(self.records)
+        except StopIteration:
+            self.close()
+            raise
+        # Stop when empty records are being returned; the file end is reached
+        for rec in records:
+            if len(rec.header) == 0:
+                self.close()
+                raise StopIteration
+        return(records)
+
+    def close(self):
+        """Close all opened files, stops the reading threads and decompression processes"""
+        for handle in self.handles:
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # The reading threads and processes outlive an iterator which was not exhausted or closed
+        if hasattr(self, 'handles'):
+            self.close()
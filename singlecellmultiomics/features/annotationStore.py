@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import array
+import gzip
+import json
+import os
+import numpy as np
+from singlecellmultiomics.utils.storeFolder import write_store_folder
+
+# Increment when the layout of the store changes, stores with another version are rebuilt
+STORE_VERSION = 1
+
+STORE_ARRAYS = (
+    'contigs', 'contig_offsets', 'contig_max_lengths',
+    'starts', 'ends', 'strands', 'types', 'frames',
+    'attribute_offsets', 'attribute_keys', 'attribute_values',
+    'string_offsets', 'string_data')
+
+
+def get_store_path(gtf_path):
+    """Default location of the compiled annotation store of a GTF file"""
+    return f'{gtf_path}.compiled'
+
+
+def _get_source_stamp(gtf_path):
+    stat = os.stat(gtf_path)
+    return {'version': STORE_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def parse_gtf_attributes(attributes):
+    """Parse the attribute column of a GTF line
+
+    Args:
+        attributes (str) : attribute column, for example 'gene_id "ENSG00000223972"; gene_name "DDX11L1";'
+
+    Returns:
+        keyValues (dict) : attribute -> value
+    """
+    keyValues = {}
+    for part in attributes.split(';'):
+        kv = part.strip().split()
+        if len(kv) == 2:
+            key = kv[0]
+            value = kv[1].replace('"', '')
+            keyValues[key] = value
+    return keyValues
+
+
+def _read_source_stamp(store_path):
+    try:
+        with open(f'{store_path}/source.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _parse_gtf(gtf_path):
+    """Parse a GTF file into the arrays of an annotation store, see compile_gtf
+
+    Args:
+        gtf_path (str) : path to (gzipped) GTF file
+
+    Returns:
+        store (dict) : name -> np.ndarray, for every name in STORE_ARRAYS
+    """
+    string_ids = {}
+
+    def intern(string):
+        string_id = string_ids.get(string)
+        if string_id is None:
+            string_id = string_ids[string] = len(string_ids)
+        return string_id
+
+    contig_ids = array.array('q')
+    starts = array.array('q')
+    ends = array.array('q')
+    strands = array.array('i')
+    types = array.array('i')
+    frames = array.array('i')
+    attribute_lengths = array.array('q')
+    attribute_keys = array.array('i')
+    attribute_values = array.array('i')
+
+    with (gzip.open(gtf_path, 'rt') if gtf_path.endswith('.gz') else open(gtf_path, 'r')) as f:
+        for line in f:
+            if line[0] == '#':
+                continue
+            parts = line.rstrip().split(None, 8)
+            if len(parts) < 8:
+                continue
+            contig_ids.append(intern(parts[0]))
+            types.append(intern(parts[2]))
+            starts.append(int(parts[3]))
+            ends.append(int(parts[4]))
+            strands.append(intern(parts[6]))
+            frames.append(intern(parts[7]))
+            keyValues = parse_gtf_attributes(parts[-1])
+            attribute_lengths.append(len(keyValues))
+            for key, value in keyValues.items():
+                attribute_keys.append(intern(key))
+                attribute_values.append(intern(value))
+
+    contig_ids = np.frombuffer(contig_ids, dtype=np.int64)
+    starts = np.frombuffer(starts, dtype=np.int64)
+    ends = np.frombuffer(ends, dtype=np.int64)
+    attribute_lengths = np.frombuffer(attribute_lengths, dtype=np.int64)
+    attribute_offsets = np.zeros(len(attribute_lengths) + 1, dtype=np.int64)
+    np.cumsum(attribute_lengths, out=attribute_offsets[1:])
+
+    # Group the features per contig, in order of appearance, and sort them by start coordinate
+    contigs, first_seen = np.unique(contig_ids, return_index=True)
+    contigs = contigs[np.argsort(first_seen)]
+    contig_rank = np.zeros(len(string_ids), dtype=np.int64)
+    contig_rank[contigs] = np.arange(len(contigs))
+    order = np.lexsort((starts, contig_rank[contig_ids]))
+
+    contig_offsets = np.zeros(len(contigs) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(contig_rank[contig_ids], minlength=len(contigs)), out=contig_offsets[1:])
+
+    # Reorder the attributes along with the features
+    lengths = attribute_lengths[order]
+    sorted_attribute_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=sorted_attribute_offsets[1:])
+    attribute_order = np.repeat(attribute_offsets[:-1][order] - sorted_attribute_offsets[:-1], lengths) \
+        + np.arange(sorted_attribute_offsets[-1], dtype=np.int64)
+
+    lengths = (ends - starts)[order]
+    contig_max_lengths = np.array([
+        lengths[contig_offsets[i]:contig_offsets[i + 1]].max() for i in range(len(contigs))],
+        dtype=np.int64)
+
+    encoded = [string.encode() for string in string_ids]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+
+    return {
+        'contigs': contigs.astype(np.int32),
+        'contig_offsets': contig_offsets,
+        'contig_max_lengths': contig_max_lengths,
+        'starts': starts[order],
+        'ends': ends[order],
+        'strands': np.frombuffer(strands, dtype=np.int32)[order],
+        'types': np.frombuffer(types, dtype=np.int32)[order],
+        'frames': np.frombuffer(frames, dtype=np.int32)[order],
+        'attribute_offsets': sorted_attribute_offsets,
+        'attribute_keys': np.frombuffer(attribute_keys, dtype=np.int32)[attribute_order],
+        'attribute_values': np.frombuffer(attribute_values, dtype=np.int32)[attribute_order],
+        'string_offsets': string_offsets,
+        'string_data': np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    }
+
+
+def compile_gtf(gtf_path, store_path=None):
+    """Parse a GTF file once and write it to a compiled annotation store.
+
+    The store is a folder of .npy files which are memory mapped when reading:
+    per feature the start, end, strand, type, frame and attributes, grouped per contig
+    and sorted by start coordinate. All strings are interned in a single string table.
+    A single process compiles the store at a time, an up to date store is kept as is.
+
+    Args:
+        gtf_path (str) : path to (gzipped) GTF file
+
+        store_path (str) : path to write the store to, defaults to get_store_path(gtf_path)
+
+    Returns:
+        store_path (str)
+    """
+    if store_path is None:
+        store_path = get_store_path(gtf_path)
+
+    def write(temp_path):
+        for name, values in _parse_gtf(gtf_path).items():
+            np.save(f'{temp_path}/{name}.npy', values)
+        with open(f'{temp_path}/source.json', 'w') as f:
+            json.dump(_get_source_stamp(gtf_path), f)
+
+    write_store_folder(store_path, write,
+                       is_valid=lambda path: _read_source_stamp(path) == _get_source_stamp(gtf_path))
+    return store_path
+
+
+class AnnotationStore():
+    """Read access to a compiled annotation store, written by compile_gtf.
+    The arrays are memory mapped, selecting the features of a region only reads the required parts from disk.
+    """
+
+    def __init__(self, store_path):
+        """Open a compiled annotation store
+
+        Args:
+            store_path (str) : path to the store folder
+        """
+        self.store_path = store_path
+        for name in STORE_ARRAYS:
+            setattr(self, name, np.load(f'{store_path}/{name}.npy', mmap_mode='r'))
+        self.strings = {}
+        # column -> ids of the strings occuring in the column
+        self.column_string_ids = {}
+        self.contig_indices = {self.string(string_id): i for i, string_id in enumerate(self.contigs)}
+
+    def string(self, string_id):
+        """Obtain an interned string
+
+        Args:
+            string_id (int) : index in the string table
+
+        Returns:
+            string (str)
+        """
+        string = self.strings.get(string_id)
+        if string is None:
+            string = self.strings[string_id] = bytes(
+                self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode()
+        return string
+
+    def string_ids(self, column, select):
+        """Obtain the ids of the strings in a column for which select(string) is True
+
+        Args:
+            column (str) : 'types', 'frames' or 'strands'
+
+            select (function) : function which accepts a string and returns a boolean
+
+        Returns:
+            string_ids (np.ndarray)
+        """
+        if column not in self.column_string_ids:
+            self.column_string_ids[column] = np.unique(getattr(self, column)).tolist()
+        return np.array([string_id for string_id in self.column_string_ids[column]
+                         if select(self.string(string_id))], dtype=np.int32)
+
+    def get_contigs(self):
+        """Contigs in order of appearance in the GTF file"""
+        return list(self.contig_indices)
+
+    def region_indices(self, contig, start=None, end=None):
+        """Obtain the indices of the features which overlap a region
+
+        Args:
+            contig (str) : contig as written in the GTF file
+
+            start (int) : start of the region (GTF coordinates), None to select the whole contig
+
+            end (int) : end of the region (GTF coordinates, inclusive)
+
+        Returns:
+            indices (np.ndarray) : feature indices, sorted by start coordinate
+        """
+        if contig not in self.contig_indices:
+            return np.zeros(0, dtype=np.int64)
+        i = self.contig_indices[contig]
+        first, last = self.contig_offsets[i], self.contig_offsets[i + 1]
+        if start is None:
+            return np.arange(first, last)
+        starts = self.starts[first:last]
+        # Features starting more than the longest feature before the region can not overlap
+        left = np.searchsorted(starts, start - self.contig_max_lengths[i], 'left')
+        right = np.searchsorted(starts, end, 'right')
+        candidates = np.arange(first + left, first + right)
+        return candidates[self.ends[candidates] >= start]
+
+    def attributes(self, index):
+        """Obtain the attributes of a feature
+
+        Args:
+            index (int) : feature index
+
+        Returns:
+            keyValues (dict) : attribute -> value, in order of the GTF file
+        """
+        first, last = self.attribute_offsets[index], self.attribute_offsets[index + 1]
+        return {self.string(key): self.string(value) for key, value in zip(
+            self.attribute_keys[first:last].tolist(), self.attribute_values[first:last].tolist())}
+
+
+# store_path -> (source stamp, AnnotationStore), stores opened by this process
+_opened_stores = {}
+
+
+def open_annotation_store(gtf_path, store_path=None, create=True):
+    """Open the compiled annotation store of a GTF file, the store is (re)built when
+    it does not exist or when the GTF file changed.
+
+    Args:
+        gtf_path (str) : path to the GTF file
+
+        store_path (str) : path of the store, defaults to get_store_path(gtf_path)
+
+        create (bool) : build the store when it is missing or outdated
+
+    Returns:
+        store (AnnotationStore) or None when no store is available and it could not be created
+    """
+    if store_path is None:
+        store_path = get_store_path(gtf_path)
+    stamp = _get_source_stamp(gtf_path)
+    if store_path in _opened_stores and _opened_stores[store_path][0] == stamp:
+        return _opened_stores[store_path][1]
+
+    if _read_source_stamp(store_path) != stamp:
+        if not create:
+            return None
+        try:
+            compile_gtf(gtf_path, store_path)
+        except OSError:
+            return None
+
+    store = AnnotationStore(store_path)
+    _opened_stores[store_path] = (stamp, store)
+    return store
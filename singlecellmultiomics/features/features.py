@@ -7,6 +7,7 @@ import re
 import functools
 import pysam
 from singlecellmultiomics.utils import Prefetcher
+from singlecellmultiomics.features.annotationStore import open_annotation_store, parse_gtf_attributes
 from copy import copy
 import collections
 import pandas as pd
@@ -44,6 +45,10 @@ def get_gene_id_to_gene_name_conversion_table(annotation_path_exons,
     return conversion_table
 
 
+# Strand encoding used for vectorised strand selection, features without strand are encoded as 0
+STRAND_CODES = {'+': 1, '-': 2}
+
+
 class FeatureContainer(Prefetcher):
 
     def __init__(self, verbose=False):
@@ -110,9 +115,12 @@ class FeatureContainer(Prefetcher):
     def loadGTF(self, path, thirdOnly=None, identifierFields=['gene_id'],
                 ignChr=False, select_feature_type=None, exon_select=None,
                 head=None, store_all=False, contig=None, offset=-1,
-                region_start=None, region_end=None):
+                region_start=None, region_end=None, compiled=True):
         """Load annotations from a GTF file.
         ignChr: ignore the chr part of the Annotation chromosome
+        compiled: read the features from the compiled annotation store of the GTF file,
+            the store is created next to the GTF file when it does not exist yet.
+            When the store can not be created (or head is set) the GTF file is parsed.
         """
         if region_end is not None or region_start is not None:
             assert contig is not None and region_end is not None and region_start is not None
@@ -127,6 +135,14 @@ class FeatureContainer(Prefetcher):
                 print(f"Loading {path}, for contig {contig}")
             else:
                 print(f"Loading {path}, for contig {contig}:{region_start}-{region_end}")
+        store = open_annotation_store(path) if compiled and head is None else None
+        if store is not None:
+            self._loadGTFStore(store, thirdOnly=thirdOnly, identifierFields=identifierFields,
+                ignChr=ignChr, select_feature_type=select_feature_type, exon_select=exon_select,
+                store_all=store_all, contig=contig, offset=offset,
+                region_start=region_start, region_end=region_end)
+            return
+
         added = 0
         with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
             for line_id, line in enumerate(f):
@@ -167,56 +183,15 @@ class FeatureContainer(Prefetcher):
                     if exon_select is not None and exon not in exon_select:
                         continue
 
-                    keyValues = {}
-                    for part in parts[-1].split(';'):
-                        kv = part.strip().split()
-                        if len(kv) == 2:
-                            key = kv[0]
-                            value = kv[1].replace('"', '')
-                            keyValues[key] = value
-
-                    #self.addFeature( self.remapKeys.get(parts[0], parts[0]), int(parts[3]), int(parts[4]), parts[9].replace('"','').replace(';',''))
-
-                    chrom = self.remapKeys.get(chrom, chrom)
-                    chromosome = chrom if ignChr == False else chrom.replace(
-                        'chr', '')
-
-                    if identifierFields is None:
-                        if parts[2] == 'exon':
-                            featureName = keyValues['exon_id']
-                            #featureName = ','.join([keyValues['exon_id'],keyValues['transcript_id']])
-                        elif parts[2] == 'gene':
-                            featureName = keyValues['gene_id']
-                        elif parts[2] == 'transcript':
-                            featureName = keyValues['transcript_id']
-                        else:
-                            featureName = ','.join(
-                                [parts[2], parts[3], parts[4], keyValues['transcript_id']])
-                    else:
-                        featureName = ','.join(
-                            [keyValues.get(i, 'none') for i in identifierFields if i in keyValues])
-
-
                     start = int( parts[3] ) + offset
                     end = int( parts[4] ) + offset
 
                     if region_end is not None and region_start is not None and ( end<region_start or start>region_end):
                         continue
 
-                    if store_all:
-                        keyValues['type'] = parts[2]
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome),start,end, strand=parts[6], name=featureName, data=tuple(
-                                keyValues.items()))
-
-                    else:
-                        self.addFeature(
-                            self.remapKeys.get(
-                                chromosome, chromosome), start,end, strand=parts[6], name=featureName, data=','.join(
-                                (':'.join(
-                                    ('type', parts[2])), ':'.join(
-                                    ('gene_id', keyValues['gene_id'])))))
+                    self._addGTFFeature(chrom, parts[2], start, end, parts[6], parse_gtf_attributes(parts[-1]),
+                        identifierFields=identifierFields, ignChr=ignChr, store_all=store_all,
+                        offset=offset)
                     added += 1
 
             if self.verbose:
@@ -229,6 +204,82 @@ class FeatureContainer(Prefetcher):
             print("The following chromosomes are available:")
             print(', '.join(sorted(list(self.startCoordinates.keys()))))
 
+    def _addGTFFeature(self, chrom, featureType, start, end, strand, keyValues,
+                       identifierFields, ignChr, store_all, offset):
+        """Add a feature obtained from a GTF file, see loadGTF for the arguments"""
+        chrom = self.remapKeys.get(chrom, chrom)
+        chromosome = chrom if ignChr == False else chrom.replace(
+            'chr', '')
+
+        if identifierFields is None:
+            if featureType == 'exon':
+                featureName = keyValues['exon_id']
+                #featureName = ','.join([keyValues['exon_id'],keyValues['transcript_id']])
+            elif featureType == 'gene':
+                featureName = keyValues['gene_id']
+            elif featureType == 'transcript':
+                featureName = keyValues['transcript_id']
+            else:
+                featureName = ','.join(
+                    [featureType, str(start - offset), str(end - offset), keyValues['transcript_id']])
+        else:
+            featureName = ','.join(
+                [keyValues.get(i, 'none') for i in identifierFields if i in keyValues])
+
+        if store_all:
+            keyValues['type'] = featureType
+            self.addFeature(
+                self.remapKeys.get(
+                    chromosome, chromosome),start,end, strand=strand, name=featureName, data=tuple(
+                    keyValues.items()))
+
+        else:
+            self.addFeature(
+                self.remapKeys.get(
+                    chromosome, chromosome), start,end, strand=strand, name=featureName, data=','.join(
+                    (':'.join(
+                        ('type', featureType)), ':'.join(
+                        ('gene_id', keyValues['gene_id'])))))
+
+    def _loadGTFStore(self, store, thirdOnly, identifierFields, ignChr, select_feature_type,
+                      exon_select, store_all, contig, offset, region_start, region_end):
+        """Load features from a compiled annotation store, see loadGTF for the arguments"""
+        for store_contig in (store.get_contigs() if contig is None else [contig]):
+            if region_start is None:
+                indices = store.region_indices(store_contig)
+            else:
+                # The store contains GTF coordinates
+                indices = store.region_indices(store_contig, region_start - offset, region_end - offset)
+
+            # Select on feature type and frame column, the same membership tests are used as when parsing the GTF
+            for selection in (thirdOnly, select_feature_type):
+                if selection is not None:
+                    indices = indices[np.isin(store.types[indices],
+                                              store.string_ids('types', lambda t: t in selection))]
+            if exon_select is not None:
+                indices = indices[np.isin(store.frames[indices],
+                                          store.string_ids('frames', lambda f: f in exon_select))]
+
+            for index, start, end, strand, featureType in zip(
+                    indices.tolist(),
+                    store.starts[indices].tolist(),
+                    store.ends[indices].tolist(),
+                    store.strands[indices].tolist(),
+                    store.types[indices].tolist()):
+                self._addGTFFeature(store_contig, store.string(featureType), start + offset, end + offset,
+                                    store.string(strand), store.attributes(index),
+                                    identifierFields=identifierFields, ignChr=ignChr, store_all=store_all,
+                                    offset=offset)
+
+        if self.verbose:
+            print("Loaded %s features, now sorting" %
+                  sum([len(self.features[c]) for c in self.features]))
+        self.sort()
+        if self.verbose:
+            print("done sorting")
+            print("The following chromosomes are available:")
+            print(', '.join(sorted(list(self.startCoordinates.keys()))))
+
     def annotateUTRs(self, utrs=['three_prime_utr', 'five_prime_utr']):
         """flag the exons that contain a utr"""
 
@@ -438,6 +489,9 @@ class FeatureContainer(Prefetcher):
         self.endIndexLookup = {}
         self.fastIndex = {}
         self.maxFeatureSizes = {}
+        # chromosome -> [(feature indices, starts, ends, running maximum of ends, strand codes), ..]
+        # for short and for long features, see findFeatureIndicesBetween
+        self.overlapIndex = {}
         self.sorted = True
         for chromosome in self.features.keys():
             # Sort in place and return new indices
@@ -449,29 +503,112 @@ class FeatureContainer(Prefetcher):
             self.endIndexes[chromosome] = np.argsort(
                 self.endCoordinates[chromosome])
             self.endCoordinates[chromosome] = self.endCoordinates[chromosome][self.endIndexes[chromosome]]
-            self.endIndexLookup[chromosome] = {
-                inR: orig for orig, inR in enumerate(
-                    self.endIndexes[chromosome])}
+            # Inverse of endIndexes
+            self.endIndexLookup[chromosome] = np.empty(
+                len(self.endIndexes[chromosome]), dtype=np.int64)
+            self.endIndexLookup[chromosome][self.endIndexes[chromosome]] = np.arange(
+                len(self.endIndexes[chromosome]))
 
             ####################### perform magic indexing ####################
-            maxLengthFeature = np.max([tup[1] - tup[0]
-                                       for tup in self.features[chromosome]])
+            starts = self.startCoordinates[chromosome]
+            ends = np.fromiter(
+                (tup[1] for tup in self.features[chromosome]), dtype=np.int64)
+            maxLengthFeature = np.max(ends - starts)
             self.maxFeatureSizes[chromosome] = maxLengthFeature
 
-            lowestStarts = np.fromiter(
-                (min(
-                    (f[0] for f in self.findFeaturesAt(
-                        chromosome,
-                        feature[0],
-                        optim='nb'))) for feature in self.features[chromosome]),
-                dtype=np.int64)
+            # The lowest start of the features overlapping the start of every feature:
+            # the features are sorted by start, the first feature of which the end is
+            # at or beyond the start coordinate is the lowest overlapping feature
+            lowestStarts = starts[np.searchsorted(
+                np.maximum.accumulate(ends), starts, 'left')]
+
+            # A few long features (such as long introns) keep the running maximum
+            # of the end coordinates high, the longest features are therefore indexed separately
+            strandCodes = np.fromiter(
+                (STRAND_CODES.get(tup[3], 0) for tup in self.features[chromosome]), dtype=np.int8)
+            lengths = ends - starts
+            isLong = lengths > np.quantile(lengths, 0.99)
+            self.overlapIndex[chromosome] = []
+            for selected in (~isLong, isLong):
+                featureIndices = np.nonzero(selected)[0]
+                if len(featureIndices):
+                    self.overlapIndex[chromosome].append((
+                        featureIndices,
+                        starts[featureIndices],
+                        ends[featureIndices],
+                        np.maximum.accumulate(ends[featureIndices]),
+                        strandCodes[featureIndices]))
 
             self.fastIndex[chromosome] = np.searchsorted(
-                self.startCoordinates[chromosome], lowestStarts, 'left')
+                starts, lowestStarts, 'left')
             ########################
 
         # find the longest feature
 
+    def findFeatureIndicesBetween(self, chromosome, starts, ends, strands=None):
+        """Find the features overlapping many regions in one vectorised pass.
+
+        Args:
+            chromosome (str) : chromosome of all regions
+
+            starts (iterable) : start coordinate of every region (inclusive)
+
+            ends (iterable) : end coordinate of every region (inclusive)
+
+            strands (str or iterable) : None to ignore the strand, '+' or '-' to select the strand for all regions,
+                or the strand ('+', '-' or None) of every region. Other strand values ('.') do not select a strand
+
+        Returns:
+            offsets (np.ndarray) : the hits of region i are indices[offsets[i]:offsets[i+1]]
+
+            indices (np.ndarray) : indices into self.features[chromosome], sorted by start coordinate per region
+        """
+        if not self.sorted:
+            self.sort()
+        starts = np.asarray(starts, dtype=np.int64).reshape(-1)
+        ends = np.asarray(ends, dtype=np.int64).reshape(-1)
+        offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        if chromosome not in self.startCoordinates or len(starts) == 0:
+            return offsets, np.zeros(0, dtype=np.int64)
+
+        if strands is None or isinstance(strands, str) or np.isscalar(strands):
+            strand_code = STRAND_CODES.get(strands, 0)
+            strands = None
+        else:
+            strand_code = 0
+            strands = np.fromiter(
+                (STRAND_CODES.get(strand, 0) for strand in strands), dtype=np.int8, count=len(starts))
+
+        hit_regions = []
+        hit_indices = []
+        for featureIndices, featureStarts, featureEnds, maxEnds, strandCodes in self.overlapIndex[chromosome]:
+            # All features before first end before the region start,
+            # all features from last onwards start after the region end
+            first = np.searchsorted(maxEnds, starts, 'left')
+            last = np.searchsorted(featureStarts, ends, 'right')
+            counts = np.maximum(last - first, 0)
+
+            # Expand the candidate ranges into (region, feature) pairs
+            regions = np.repeat(np.arange(len(starts)), counts)
+            candidates = np.arange(counts.sum()) + np.repeat(first - (np.cumsum(counts) - counts), counts)
+
+            keep = featureEnds[candidates] >= starts[regions]
+            if strand_code != 0:
+                keep &= strandCodes[candidates] == strand_code
+            elif strands is not None:
+                region_strands = strands[regions]
+                keep &= (region_strands == 0) | (strandCodes[candidates] == region_strands)
+            hit_regions.append(regions[keep])
+            hit_indices.append(featureIndices[candidates[keep]])
+
+        regions = np.concatenate(hit_regions)
+        indices = np.concatenate(hit_indices)
+        if len(hit_regions) > 1:
+            order = np.lexsort((indices, regions))
+            indices = indices[order]
+        np.cumsum(np.bincount(regions, minlength=len(starts)), out=offsets[1:])
+        return offsets, indices
+
     """Return a feature left of the lookupCoordinate"""
 
     def findNearestLeftFeature(
@@ -740,14 +877,16 @@ class FeatureContainer(Prefetcher):
                     pysamRead.reference_name, referencePos, strand=strand)))
             return(hits)
         else:
-            return(set(itertools.chain.from_iterable([
-                self.findFeaturesBetween(
-                    pysamRead.reference_name,
-                    lookupCoordinateStart,
-                    lookupCoordinateEnd,
-                    strand=strand)
-                for lookupCoordinateStart, lookupCoordinateEnd
-                in pysamRead.get_blocks()])))
+            blocks = pysamRead.get_blocks()
+            if len(blocks) == 0:
+                return set()
+            offsets, indices = self.findFeatureIndicesBetween(
+                pysamRead.reference_name,
+                [start for start, end in blocks],
+                [end for start, end in blocks],
+                strands=strand)
+            features = self.features[pysamRead.reference_name]
+            return set(features[i] for i in indices.tolist())
 
     def findFeaturesBetweenBRK(
             self,
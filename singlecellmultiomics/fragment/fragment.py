@@ -45,6 +45,10 @@ class Fragment():
 
     """
 
+    # When True, a fragment can only be assigned to a molecule when umi_eq() holds.
+    # This allows the MoleculeIterator to look up candidate molecules by UMI
+    umi_indexable = True
+
     def __init__(self, reads,
                  assignment_radius: int = 0,
                  umi_hamming_distance: int = 1,
@@ -1016,22 +1020,26 @@ class SingleEndTranscriptFragment(Fragment, FeatureAnnotatedObject):
 
             strand = ('-' if read_strand else '+')
             read.set_tag('mr',strand)
-            for start, end in read.get_blocks():
-
-                for hit in self.features.findFeaturesBetween(
-                        chromosome=read.reference_name,
-                        sampleStart=start,
-                        sampleEnd=end,
-                        strand=(None if self.stranded is None else strand)) :
+            blocks = read.get_blocks()
+            if len(blocks) == 0:
+                continue
+            # Look up the features of all blocks of the read at once
+            offsets, indices = self.features.findFeatureIndicesBetween(
+                read.reference_name,
+                [start for start, end in blocks],
+                [end for start, end in blocks],
+                strands=(None if self.stranded is None else strand))
+            contig_features = self.features.features.get(read.reference_name, [])
+            for index in indices.tolist():
 
-                    hit_start, hit_end, hit_id, hit_strand, hit_ids = hit
-                    self.hits[hit_ids].add(
-                        (read.reference_name, (hit_start, hit_end)))
+                hit_start, hit_end, hit_id, hit_strand, hit_ids = contig_features[index]
+                self.hits[hit_ids].add(
+                    (read.reference_name, (hit_start, hit_end)))
 
-                    if self.capture_locations:
-                        if not hit_id in self.feature_locations:
-                            self.feature_locations[hit_id] = []
-                        self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
+                if self.capture_locations:
+                    if not hit_id in self.feature_locations:
+                        self.feature_locations[hit_id] = []
+                    self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
 
 
     def get_site_location(self):
@@ -1175,6 +1183,8 @@ class FragmentWithoutUMI(Fragment):
     Use this class when no UMI information is available
     """
 
+    umi_indexable = False
+
     def __init__(self, reads, **kwargs):
         Fragment.__init__(self, reads, **kwargs)
 
@@ -6,6 +6,8 @@ class ScarTraceFragment(Fragment):
     Fragment definition for ScarTrace
     """
 
+    umi_indexable = False
+
     def __init__(self, reads,scartrace_r1_primers=None, **kwargs):
         Fragment.__init__(self, reads,  **kwargs)
         self.scartrace_r1_primers = scartrace_r1_primers
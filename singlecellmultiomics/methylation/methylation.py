@@ -3,14 +3,44 @@
 import pysam
 import pandas as pd
 import numpy as np
-from multiprocessing import Pool, Manager
+import scipy.sparse
+from multiprocessing import Manager
 from collections import defaultdict
 from singlecellmultiomics.bamProcessing import get_reference_path_from_bam
 from singlecellmultiomics.molecule import MoleculeIterator,TAPS
 
-def get_bulk_vector(args):
-    obj, samples, location = args
-    return obj.get_bulk_column(samples, location)
+def get_bulk_statistics(sites, unmethylated, methylated, n_sites):
+    """
+    Calculate the summed counts, beta value, variance of the single sample beta values
+    and amount of samples with at least one call for every location in a single pass
+
+    Args:
+        sites (np.ndarray) : site id of every (sample, location) entry
+
+        unmethylated (np.ndarray) : amount of unmethylated calls of every entry
+
+        methylated (np.ndarray) : amount of methylated calls of every entry
+
+        n_sites (int) : amount of sites
+
+    Returns:
+        statistics (np.ndarray) : array of shape (n_sites, 5) indexed by site id, with columns
+            unmethylated, methylated, beta, variance and n_samples
+    """
+    total_unmethylated = np.bincount(sites, weights=unmethylated, minlength=n_sites)
+    total_methylated = np.bincount(sites, weights=methylated, minlength=n_sites)
+
+    observed = (unmethylated + methylated) > 0
+    observed_sites = sites[observed]
+    betas = methylated[observed] / (methylated[observed] + unmethylated[observed])
+    n_samples = np.bincount(observed_sites, minlength=n_sites).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = total_methylated / (total_methylated + total_unmethylated)
+        mean_beta = np.bincount(observed_sites, weights=betas, minlength=n_sites) / n_samples
+        variance = np.bincount(observed_sites, weights=(betas - mean_beta[observed_sites]) ** 2,
+                               minlength=n_sites) / n_samples
+    return np.stack([total_unmethylated, total_methylated, beta, variance, n_samples], axis=1)
 
 class MethylationCountMatrix:
 
@@ -33,6 +63,9 @@ class MethylationCountMatrix:
             self.counts[sample][location] = [0, 0]
         return self.counts[sample][location]
 
+    def add(self, sample, location, methylated, count=1):
+        self[sample, location][int(methylated)] += count
+
     def get_without_init(self, key: tuple):
         # Obtain a key without setting it
         # sample, location = key
@@ -65,11 +98,26 @@ class MethylationCountMatrix:
         if len(self.sites)==0 or len(self.counts) == 0 or min_samples == 0 and min_variance is None:
             return
 
-        for location, row in self.get_bulk_frame(use_multi=False).iterrows():
-            if row.n_samples < min_samples:
-                self.delete_location(location)
-            elif min_variance is not None and (np.isnan(row.variance) or row.variance < min_variance):
-                self.delete_location(location)
+        locations = sorted(self.sites)
+        statistics = self.get_bulk_statistics(locations)
+        keep = statistics[:, 4] >= min_samples
+        if min_variance is not None:
+            keep &= ~np.isnan(statistics[:, 3]) & (statistics[:, 3] >= min_variance)
+        if keep.all():
+            return
+
+        drop_locations = {location for location, keep_location in zip(locations, keep.tolist()) if not keep_location}
+        drop_samples = []
+        for sample, counts in self.counts.items():
+            for location in drop_locations.intersection(counts):
+                del counts[location]
+            if len(counts) == 0:
+                drop_samples.append(sample)
+        self.sites -= drop_locations
+
+        # Remove samples without any data left:
+        for d in drop_samples:
+            del self.counts[d]
 
     def delete_location(self, location):
 
@@ -168,10 +216,35 @@ class MethylationCountMatrix:
         return [ total_un, total_met, np.nan if empty else total_met/(total_un+total_met), np.var(betas) if len(betas) else np.nan, n_samples]
 
 
+    def get_bulk_statistics(self, locations):
+        """
+        Calculate the bulk statistics of every location, see get_bulk_statistics
+
+        Args:
+            locations (list) : locations to calculate the statistics for, all locations with counts should be present
+
+        Returns:
+            statistics (np.ndarray) : array of shape (len(locations), 5), with columns
+                unmethylated, methylated, beta, variance and n_samples
+        """
+        site_ids = {location: i for i, location in enumerate(locations)}
+        sites = []
+        values = []
+        for counts in self.counts.values():
+            sites.extend(map(site_ids.__getitem__, counts.keys()))
+            values.extend(counts.values())
+        sites = np.array(sites, dtype=np.int64)
+        values = np.array(values, dtype=np.int64).reshape(-1, 2)
+        return get_bulk_statistics(sites, values[:, 0], values[:, 1], len(locations))
+
     def get_bulk_frame(self, dtype='pd', use_multi=True):
         """
         Get pandas dataframe containing the selected columns
 
+        Args:
+            dtype (str) : 'pd' to return a pd.DataFrame, 'np' to return a np.ndarray
+
+            use_multi (bool) : unused, the statistics are calculated in a single vectorised pass
 
         Returns:
             df(pd.DataFrame) : Dataframe containing the selected column, rows are locations,
@@ -180,34 +253,282 @@ class MethylationCountMatrix:
         self.check_integrity()
         # Fix columns
         columns = list(sorted(self.sites))
-        # Create column to index mapping:
-        column_to_index = {c: i for i, c in enumerate(columns)}
+        mat = self.get_bulk_statistics(columns)
 
-        samples = self.get_sample_list()
+        if dtype == 'pd':
+            return pd.DataFrame(mat, index=pd.MultiIndex.from_tuples(columns),
+                                columns=('unmethylated', 'methylated', 'beta', 'variance', 'n_samples'))
+        elif dtype == 'np':
+            return mat
+        else:
+            raise ValueError('dtype should be pd or np')
 
-        mat = np.zeros((len(columns), 5))
-        mat[:] = np.nan
 
+class SparseMethylationCountMatrix():
+    """Methylation call matrix backed by arrays instead of nested dictionaries,
+    drop-in replacement of MethylationCountMatrix for large (single CpG) matrices.
+
+    Samples and locations are registered as integer ids in order of appearance. Calls are appended to coordinate
+    lists which are consolidated into aligned arrays of unique (location, sample) entries with the amount of
+    unmethylated and methylated calls, these are exposed as scipy sparse matrices by get_sparse_matrix.
+
+    Example:
+        >>> m = SparseMethylationCountMatrix()
+        >>> m.add('cell_1', ('chr1', 100, 101), 1)
+        >>> m.add('cell_2', ('chr1', 100, 101), 0)
+        >>> m.get_bulk_frame()
+                       unmethylated  methylated  beta  variance  n_samples
+        chr1 100 101           1.0         1.0   0.5      0.25        2.0
+    """
+
+    def __init__(self, threads=None, consolidate_every=1_000_000):
+        """Initialise SparseMethylationCountMatrix
+
+        Args:
+            threads (int) : accepted for compatibility with MethylationCountMatrix, all operations are vectorised
+
+            consolidate_every (int) : amount of calls after which the pending calls are summed
+        """
+        self.samples = {}  # sample -> sample id
+        self.sites = {}  # location -> site id
+        self.threads = threads
+        self.consolidate_every = consolidate_every
+
+        # Calls which are not consolidated yet, arrays of (site ids, sample ids, unmethylated, methylated)
+        self.pending_blocks = []
+        self.pending_sites = []
+        self.pending_samples = []
+        self.pending_calls = []
+
+        # Consolidated entries, sorted by site and sample
+        self.entry_sites = np.zeros(0, dtype=np.int64)
+        self.entry_samples = np.zeros(0, dtype=np.int64)
+        self.entry_unmethylated = np.zeros(0, dtype=np.int64)
+        self.entry_methylated = np.zeros(0, dtype=np.int64)
 
-        if use_multi and (self.threads is not None and self.threads>1):
-            with Pool(self.threads) as workers:
-                for index,column in enumerate(
-                                                    workers.imap( get_bulk_vector,
-                                                    ( (self, samples, location)
-                                                    for index, location in enumerate(columns) ), chunksize=100_000)):
-                    mat[index, :] =  column
+    def add(self, sample, location, methylated, count=1):
+        """Add a methylation call
+
+        Args:
+            sample (hashable) : sample the call belongs to
+
+            location (tuple) : location, for example (contig, bin_start, bin_end)
+
+            methylated (int or bool) : 1 for a methylated call, 0 for an unmethylated call
+
+            count (int) : amount of calls to add
+        """
+        try:
+            sample_id = self.samples[sample]
+        except KeyError:
+            sample_id = self.samples[sample] = len(self.samples)
+        try:
+            site_id = self.sites[location]
+        except KeyError:
+            site_id = self.sites[location] = len(self.sites)
+        self.pending_sites.append(site_id)
+        self.pending_samples.append(sample_id)
+        self.pending_calls.append(count if methylated else -count)
+        if len(self.pending_calls) >= self.consolidate_every:
+            self.consolidate()
+
+    def consolidate(self):
+        """Sum the pending calls into the consolidated entries"""
+        if len(self.pending_calls) == 0 and len(self.pending_blocks) == 0:
+            return
+        blocks = [(self.entry_sites, self.entry_samples, self.entry_unmethylated, self.entry_methylated)]
+        blocks += self.pending_blocks
+        if len(self.pending_calls):
+            calls = np.array(self.pending_calls, dtype=np.int64)
+            blocks.append((np.array(self.pending_sites, dtype=np.int64),
+                           np.array(self.pending_samples, dtype=np.int64),
+                           np.where(calls < 0, -calls, 0),
+                           np.where(calls > 0, calls, 0)))
+
+        keys = np.concatenate([(sites << 32) | samples for sites, samples, _, _ in blocks])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        self.entry_sites = keys >> 32
+        self.entry_samples = keys & 0xffffffff
+        self.entry_unmethylated = np.bincount(
+            inverse, weights=np.concatenate([block[2] for block in blocks]), minlength=len(keys)).astype(np.int64)
+        self.entry_methylated = np.bincount(
+            inverse, weights=np.concatenate([block[3] for block in blocks]), minlength=len(keys)).astype(np.int64)
+
+        self.pending_blocks = []
+        self.pending_sites = []
+        self.pending_samples = []
+        self.pending_calls = []
+
+    def update(self, other):
+        """Add all calls of another SparseMethylationCountMatrix to this matrix.
+        Calls of (sample, location) pairs present in both matrices are summed.
+
+        Args:
+            other (SparseMethylationCountMatrix) : matrix to add
+        """
+        other.consolidate()
+        sample_map = np.array([self.samples.setdefault(sample, len(self.samples))
+                               for sample in other.samples], dtype=np.int64)
+        site_map = np.array([self.sites.setdefault(location, len(self.sites))
+                             for location in other.sites], dtype=np.int64)
+        if len(other.entry_sites):
+            self.pending_blocks.append((site_map[other.entry_sites], sample_map[other.entry_samples],
+                                        other.entry_unmethylated, other.entry_methylated))
+        if sum(len(block[0]) for block in self.pending_blocks) >= self.consolidate_every:
+            self.consolidate()
+
+    def get_sample_list(self):
+        return sorted(list(self.samples.keys()))
+
+    def __repr__(self):
+        return f'Methylation call matrix containing {len(self.samples)} samples and {len(self.sites)} locations'
+
+    def check_integrity(self):
+        if len(self.sites) == 0 or len(self.samples) == 0:
+            print(self)
+            raise ValueError('The count matrix contains no data, verify if the input data was empty or filtered to stringently')
+
+    def _get_orders(self):
+        """Obtain the rank of every site and sample id when sorted by location and sample"""
+        locations = list(self.sites)
+        site_rank = np.empty(len(locations), dtype=np.int64)
+        site_rank[sorted(range(len(locations)), key=locations.__getitem__)] = np.arange(len(locations))
+        samples = list(self.samples)
+        sample_rank = np.empty(len(samples), dtype=np.int64)
+        sample_rank[sorted(range(len(samples)), key=samples.__getitem__)] = np.arange(len(samples))
+        return site_rank, sample_rank
+
+    def get_sparse_matrix(self, dtype: str):
+        """
+        Get sparse matrix containing the selected counts
+
+        Args:
+            dtype: either 'methylated' or 'unmethylated'
+
+        Returns:
+            matrix (scipy.sparse.csr_matrix) : rows are samples in order of get_sample_list(),
+                columns are the sorted locations
+
+            samples (list) : sample for every row
+
+            locations (list) : location for every column
+        """
+        self.consolidate()
+        if dtype == 'methylated':
+            values = self.entry_methylated
+        elif dtype == 'unmethylated':
+            values = self.entry_unmethylated
+        else:
+            raise ValueError('dtype should be methylated or unmethylated')
+        site_rank, sample_rank = self._get_orders()
+        matrix = scipy.sparse.csr_matrix(
+            (values, (sample_rank[self.entry_samples], site_rank[self.entry_sites])),
+            shape=(len(self.samples), len(self.sites)))
+        return matrix, self.get_sample_list(), sorted(self.sites)
+
+    def get_frame(self, dtype: str):
+        """
+        Get pandas dataframe containing the selected column
+
+        Args:
+            dtype: either 'methylated', 'unmethylated' or 'beta'
+
+        Returns:
+            df(pd.DataFrame) : Dataframe containing the selected column, rows are samples, columns are locations
+
+        """
+        self.check_integrity()
+        self.consolidate()
+        if dtype == 'methylated':
+            values = self.entry_methylated
+        elif dtype == 'unmethylated':
+            values = self.entry_unmethylated
+        elif dtype == 'beta':
+            values = self.entry_methylated / (self.entry_methylated + self.entry_unmethylated)
         else:
-            for index, location in enumerate(columns):
-                mat[index, :] = self.get_bulk_column(samples, location)
+            raise ValueError
+        site_rank, sample_rank = self._get_orders()
+        mat = np.full((len(self.samples), len(self.sites)), np.nan)
+        mat[sample_rank[self.entry_samples], site_rank[self.entry_sites]] = values
+        return pd.DataFrame(mat, index=self.get_sample_list(), columns=pd.MultiIndex.from_tuples(sorted(self.sites)))
+
+    def get_sample_distance_matrix(self):
+        return MethylationCountMatrix.get_sample_distance_matrix(self)
+
+    def get_bulk_statistics(self):
+        """
+        Calculate the bulk statistics of every location, see get_bulk_statistics
+
+        Returns:
+            statistics (np.ndarray) : array of shape (n_sites, 5) indexed by site id, with columns
+                unmethylated, methylated, beta, variance and n_samples
+        """
+        self.consolidate()
+        return get_bulk_statistics(self.entry_sites, self.entry_unmethylated, self.entry_methylated, len(self.sites))
+
+    def get_bulk_frame(self, dtype='pd', use_multi=True):
+        """
+        Get pandas dataframe containing the selected columns
+
+        Args:
+            dtype (str) : 'pd' to return a pd.DataFrame, 'np' to return a np.ndarray
+
+            use_multi (bool) : accepted for compatibility with MethylationCountMatrix
+
+        Returns:
+            df(pd.DataFrame) : Dataframe containing the selected column, rows are locations,
+
+        """
+        self.check_integrity()
+        locations = list(self.sites)
+        order = sorted(range(len(locations)), key=locations.__getitem__)
+        mat = self.get_bulk_statistics()[order]
 
         if dtype == 'pd':
-            return pd.DataFrame(mat, index=pd.MultiIndex.from_tuples(columns),
+            return pd.DataFrame(mat, index=pd.MultiIndex.from_tuples([locations[i] for i in order]),
                                 columns=('unmethylated', 'methylated', 'beta', 'variance', 'n_samples'))
         elif dtype == 'np':
             return mat
         else:
             raise ValueError('dtype should be pd or np')
 
+    def _keep_sites(self, keep):
+        """Drop the locations for which keep is False, and the samples without calls left
+
+        Args:
+            keep (np.ndarray) : boolean for every site id
+        """
+        self.consolidate()
+        keep_entries = keep[self.entry_sites]
+        keep_samples = np.bincount(self.entry_samples[keep_entries], minlength=len(self.samples)) > 0
+
+        site_map = np.cumsum(keep) - 1
+        sample_map = np.cumsum(keep_samples) - 1
+        self.sites = {location: int(site_map[site_id]) for location, site_id in self.sites.items() if keep[site_id]}
+        self.samples = {sample: int(sample_map[sample_id]) for sample, sample_id in self.samples.items()
+                        if keep_samples[sample_id]}
+
+        self.entry_sites = site_map[self.entry_sites[keep_entries]]
+        self.entry_samples = sample_map[self.entry_samples[keep_entries]]
+        self.entry_unmethylated = self.entry_unmethylated[keep_entries]
+        self.entry_methylated = self.entry_methylated[keep_entries]
+
+    def prune(self, min_samples: int = 0, min_variance: float = None):
+        if len(self.sites) == 0 or len(self.samples) == 0 or min_samples == 0 and min_variance is None:
+            return
+        statistics = self.get_bulk_statistics()
+        keep = statistics[:, 4] >= min_samples
+        if min_variance is not None:
+            keep &= ~np.isnan(statistics[:, 3]) & (statistics[:, 3] >= min_variance)
+        if not keep.all():
+            self._keep_sites(keep)
+
+    def delete_location(self, location):
+        keep = np.ones(len(self.sites), dtype=bool)
+        keep[self.sites[location]] = False
+        self._keep_sites(keep)
+
 
 def methylation_dict_to_location_values(methylation_per_location_per_cell: dict, select_samples=None)->tuple:
     """
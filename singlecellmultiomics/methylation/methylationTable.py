@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pysam
+import pandas as pd
+from multiprocessing import Pool
+from singlecellmultiomics.bamProcessing.bamFunctions import get_contigs_with_reads
+from .methylation import extract_cpgs, SparseMethylationCountMatrix
+
+# Columns of a methylation table, pos is zero based, strand is '+', '-' or '.' when the calls are not stranded
+METHYLATION_TABLE_COLUMNS = ('contig', 'pos', 'strand', 'cell', 'met', 'unmet')
+
+
+def get_strand_symbol(strand):
+    """Convert a strand (bool, None or symbol) to the symbol written to a methylation table"""
+    if strand is None:
+        return '.'
+    if isinstance(strand, str):
+        return strand
+    return '+-'[bool(strand)]
+
+
+class MethylationTableWriter():
+    """Writes methylation calls to a BGZF compressed long format table with one row per (location, cell),
+    which is tabix indexed when the writer is closed.
+
+    The rows have to be written in coordinate order, all rows of a contig have to be written before the next contig.
+    Rows of every written batch are sorted, this allows to write the calls of consecutive regions as soon as they are
+    available. A location and cell can occur in more than one row, the reader sums these rows.
+
+    Example:
+        >>> with MethylationTableWriter('./calls.tsv.gz') as writer:
+        >>>     for region_calls in regions:
+        >>>         writer.write_calls(region_calls)
+    """
+
+    def __init__(self, path):
+        """Open a methylation table for writing
+
+        Args:
+            path (str) : path to write the table to, the tabix index is written to {path}.tbi
+        """
+        self.path = path
+        self.handle = pysam.BGZFile(path, 'wb')
+        self.handle.write(('#' + '\t'.join(METHYLATION_TABLE_COLUMNS) + '\n').encode())
+        self.written_contigs = []
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, rows):
+        """Write a batch of rows
+
+        Args:
+            rows (iterable) : (contig, pos, strand, cell, met, unmet) tuples, the batch is sorted before writing
+        """
+        rows = list(rows)
+        # Rows of the contig which is currently written go first, followed by the other contigs in order of appearance
+        contig_order = {} if not self.written_contigs else {self.written_contigs[-1]: -1}
+        for row in rows:
+            contig_order.setdefault(row[0], len(contig_order))
+        rows.sort(key=lambda row: (contig_order[row[0]], row[1], row[2], row[3]))
+
+        lines = []
+        for contig, pos, strand, cell, met, unmet in rows:
+            if not self.written_contigs or self.written_contigs[-1] != contig:
+                if contig in self.written_contigs:
+                    raise ValueError(f'The rows of {contig} were not written consecutively')
+                self.written_contigs.append(contig)
+            lines.append(f'{contig}\t{pos}\t{strand}\t{cell}\t{met}\t{unmet}\n')
+        self.handle.write(''.join(lines).encode())
+        self.rows += len(lines)
+
+    def write_calls(self, methylation_per_cell_per_cpg, stranded=False):
+        """Write the calls obtained from extract_cpgs
+
+        Args:
+            methylation_per_cell_per_cpg (dict) : (contig, pos[, strand]) -> cell -> [unmethylated, methylated]
+
+            stranded (bool) : the last element of every location is the strand
+        """
+        self.write(
+            (location[0], location[1], get_strand_symbol(location[-1] if stranded else None), cell, met, unmet)
+            for location, calls_per_cell in methylation_per_cell_per_cpg.items()
+            for cell, (unmet, met) in calls_per_cell.items())
+
+    def write_matrix(self, matrix):
+        """Write the calls of a (Sparse)MethylationCountMatrix, the location of every row is the start of the bin
+
+        Args:
+            matrix (MethylationCountMatrix or SparseMethylationCountMatrix) : locations are
+                (contig, bin_start, bin_end[, strand]) tuples
+        """
+        if isinstance(matrix, SparseMethylationCountMatrix):
+            matrix.consolidate()
+            locations = list(matrix.sites)
+            samples = list(matrix.samples)
+            entries = ((locations[site], samples[sample], unmet, met) for site, sample, unmet, met in zip(
+                matrix.entry_sites.tolist(), matrix.entry_samples.tolist(),
+                matrix.entry_unmethylated.tolist(), matrix.entry_methylated.tolist()))
+        else:
+            entries = ((location, sample, unmet, met)
+                       for sample, counts in matrix.counts.items()
+                       for location, (unmet, met) in counts.items())
+        self.write(
+            (location[0], location[1], get_strand_symbol(location[3] if len(location) > 3 else None), sample, met, unmet)
+            for location, sample, unmet, met in entries)
+
+    def close(self):
+        """Close the table and write the tabix index"""
+        if self.handle is None:
+            return
+        self.handle.close()
+        self.handle = None
+        pysam.tabix_index(self.path, seq_col=0, start_col=1, end_col=1, zerobased=True, meta_char='#', force=True)
+
+
+class MethylationTable():
+    """Lazy read access to a methylation table written by MethylationTableWriter,
+    only the blocks overlapping the queried region are decompressed.
+
+    Example:
+        >>> table = MethylationTable('./calls.tsv.gz')
+        >>> table.fetch('chr1', 1_000_000, 2_000_000, cells=['cell_1', 'cell_2'])
+    """
+
+    def __init__(self, path):
+        """Open a methylation table
+
+        Args:
+            path (str) : path to the table, the tabix index should exist at {path}.tbi
+        """
+        if not os.path.exists(f'{path}.tbi'):
+            raise ValueError(f'Tabix index missing at {path}.tbi')
+        self.path = path
+        self.handle = pysam.TabixFile(path, parser=pysam.asTuple())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.handle.close()
+
+    def get_contigs(self):
+        """Contigs with rows"""
+        return list(self.handle.contigs)
+
+    def fetch(self, contig, start=None, end=None, cells=None):
+        """
+        Obtain the calls of a contig or region
+
+        Args:
+            contig (str) : contig to fetch
+
+            start (int) : zero based start of the region, None to start at the start of the contig
+
+            end (int) : zero based end of the region (exclusive), None to fetch up to the end of the contig
+
+            cells (iterable) : cells to select, all cells when None
+
+        Returns:
+            calls (pd.DataFrame) : one row per (location, cell), with columns METHYLATION_TABLE_COLUMNS
+        """
+        if cells is not None:
+            cells = set(cells)
+        columns = {column: [] for column in METHYLATION_TABLE_COLUMNS}
+        if contig in self.handle.contigs:
+            for row in self.handle.fetch(contig, start, end):
+                if cells is not None and row[3] not in cells:
+                    continue
+                columns['contig'].append(row[0])
+                columns['pos'].append(int(row[1]))
+                columns['strand'].append(row[2])
+                columns['cell'].append(row[3])
+                columns['met'].append(int(row[4]))
+                columns['unmet'].append(int(row[5]))
+
+        calls = pd.DataFrame(columns)
+        calls[['pos', 'met', 'unmet']] = calls[['pos', 'met', 'unmet']].astype(int)
+        # Locations at the border of two written batches can be present in both batches
+        keys = ['contig', 'pos', 'strand', 'cell']
+        if calls.duplicated(keys).any():
+            calls = calls.groupby(keys, sort=False, as_index=False)[['met', 'unmet']].sum()
+        return calls
+
+    def get_frame(self, dtype, contig, start=None, end=None, cells=None):
+        """
+        Get pandas dataframe containing the selected column for a contig or region
+
+        Args:
+            dtype (str) : either 'methylated', 'unmethylated' or 'beta'
+
+            contig, start, end, cells : region and cells to select, see fetch
+
+        Returns:
+            df(pd.DataFrame) : rows are cells, columns are (contig, pos, strand) locations,
+                NaN for locations without calls in a cell
+        """
+        calls = self.fetch(contig, start, end, cells)
+        if dtype == 'methylated':
+            calls['value'] = calls['met']
+        elif dtype == 'unmethylated':
+            calls['value'] = calls['unmet']
+        elif dtype == 'beta':
+            calls['value'] = calls['met'] / (calls['met'] + calls['unmet'])
+        else:
+            raise ValueError
+        return calls.pivot(index='cell', columns=['contig', 'pos', 'strand'], values='value').sort_index()
+
+
+def _extract_region_rows(args):
+    """Obtain the sorted methylation table rows of a single region"""
+    bam_path, contig, start, end, fetch_margin, stranded, kwargs = args
+    calls = extract_cpgs(bam_path,
+                         contig,
+                         start=start,
+                         end=end,
+                         fetch_start=max(0, start - fetch_margin),
+                         fetch_end=end + fetch_margin,
+                         stranded=stranded,
+                         **kwargs)
+    return sorted(
+        (location[0], location[1], get_strand_symbol(location[-1] if stranded else None), cell, met, unmet)
+        for location, calls_per_cell in calls.items()
+        for cell, (unmet, met) in calls_per_cell.items())
+
+
+def write_methylation_table(bam_path,
+                            table_path,
+                            fragment_class,
+                            molecule_class,
+                            contigs=None,
+                            region_size=1_000_000,
+                            fetch_margin=1_000,
+                            threads=None,
+                            stranded=False,
+                            **extract_kwargs):
+    """
+    Extract the single CpG methylation calls of every cell from a BAM file and write them to a methylation table.
+    The calls are extracted per region and written as soon as the region is finished,
+    the memory usage is bound by the amount of regions in flight instead of the size of the genome.
+
+    Args:
+        bam_path (str) : path to coordinate sorted and indexed BAM file
+
+        table_path (str) : path to write the table to, for example ./calls.tsv.gz
+
+        fragment_class, molecule_class : classes used to assemble the molecules, see extract_cpgs
+
+        contigs (list) : contigs to process, all contigs with reads when None
+
+        region_size (int) : size of the regions processed in one go
+
+        fetch_margin (int) : amount of bases fetched around every region, should be at least the fragment size
+
+        threads (int) : amount of regions to process in parallel
+
+        stranded (bool) : write strand specific calls
+
+        extract_kwargs : additional arguments supplied to extract_cpgs, for example context or reference_path
+
+    Returns:
+        rows (int) : amount of rows written
+    """
+    if extract_kwargs.get('allelic') or extract_kwargs.get('pool_alias') or extract_kwargs.get('bin_size'):
+        raise ValueError('Allelic, pooled or binned calls can not be written to a methylation table')
+    extract_kwargs.update({'fragment_class': fragment_class, 'molecule_class': molecule_class})
+
+    contig_lengths = dict(get_contigs_with_reads(bam_path, with_length=True))
+    if contigs is None:
+        contigs = list(contig_lengths)
+    jobs = ((bam_path, contig, start, min(start + region_size, contig_lengths[contig]), fetch_margin, stranded,
+             extract_kwargs)
+            for contig in contigs if contig in contig_lengths
+            for start in range(0, contig_lengths[contig], region_size))
+
+    with MethylationTableWriter(table_path) as writer:
+        if threads is not None and threads > 1:
+            with Pool(threads) as workers:
+                for rows in workers.imap(_extract_region_rows, jobs):
+                    writer.write(rows)
+        else:
+            for rows in map(_extract_region_rows, jobs):
+                writer.write(rows)
+    return writer.rows
@@ -14,6 +14,123 @@ import singlecellmultiomics.modularDemultiplexer.demultiplexModules as dm
 import singlecellmultiomics.fastqProcessing.fastqIterator as fastqIterator
 from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import NonMultiplexable, IlluminaBaseDemultiplexer
 import logging
+import multiprocessing
+
+
+class DemultiplexedRecord():
+    """Text representation of a demultiplexed record, used to send records from
+    demultiplexing worker processes to the writing process.
+    Keeps the tags which are used by FastqHandle to select the output file.
+    """
+    __slots__ = ('text', 'tags')
+
+    def __init__(self, record):
+        self.text = str(record)
+        self.tags = {tag: record.tags[tag] for tag in ('bi', 'MX') if tag in record.tags} \
+            if hasattr(record, 'tags') else {}
+
+    def __str__(self):
+        return self.text
+
+
+def demultiplex_read_pair(reads, strategies, baseDemux, library=None, probe=None, reject=True):
+    """Demultiplex a single read pair using all supplied strategies
+
+    Args:
+        reads (tuple) : FastqRecord of every read of the pair
+
+        strategies (list) : demultiplexing strategies to apply
+
+        baseDemux (IlluminaBaseDemultiplexer) : strategy used to create the rejected records
+
+        reject (bool) : create records for read pairs which could not be demultiplexed
+
+    Returns:
+        demultiplexed (list) : demultiplexed records of every strategy which could demultiplex the pair
+        rejected (list) : records of every strategy which could not demultiplex the pair
+        yields (collections.Counter) : strategy shortName -> 1 for every strategy which yielded the pair
+        errors (list) : (printed message, log message) for every strategy which failed
+    """
+    demultiplexed = []
+    rejected = []
+    yields = collections.Counter()
+    errors = []
+    for strategy in strategies:
+        try:
+            demultiplexed.append(strategy.demultiplex(
+                reads, library=library, probe=probe))
+
+        except NonMultiplexable as reason:
+            # print('NonMultiplexable')
+            if not reject:
+                continue
+            try:
+                rejected.append(baseDemux.demultiplex(
+                    reads, library=library, reason=reason))
+
+            except NonMultiplexable as e:
+                # we cannot read the header of the read..
+                rejected.append([
+                    '\n'.join(
+                        (read.header +
+                         f';RR:{reason};Rr:{e}',
+                         read.sequence,
+                         read.plus,
+                         read.qual)) for read in reads])
+            continue
+        except Exception as e:
+            if probe:
+                continue
+            errors.append((
+                '\n'.join([
+                    traceback.format_exc(),
+                    f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}',
+                    'The read(s) causing the error looked like this:'] +
+                    [str(read) for read in reads] +
+                    [Style.RESET_ALL]),
+                f"Error occured using {strategy.longName}\n"))
+        # print(recodedRecord)
+        yields[strategy.shortName] += 1
+    return demultiplexed, rejected, yields, errors
+
+
+def _chunked(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk):
+        yield chunk
+
+
+_worker_state = None
+
+
+def _initialise_demultiplex_worker(strategies, baseDemux, library, probe, reject):
+    global _worker_state
+    _worker_state = (strategies, baseDemux, library, probe, reject)
+
+
+def _demultiplex_chunk(read_pairs):
+    """Demultiplex a chunk of read pairs in a worker process,
+    returns the concatenated results of demultiplex_read_pair"""
+    strategies, baseDemux, library, probe, reject = _worker_state
+    demultiplexed = []
+    rejected = []
+    yields = collections.Counter()
+    errors = []
+    for reads in read_pairs:
+        pair_demultiplexed, pair_rejected, pair_yields, pair_errors = demultiplex_read_pair(
+            reads, strategies, baseDemux, library=library, probe=probe, reject=reject)
+        demultiplexed += [[DemultiplexedRecord(record) for record in records]
+                          for records in pair_demultiplexed]
+        rejected += [[DemultiplexedRecord(record) for record in records]
+                     for records in pair_rejected]
+        yields.update(pair_yields)
+        errors += pair_errors
+    return demultiplexed, rejected, yields, errors
 
 
 class DemultiplexingStrategyLoader:
@@ -111,19 +228,26 @@ class DemultiplexingStrategyLoader:
             raise ValueError()
         return selectedStrategies
 
-    def list(self):
+    def list(self, show_target_counts=True):
+        """Print the available demultiplexing strategies
+
+        Args:
+            show_target_counts (bool) : show the amount of barcodes of every strategy, this requires loading the barcodes of all strategies
+        """
         print(f"{Style.BRIGHT}Available demultiplexing strategies:{Style.RESET_ALL}")
         #print('Name, alias, will be auto detected, description')
         for strategy in self.demultiplexingStrategies:
 
             try:
+                target_count = strategy.barcodeFileParser.getTargetCount(strategy.barcodeFileAlias) \
+                    if show_target_counts and hasattr(strategy, "barcodeFileParser") else "NA"
                 print(
                     f'{Style.BRIGHT}{strategy.shortName}{Style.RESET_ALL}\t{strategy.longName}\t' +
                     (
                         f'{Fore.GREEN}Will be autodetected' if strategy.autoDetectable else f'{Fore.RED}Will not be autodetected') +
                     Style.RESET_ALL +
                     Style.DIM +
-                    f' {strategy.barcodeFileParser.getTargetCount(strategy.barcodeFileAlias) if hasattr(strategy,"barcodeFileParser") else "NA"} targets\n ' +
+                    f' {target_count} targets\n ' +
                     Style.DIM +
                     strategy.description +
                     '\n' +
@@ -167,8 +291,36 @@ class DemultiplexingStrategyLoader:
             targetFile=None,
             rejectHandle=None,
             log_handle=None,
-            probe=None
+            probe=None,
+            threads=1,
+            chunk_size=10000
             ):
+        """Demultiplex read pairs from fastq files
+
+        Args:
+            fastqfiles (list) : paths to the R1 (and R2) fastq file
+
+            maxReadPairs (int) : maximum amount of read pairs to process
+
+            strategies (list) : strategies to apply, when None the auto detectable strategies are used
+
+            library (str) : library name
+
+            targetFile (FastqHandle) : handle to write demultiplexed read pairs to
+
+            rejectHandle (FastqHandle) : handle to write rejected read pairs to
+
+            log_handle (file) : handle to write log messages to
+
+            probe (bool) : probing run used for detecting the library type
+
+            threads (int) : amount of worker processes, the output is identical to a single process run
+
+            chunk_size (int) : amount of read pairs sent to a worker at once
+
+        Returns:
+            processedReadPairs (int), strategyYields (collections.Counter)
+        """
 
         useStrategies = strategies if strategies is not None else self.getAutodetectStrategies()
         strategyYields = collections.Counter()
@@ -178,57 +330,50 @@ class DemultiplexingStrategyLoader:
             barcodeParser=self.barcodeParser,
             probe=probe)
 
-        for p, reads in enumerate(
-                fastqIterator.FastqIterator(*fastqfiles)):
-            processedReadPairs = p+1
-
-            for strategy in useStrategies:
-                try:
-                    recodedRecords = strategy.demultiplex(
-                        reads, library=library, probe=probe)
-
-                    if targetFile is not None:
-                        targetFile.write(recodedRecords)
-
-                except NonMultiplexable as reason:
-                    # print('NonMultiplexable')
-                    if rejectHandle is not None:
-
-                        try:
-                            to_write = baseDemux.demultiplex(
-                                reads, library=library, reason=reason)
-                            rejectHandle.write(to_write)
-
-                        except NonMultiplexable as e:
-                            # we cannot read the header of the read..
-                            reads = [
-                                '\n'.join(
-                                    (read.header +
-                                     f';RR:{reason};Rr:{e}',
-                                     read.sequence,
-                                     read.plus,
-                                     read.qual)) for read in reads]
-                            rejectHandle.write(reads)
+        def write_results(results):
+            demultiplexed, rejected, yields, errors = results
+            if targetFile is not None:
+                for records in demultiplexed:
+                    targetFile.write(records)
+            if rejectHandle is not None:
+                for records in rejected:
+                    rejectHandle.write(records)
+            for message, log_message in errors:
+                print(message)
+                if log_handle is not None:
+                    log_handle.write(log_message)
+            strategyYields.update(yields)
+
+        with fastqIterator.FastqIterator(*fastqfiles) as fastq_iterator:
+
+            def read_pairs():
+                for p, reads in enumerate(fastq_iterator):
+                    yield reads
+                    if (maxReadPairs is not None and (
+                            p+1) >= maxReadPairs):
+                        break
+
+            if threads > 1:
+                with multiprocessing.Pool(threads,
+                                          initializer=_initialise_demultiplex_worker,
+                                          initargs=(useStrategies, baseDemux, library, probe,
+                                                    rejectHandle is not None)) as pool:
+                    pending = collections.deque()
+                    for chunk in _chunked(read_pairs(), chunk_size):
+                        processedReadPairs += len(chunk)
+                        pending.append(pool.apply_async(_demultiplex_chunk, (chunk,)))
+                        # Limit the amount of chunks held in memory, write in order
+                        while len(pending) > 2 * threads:
+                            write_results(pending.popleft().get())
+                    while len(pending):
+                        write_results(pending.popleft().get())
+            else:
+                for reads in read_pairs():
+                    processedReadPairs += 1
+                    write_results(demultiplex_read_pair(
+                        reads, useStrategies, baseDemux, library=library, probe=probe,
+                        reject=rejectHandle is not None))
 
-                    continue
-                except Exception as e:
-                    if probe:
-                        continue
-                    print(traceback.format_exc())
-                    print(
-                        f'{Fore.RED}Fatal error. While demultiplexing strategy {strategy.longName} yielded an error, the error message was: {e}')
-                    print('The read(s) causing the error looked like this:')
-                    for read in reads:
-                        print(str(read))
-                    print(Style.RESET_ALL)
-                    if log_handle is not None:
-                        log_handle.write(
-                            f"Error occured using {strategy.longName}\n")
-                # print(recodedRecord)
-                strategyYields[strategy.shortName] += 1
-            if (maxReadPairs is not None and (
-                    processedReadPairs) >= maxReadPairs):
-                break
         # write yields to log file if applicable:
         if log_handle is not None:
             log_handle.write(f'processed {processedReadPairs+1} read pairs\n')
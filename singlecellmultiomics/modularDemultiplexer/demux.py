@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import pkg_resources
+import time
+# Used to report the time spent on start-up
+start_time = time.time()
+import collections
 import logging
 from singlecellmultiomics.modularDemultiplexer.baseDemultiplexMethods import NonMultiplexable
 from colorama import init
@@ -122,9 +125,7 @@ if __name__ == '__main__':
         action='store_true')
     bcArgs.add_argument(
         '-barcodeDir',
-        default=pkg_resources.resource_filename(
-            'singlecellmultiomics',
-            'modularDemultiplexer/barcodes/'),
+        default=os.path.join(demuxer_location, 'barcodes/'),
         help="Directory from which to obtain the barcodes, when nothing is supplied the package resources are used")
 
     indexArgs = argparser.add_argument_group('Sequencing indices', '')
@@ -134,9 +135,7 @@ if __name__ == '__main__':
         action='store_true')
     indexArgs.add_argument(
         '-indexDir',
-        default=pkg_resources.resource_filename(
-            'singlecellmultiomics',
-            'modularDemultiplexer/indices/'),
+        default=os.path.join(demuxer_location, 'indices/'),
         help="Directory from which to obtain the sequencing indices,  when nothing is supplied the package resources are used")
     indexArgs.add_argument(
         '-si', help="Select only these sequencing indices -si CGATGT,TTAGGC")
@@ -175,6 +174,11 @@ if __name__ == '__main__':
         help="Amount of reads used to determine barcode type",
         type=int,
         default=2000)
+    techArgs.add_argument(
+        '-t',
+        help="Amount of worker processes used for demultiplexing, the output is identical to a run using a single process",
+        type=int,
+        default=1)
     techArgs.add_argument(
         '--nochunk',
         help="Do not run lanes in separate jobs",
@@ -235,6 +239,11 @@ if __name__ == '__main__':
     args = argparser.parse_args()
     verbosity = 1
 
+    # Duration of every start-up stage, reported before demultiplexing
+    startup_timings = collections.OrderedDict()
+    startup_timings['imports and argument parsing'] = time.time() - start_time
+    checkpoint = time.time()
+
     if args.y and args.sched is not None:
         raise ValueError('Use --y or -sched [scheduler], never both')
 
@@ -262,7 +271,7 @@ if __name__ == '__main__':
     # Sort the fastq files..
     args.fastqfiles = sorted(args.fastqfiles)
 
-    # Load barcodes
+    # Load barcodes, the barcode files are parsed and expanded when a strategy first uses them
     barcodeParser = barcodeFileParser.BarcodeParser(
         hammingDistanceExpansion=args.hd,
         barcodeDirectory=args.barcodeDir)
@@ -298,6 +307,9 @@ if __name__ == '__main__':
     if args.li:
         indexParser.list(showBarcodes=None)
 
+    startup_timings['barcode and index parsers'] = time.time() - checkpoint
+    checkpoint = time.time()
+
     # Load the demultiplexing strategies
     dmx = DemultiplexingStrategyLoader(
         barcodeParser=barcodeParser,
@@ -305,7 +317,11 @@ if __name__ == '__main__':
         #ignoreMethods=ignoreMethods,
         only_detect_methods = only_detect_methods,
         indexFileAlias=indexFileAlias)
-    dmx.list()
+    # Showing the target counts requires the barcodes of every strategy,
+    # when the strategies are supplied only the barcodes of the selected strategies are loaded
+    dmx.list(show_target_counts=args.use is None)
+    startup_timings['strategies'] = time.time() - checkpoint
+    checkpoint = time.time()
 
     if len(args.fastqfiles) == 0:
         print(f'{Fore.RED}No files supplied, exitting.{Style.RESET_ALL}')
@@ -314,6 +330,8 @@ if __name__ == '__main__':
     print(f"\n{Style.BRIGHT}Detected libraries:{Style.RESET_ALL}")
     libraries = sequencingLibraryListing.SequencingLibraryLister().detect(
         args.fastqfiles, args=args)
+    startup_timings['library detection'] = time.time() - checkpoint
+    checkpoint = time.time()
 
     # Detect the libraries:
     if args.use is None:
@@ -325,6 +343,12 @@ if __name__ == '__main__':
         # Run autodetect
         processedReadPairs, strategyYieldsForAllLibraries = dmx.detectLibYields(
             libraries, testReads=args.dsize, maxAutoDetectMethods=args.maxAutoDetectMethods, minAutoDetectPct=args.minAutoDetectPct, verbose=True)
+        startup_timings['strategy autodetection'] = time.time() - checkpoint
+
+    print(f"\n{Style.BRIGHT}Start-up timing:{Style.RESET_ALL}")
+    for stage, duration in startup_timings.items():
+        print(f'{Style.DIM}{stage}:{Style.RESET_ALL} {duration:.2f}s')
+    print(f'{Style.DIM}total:{Style.RESET_ALL} {time.time() - start_time:.2f}s')
 
     print(f"\n{Style.BRIGHT}Demultiplexing:{Style.RESET_ALL}")
 
@@ -477,6 +501,7 @@ if __name__ == '__main__':
                                                                          rejectHandle=rejectHandle,
                                                                          log_handle=log_handle,
                                                                          library=library,
+                                                                         threads=args.t,
                                                                          maxReadPairs=None if args.n is None else (args.n - processedReadPairsForThisLib))
                     processedReadPairsForThisLib += processedReadPairs
                     log_handle.write(
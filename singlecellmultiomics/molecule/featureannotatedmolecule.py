@@ -1,5 +1,6 @@
 from singlecellmultiomics.molecule.molecule import Molecule
 import collections
+import numpy as np
 import pandas as pd
 
 class TranscriptMolecule(Molecule):
@@ -265,32 +266,42 @@ class FeatureAnnotatedMolecule(Molecule):
 
             # Obtain all blocks:
             try:
-                for start, end in self.get_aligned_blocks():
-                    for hit in self.features.findFeaturesBetween(
-                            chromosome=self.chromosome, sampleStart=start, sampleEnd=end, strand=strand):
-                        hit_start, hit_end, hit_id, hit_strand, hit_ids = hit
-                        self.hits[hit_ids].add(
-                            (self.chromosome, (hit_start, hit_end)))
-
-                        if self.capture_locations:
-                            if not hit_id in self.feature_locations:
-                                self.feature_locations[hit_id] = []
-                            self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
-
+                blocks = list(self.get_aligned_blocks())
             except TypeError:
                 # This happens when no reads map
-                pass
+                blocks = []
+            if len(blocks):
+                # Look up the features of all blocks at once
+                offsets, indices = self.features.findFeatureIndicesBetween(
+                    self.chromosome,
+                    [start for start, end in blocks],
+                    [end for start, end in blocks],
+                    strands=strand)
+                contig_features = self.features.features.get(self.chromosome, [])
+                for index in indices.tolist():
+                    hit_start, hit_end, hit_id, hit_strand, hit_ids = contig_features[index]
+                    self.hits[hit_ids].add(
+                        (self.chromosome, (hit_start, hit_end)))
+
+                    if self.capture_locations:
+                        if not hit_id in self.feature_locations:
+                            self.feature_locations[hit_id] = []
+                        self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
         else:
 
             for read in self.iter_reads():
-                for q_pos, ref_pos in read.get_aligned_pairs(
-                        matches_only=True, with_seq=False):
-                    for hit in self.features.findFeaturesAt(
-                            chromosome=read.reference_name, lookupCoordinate=ref_pos, strand=strand):
-                        hit_start, hit_end, hit_id, hit_strand, hit_ids = hit
-                        self.hits[hit_ids].add((read.reference_name, ref_pos))
-
-                        if self.capture_locations:
-                            if not hit_id in self.feature_locations:
-                                self.feature_locations[hit_id] = []
-                            self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
+                ref_positions = [ref_pos for q_pos, ref_pos in read.get_aligned_pairs(
+                        matches_only=True, with_seq=False)]
+                # Every aligned position is a region of a single base
+                offsets, indices = self.features.findFeatureIndicesBetween(
+                    read.reference_name, ref_positions, ref_positions, strands=strand)
+                contig_features = self.features.features.get(read.reference_name, [])
+                for ref_pos, index in zip(
+                        np.repeat(ref_positions, np.diff(offsets)).tolist(), indices.tolist()):
+                    hit_start, hit_end, hit_id, hit_strand, hit_ids = contig_features[index]
+                    self.hits[hit_ids].add((read.reference_name, ref_pos))
+
+                    if self.capture_locations:
+                        if not hit_id in self.feature_locations:
+                            self.feature_locations[hit_id] = []
+                        self.feature_locations[hit_id].append( (hit_start, hit_end, hit_strand))
@@ -6,6 +6,8 @@ from singlecellmultiomics.utils.prefetch import initialise_dict, initialise
 from singlecellmultiomics.universalBamTagger import QueryNameFlagger
 import pysamiterators.iterators
 import collections
+import functools
+import heapq
 import pysam
 
 
@@ -18,6 +20,268 @@ class ReadIterator(pysamiterators.iterators.MatePairIterator):
         except StopIteration:
             raise
 
+class EjectionIndex():
+    """Index on the molecules buffered by a MoleculeIterator, used to find the
+    molecules which can be ejected without calling can_be_yielded on every buffered molecule.
+
+    For every contig two heaps are kept, a min-heap keyed on the coordinate after which a
+    molecule can be yielded (spanEnd + cache_size*0.5) and a max-heap keyed on the
+    coordinate before which a molecule can be yielded (spanStart - cache_size*0.5).
+    The span of a molecule only grows when fragments are added, so a key stored in a heap
+    is always less strict than the actual key. Stale keys are refreshed when they surface
+    at the top of a heap. A molecule ejected using one heap leaves an entry in the other heap,
+    the heaps of a contig are compacted when these entries outnumber the buffered molecules.
+
+    Example:
+        >>> index = EjectionIndex()
+        >>> index.add(molecule, hash_group=molecule.match_hash)
+        >>> if index.has_ejectable('chr1', 1_000_000):
+        >>>     for serial, molecule, hash_group in index.pop_ejectable('chr1', 1_000_000):
+        >>>         print(molecule)
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.contigs = {} # contig -> (after_heap, before_heap)
+        self.contig_sizes = {} # contig -> amount of buffered molecules
+        self.buffered = {} # serial -> (molecule, hash_group)
+        self.serial = 0
+
+    def __len__(self):
+        return len(self.buffered)
+
+    @staticmethod
+    def eject_after(molecule):
+        if molecule.spanEnd is None:
+            return float('inf')
+        return molecule.spanEnd + molecule.cache_size * 0.5
+
+    @staticmethod
+    def eject_before(molecule):
+        if molecule.spanStart is None:
+            return float('-inf')
+        return molecule.spanStart - molecule.cache_size * 0.5
+
+    def add(self, molecule, hash_group=None):
+        """Add a molecule to the index
+
+        Args:
+            molecule (Molecule) : molecule to add, the chromosome of the molecule has to be set
+
+            hash_group : hash group of the molecule, returned when the molecule is ejected
+
+        Returns:
+            serial (int) : insertion serial of the molecule
+        """
+        serial = self.serial
+        self.serial += 1
+        self.buffered[serial] = (molecule, hash_group)
+        after_heap, before_heap = self.contigs.setdefault(molecule.chromosome, ([], []))
+        heapq.heappush(after_heap, (self.eject_after(molecule), serial))
+        heapq.heappush(before_heap, (-self.eject_before(molecule), serial))
+        self.contig_sizes[molecule.chromosome] = self.contig_sizes.get(molecule.chromosome, 0) + 1
+        return serial
+
+    def _top(self, heap):
+        # Discard entries of molecules which have been ejected using the other heap
+        while len(heap) and heap[0][1] not in self.buffered:
+            heapq.heappop(heap)
+        return heap[0] if len(heap) else None
+
+    def _compact(self, chromosome):
+        # Remove the entries of ejected molecules, amortised over the ejections which created them
+        live = self.contig_sizes[chromosome]
+        for heap in self.contigs[chromosome]:
+            if len(heap) > 2 * live + 64:
+                heap[:] = [entry for entry in heap if entry[1] in self.buffered]
+                heapq.heapify(heap)
+
+    def has_ejectable(self, chromosome, position):
+        """Check if any of the indexed molecules can be yielded at the supplied location.
+        This only inspects the watermark of the heaps and is cheap enough to call for every fragment.
+        The answer can be a false positive when stale keys are at the top of the heaps.
+
+        Args:
+            chromosome (str) : chromosome / contig of location to test
+            position (int) : genomic location of location to test
+
+        Returns:
+            has_ejectable (bool)
+        """
+        if chromosome is None or len(self.buffered) == 0:
+            return False
+        if len(self.contigs) > 1 or chromosome not in self.contigs:
+            return True
+        after_heap, before_heap = self.contigs[chromosome]
+        top = self._top(after_heap)
+        if top is not None and position > top[0]:
+            return True
+        top = self._top(before_heap)
+        if top is not None and position < -top[0]:
+            return True
+        return False
+
+    def pop_ejectable(self, chromosome, position):
+        """Remove and return all molecules for which can_be_yielded(chromosome, position) holds
+
+        Args:
+            chromosome (str) : chromosome / contig of location to test
+            position (int) : genomic location of location to test
+
+        Returns:
+            ejected (list) : list of (serial, molecule, hash_group) tuples, sorted by serial
+        """
+        if chromosome is None:
+            return []
+
+        ejected = []
+        # Everything on other contigs can be yielded
+        for contig in [contig for contig in self.contigs if contig != chromosome]:
+            del self.contig_sizes[contig]
+            for heap in self.contigs.pop(contig):
+                for _, serial in heap:
+                    if serial in self.buffered:
+                        molecule, hash_group = self.buffered.pop(serial)
+                        ejected.append((serial, molecule, hash_group))
+
+        if chromosome in self.contigs:
+            after_heap, before_heap = self.contigs[chromosome]
+            n_ejected = len(ejected)
+            while True:
+                top = self._top(after_heap)
+                if top is None or not position > top[0]:
+                    break
+                _, serial = heapq.heappop(after_heap)
+                molecule, hash_group = self.buffered[serial]
+                key = self.eject_after(molecule)
+                if position > key:
+                    del self.buffered[serial]
+                    ejected.append((serial, molecule, hash_group))
+                else:
+                    heapq.heappush(after_heap, (key, serial))
+
+            while True:
+                top = self._top(before_heap)
+                if top is None or not position < -top[0]:
+                    break
+                _, serial = heapq.heappop(before_heap)
+                molecule, hash_group = self.buffered[serial]
+                key = self.eject_before(molecule)
+                if position < key:
+                    del self.buffered[serial]
+                    ejected.append((serial, molecule, hash_group))
+                else:
+                    heapq.heappush(before_heap, (-key, serial))
+
+            self.contig_sizes[chromosome] -= len(ejected) - n_ejected
+            if self.contig_sizes[chromosome] == 0:
+                del self.contigs[chromosome]
+                del self.contig_sizes[chromosome]
+            else:
+                self._compact(chromosome)
+
+        ejected.sort(key=lambda t: t[0])
+        return ejected
+
+
+@functools.lru_cache(maxsize=2**17)
+def umi_index_keys(umi):
+    """Obtain the keys a UMI is stored under in a MoleculeHashGroup
+
+    Every UMI is stored under its exact sequence. UMIs without N are also stored under
+    their deletion neighbourhood: the UMI with one position removed, for every position.
+    Two UMIs of the same length have a hamming distance of at most 1 when they share one of these keys.
+    UMIs containing N (which matches any base) are stored under a wildcard key.
+
+    Args:
+        umi (str) : umi sequence
+
+    Returns:
+        keys (tuple) : tuple of hashable keys
+    """
+    if isinstance(umi, str) and 'N' not in umi:
+        return ((None, umi), ) + tuple( (i, umi[:i] + umi[i+1:]) for i in range(len(umi)) )
+    return ((None, umi), ('*', ))
+
+
+class MoleculeHashGroup():
+    """Molecules sharing the same match_hash, indexed on UMI.
+
+    Used by the MoleculeIterator to obtain the molecules a fragment could be assigned to
+    without comparing the fragment to every molecule in the hash group.
+    The candidate molecules are a superset of the molecules which have a UMI matching the
+    fragment and are returned in order of insertion, this way the first molecule
+    accepting the fragment is identical to the one found by a linear search.
+    """
+
+    def __init__(self):
+        self.molecules = {} # serial -> molecule, in order of insertion
+        self.keyed_umi = {} # serial -> umi the molecule is stored under
+        self.buckets = collections.defaultdict(dict) # key -> {serial: molecule}
+
+    def __len__(self):
+        return len(self.molecules)
+
+    def __iter__(self):
+        return iter(self.molecules.values())
+
+    def add(self, serial, molecule):
+        self.molecules[serial] = molecule
+        self._store(serial, molecule)
+
+    def _store(self, serial, molecule):
+        self.keyed_umi[serial] = molecule.umi
+        for key in umi_index_keys(molecule.umi):
+            self.buckets[key][serial] = molecule
+
+    def _unstore(self, serial):
+        for key in umi_index_keys(self.keyed_umi.pop(serial)):
+            bucket = self.buckets[key]
+            del bucket[serial]
+            if len(bucket) == 0:
+                del self.buckets[key]
+
+    def remove(self, serial):
+        self._unstore(serial)
+        del self.molecules[serial]
+
+    def update(self, serial):
+        """Update the index after a fragment has been added to the molecule, the umi of the molecule can have changed"""
+        molecule = self.molecules[serial]
+        if molecule.umi != self.keyed_umi[serial]:
+            self._unstore(serial)
+            self._store(serial, molecule)
+
+    def candidates(self, fragment):
+        """Obtain the molecules the fragment could be assigned to
+
+        Args:
+            fragment (Fragment) : fragment to assign
+
+        Returns:
+            candidates (list) : list of (serial, molecule) tuples in order of insertion
+        """
+        if not fragment.umi_indexable:
+            return list(self.molecules.items())
+
+        umi = fragment.umi
+        if fragment.umi_hamming_distance == 0:
+            keys = ((None, umi), )
+        elif fragment.umi_hamming_distance == 1 and isinstance(umi, str) and 'N' not in umi:
+            keys = umi_index_keys(umi) + (('*', ), )
+        else:
+            return list(self.molecules.items())
+
+        found = {}
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                found.update(bucket)
+        return sorted(found.items(), key=lambda t: t[0])
+
+
 class MoleculeIterator():
     """Iterate over molecules in pysam.AlignmentFile or reads from a generator or list
 
@@ -144,9 +408,8 @@ class MoleculeIterator():
 
     def __init__(self, alignments, molecule_class=Molecule,
                  fragment_class=Fragment,
-                 check_eject_every=10_000,  # bigger sizes are very speed benificial
-                 molecule_class_args={},  # because the relative amount of molecules
-                 # which can be ejected will be much higher
+                 check_eject_every=1,  # checks use the ejection index and are cheap
+                 molecule_class_args={},
                  fragment_class_args={},
                  perform_qflag=True,
                  pooling_method=1,
@@ -173,7 +436,7 @@ class MoleculeIterator():
 
             fragment_class (pysam.FastaFile): Class to use for fragments.
 
-            check_eject_every (int): Check for yielding every N reads. When None is supplied, all reads are kept into memory making coordinate sorted data not required.
+            check_eject_every (int): Check for yielding every N fragments. The check only inspects the watermark of the ejection index, so checking every fragment is cheap. When None is supplied, all reads are kept into memory making coordinate sorted data not required.
 
             molecule_class_args (dict): arguments to pass to molecule_class.
 
@@ -182,7 +445,7 @@ class MoleculeIterator():
             perform_qflag (bool):  Make sure the sample/umi etc tags are copied
                 from the read name into bam tags
 
-            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash
+            pooling_method(int) : 0: no  pooling, 1: only compare molecules with the same sample id and hash, within a hash group the molecules are indexed on UMI
 
             yield_invalid (bool) : When true all fragments which are invalid will be yielded as a molecule
 
@@ -236,11 +499,14 @@ class MoleculeIterator():
         self.yielded_fragments = 0
         self.deleted_fragments = 0
         self.check_ejection_iter = 0
+        self.ejection_index = EjectionIndex()
+        self.hash_group_order = {} # hash -> rank, hash groups are removed when all their molecules are ejected
+        self.hash_group_serial = 0
         if self.pooling_method == 0:
-            self.molecules = []
+            self.molecules = {} # serial -> molecule, in order of insertion
         elif self.pooling_method == 1:
             self.molecules_per_cell = collections.defaultdict(
-                list)  # {hash:[], :}
+                MoleculeHashGroup)  # {hash:MoleculeHashGroup, :}
         else:
             raise NotImplementedError()
 
@@ -251,14 +517,7 @@ class MoleculeIterator():
         Mate pair iterator: {str(self.matePairIterator)}"""
 
     def get_molecule_cache_size(self):
-        if self.pooling_method == 0:
-            return len(self.molecules)
-        elif self.pooling_method == 1:
-            return sum(len(cell_molecules) for cell,
-                       cell_molecules in self.molecules_per_cell.items())
-
-        else:
-            raise NotImplementedError()
+        return len(self.ejection_index)
 
 
     def yield_func(self, molecule_to_be_emitted):
@@ -351,13 +610,15 @@ class MoleculeIterator():
             added = False
             try:
                 if self.pooling_method == 0:
-                    for molecule in self.molecules:
+                    for molecule in self.molecules.values():
                         if molecule.add_fragment(fragment, use_hash=False):
                             added = True
                             break
                 elif self.pooling_method == 1:
-                    for molecule in self.molecules_per_cell[fragment.match_hash]:
+                    hash_group = self.molecules_per_cell.get(fragment.match_hash)
+                    for serial, molecule in (() if hash_group is None else hash_group.candidates(fragment)):
                         if molecule.add_fragment(fragment, use_hash=True):
+                            hash_group.update(serial)
                             added = True
                             break
             except OverflowError:
@@ -372,13 +633,15 @@ class MoleculeIterator():
                 continue
 
             if not added:
+                m = self.molecule_class(fragment, **self.molecule_class_args)
                 if self.pooling_method == 0:
-                    self.molecules.append(self.molecule_class(
-                        fragment, **self.molecule_class_args))
+                    self.molecules[self.ejection_index.add(m)] = m
                 else:
-                    self.molecules_per_cell[fragment.match_hash].append(
-                        self.molecule_class(fragment, **self.molecule_class_args)
-                    )
+                    if fragment.match_hash not in self.hash_group_order:
+                        self.hash_group_order[fragment.match_hash] = self.hash_group_serial
+                        self.hash_group_serial += 1
+                    serial = self.ejection_index.add(m, fragment.match_hash)
+                    self.molecules_per_cell[fragment.match_hash].add(serial, m)
 
             self.waiting_fragments += 1
             self.check_ejection_iter += 1
@@ -386,43 +649,42 @@ class MoleculeIterator():
             if self.max_buffer_size is not None and self.waiting_fragments>self.max_buffer_size:
                 raise MemoryError(f'max_buffer_size exceeded with {self.waiting_fragments} waiting fragments')
 
-            if self.check_eject_every is not None and self.check_ejection_iter > self.check_eject_every:
+            if self.check_eject_every is not None and self.check_ejection_iter >= self.check_eject_every:
                 current_chrom, _, current_position = fragment.get_span()
                 if current_chrom is None:
                     continue
 
                 self.check_ejection_iter = 0
-                if self.pooling_method == 0:
-                    to_pop = []
-                    for i, m in enumerate(self.molecules):
-                        if m.can_be_yielded(current_chrom, current_position):
-                            to_pop.append(i)
-                            self.waiting_fragments -= len(m)
-                            self.yielded_fragments += len(m)
-
-                    for i, j in enumerate(to_pop):
-                        m = self.molecules.pop(i - j)
-                        m.__finalise__()
-                        yield from self.yield_func(m)
-                else:
-                    for hash_group, molecules in self.molecules_per_cell.items():
+                if not self.ejection_index.has_ejectable(current_chrom, current_position):
+                    continue
 
-                        to_pop = []
-                        for i, m in enumerate(molecules):
-                            if m.can_be_yielded(
-                                    current_chrom, current_position):
-                                to_pop.append(i)
-                                self.waiting_fragments -= len(m)
-                                self.yielded_fragments += len(m)
+                ejected = self.ejection_index.pop_ejectable(current_chrom, current_position)
+                if len(ejected) == 0:
+                    continue
+                for _, m, hash_group in ejected:
+                    self.waiting_fragments -= len(m)
+                    self.yielded_fragments += len(m)
 
-                        for i, j in enumerate(to_pop):
-                            m = self.molecules_per_cell[hash_group].pop(i - j)
-                            m.__finalise__()
-                            yield from self.yield_func(m)
+                if self.pooling_method == 0:
+                    for serial, _, _ in ejected:
+                        del self.molecules[serial]
+                else:
+                    # Yield in the order of the hash groups, then in order of insertion
+                    ejected.sort(key=lambda t: (self.hash_group_order[t[2]], t[0]))
+                    for serial, _, hash_group in ejected:
+                        molecules = self.molecules_per_cell[hash_group]
+                        molecules.remove(serial)
+                        if len(molecules) == 0:
+                            del self.molecules_per_cell[hash_group]
+                            del self.hash_group_order[hash_group]
+
+                for _, m, _ in ejected:
+                    m.__finalise__()
+                    yield from self.yield_func(m)
 
         # Yield remains
         if self.pooling_method == 0:
-            for m in self.molecules:
+            for m in self.molecules.values():
                 m.__finalise__()
                 yield from self.yield_func(m)
             #yield from iter(self.molecules)
@@ -16,11 +16,203 @@ from singlecellmultiomics.utils import find_ranges, create_MD_tag
 import pandas as pd
 from uuid import uuid4
 from cached_property import cached_property
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
 
 
 ###############
 
+# Compact per-molecule base observations, one entry per aligned base call.
+# bases and reference_bases are stored as ASCII codes (uint8)
+BaseObservations = namedtuple(
+    'BaseObservations',
+    ['reference_ids', 'positions', 'bases', 'qualities', 'fragment_indices', 'reference_bases'])
+
+_CIGAR_CONSUMES_QUERY = (True, True, False, False, True, False, False, True, True, False)
+_CIGAR_CONSUMES_REFERENCE = (True, False, True, True, False, False, False, True, True, False)
+_N_CODE = ord('N')
+
+
+def get_aligned_pair_arrays(read):
+    """Obtain the aligned (matching) query and reference positions of a read as arrays,
+    equivalent to read.get_aligned_pairs(matches_only=True) but without creating a tuple per base
+
+    Args:
+        read (pysam.AlignedSegment) : read to obtain the aligned pairs for
+
+    Returns:
+        query_positions (np.ndarray), reference_positions (np.ndarray)
+    """
+    query_blocks = []
+    reference_blocks = []
+    qpos = 0
+    rpos = read.reference_start
+    for operation, length in (read.cigartuples or ()):
+        consumes_query = _CIGAR_CONSUMES_QUERY[operation]
+        consumes_reference = _CIGAR_CONSUMES_REFERENCE[operation]
+        if consumes_query and consumes_reference:
+            query_blocks.append(np.arange(qpos, qpos + length, dtype=np.int64))
+            reference_blocks.append(np.arange(rpos, rpos + length, dtype=np.int64))
+        if consumes_query:
+            qpos += length
+        if consumes_reference:
+            rpos += length
+
+    if len(query_blocks) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(query_blocks), np.concatenate(reference_blocks)
+
+
+def get_read_cycles(read, query_positions,
+                    trimmed_begin_tag_R1='eB', trimmed_begin_tag_R2='EB'):
+    """Obtain the sequencing cycle of the supplied query positions,
+    vectorised equivalent of the cycles emitted by pysamiterators.iterators.ReadCycleIterator
+
+    Args:
+        read (pysam.AlignedSegment) : read the query positions belong to
+
+        query_positions (np.ndarray) : query positions to obtain the cycle for
+
+    Returns:
+        cycles (np.ndarray)
+    """
+    start = pysamiterators.iterators.getCycleOffset(
+        read, trimmed_begin_tag_R1=trimmed_begin_tag_R1, trimmed_begin_tag_R2=trimmed_begin_tag_R2)
+    if read.is_reverse:
+        total_cycles = pysamiterators.iterators.getReadTotalCycles(
+            read, cycleOffset=start,
+            trimmed_begin_tag_R1=trimmed_begin_tag_R1, trimmed_begin_tag_R2=trimmed_begin_tag_R2)
+        return total_cycles - query_positions - start - 1
+    return query_positions + start
+
+
+def get_read_base_observation_arrays(read, return_refbases=False, reference=None):
+    """Decode the sequence, qualities and aligned pairs of a read once into arrays
+
+    Args:
+        read (pysam.AlignedSegment) : read to decode
+
+        return_refbases (bool) : also obtain the reference base of every aligned position
+
+        reference (pysam.FastaFile) : obtain reference bases from this handle instead of the MD tag
+
+    Returns:
+        query_positions (np.ndarray) : query index of every aligned base
+        reference_positions (np.ndarray) : reference position of every aligned base
+        bases (np.ndarray) : ASCII code of the query base
+        qualities (np.ndarray) : base quality of the query base
+        reference_bases (np.ndarray) : upper case ASCII code of the reference base, None when return_refbases is False
+    """
+    query_positions, reference_positions = get_aligned_pair_arrays(read)
+    sequence = read.query_sequence
+    if sequence is None or len(query_positions) == 0:
+        empty = np.zeros(0, dtype=np.uint8)
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), empty, empty,
+                empty if return_refbases else None)
+
+    bases = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)[query_positions]
+    qualities = read.query_qualities
+    if qualities is None:
+        qualities = np.full(len(query_positions), 255, dtype=np.uint8)
+    else:
+        qualities = np.asarray(qualities, dtype=np.uint8)[query_positions]
+
+    reference_bases = None
+    if return_refbases:
+        if reference is not None:
+            span_start = reference_positions[0]
+            span_end = int(reference_positions[-1]) + 1
+            reference_sequence = reference.fetch(
+                read.reference_name, int(span_start), span_end)
+            # Positions beyond the end of the contig
+            reference_sequence = reference_sequence.ljust(span_end - span_start, 'N')
+            offsets = reference_positions - span_start
+        else:
+            # Requires the MD tag, covers the aligned reference span of the read without the skipped (N) regions
+            reference_sequence = read.get_reference_sequence()
+            skip_ends = []
+            skipped = [0]
+            rpos = read.reference_start
+            for operation, length in read.cigartuples:
+                if operation == pysam.CREF_SKIP:
+                    skip_ends.append(rpos + length)
+                    skipped.append(skipped[-1] + length)
+                if _CIGAR_CONSUMES_REFERENCE[operation]:
+                    rpos += length
+            offsets = reference_positions - read.reference_start - \
+                np.array(skipped, dtype=np.int64)[np.searchsorted(skip_ends, reference_positions, 'right')]
+        reference_bases = np.frombuffer(
+            reference_sequence.upper().encode('ascii'), dtype=np.uint8)[offsets]
+
+    return query_positions, reference_positions, bases, qualities, reference_bases
+
+
+def _base_observations_to_probabilities(contig, positions, bases, qualities):
+    """Convert base observations into per location base probabilities.
+
+    For every location the likelihood of every observed base is the product of the
+    probabilities of its calls, the likelihood of N is the product of the error
+    probabilities since the last newly observed base at the location.
+
+    Args:
+        contig (str) : contig used to construct the location keys
+        positions (np.ndarray) : reference position of every observation, in observation order
+        bases (np.ndarray) : ASCII code of every observed base
+        qualities (np.ndarray) : phred score of every observed base
+
+    Returns:
+        probabilities (dict) : {(contig, position) : {base : probability}}
+    """
+    if len(positions) == 0:
+        return {}
+    p = 1 - np.power(10, -qualities.astype(np.float64) / 10)
+
+    # Group the observations per location and base, keeping the observation order
+    # within the groups so the products are calculated in the same order as they were observed
+    keys = (positions << 8) | bases
+    order = np.argsort(keys, kind='stable')
+    group_starts = np.flatnonzero(np.r_[True, keys[order][1:] != keys[order][:-1]])
+    group_likelihoods = np.multiply.reduceat(p[order], group_starts)
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    group_first = order[group_starts]
+    group_positions = positions[group_first]
+    group_bases = bases[group_first]
+
+    # The N likelihood is reset every time a new base is observed at a location
+    location_starts = np.flatnonzero(np.r_[True, group_positions[1:] != group_positions[:-1]])
+    locations = group_positions[location_starts]
+    locations_list = locations.tolist()
+    reset_index = np.maximum.reduceat(group_first, location_starts)
+
+    order = np.argsort(positions, kind='stable')
+    location_index = np.searchsorted(locations, positions[order])
+    since_reset = order[order >= reset_index[location_index]]
+    n_starts = np.flatnonzero(np.r_[True, positions[since_reset][1:] != positions[since_reset][:-1]])
+    n_likelihoods = np.multiply.reduceat(1 - p[since_reset], n_starts)
+    n_sizes = np.diff(np.r_[n_starts, len(since_reset)])
+
+    # Perform likelihood conversion and convert to probs
+    group_values = group_likelihoods / np.power(0.25, group_sizes - 1)
+    n_values = n_likelihoods / np.power(0.25, n_sizes - 1)
+    totals = np.add.reduceat(group_values, location_starts) + n_values
+    group_location = np.repeat(np.arange(len(locations)), np.diff(np.r_[location_starts, len(group_first)]))
+    group_probs = group_values / totals[group_location]
+    n_probs = n_values / totals
+
+    # Emit the locations and bases in the order they were first observed
+    first_observed = np.argsort(group_first, kind='stable')
+    n_probs = n_probs.tolist()
+    probabilities = {}
+    for location, base, prob in zip(group_location[first_observed].tolist(),
+                                    group_bases[first_observed].view('S1').tolist(),
+                                    group_probs[first_observed].tolist()):
+        k = (contig, locations_list[location])
+        if not k in probabilities:
+            probabilities[k] = {base.decode(): prob, 'N': n_probs[location]}
+        else:
+            probabilities[k][base.decode()] = prob
+    return probabilities
+
+
 # Variant validation function
 def detect_alleles(molecules,
                    contig,
@@ -2221,69 +2413,34 @@ class Molecule():
     @cached_property
     def base_probabilities(self):
         # Optimization which is equal to {location:likelihood_to_prob(liks) for location,liks in self.base_likelihoods.items()}
-        obs = {}
-        for read in self.iter_reads():
-            for qpos, rpos in read.get_aligned_pairs(matches_only=True):
-                qbase = read.seq[qpos]
-                qqual = read.query_qualities[qpos]
-                if qbase=='N':
-                    continue
-                # @ todo reads which span multiple chromosomes
-                k = (self.chromosome, rpos)
-                p = 1 - np.power(10, -qqual / 10)
-
-                if not k in obs:
-                    obs[k] = {}
-                if not qbase in obs[k]:
-                    obs[k][qbase] = [p,1] # likelihood, n
-                    obs[k]['N'] = [1-p,1] # likelihood, n
-                else:
-                    obs[k][qbase][0] *= p
-                    obs[k][qbase][1] += 1
-
-                    obs[k]['N'][0] *= 1-p # likelihood, n
-                    obs[k]['N'][1] += 1 # likelihood, n
-        # Perform likelihood conversion and convert to probs
-        return { location: likelihood_to_prob({
-            base:likelihood/np.power(0.25,n-1)
-                    for base,(likelihood,n) in base_likelihoods.items() })
-                    for location,base_likelihoods in obs.items()}
+        # @ todo reads which span multiple chromosomes
+        observations = self.get_base_observation_arrays()
+        return _base_observations_to_probabilities(self.chromosome,
+                                                   observations.positions,
+                                                   observations.bases,
+                                                   observations.qualities)
 
     ## This is a duplicate of the above but only calculates for allele informative positions
     @cached_property
     def allele_informative_base_probabilities(self):
-        # Optimization which is equal to {location:likelihood_to_prob(liks) for location,liks in self.base_likelihoods.items()}
-        obs = {}
-        for read in self.iter_reads():
-            for qpos, rpos in read.get_aligned_pairs(matches_only=True):
-                if not self.allele_resolver.has_location( read.reference_name, rpos ):
-                    continue
-                qbase = read.seq[qpos]
-                qqual = read.query_qualities[qpos]
-                if qbase=='N':
-                    continue
-                # @ todo reads which span multiple chromosomes
-                k = (self.chromosome, rpos)
-                p = 1 - np.power(10, -qqual / 10)
-
-                if not k in obs:
-                    obs[k] = {}
-                if not qbase in obs[k]:
-                    obs[k][qbase] = [p,1] # likelihood, n
-                    obs[k]['N'] = [1-p,1] # likelihood, n
-                else:
-                    obs[k][qbase][0] *= p
-                    obs[k][qbase][1] += 1
-
-                    obs[k]['N'][0] *= 1-p # likelihood, n
-                    obs[k]['N'][1] += 1 # likelihood, n
-        # Perform likelihood conversion and convert to probs
-        return { location: likelihood_to_prob({
-            base:likelihood/np.power(0.25,n-1)
-                    for base,(likelihood,n) in base_likelihoods.items() })
-                    for location,base_likelihoods in obs.items()}
-
-
+        observations = self.get_base_observation_arrays()
+        if len(observations.positions) == 0:
+            return {}
+
+        # Query the allele resolver once per unique location
+        reference_names = {read.reference_id: read.reference_name for read in self.iter_reads()}
+        locations, location_index = np.unique(
+            np.vstack([observations.reference_ids, observations.positions]),
+            axis=1, return_inverse=True)
+        informative = np.array([
+            self.allele_resolver.has_location(reference_names[reference_id], position)
+            for reference_id, position in zip(locations[0].tolist(), locations[1].tolist())], dtype=bool)
+        keep = informative[location_index.ravel()]
+
+        return _base_observations_to_probabilities(self.chromosome,
+                                                   observations.positions[keep],
+                                                   observations.bases[keep],
+                                                   observations.qualities[keep])
 
     def calculate_allele_likelihoods(self):
         self.aibd = defaultdict(list)
@@ -2447,29 +2604,144 @@ class Molecule():
 
         base_obs = defaultdict(Counter)
 
-        used = 0  # some alignments yielded valid calls
-        ignored = 0
+        reference_names = {}
+        blocks = []
         for fragment in self:
             _, start, end = fragment.span
             for read in fragment:
                 if read is None:
                     continue
 
-                for cycle, query_pos, ref_pos in pysamiterators.iterators.ReadCycleIterator(
-                        read, with_seq=False):
-
-                    if query_pos is None or ref_pos is None or ref_pos < start or ref_pos > end:
-                        continue
-                    query_base = read.seq[query_pos]
-                    if query_base == 'N' and not allow_N:
-                        continue
-                    base_obs[(read.reference_name, ref_pos)][query_base] += 1
+                _, ref_positions, bases, _, _ = get_read_base_observation_arrays(read)
+                keep = (ref_positions >= start) & (ref_positions <= end)
+                if not allow_N:
+                    keep &= bases != _N_CODE
+                reference_names[read.reference_id] = read.reference_name
+                blocks.append((np.full(int(keep.sum()), read.reference_id, dtype=np.int64),
+                               ref_positions[keep], bases[keep]))
 
-        if used == 0 and ignored > 0:
-            raise ValueError('Could not extract any safe data from molecule')
+        if len(blocks) > 0:
+            self._add_base_observation_counts(
+                base_obs, reference_names, *[np.concatenate(column) for column in zip(*blocks)])
 
         return base_obs
 
+    @staticmethod
+    def _add_base_observation_counts(base_obs, reference_names, reference_ids, positions, bases):
+        """Add observations to a { genome_location : Counter } dictionary,
+        locations and bases are inserted in the order they were first observed
+
+        Args:
+            base_obs (defaultdict(Counter)) : dictionary to update
+            reference_names (dict) : reference_id -> reference_name
+            reference_ids, positions, bases (np.ndarray) : observations
+        """
+        if len(positions) == 0:
+            return
+        keys = (reference_ids << 40) | (positions << 8) | bases
+        unique_keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        order = np.argsort(first, kind='stable')
+        unique_keys = unique_keys[order]
+        for reference_id, position, base, count in zip(
+                (unique_keys >> 40).tolist(),
+                ((unique_keys >> 8) & 0xFFFFFFFF).tolist(),
+                (unique_keys & 0xFF).astype(np.uint8).view('S1').tolist(),
+                counts[order].tolist()):
+            base_obs[(reference_names[reference_id], position)][base.decode()] += count
+
+    def get_base_observation_arrays(self, return_refbases=False, allow_N=False,
+        allow_unsafe=True, one_call_per_frag=False, min_cycle_r1=None,
+         max_cycle_r1=None, min_cycle_r2=None, max_cycle_r2=None, min_bq=None):
+        '''
+        Obtain observed bases at reference aligned locations as compact arrays.
+        The sequence, qualities and aligned pairs of every read are decoded once, all filters are applied as masks.
+
+        Args:
+            return_refbases ( bool ):
+                also return the reference base of every observation
+            allow_N (bool): Keep N base calls in observations
+
+            allow_unsafe (bool): When False reference bases are obtained from the reference handle of the molecule (when available)
+
+            one_call_per_frag (bool): Only keep the first base call of every location of every fragment
+
+            min_cycle_r1(int) : Exclude read 1 base calls with a cycle smaller than this value (excludes bases which are trimmed before mapping)
+
+            max_cycle_r1(int) : Exclude read 1 base calls with a cycle larger than this value (excludes bases which are trimmed before mapping)
+
+            min_cycle_r2(int) : Exclude read 2 base calls with a cycle smaller than this value (excludes bases which are trimmed before mapping)
+
+            max_cycle_r2(int) : Exclude read 2 base calls with a cycle larger than this value (excludes bases which are trimmed before mapping)
+
+            min_bq(int) : Exclude base calls with a base quality lower than this value
+
+        Returns:
+            observations (BaseObservations) : namedtuple of arrays with one entry per base call, in the order of the reads and aligned pairs:
+                reference_ids, positions, bases (ASCII), qualities, fragment_indices, reference_bases (ASCII, None if return_refbases is False)
+        '''
+        reference = None if allow_unsafe else self.reference
+        apply_cycle_filters = not allow_unsafe and any(
+            value is not None for value in (min_cycle_r1, max_cycle_r1, min_cycle_r2, max_cycle_r2))
+
+        blocks = []
+        for fragment_index, fragment in enumerate(self):
+            fragment_blocks = []
+            for read in fragment:
+                if read is None:
+                    continue
+
+                query_positions, ref_positions, bases, qualities, ref_bases = get_read_base_observation_arrays(
+                    read, return_refbases=return_refbases, reference=reference)
+
+                keep = np.ones(len(ref_positions), dtype=bool)
+                if apply_cycle_filters:
+                    cycles = get_read_cycles(read, query_positions)
+                    if read.is_paired and read.is_read2:
+                        min_cycle, max_cycle = min_cycle_r2, max_cycle_r2
+                    else:
+                        min_cycle, max_cycle = min_cycle_r1, max_cycle_r1
+                    if min_cycle is not None:
+                        keep &= cycles >= min_cycle
+                    if max_cycle is not None:
+                        keep &= cycles <= max_cycle
+                if min_bq is not None:
+                    keep &= qualities >= min_bq
+                if not allow_N:
+                    keep &= bases != _N_CODE
+
+                fragment_blocks.append((
+                    np.full(int(keep.sum()), read.reference_id, dtype=np.int64),
+                    ref_positions[keep],
+                    bases[keep],
+                    qualities[keep],
+                    ref_bases[keep] if return_refbases else None))
+
+            if len(fragment_blocks) == 0:
+                continue
+            fragment_arrays = [np.concatenate(column) if column[0] is not None else None
+                               for column in zip(*fragment_blocks)]
+
+            if one_call_per_frag and len(fragment_arrays[1]) > 0:
+                # Keep only the first call of every location
+                keys = (fragment_arrays[0] << 36) | fragment_arrays[1]
+                _, first = np.unique(keys, return_index=True)
+                first.sort()
+                fragment_arrays = [column[first] if column is not None else None
+                                   for column in fragment_arrays]
+
+            blocks.append(fragment_arrays + [np.full(len(fragment_arrays[1]), fragment_index, dtype=np.int64)])
+
+        if len(blocks) == 0:
+            empty = np.zeros(0, dtype=np.uint8)
+            empty_int = np.zeros(0, dtype=np.int64)
+            return BaseObservations(empty_int, empty_int, empty, empty, empty_int,
+                                    empty if return_refbases else None)
+
+        reference_ids, positions, bases, qualities, ref_bases, fragment_indices = [
+            np.concatenate(column) if column[0] is not None else None
+            for column in zip(*blocks)]
+        return BaseObservations(reference_ids, positions, bases, qualities, fragment_indices, ref_bases)
+
     def get_base_observation_dict(self, return_refbases=False, allow_N=False,
         allow_unsafe=True, one_call_per_frag=False, min_cycle_r1=None,
          max_cycle_r1=None, min_cycle_r2=None, max_cycle_r2=None, use_cache=True, min_bq=None):
@@ -2505,91 +2777,23 @@ class Molecule():
                     if self.saved_base_obs[1] is not None:
                         return self.saved_base_obs
 
+        observations = self.get_base_observation_arrays(
+            return_refbases=return_refbases, allow_N=False, allow_unsafe=allow_unsafe,
+            one_call_per_frag=one_call_per_frag, min_cycle_r1=min_cycle_r1,
+            max_cycle_r1=max_cycle_r1, min_cycle_r2=min_cycle_r2,
+            max_cycle_r2=max_cycle_r2, min_bq=min_bq)
+
+        reference_names = {read.reference_id: read.reference_name for read in self.iter_reads()}
         base_obs = defaultdict(Counter)
+        self._add_base_observation_counts(base_obs, reference_names, observations.reference_ids,
+                                          observations.positions, observations.bases)
 
         ref_bases = {}
-        used = 0  # some alignments yielded valid calls
-        ignored = 0
-        error = None
-        for fragment in self:
-            _, start, end = fragment.span
-
-            used += 1
-
-            if one_call_per_frag:
-                frag_location_obs = set()
-
-            for read in fragment:
-                if read is None:
-                    continue
-
-                if allow_unsafe:
-                    for query_pos, ref_pos, ref_base in read.get_aligned_pairs(matches_only=True, with_seq=True):
-                        if query_pos is None or ref_pos is None:  # or ref_pos < start or ref_pos > end:
-                            continue
-
-                        query_base = read.seq[query_pos]
-                        # query_qual = read.qual[query_pos]
-                        if min_bq is not None and read.query_qualities[query_pos]<min_bq:
-                            continue
-
-                        if query_base == 'N':
-                            continue
-
-                        k = (read.reference_name, ref_pos)
-
-                        if one_call_per_frag:
-                            if k in frag_location_obs:
-                                continue
-                            frag_location_obs.add(k)
-
-                        base_obs[k][query_base] += 1
-
-                        if return_refbases:
-                            ref_bases[(read.reference_name, ref_pos)
-                            ] = ref_base.upper()
-
-
-                else:
-                    for cycle, query_pos, ref_pos, ref_base in pysamiterators.iterators.ReadCycleIterator(
-                            read, with_seq=True, reference=self.reference):
-
-                        if query_pos is None or ref_pos is None:  # or ref_pos < start or ref_pos > end:
-                            continue
-
-                        # Verify cycle filters:
-                        if (not read.is_paired or read.is_read1) and (
-                                ( min_cycle_r1 is not None and cycle <  min_cycle_r1 ) or
-                                ( max_cycle_r1 is not None and  cycle >  max_cycle_r1 )):
-                            continue
-
-                        if (read.is_paired and read.is_read2) and (
-                                ( min_cycle_r2 is not None and cycle <  min_cycle_r2 ) or
-                                ( max_cycle_r2 is not None and cycle >  max_cycle_r2 )):
-                            continue
-
-                        query_base = read.seq[query_pos]
-                        # Skip bases with low bq:
-                        if min_bq is not None and read.query_qualities[query_pos]<min_bq:
-                            continue
-
-                        if query_base == 'N':
-                            continue
-
-                        k = (read.reference_name, ref_pos)
-                        if one_call_per_frag:
-                            if k in frag_location_obs:
-                                continue
-                            frag_location_obs.add(k)
-
-                        base_obs[(read.reference_name, ref_pos)][query_base] += 1
-
-                        if return_refbases:
-                            ref_bases[(read.reference_name, ref_pos)
-                            ] = ref_base.upper()
-
-        if used == 0 and ignored > 0:
-            raise ValueError(f'Could not extract any safe data from molecule {error}')
+        if return_refbases:
+            ref_bases = {(reference_names[reference_id], position): ref_base.decode()
+                         for reference_id, position, ref_base in zip(observations.reference_ids.tolist(),
+                                                                     observations.positions.tolist(),
+                                                                     observations.reference_bases.view('S1').tolist())}
 
         self.saved_base_obs = (base_obs, ref_bases)
 
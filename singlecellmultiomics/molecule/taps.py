@@ -9,8 +9,18 @@ from singlecellmultiomics.utils.sequtils import complement
 from itertools import product
 from matplotlib.pyplot import get_cmap
 from copy import copy
+import numpy as np
 complement_trans = str.maketrans('ATGC', 'TACG')
 
+# Base (ASCII) to code lookup table, codes are A:0 C:1 G:2 T:3 other:4
+base_codes = np.full(256, 4, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+    base_codes[ord(base)] = code
+    base_codes[ord(base.lower())] = code
+complement_codes = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+# Context code (25*first + 5*second + third base code) to 3bp context
+context_codes = [''.join(context) for context in product('ACGTN', repeat=3)]
+
 
 class TAPS:
     # Methylated Cs get converted into T readout
@@ -62,6 +72,11 @@ class TAPS:
         self.colormap = copy(get_cmap('RdYlBu_r')) # Make a copy 
         self.colormap.set_bad((0,0,0)) # For reads without C's
 
+        # Lookup table of context code to bismark letter, index 0: not methylated, 1: methylated, 2: no call
+        self.context_lookup = np.array([
+            [self.context_mapping[methylated].get(context, '.') for context in context_codes]
+            for methylated in (False, True)] + [['.'] * len(context_codes)])
+
     def position_to_context(
             self,
             chromosome,
@@ -129,6 +144,69 @@ class TAPS:
             symbol = self.context_mapping[methylated].get(context, '.')
         return context, symbol
 
+    def positions_to_context(
+            self,
+            chromosome,
+            positions,
+            ref_base,
+            observed_bases,
+            reference=None
+        ):
+        """Extract bismark call letters for many locations of a contig at once.
+        The reference span covering all positions (padded by 2bp) is fetched only once.
+
+        Args:
+
+            chromosome (str) : chromosome / contig of the locations to test
+
+            positions (iterable) : genomic locations to test
+
+            ref_base(str) : reference base at all positions, C or G
+
+            observed_bases(iterable) : base observed in the read for every position
+
+            reference (pysam.FastaFile) : reference to obtain the contexts from
+
+        Returns:
+            contexts(list) : 3 basepair context for every position, bases other than ACGT are reported as N
+            bismark_letters(list) : bismark call for every position
+        """
+        assert reference is not None
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) == 0:
+            return [], []
+
+        if ref_base == 'C':
+            methylated_base, unmethylated_base, offsets = 'T', 'C', (0, 1, 2)
+        elif ref_base == 'G':
+            methylated_base, unmethylated_base, offsets = 'A', 'G', (0, -1, -2)
+        else:
+            raise ValueError('Only supply reference C or G')
+
+        # Fetch the span once, positions outside of the contig are padded with N
+        padded_start = int(positions.min()) - 2
+        span_start = max(0, padded_start)
+        span_end = int(positions.max()) + 3
+        sequence = reference.fetch(chromosome, span_start, span_end)
+        sequence = np.concatenate([
+            np.full(span_start - padded_start, 4, dtype=np.uint8),
+            base_codes[np.frombuffer(
+                sequence.ljust(span_end - span_start, 'N').encode('ascii'), dtype=np.uint8)]])
+        index = positions - padded_start
+
+        first, second, third = (sequence[index + offset] for offset in offsets)
+        if ref_base == 'G':
+            first, second, third = (complement_codes[code] for code in (first, second, third))
+        context_code = first.astype(np.int64) * 25 + second * 5 + third
+
+        observed_bases = np.array([base.upper() for base in observed_bases])
+        methylation_state = np.full(len(positions), 2, dtype=np.int64)
+        methylation_state[observed_bases == unmethylated_base] = 0
+        methylation_state[observed_bases == methylated_base] = 1
+
+        return ([context_codes[code] for code in context_code.tolist()],
+                self.context_lookup[methylation_state, context_code].tolist())
+
     def molecule_to_context_call_dict(self, molecule):
         """Extract bismark call_string dictionary from a molecule
 
@@ -251,19 +329,29 @@ class TAPSMolecule(Molecule):
                 return None
             raise
 
-        # obtain the context of the conversions:
+        # obtain the context of the conversions, for every contig at once:
+        locations_per_contig = {}
+        for (contig, position), base_call in c_pos_consensus.items():
+            locations_per_contig.setdefault(contig, []).append((position, base_call))
+
+        letters = {}
+        for contig, locations in locations_per_contig.items():
+            positions, base_calls = zip(*locations)
+            letters.update(zip(
+                ((contig, position) for position in positions),
+                self.taps.positions_to_context(
+                    chromosome=contig,
+                    positions=positions,
+                    ref_base=expected_base_to_be_converted,
+                    observed_bases=base_calls,
+                    reference=self.reference)[1]))
+
         conversion_contexts = {
-            (contig, position):
+            location:
             {'consensus': base_call,
              'reference_base': expected_base_to_be_converted,
-             'context': self.taps.position_to_context(
-                chromosome=contig,
-                position=position,
-                reference=self.reference,
-                observed_base=base_call,
-                ref_base=expected_base_to_be_converted,
-                strand=self.strand)[1]}
-            for (contig, position), base_call in c_pos_consensus.items()}
+             'context': letters[location]}
+            for location, base_call in c_pos_consensus.items()}
 
         # Write bismark tags:
         self.set_methylation_call_tags(conversion_contexts)
@@ -400,7 +488,13 @@ class TAPSPTaggedMolecule(AnnotatedTAPSNlaIIIMolecule):
 
         context_obs = Counter()
 
-        for read in self.iter_reads():
+        # Fetch the reference sequence of the molecule once
+        reads = list(self.iter_reads())
+        span_start = max(0, min(read.reference_start for read in reads) - 1)
+        span_sequence = self.reference.fetch(
+            self.chromosome, span_start, max(read.reference_end for read in reads) + 1).upper()
+
+        for read in reads:
             for qpos, refpos, reference_base in read.get_aligned_pairs(with_seq=True, matches_only=True):
 
                 location = (read.reference_name, refpos)
@@ -410,7 +504,7 @@ class TAPSPTaggedMolecule(AnnotatedTAPSNlaIIIMolecule):
                 #    continue
 
                 query = read.seq[qpos]
-                context = self.reference.fetch(self.chromosome, refpos-1, refpos+2).upper()
+                context = span_sequence[max(0, refpos - 1 - span_start):refpos + 2 - span_start]
 
                 # Check if call is the same as the consensus call:
                 if query!=consensus.get((read.reference_name,refpos), 'X'):
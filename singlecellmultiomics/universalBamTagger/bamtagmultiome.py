@@ -7,15 +7,17 @@ import singlecellmultiomics
 import singlecellmultiomics.molecule
 from singlecellmultiomics.molecule.consensus import calculate_consensus
 import singlecellmultiomics.fragment
-from singlecellmultiomics.bamProcessing.bamFunctions import sorted_bam_file, get_reference_from_pysam_alignmentFile, write_program_tag, MapabilityReader, verify_and_fix_bam,add_blacklisted_region
+from singlecellmultiomics.bamProcessing.bamFunctions import sorted_bam_file, get_reference_from_pysam_alignmentFile, write_program_tag, MapabilityReader, verify_and_fix_bam,add_blacklisted_region, write_bam_header_to_body, sort_and_index
+from singlecellmultiomics.bamProcessing.mappabilityStore import is_mappability_store
 from singlecellmultiomics.utils import is_main_chromosome
 from singlecellmultiomics.utils.submission import submit_job
 import singlecellmultiomics.alleleTools
 from singlecellmultiomics.universalBamTagger.customreads import CustomAssingmentQueryNameFlagger
 import singlecellmultiomics.features
 from pysamiterators import MatePairIteratorIncludingNonProper, MatePairIterator
-from singlecellmultiomics.universalBamTagger.tagging import generate_tasks, prefetch, run_tagging_tasks
+from singlecellmultiomics.universalBamTagger.tagging import generate_tasks, prefetch, run_tagging_tasks, run_tagging_tasks_streamed, task_lower_bound, UNMAPPED_SORT_KEY, TaggingManifest
 from singlecellmultiomics.bamProcessing.bamBinCounts import blacklisted_binning_contigs,get_bins_from_bed_iter
+from singlecellmultiomics.bamProcessing.cutSiteIndex import write_cut_site_index
 from singlecellmultiomics.utils.binning import bp_chunked
 from singlecellmultiomics.bamProcessing import merge_bams, get_contigs_with_reads, sam_to_bam
 from singlecellmultiomics.fastaProcessing import CachedFastaNoHandle
@@ -24,6 +26,7 @@ from multiprocessing import Pool
 from typing import Generator
 import argparse
 import uuid
+import glob
 import os
 import sys
 import colorama
@@ -31,6 +34,7 @@ import pkg_resources
 import pickle
 from datetime import datetime
 from time import sleep
+import heapq
 
 
 argparser = argparse.ArgumentParser(
@@ -108,8 +112,7 @@ allele_gr.add_argument(
 allele_gr.add_argument(
     '--use_allele_cache',
     action='store_true',
-    help='''Write and use a cache file for the allele information. NOTE: THIS IS NOT THREAD SAFE! Meaning you should not use this function on multiple libraries at the same time when the cache files are not yet available.
-        Once they are available there is not thread safety issue anymore''')
+    help='Write and use a memory mapped cache of the allele information, the cache is stored next to the variant file. Processes running at the same time share the cache, it is created once')
 
 argparser.add_argument('-molecule_iterator_verbosity_interval',type=int,default=None,help='Molecule iterator information interval in seconds')
 argparser.add_argument('--molecule_iterator_verbose', action='store_true', help='Show progress indication on command line')
@@ -119,6 +122,18 @@ argparser.add_argument(
     '--multiprocess',
     action='store_true',
     help="Use multiple the CPUs of you system to achieve (much) faster tagging")
+argparser.add_argument(
+    '--stream',
+    action='store_true',
+    help="When using --multiprocess, send the tagged reads from the workers to a single process which writes them in coordinate order. This skips writing, sorting and merging temporary bam files")
+argparser.add_argument(
+    '--resume',
+    action='store_true',
+    help="When using --multiprocess, resume a previous run with the same output path which did not finish. Segments which have been tagged already are skipped")
+argparser.add_argument(
+    '--cut_site_index',
+    action='store_true',
+    help="Write a columnar index of the cut site, strand, sample, flags, mapping quality, allele and umi count of every fragment next to the output bam file (OUTPUT.bam.cutsites), see singlecellmultiomics.bamProcessing.cutSiteIndex")
 argparser.add_argument(
     '-tagthreads',
     type=int,
@@ -174,7 +189,7 @@ molecule_settings = argparser.add_argument_group('Molecule settings')
 molecule_settings.add_argument(
     '-mapfile',
     type=str,
-    help='Path to *.safe.bgzf file, used to decide if molecules are uniquely mappable, generate one using createMapabilityIndex.py ')
+    help='Path to *.safe.bgzf file or *.mappability.store folder, used to decide if molecules are uniquely mappable, generate one using createMappabilityIndex.py ')
 molecule_settings.add_argument('-umi_hamming_distance', type=int, default=1)
 molecule_settings.add_argument(
     '-annotmethod',
@@ -251,6 +266,51 @@ ma.add_argument(
 ma.add_argument('-max_associated_fragments',type=int, default=None, help="Limit the maximum amount of reads associated to a single molecule.")
 
 
+# Arguments which do not change the tagged reads, these are not part of the parameters checked when resuming a run
+RESUME_IGNORED_ARGUMENTS = ('o', 'tagthreads', 'resume', 'temp_folder', 'cut_site_index',
+                            'molecule_iterator_verbose', 'molecule_iterator_verbosity_interval',
+                            'set_allele_resolver_verbose', 'feature_container_verbose')
+
+
+def get_input_stat(path):
+    """Obtain the size and modification time of an input file, for a folder the newest file in the folder is used
+
+    Args:
+        path (str) : path to file or folder
+
+    Returns:
+        stat (list) : [size, mtime]
+    """
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names]
+        return [sum(stat.st_size for stat in stats), max([stat.st_mtime for stat in stats], default=None)]
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def get_run_parameters(args):
+    """Obtain the parameters of a run used to decide if the run can be resumed: all arguments except
+    RESUME_IGNORED_ARGUMENTS. For every argument which refers to files (for example the VCF, GTF, mapfile or reference)
+    the size and modification time of the files are included, a changed file prevents resuming.
+
+    Args:
+        args (argparse.Namespace) : parsed arguments
+
+    Returns:
+        parameters (dict)
+    """
+    parameters = {}
+    for key, value in vars(args).items():
+        if key in RESUME_IGNORED_ARGUMENTS:
+            continue
+        parameters[key] = value
+        if isinstance(value, str) and key != 'bamin':
+            paths = value.split(',')
+            if all(os.path.exists(path) for path in paths):
+                parameters[f'{key}_stat'] = [get_input_stat(path) for path in paths]
+    return parameters
+
+
 def tag_multiome_multi_processing(
         input_bam_path: str,
         out_bam_path: str,
@@ -270,7 +330,10 @@ def tag_multiome_multi_processing(
         use_pool: bool = True,
         one_contig_per_process: bool =False,
         additional_args: dict = None,
-        n_threads=None
+        n_threads=None,
+        stream: bool = False,
+        resume: bool = False,
+        run_parameters: dict = None
     ):
 
     assert bp_per_job is not None
@@ -279,7 +342,18 @@ def tag_multiome_multi_processing(
 
     if not os.path.exists(temp_folder_root):
         raise ValueError(f'The path {temp_folder_root} does not exist')
-    temp_folder = os.path.join( temp_folder_root , f'scmo_{uuid.uuid4()}' )
+    if resume and stream:
+        raise ValueError('Streaming output cannot be resumed, remove --stream or --resume')
+    # Every run uses its own temp folder, the folder name starts with a prefix derived from the output path.
+    # When resuming, the most recent folder of a previous run with the same output path is continued
+    temp_folder_prefix = os.path.join( temp_folder_root , f'scmo_{uuid.uuid5(uuid.NAMESPACE_URL, os.path.abspath(out_bam_path))}' )
+    previous_manifests = sorted(glob.glob(f'{temp_folder_prefix}_*/manifest.jsonl'), key=os.path.getmtime)
+    if resume and len(previous_manifests):
+        temp_folder = os.path.dirname(previous_manifests[-1])
+    else:
+        if resume:
+            print('No previous run found to resume, starting a new run')
+        temp_folder = f'{temp_folder_prefix}_{uuid.uuid4()}'
     if not os.path.exists(temp_folder):
         os.makedirs(temp_folder, exist_ok=True)
 
@@ -323,6 +397,33 @@ def tag_multiome_multi_processing(
         # Chunk into jobs of roughly equal size: (A single job will process multiple segments)
         job_gen = bp_chunked(regions, bp_per_job)
 
+    if stream:
+        # The lower bounds of the jobs are required to decide which reads can be written
+        job_gen = list(job_gen)
+    else:
+        # Keep track of the completed jobs, these are skipped when the run is resumed
+        manifest = TaggingManifest(
+            os.path.join(temp_folder, 'manifest.jsonl'),
+            parameters={
+                **({} if run_parameters is None else run_parameters),
+                'input': os.path.abspath(input_bam_path),
+                'input_stat': get_input_stat(input_bam_path),
+                'version': singlecellmultiomics.__version__,
+                'molecule_class': getattr(molecule_iterator_args.get('molecule_class'), '__name__', None),
+                'fragment_class': getattr(molecule_iterator_args.get('fragment_class'), '__name__', None),
+                'contigs': list(contig_whitelist),
+                'blacklist': blacklist_path,
+                'bp_per_job': bp_per_job,
+                'bp_per_segment': bp_per_segment,
+                'fragment_size': fragment_size,
+                'one_contig_per_process': one_contig_per_process,
+                'additional_args': additional_args
+            },
+            resume=resume)
+        if resume:
+            print(f'Resuming, {len(manifest.completed)} jobs have been completed already')
+        job_gen = (job for job in job_gen if not manifest.is_completed(job))
+
     tasks = generate_tasks(input_bam_path=input_bam_path,
                            job_gen=job_gen,
                            iteration_args=iteration_args,
@@ -331,7 +432,7 @@ def tag_multiome_multi_processing(
                            max_time_per_segment=max_time_per_segment)
 
     # Create header bam:
-    temp_header_bam_path = f'{temp_folder}/{uuid.uuid4()}_header.bam'
+    temp_header_bam_path = f'{temp_folder}/header.bam'
     with pysam.AlignmentFile(input_bam_path) as input_bam:
         input_header = input_bam.header.as_dict()
 
@@ -355,7 +456,39 @@ def tag_multiome_multi_processing(
         # @todo : Obtain auto blacklisted regions if applicable
         # @todo : Progress indication
 
+        if stream:
+            write_streamed_tagging_results(
+                tasks=tasks,
+                jobs=job_gen,
+                out_bam_path=out_bam_path,
+                temp_folder=temp_folder,
+                input_header=input_header,
+                reference_ids={contig:input_bam.get_tid(contig) for contig in input_bam.references},
+                margin=fragment_size,
+                head=head,
+                use_pool=use_pool,
+                n_threads=n_threads)
+            try:
+                os.rmdir(temp_folder)
+            except Exception:
+                sys.stderr.write(f'Failed to remove {temp_folder}\n')
+            write_status(out_bam_path, 'Reached end. All ok!')
+            return
+
         bam_files_generated = []
+        total_processed_molecules = 0
+
+        # Results of jobs completed in a previous run:
+        for job in manifest.completed:
+            if job['bam'] is not None:
+                bam_files_generated.append(job['bam'])
+            total_processed_molecules += job['total_molecules']
+            for timeout in job['timeout_tasks']:
+                add_blacklisted_region(input_header,
+                    contig=timeout['contig'],
+                    start=timeout['start'],
+                    end=timeout['end']
+                )
 
         if use_pool:
             workers = Pool(n_threads)
@@ -364,8 +497,8 @@ def tag_multiome_multi_processing(
         else:
             job_generator = (run_tagging_tasks(task) for task in tasks)
 
-        total_processed_molecules = 0
         for bam, meta in job_generator:
+            manifest.record(bam, meta)
             if bam is not None:
                 bam_files_generated.append(bam)
             if len(meta):
@@ -396,6 +529,7 @@ def tag_multiome_multi_processing(
     # Remove the temp dir:
     sleep(5)
     try:
+        manifest.remove()
         os.rmdir(temp_folder)
     except Exception:
         sys.stderr.write(f'Failed to remove {temp_folder}\n')
@@ -403,6 +537,104 @@ def tag_multiome_multi_processing(
     write_status(out_bam_path, 'Reached end. All ok!')
 
 
+def write_streamed_tagging_results(tasks, jobs, out_bam_path, temp_folder, input_header, reference_ids,
+                                   margin=0, head=None, use_pool=True, n_threads=None):
+    """ Run the tagging tasks and write the tagged reads sent back by the workers in coordinate order to out_bam_path
+
+    The jobs are generated in genomic order, the results are obtained in the same order.
+    Reads are kept in a buffer until no job which still has to be processed can generate a read
+    located before them. Reads which arrive after reads located further on the genome have
+    been written (for example mates mapping far away from the cut site) are written at the end,
+    after which the output is sorted.
+
+    Args:
+        tasks (iterable) : tasks generated by generate_tasks
+        jobs (list) : list of jobs, every job is a list of (contig, start, end, fetch_start, fetch_end) tuples
+        out_bam_path (str) : path to write sorted and indexed bam file to
+        temp_folder (str) : folder to write unsorted output to in the case reads are received too late
+        input_header (dict) : header for the output bam file, read groups and blacklisted regions are added to this header
+        reference_ids (dict) : {contig:reference_id}
+        margin (int) : amount of bp reads are expected to start before the fetch_start coordinate of their job
+        head (int) : stop after this amount of molecules
+        use_pool (bool) : use a multiprocessing pool
+        n_threads (int) : amount of worker processes
+
+    """
+    # Lowest sort key of all reads which can still be generated by the jobs following job i:
+    lower_bounds = [UNMAPPED_SORT_KEY] * (len(jobs) + 1)
+    for i in range(len(jobs)-1, -1, -1):
+        lower_bounds[i] = min([lower_bounds[i+1]] + [task_lower_bound(task, reference_ids, margin) for task in jobs[i]])
+
+    if use_pool:
+        workers = Pool(n_threads)
+        job_generator = workers.imap(run_tagging_tasks_streamed, tasks)
+    else:
+        job_generator = (run_tagging_tasks_streamed(task) for task in tasks)
+
+    read_groups = dict()
+    pending = [] # heap of (sort key, arrival index, SAM string)
+    late = []
+    last_written = None
+    arrival = 0
+    total_processed_molecules = 0
+
+    body_path = f'{out_bam_path}.body'
+    with pysam.AlignmentFile(body_path, 'wb', header=input_header) as body:
+        # The header is written in separate blocks, the records start at this offset:
+        body_offset = body.tell() >> 16
+        header = body.header
+
+        def flush(until):
+            nonlocal last_written
+            while len(pending) and pending[0][0] < until:
+                key, _, record = heapq.heappop(pending)
+                body.write(pysam.AlignedSegment.fromstring(record, header))
+                last_written = key
+
+        for i, (records, meta) in enumerate(job_generator):
+            for key, record in records:
+                if last_written is not None and key < last_written:
+                    late.append(record)
+                else:
+                    heapq.heappush(pending, (key, arrival, record))
+                    arrival += 1
+
+            read_groups.update(meta.get('read_groups', {}))
+            total_processed_molecules += meta.get('total_molecules', 0)
+            for timeout in meta.get('timeout_tasks', []):
+                print('blacklisted', timeout['contig'], timeout['start'], timeout['end'])
+                add_blacklisted_region(input_header,
+                    contig=timeout['contig'],
+                    start=timeout['start'],
+                    end=timeout['end']
+                )
+            if head is not None and total_processed_molecules>head:
+                print('Head was supplied, stopping')
+                break
+
+            # Unmapped reads are written at the very end
+            flush(min(lower_bounds[i+1], UNMAPPED_SORT_KEY))
+
+        flush((float('inf'), ))
+        for record in late:
+            body.write(pysam.AlignedSegment.fromstring(record, header))
+
+    if use_pool:
+        workers.close()
+
+    input_header['RG'] = list(read_groups.values())
+    input_header.setdefault('HD', {'VN': '1.6'})['SO'] = 'coordinate'
+
+    if len(late) == 0:
+        write_bam_header_to_body(input_header, body_path, body_offset, out_bam_path)
+        pysam.index(out_bam_path)
+    else:
+        print(f'{len(late)} reads were received after reads located further on the genome were written, sorting output')
+        unsorted_path = f'{temp_folder}/{uuid.uuid4()}.unsorted.bam'
+        write_bam_header_to_body(input_header, body_path, body_offset, unsorted_path)
+        sort_and_index(unsorted_path, out_bam_path, remove_unsorted=True)
+
+
 def tag_multiome_single_thread(
         input_bam_path,
         out_bam_path,
@@ -555,7 +787,7 @@ def run_multiome_tagging(args):
 
         unphased_alleles(str) : Path to VCF containing unphased germline SNPs
 
-        mapfile (str) : 'Path to \*.safe.bgzf file, used to decide if molecules are uniquely mappable, generate one using createMapabilityIndex.py
+        mapfile (str) : 'Path to \*.safe.bgzf file or \*.mappability.store folder, used to decide if molecules are uniquely mappable, generate one using createMappabilityIndex.py
 
         annotmethod (int) : Annotation resolving method. 0: molecule consensus aligned blocks. 1: per read per aligned base
 
@@ -682,7 +914,7 @@ def run_multiome_tagging(args):
             ignore_conversions=ignore_conversions)
 
     if args.mapfile is not None:
-        assert args.mapfile.endswith('safe.bgzf'), 'the mapfile name should end with safe.bgzf '
+        assert args.mapfile.endswith('safe.bgzf') or is_mappability_store(args.mapfile), 'the mapfile name should end with safe.bgzf or be a mappability store'
         molecule_class_args['mapability_reader'] = MapabilityReader(args.mapfile)
 
     ### Transcriptome configuration ###
@@ -1077,7 +1309,7 @@ def run_multiome_tagging(args):
                     os.remove(temp_bam_path)
 
                 arguments = " ".join(
-                    [x for x in sys.argv if not x == args.o and x != '-o']) + f" -contig {chrom} -o {temp_bam_path}"
+                    [x for x in sys.argv if not x == args.o and x != '-o' and x != '--cut_site_index']) + f" -contig {chrom} -o {temp_bam_path}"
                 files_to_merge.append(temp_bam_path)
                 if consensus_model_path is not None:
                     arguments += f' -consensus_model {consensus_model_path}'
@@ -1100,7 +1332,10 @@ def run_multiome_tagging(args):
 
             final_status = args.o.replace('.bam','.status.txt')
             # Create list of output files
-            command = f'samtools merge -@ 4 -c {args.o} {" ".join(files_to_merge)} && samtools index {args.o} && rm {temp_prefix}*.ba* && rm {temp_prefix}*.status.txt && echo "All done" > {final_status}'
+            command = f'samtools merge -@ 4 -c {args.o} {" ".join(files_to_merge)} && samtools index {args.o} && rm {temp_prefix}*.ba* && rm {temp_prefix}*.status.txt'
+            if args.cut_site_index:
+                command += f' && python -m singlecellmultiomics.bamProcessing.cutSiteIndex {args.o}'
+            command += f' && echo "All done" > {final_status}'
 
             final_job_id = submit_job(f'{command};', job_name=job, target_directory=cluster_file_folder,  working_directory=None,
                            threads_n=4, memory_gb=10, time_h=args.time, scheduler=args.sched, copy_env=True,
@@ -1148,7 +1383,9 @@ def run_multiome_tagging(args):
                                       head=args.head, no_source_reads=args.no_source_reads,
                                       fragment_size=fragment_size, blacklist_path=args.blacklist,bp_per_job=bp_per_job,
                                       bp_per_segment=bp_per_segment, temp_folder_root=args.temp_folder, max_time_per_segment=max_time_per_segment,
-                                      additional_args=consensus_model_args, n_threads=args.tagthreads, one_contig_per_process=one_contig_per_process
+                                      additional_args=consensus_model_args, n_threads=args.tagthreads, one_contig_per_process=one_contig_per_process,
+                                      stream=args.stream, resume=args.resume,
+                                      run_parameters=get_run_parameters(args)
                                       )
     else:
 
@@ -1170,6 +1407,10 @@ def run_multiome_tagging(args):
             no_source_reads=args.no_source_reads
             )
 
+    if args.cut_site_index:
+        print('Writing cut site index')
+        write_cut_site_index(args.o, threads=args.tagthreads if args.multiprocess else None)
+
 
 if __name__ == '__main__':
     args = argparser.parse_args()
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 from os import remove
+import os
+import json
 from pysam import AlignmentFile
 from singlecellmultiomics.bamProcessing import sorted_bam_file
 from uuid import uuid4
@@ -21,8 +23,15 @@ def prefetch(contig, start, end, fetch_start,fetch_end,molecule_iterator_args):
             for key, value in molecule_iterator_args[iterator_arg].items():
                 if key == 'features':
                     value = value.prefetch(contig,start,end)
-                if key == 'mappability_reader':
-                    value = value.prefetch(contig,start,end)
+                if key == 'mapability_reader' and value is not None:
+                    value = value.prefetch(contig,
+                                           start if fetch_start is None else fetch_start,
+                                           end if fetch_end is None else fetch_end)
+                if key == 'allele_resolver' and value is not None:
+                    # Reads are fetched from fetch_start up to fetch_end
+                    value = value.prefetch(contig,
+                                           start if fetch_start is None else fetch_start,
+                                           end if fetch_end is None else fetch_end)
                 new_args[key] = value
             new_kwarg_dict[iterator_arg] = new_args
         else:
@@ -180,6 +189,7 @@ def run_tagging_tasks(args: tuple):
     meta = {
         'timeout_tasks' : timeout_tasks,
         'total_molecules' : total_molecules,
+        'tasks' : [ task_region(task) for task in arglist ]
     }
 
     if total_molecules>0:
@@ -197,6 +207,208 @@ def run_tagging_tasks(args: tuple):
     return None, meta
 
 
+def task_region(task):
+    """ Obtain the region of a tagging task
+
+    Args:
+        task (dict) : task generated by generate_tasks
+
+    Returns:
+        region (tuple) : (contig, start, end, fetch_start, fetch_end)
+    """
+    return tuple( task[key] for key in ('contig', 'start', 'end', 'fetch_start', 'fetch_end') )
+
+
+class TaggingManifest():
+    """ Persistent record of the completed jobs of a multiprocess tagging run, used to resume a run.
+
+    The manifest is a file with one JSON record per line. The first line contains the parameters of the run,
+    every next line describes a completed job: the regions of its tasks, the bam file written and its statistics.
+    Records are only appended after the bam file of the job has been written and indexed,
+    a truncated last line (a job which did not finish) is ignored.
+
+    Example:
+        >>> manifest = TaggingManifest('./scmo_temp/manifest.jsonl', parameters={'input':'input.bam'}, resume=True)
+        >>> jobs = [job for job in jobs if not manifest.is_completed(job)]
+        >>> for bam, meta in job_generator:
+        >>>     manifest.record(bam, meta)
+
+    """
+
+    def __init__(self, path, parameters, resume=False):
+        """
+        Args:
+            path (str) : path to manifest file
+
+            parameters (dict) : JSON serialisable parameters of the run, a run can only be resumed when the parameters are identical
+
+            resume (bool) : read the completed jobs from an existing manifest, a ValueError is raised when its parameters differ.
+                When False an existing manifest is replaced and the bam files it lists are removed
+        """
+        self.path = path
+        self.parameters = json.loads(json.dumps(parameters))
+        self.completed = [] # list of job records
+
+        if os.path.exists(path):
+            previous_parameters, completed = self._read()
+            if resume:
+                if previous_parameters != self.parameters:
+                    raise ValueError(f'The run in {os.path.dirname(path)} was started with different parameters and cannot be resumed')
+                # Only keep jobs of which the bam file still exists
+                self.completed = [job for job in completed
+                                  if job['bam'] is None or (os.path.exists(job['bam']) and os.path.exists(job['bam']+'.bai'))]
+            else:
+                for job in completed:
+                    if job['bam'] is not None:
+                        for stale_path in (job['bam'], job['bam']+'.bai'):
+                            if os.path.exists(stale_path):
+                                remove(stale_path)
+
+        # (Re)write the manifest, this also drops a truncated last line
+        with open(path, 'w') as o:
+            o.write(json.dumps(self.parameters)+'\n')
+            for job in self.completed:
+                o.write(json.dumps(job)+'\n')
+
+        self.completed_tasks = set()
+        for job in self.completed:
+            self.completed_tasks.update( tuple(task) for task in job['tasks'] )
+
+    def _read(self):
+        parameters = None
+        completed = []
+        with open(self.path) as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if i == 0:
+                    parameters = record
+                else:
+                    completed.append(record)
+        return parameters, completed
+
+    def is_completed(self, job):
+        """ Check if all tasks of the job have been completed
+
+        Args:
+            job (list) : list of (contig, start, end, fetch_start, fetch_end) tuples
+        """
+        return all( tuple(task) in self.completed_tasks for task in job )
+
+    def record(self, bam, meta):
+        """ Record a completed job
+
+        Args:
+            bam (str) : path to the (indexed) bam file written by the job, None when no molecules were written
+            meta (dict) : meta data returned by run_tagging_tasks
+        """
+        job = {
+            'bam': bam,
+            'tasks': [ list(task) for task in meta.get('tasks', []) ],
+            'total_molecules': meta.get('total_molecules', 0),
+            'timeout_tasks': [ {key:task[key] for key in ('contig', 'start', 'end')} for task in meta.get('timeout_tasks', []) ]
+        }
+        self.completed.append(job)
+        self.completed_tasks.update( tuple(task) for task in job['tasks'] )
+        with open(self.path, 'a') as o:
+            o.write(json.dumps(job)+'\n')
+            o.flush()
+            os.fsync(o.fileno())
+
+    def remove(self):
+        remove(self.path)
+
+
+# Sort key used for reads without coordinate, these are placed at the end of a sorted bam file
+UNMAPPED_SORT_KEY = (2**31, 0)
+
+def coordinate_sort_key(read):
+    """ Obtain key to sort reads in the same order as a coordinate sorted bam file
+
+    Args:
+        read (pysam.AlignedSegment)
+
+    Returns:
+        key (tuple) : (reference_id, reference_start)
+    """
+    if read.reference_id < 0:
+        return UNMAPPED_SORT_KEY
+    return (read.reference_id, read.reference_start)
+
+
+class TaggedReadCollector():
+    """ Write handle which keeps the written reads in memory as (sort key, SAM string) tuples,
+    the reads can be send to another process and written there.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.records = []
+
+    def write(self, read):
+        self.records.append( (coordinate_sort_key(read), read.to_string()) )
+
+    def sorted_records(self):
+        self.records.sort(key=lambda record: record[0])
+        return self.records
+
+
+def run_tagging_tasks_streamed(args: tuple):
+    """ Run tagging for one or more tasks, keeping the tagged reads in memory instead of writing a temporary bam file
+
+    Args:
+        args (tuple): (alignments_path, temp_dir, timeout_time), arglist
+
+    Returns:
+        records (list) : coordinate sorted list of (sort key, SAM string) tuples
+        meta (dict) : {'timeout_tasks':[..], 'total_molecules':int, 'read_groups':dict}
+
+    """
+
+    (alignments_path, temp_dir, timeout_time), arglist = args
+
+    timeout_tasks = []
+    total_molecules = 0
+    read_groups = dict()
+
+    with AlignmentFile(alignments_path) as alignments:
+        output = TaggedReadCollector(alignments.header)
+        for task in arglist:
+            try:
+                statistics = run_tagging_task(alignments, output, read_groups=read_groups, timeout_time=timeout_time, **task)
+                total_molecules += statistics.get('total_molecules_written', 0)
+            except TimeoutError:
+                timeout_tasks.append( task )
+
+    meta = {
+        'timeout_tasks' : timeout_tasks,
+        'total_molecules' : total_molecules,
+        'read_groups' : read_groups
+    }
+
+    return output.sorted_records(), meta
+
+
+def task_lower_bound(task, reference_ids, margin=0):
+    """ Obtain the lowest sort key a read produced by the task can have (when the read is not far away from its cut site)
+
+    Args:
+        task (tuple) : (contig, start, end, fetch_start, fetch_end)
+        reference_ids (dict) : {contig:reference_id}
+        margin (int) : amount of bp reads can start before fetch_start
+
+    Returns:
+        key (tuple) : (reference_id, position)
+    """
+    contig, start, end, fetch_start, fetch_end = task
+    position = fetch_start if fetch_start is not None else start
+    if position is None:
+        position = 0
+    return (reference_ids[contig], max(0, position - margin))
+
+
 def generate_tasks(input_bam_path: str, temp_folder: str, job_gen: Generator, iteration_args: dict,
                    additional_args: dict,
                    max_time_per_segment: int = None) -> Generator:
@@ -152,8 +152,7 @@ if __name__ == '__main__':
     allele_gr.add_argument(
         '--use_allele_cache',
         action='store_true',
-        help='''Write and use a cache file for the allele information. NOTE: THIS IS NOT THREAD SAFE! Meaning you should not use this function on multiple libraries at the same time when the cache files are not yet available.
-            Once they are available there is not thread safety issue anymore''')
+        help='Write and use a memory mapped cache of the allele information, the cache is stored next to the variant file. Processes running at the same time share the cache, it is created once')
 
 
     args = argparser.parse_args()
@@ -86,3 +86,25 @@ def bp_chunked(job_generator, bp_per_job):
             bp_current=0
             current_tasks=[]
     yield current_tasks
+
+
+def coordinates_to_sliding_bin_ids(positions, bin_size, sliding_increment):
+    """ Vectorised coordinate_to_sliding_bin_locations, obtain the range of sliding bins overlapping every coordinate
+
+    Args:
+        positions (np.ndarray) : coordinates to look up
+
+        bin_size (int) : bin size
+
+        sliding_increment (int) : sliding window offset, this is the increment between bins
+
+    Returns:
+        start_ids (np.ndarray) : the index of the first overlapping bin of every coordinate
+
+        end_ids (np.ndarray) : the index of the last overlapping bin of every coordinate
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    # -((bin_size - p) // inc) is the integer ceil of (p - bin_size) / inc
+    start_ids = -((bin_size - positions) // sliding_increment)
+    end_ids = positions // sliding_increment
+    return start_ids, end_ids
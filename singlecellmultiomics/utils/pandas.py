@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-import seaborn as sns
 import warnings
 
 def createRowColorDataFrame( discreteStatesDataFrame, nanColor =(0,0,0), predeterminedColorMapping={} ):
@@ -19,6 +18,9 @@ def createRowColorDataFrame( discreteStatesDataFrame, nanColor =(0,0,0), predete
 
         luts (dict) : class->color mapping
     """
+    # seaborn is imported here as it is slow to import, and only used for plotting
+    import seaborn as sns
+
     # Should look like:
     # discreteStatesDataFrame = pd.DataFrame( [['A','x'],['A','y']],index=['A','B'], columns=['First', 'Second'] )
     colorMatrix = []
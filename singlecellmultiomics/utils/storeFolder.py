@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import contextlib
+import os
+import shutil
+
+# lock path -> [handle, depth], locks held by this process
+_held_locks = {}
+
+
+@contextlib.contextmanager
+def store_lock(store_path):
+    """Hold an exclusive lock on a store folder, used to let a single process create the store.
+    The lock is re-entrant within a process. On platforms without fcntl no lock is taken,
+    concurrent processes then each write the store, which is safe as write_store_folder
+    renames complete stores into place.
+
+    Args:
+        store_path (str) : path of the store
+    """
+    lock_path = f'{os.path.abspath(store_path)}.lock'
+    if lock_path in _held_locks:
+        _held_locks[lock_path][1] += 1
+        try:
+            yield
+        finally:
+            _held_locks[lock_path][1] -= 1
+        return
+
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(lock_path, 'w') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        _held_locks[lock_path] = [handle, 1]
+        try:
+            yield
+        finally:
+            del _held_locks[lock_path]
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def write_store_folder(store_path, write, is_valid=None):
+    """Create a store folder atomically. The contents are written to a temporary folder
+    which replaces the store with a single rename when complete, other processes never
+    observe an incomplete store. A valid store is never removed: when another process
+    created a valid store in the mean time nothing is written.
+
+    Args:
+        store_path (str) : path of the store
+
+        write (callable) : called with the path of the (empty) temporary folder to write the contents to
+
+        is_valid (callable) : called with store_path, returns True when the existing store
+            can be used as is. When None any existing store is replaced
+
+    Returns:
+        written (bool) : False when an existing valid store was kept
+    """
+    with store_lock(store_path):
+        if is_valid is not None and os.path.exists(store_path) and is_valid(store_path):
+            return False
+
+        temp_path = f'{store_path}.{os.getpid()}.tmp'
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        os.makedirs(temp_path)
+        try:
+            write(temp_path)
+        except BaseException:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+
+        # Move the outdated store aside, the swap itself is a single rename
+        old_path = None
+        if os.path.exists(store_path):
+            old_path = f'{store_path}.{os.getpid()}.old'
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            try:
+                os.rename(store_path, old_path)
+            except OSError:
+                old_path = None
+        try:
+            os.rename(temp_path, store_path)
+        except OSError:
+            # Another (unlocked) process created the store in the mean time
+            shutil.rmtree(temp_path, ignore_errors=True)
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+    return True
@@ -4,6 +4,8 @@ import unittest
 import itertools
 import pysam
 import os
+import random
+import tempfile
 from singlecellmultiomics.alleleTools import AlleleResolver
 import pysam
 
@@ -11,6 +13,23 @@ import pysam
 These tests check if the AlleleResolver is working correctly
 """
 
+def write_random_vcf(path):
+    """Write an indexed vcf file with random phased variants, returns the path of the bgzipped vcf"""
+    random.seed(3)
+    genotypes = ['0|0', '0|1', '1|0', '1|1', '.|.']
+    with open(path, 'w') as f:
+        f.write('##fileformat=VCFv4.0\n##contig=<ID=1,length=20000>\n##contig=<ID=2,length=20000>\n'
+                '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n'
+                '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+                '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tA\tB\tC\n')
+        for contig in ('1', '2'):
+            for pos in sorted(random.sample(range(1, 20000), 500)):
+                ref, alt = random.sample('ACGT', 2)
+                f.write('\t'.join([contig, str(pos), '.', ref, alt, '42', 'PASS', 'DP=4', 'GT'] +
+                                  random.choices(genotypes, k=3)) + '\n')
+    return pysam.tabix_index(path, preset='vcf')
+
+
 class TestAlleleResolver(unittest.TestCase):
 
     def test_vcf_reader(self):
@@ -53,6 +72,109 @@ class TestAlleleResolver(unittest.TestCase):
         except Exception as e:
             raise
 
+    def test_region_store(self):
+        with tempfile.TemporaryDirectory() as folder:
+            vcf_path = write_random_vcf(f'{folder}/variants.vcf')
+
+            complete = AlleleResolver(vcffile=vcf_path)
+            lazy = AlleleResolver(vcffile=vcf_path, lazyLoad=True)
+            prefetched = lazy.prefetch('1', 5000, 10000)
+            self.assertEqual(list(prefetched.alleleStores), ['1'])
+            self.assertTrue(all(5000 <= position < 10000 for position in prefetched.alleleStores['1'].positions))
+
+            for contig in ('1', '2', '3'):
+                for pos in range(0, 20000):
+                    for base in 'ACGTN':
+                        expected = complete.getAllelesAt(contig, pos, base)
+                        self.assertEqual(lazy.getAllelesAt(contig, pos, base), expected)
+                        self.assertEqual(prefetched.getAllelesAt(contig, pos, base), expected)
+                    self.assertEqual(lazy.has_location(contig, pos), complete.has_location(contig, pos))
+
+            # Lookups outside of the prefetched region do not replace the prefetched store
+            self.assertEqual((prefetched.alleleStores['1'].start, prefetched.alleleStores['1'].end), (5000, 10000))
+            self.assertEqual(list(prefetched.lazyAlleleStores['1']), [0])
+
+    def test_lazy_region_cache(self):
+        from unittest.mock import patch
+        import singlecellmultiomics.alleleTools.alleleTools as alleleTools
+        with tempfile.TemporaryDirectory() as folder, patch.object(alleleTools, 'LAZY_REGION_SIZE', 1000):
+            vcf_path = write_random_vcf(f'{folder}/variants.vcf')
+            complete = AlleleResolver(vcffile=vcf_path)
+            prefetched = AlleleResolver(vcffile=vcf_path, lazyLoad=True).prefetch('1', 5000, 6000)
+
+            loaded = []
+            fetch_region = prefetched.fetchRegion
+            def counting_fetch_region(chrom, start=None, end=None, lazy=False):
+                loaded.append(start)
+                return fetch_region(chrom, start, end, lazy=lazy)
+            prefetched.fetchRegion = counting_fetch_region
+
+            # Alternate between two neighbouring blocks and the prefetched region
+            for pos in list(range(3000, 5000)) * 2 + list(range(5000, 6000)) + list(range(6000, 20000)):
+                for base in 'ACGT':
+                    self.assertEqual(prefetched.getAllelesAt('1', pos, base), complete.getAllelesAt('1', pos, base))
+                self.assertLessEqual(len(prefetched.lazyAlleleStores['1']), alleleTools.LAZY_REGION_CACHE_SIZE)
+            self.assertEqual(loaded, [3000, 4000] + list(range(6000, 20000, 1000)))
+            self.assertEqual((prefetched.alleleStores['1'].start, prefetched.alleleStores['1'].end), (5000, 6000))
+
+    def test_lazy_region_load_failure(self):
+        with tempfile.TemporaryDirectory() as folder:
+            vcf_path = write_random_vcf(f'{folder}/variants.vcf')
+            complete = AlleleResolver(vcffile=vcf_path)
+            prefetched = AlleleResolver(vcffile=vcf_path, lazyLoad=True).prefetch('1', 5000, 6000)
+
+            loaded = []
+            def failing_fetch_region(chrom, start=None, end=None, lazy=False):
+                loaded.append(start)
+                raise OSError('Could not read the variant file')
+            prefetched.fetchRegion = failing_fetch_region
+
+            # A failed lazy load does not replace the prefetched store, and is not retried
+            for pos in (100, 200, 5500):
+                for base in 'ACGT':
+                    expected = complete.getAllelesAt('1', pos, base) if pos == 5500 else None
+                    self.assertEqual(prefetched.getAllelesAt('1', pos, base), expected)
+            self.assertEqual(loaded, [0])
+            self.assertEqual((prefetched.alleleStores['1'].start, prefetched.alleleStores['1'].end), (5000, 6000))
+
+    def test_allele_cache(self):
+        with tempfile.TemporaryDirectory() as folder:
+            vcf_path = write_random_vcf(f'{folder}/variants.vcf')
+            complete = AlleleResolver(vcffile=vcf_path, select_samples=['A', 'B'])
+
+            cached = AlleleResolver(vcffile=vcf_path, select_samples=['A', 'B'], use_cache=True).prefetch('1', 100, 15000)
+            cache_path = cached.get_cache_path('1')
+            self.assertTrue(os.path.exists(f'{cache_path}/positions.npy'))
+            created = os.stat(f'{cache_path}/positions.npy').st_mtime_ns
+
+            # The cache is re-used by other resolvers
+            for resolver in (cached, AlleleResolver(vcffile=vcf_path, select_samples=['A', 'B'], use_cache=True)):
+                for pos in range(0, 20000):
+                    for base in 'ACGT':
+                        self.assertEqual(resolver.getAllelesAt('1', pos, base), complete.getAllelesAt('1', pos, base))
+            self.assertEqual(os.stat(f'{cache_path}/positions.npy').st_mtime_ns, created)
+
+            # Reading the cache into the dictionary
+            resolver = AlleleResolver(vcffile=vcf_path, select_samples=['A', 'B'], use_cache=True)
+            resolver.fetchChromosome(vcf_path, '2')
+            self.assertEqual(resolver.locationToAllele['2'], complete.locationToAllele['2'])
+
+            # Other settings use another cache
+            self.assertNotEqual(AlleleResolver(vcffile=vcf_path, use_cache=True).get_cache_path('1'), cache_path)
+
+            # The cache is rebuilt when the vcf file changes
+            os.utime(vcf_path, ns=(created, created + 10**9))
+            AlleleResolver(vcffile=vcf_path, select_samples=['A', 'B'], use_cache=True).prefetch('1', 100, 15000)
+            self.assertNotEqual(os.stat(f'{cache_path}/positions.npy').st_mtime_ns, created)
+
+    def test_allele_cache_without_fcntl(self):
+        from unittest.mock import patch
+        from singlecellmultiomics.alleleTools.alleleCache import allele_cache_lock
+        with tempfile.TemporaryDirectory() as folder, patch.dict('sys.modules', {'fcntl': None}):
+            # Platforms without fcntl do not lock the cache
+            with allele_cache_lock(f'{folder}/cache/1'):
+                pass
+            self.assertFalse(os.path.exists(f'{folder}/cache/1.lock'))
 
 if __name__ == '__main__':
     unittest.main()
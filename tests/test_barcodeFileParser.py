@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
+import glob
 import itertools
+import os
+import tempfile
+from unittest.mock import patch
 
 import singlecellmultiomics.barcodeFileParser.barcodeFileParser as barcodeFileParser
 
@@ -102,6 +106,62 @@ class TestBarcodeParser(unittest.TestCase):
         self.assertEqual(barcode,'AAA')
         self.assertEqual(hd,1)
 
+    def test_correction_index(self):
+
+        for hd in (1, 2):
+            b = barcodeFileParser.BarcodeParser()
+            for index, barcode in enumerate(['AAAA', 'AATT', 'TTTT', 'ACGT', 'GGCA', 'ACG']):
+                b.addBarcode(barcodeFileAlias='test', barcode=barcode, index=index)
+            b.expand(hd, 'test')
+
+            # The index resolves exactly the same as the dictionary expansion
+            index = barcodeFileParser.BarcodeCorrectionIndex.build(b.barcodes['test'], hd)
+            for query in map(''.join, itertools.chain(
+                    itertools.product('ACGTN', repeat=3),
+                    itertools.product('ACGTN', repeat=4))):
+                origin, distance = index.lookup(query)
+                _, expected_origin, expected_distance = b.getIndexCorrectedBarcodeAndHammingDistance(query, 'test')
+                self.assertEqual((origin, distance), (expected_origin, expected_distance))
+
+        # Barcodes which can not be packed
+        self.assertIsNone(barcodeFileParser.BarcodeCorrectionIndex.build(['AXA'], 1))
+        self.assertIsNone(barcodeFileParser.pack_barcode('A1'))
+
+    def test_lazy_expansion(self):
+
+        with tempfile.TemporaryDirectory() as folder:
+            with open(f'{folder}/test.bc', 'w') as f:
+                f.write('1 AAAA\n2 AATT\n3 TTTT\n')
+
+            for i in range(2):
+                b = barcodeFileParser.BarcodeParser(folder, hammingDistanceExpansion=2,
+                                                    cacheDirectory=f'{folder}/cache')
+                # Barcode files are parsed on first use
+                self.assertEqual(len(b.barcodes), 0)
+                self.assertEqual(len(b.correctionIndices), 0)
+                self.assertEqual(b.getIndexCorrectedBarcodeAndHammingDistance('TTTG', 'test'), (3, 'TTTT', 1))
+                self.assertEqual(b.getIndexCorrectedBarcodeAndHammingDistance('AAAT', 'test'), (None, None, None))
+                self.assertEqual(b.getIndexCorrectedBarcodeAndHammingDistance('CAAG', 'test'), (1, 'AAAA', 2))
+                # The index is stored in the cache directory, not next to the barcode file
+                self.assertEqual(len(glob.glob(f'{folder}/cache/test.bc.*.hd2.npz')), 1)
+                self.assertEqual(list(b.barcodes.keys()), ['test'])
+
+            # The lookup memoization is bounded
+            with patch.object(barcodeFileParser, 'LOOKUP_CACHE_SIZE', 10):
+                for query in map(''.join, itertools.product('ACGT', repeat=4)):
+                    b.getIndexCorrectedBarcodeAndHammingDistance(query, 'test')
+                self.assertEqual(len(b.correctionIndices['test'].cache), 10)
+
+            # By default the index is stored in the user cache directory
+            with patch.dict(os.environ, {'XDG_CACHE_HOME': f'{folder}/user_cache'}):
+                self.assertEqual(barcodeFileParser.BarcodeParser(folder).cacheDirectory,
+                                 f'{folder}/user_cache/singlecellmultiomics/barcode_indices')
+
+            # Adding a barcode invalidates the index
+            b.addBarcode('test', barcode='CCCC', index=4)
+            self.assertEqual(b.getIndexCorrectedBarcodeAndHammingDistance('CCCA', 'test'), (4, 'CCCC', 1))
+            self.assertEqual(b.getTargetCount('test')[0], 4)
+
 
 if __name__ == '__main__':
     unittest.main()
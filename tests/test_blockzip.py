@@ -2,8 +2,13 @@
 # -*- coding: utf-8 -*-
 import unittest
 from singlecellmultiomics.utils import BlockZip
+from singlecellmultiomics.bamProcessing import MapabilityReader
+from singlecellmultiomics.bamProcessing.mappabilityStore import blockzip_to_mappability_store, MappabilityStore
 
 import os
+import pickle
+import tempfile
+import numpy as np
 """
 These tests check if the BlockZip module is working correctly
 """
@@ -48,6 +53,42 @@ class Test_BlockZip(unittest.TestCase):
         self.assertRaises(ValueError, BlockZip, './non_existing.bgzf','r')
 
 
+    def test_mappability_store(self):
+        rng = np.random.default_rng(3)
+        with tempfile.TemporaryDirectory() as folder:
+            safe_path = f'{folder}/sites.safe.bgzf'
+            sites = {contig: sorted({(int(pos), bool(strand)) for pos, strand in zip(
+                rng.integers(10_000, size=500), rng.integers(2, size=500))}) for contig in ('chr1', 'chr2')}
+            with BlockZip(safe_path, 'w') as f:
+                for contig, contig_sites in sites.items():
+                    for pos, strand in contig_sites:
+                        f.write(contig, pos, strand, 'ok')
+
+            store_path = blockzip_to_mappability_store(safe_path, f'{folder}/sites.mappability.store')
+            blockzip_reader = MapabilityReader(safe_path)
+            store_reader = MapabilityReader(store_path)
+            prefetched = store_reader.prefetch('chr1', 2_000, 5_000)
+            # The region does not hold a copy of the memory mapped arrays
+            self.assertTrue(np.shares_memory(prefetched.handle.positions, store_reader.handle.positions))
+            unpickled = pickle.loads(pickle.dumps(prefetched.handle))
+            self.assertEqual(len(unpickled.positions), len(prefetched.handle.positions))
+            # A region of a region is selected from the complete store, also for another contig
+            other_region = prefetched.handle.region('chr2', 1_000, 8_000)
+            self.assertTrue(len(other_region.positions) > 0)
+            self.assertTrue(all(1_000 <= pos < 8_000 for pos in other_region.positions))
+
+            queries = [('chr1', pos, strand) for pos, strand in sites['chr1'][::7]] + \
+                [(contig, int(pos), bool(strand)) for contig, pos, strand in zip(
+                    rng.choice(['chr1', 'chr2', 'chr3'], size=1000), rng.integers(10_000, size=1000),
+                    rng.integers(2, size=1000))]
+            for query in queries:
+                expected = blockzip_reader.site_is_mapable(*query)
+                self.assertEqual(store_reader.site_is_mapable(*query), expected)
+                self.assertEqual(prefetched.site_is_mapable(*query), expected)
+                self.assertEqual(unpickled.site_is_mapable(*query), expected)
+                self.assertEqual(other_region.site_is_mapable(*query), expected)
+                self.assertEqual(store_reader[query], blockzip_reader[query])
+            self.assertEqual(MappabilityStore(store_path).get_contigs(), ['chr1', 'chr2'])
 
 
 if __name__ == '__main__':
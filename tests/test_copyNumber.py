@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import numpy as np
+from singlecellmultiomics.bamProcessing.bamCopyNumber import cbs_stat, cbs_stat_batch, tstat, tstat_batch, segment_profiles, \
+    permutation_batches
+
+"""
+These tests check if copy number profiles are segmented correctly
+"""
+
+
+class TestSegmentation(unittest.TestCase):
+
+    def test_batched_statistics(self):
+        X = np.random.default_rng(0).normal(size=(20, 60))
+        self.assertTrue(np.allclose(cbs_stat_batch(X), [cbs_stat(x)[0] for x in X]))
+        self.assertTrue(np.allclose(tstat_batch(X, 13), [tstat(x, 13) for x in X]))
+
+    def test_permutation_batches(self):
+        x = np.arange(50)
+        batches = list(permutation_batches(x, 25, np.random.default_rng(2)))
+        permutations = np.concatenate(batches)
+        self.assertEqual(permutations.shape, (25, 50))
+        # Every row is a permutation of x, shuffled independently of the other rows
+        self.assertTrue((np.sort(permutations, axis=1) == x).all())
+        self.assertEqual(len({tuple(row) for row in permutations}), 25)
+
+    def test_segment_profiles(self):
+        rng = np.random.default_rng(1)
+        profiles = [
+            np.concatenate([rng.normal(2, 0.2, 60), rng.normal(4, 0.2, 40), rng.normal(1, 0.2, 50)]),
+            rng.normal(2, 0.2, 100)
+        ]
+        segmentations = segment_profiles(profiles, shuffles=2000, p=0.01)
+        breakpoints = segmentations[0][1]
+        self.assertEqual(len(breakpoints), 4)
+        for observed, expected in zip(breakpoints, [0, 60, 100, 150]):
+            self.assertLessEqual(abs(observed - expected), 1)
+        self.assertEqual(segmentations[1][1], [0, 100])
+        # Segmentation is reproducible and does not depend on the amount of processes
+        self.assertEqual(segment_profiles(profiles, shuffles=2000, p=0.01, threads=2), segmentations)
+
+
+if __name__ == '__main__':
+    unittest.main()
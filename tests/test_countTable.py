@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
+import collections
+import os
+import random
+import tempfile
+import pandas as pd
+import pysam
+import scipy.sparse
 from types import SimpleNamespace
 import singlecellmultiomics.bamProcessing.bamToCountTable
+from singlecellmultiomics.countTableProcessing import SparseCountTable
 
 from singlecellmultiomics.bamProcessing.bamBinCounts import range_contains_overlap,blacklisted_binning
+from singlecellmultiomics.bamProcessing.bamBinCounts import get_binned_counts, get_multi_binned_counts, CutPositions, BinnedCounts, _count_blocks
+from singlecellmultiomics.utils.binning import coordinate_to_bins
 
 class TestIterables(unittest.TestCase):
 
@@ -335,7 +345,189 @@ class TestCountTable(unittest.TestCase):
         self.assertEqual( df.loc[:,['A3-P15-1-1_25']].sum(skipna=True).sum(skipna=True), 12.0 )
 
 
-
+    def test_sparse_count_table(self):
+        random.seed(5)
+        increments = [(f'cell_{random.randint(0, 20)}', ('chr1', random.randint(0, 50)), random.choice([1, 1, 0.5]))
+                      for i in range(5000)]
+        # Consolidate often, and merge two partial tables
+        tables = [SparseCountTable(consolidate_every=100), SparseCountTable(consolidate_every=100)]
+        counts = collections.defaultdict(collections.Counter)
+        for i, (sample, feature, value) in enumerate(increments):
+            tables[i >= 2500].add(sample, feature, value)
+            counts[sample][feature] += value
+        tables[0].update(tables[1])
+        self.assertTrue(tables[0].to_dataframe().equals(pd.DataFrame.from_dict(counts)))
+
+        table = SparseCountTable()
+        table.add(('A',), 'chr1', 1)
+        table.add(('B',), 'chr2', 1)
+        table.add(('A',), 'chr2', 2)
+        df = table.to_dataframe()
+        self.assertTrue(df.equals(pd.DataFrame.from_dict({('A',): {'chr1': 1, 'chr2': 2}, ('B',): {'chr2': 1}})))
+        self.assertEqual(str(df[('A',)].dtype), 'int64')
+
+    def test_sparse_output(self):
+        args = SimpleNamespace(
+                alignmentfiles=['./data/mini_nla_test.bam'],
+                head=None,
+                o=None,
+                bin=1000,
+                binTag='DS',
+                sliding=None,
+                bedfile=None,
+                showtags=False,
+                featureTags=None,
+                joinedFeatureTags='reference_name',
+                byValue=None,
+                sampleTags='SM', proper_pairs_only=False, no_indels=False, max_base_edits=None, no_softclips=False,
+                minMQ=0,
+                filterXA=False,
+                dedup=False,
+                divideMultimapping=False,
+                doNotDivideFragments=True,
+                contig=None,
+                blacklist=None,
+                r1only=False,
+                r2only=False,
+                filterMP=False,
+                keepOverBounds=False,
+                splitFeatures=False,
+                feature_delimiter=',',
+                 noNames=False)
+        df = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args, return_df=True)
+        with tempfile.TemporaryDirectory() as folder:
+            args.o = f'{folder}/counts.npz'
+            singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args)
+            matrix = scipy.sparse.load_npz(args.o)
+            features = pd.read_csv(f'{folder}/counts.features.tsv', sep='\t')
+            samples = pd.read_csv(f'{folder}/counts.samples.tsv', sep='\t')
+            self.assertEqual(list(features.columns), list(df.index.names))
+            self.assertEqual(list(samples.iloc[:, 0]), [sample for sample, in df.columns])
+            self.assertTrue(((matrix.toarray() == df.fillna(0).values)).all())
+
+
+    def test_parallel_counting(self):
+        for bedfile, bin in ((None, 1000), ('./data/mini_test.bed', None)):
+            args = SimpleNamespace(
+                    alignmentfiles=['./data/mini_nla_test.bam'],
+                    head=None,
+                    o=None,
+                    bin=bin,
+                    binTag='DS',
+                    sliding=250 if bin else None,
+                    bedfile=bedfile,
+                    showtags=False,
+                    featureTags=None,
+                    joinedFeatureTags='reference_name',
+                    byValue=None,
+                    sampleTags='SM', proper_pairs_only=False, no_indels=False, max_base_edits=None, no_softclips=False,
+                    minMQ=0,
+                    filterXA=False,
+                    dedup=False,
+                    divideMultimapping=False,
+                    doNotDivideFragments=False,
+                    contig=None,
+                    blacklist=None,
+                    r1only=False,
+                    r2only=False,
+                    filterMP=False,
+                    keepOverBounds=False,
+                    splitFeatures=False,
+                    feature_delimiter=',',
+                     noNames=False)
+            df = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args, return_df=True)
+            args.t = 2
+            self.assertTrue(
+                singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args, return_df=True).equals(df))
+
+    def test_parallel_counting_unplaced(self):
+        with tempfile.TemporaryDirectory() as folder:
+            # Append unmapped reads without coordinate to the end of a sorted bam file
+            bam_path = f'{folder}/unplaced.bam'
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as source, \
+                    pysam.AlignmentFile(bam_path, 'wb', template=source) as out:
+                for read in source:
+                    out.write(read)
+                for i in range(10):
+                    read = pysam.AlignedSegment(out.header)
+                    read.query_name = f'unplaced_{i}'
+                    read.query_sequence = 'ACGT' * 10
+                    read.query_qualities = pysam.qualitystring_to_array('A' * 40)
+                    read.is_unmapped = True
+                    read.set_tag('SM', f'cell_{i % 3}')
+                    out.write(read)
+            pysam.index(bam_path)
+
+            args = SimpleNamespace(
+                    alignmentfiles=[bam_path], head=None, o=None, bin=None, binTag='DS', sliding=None,
+                    bedfile=None, showtags=False, featureTags='SM', joinedFeatureTags=None, byValue=None,
+                    sampleTags='SM', proper_pairs_only=False, no_indels=False, max_base_edits=None,
+                    no_softclips=False, minMQ=0, filterXA=False, dedup=False, divideMultimapping=False,
+                    doNotDivideFragments=False, contig=None, blacklist=None, r1only=False, r2only=False,
+                    filterMP=False, keepOverBounds=False, splitFeatures=False, feature_delimiter=',',
+                    noNames=False)
+            df = singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args, return_df=True)
+            self.assertNotIn('cell_0', df.columns.get_level_values(0))
+            args.t = 2
+            self.assertTrue(
+                singlecellmultiomics.bamProcessing.bamToCountTable.create_count_table(args, return_df=True).equals(df))
+
+    def test_multi_bin_size_counting(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cut_positions_path = f'{folder}/cuts.npz'
+            counts = get_multi_binned_counts(['./data/mini_nla_test.bam'], [1000, 50_000], regions=['chr1'],
+                                             cut_positions_path=cut_positions_path)
+            for bin_size, df in counts.items():
+                expected = get_binned_counts(['./data/mini_nla_test.bam'], bin_size, regions=['chr1'])
+                self.assertTrue(df.equals(expected[df.columns].sort_index().astype(float)))
+
+            # The stored cut positions are used, the bam file is not read
+            sliding = get_multi_binned_counts(['./missing.bam'], [1000], sliding_increment=250,
+                                              cut_positions_path=cut_positions_path)[1000]
+            cut_positions = CutPositions.read(cut_positions_path)
+            expected = collections.Counter()
+            for position in cut_positions.positions['chr1'].tolist():
+                for bin_start, bin_end in coordinate_to_bins(position, 1000, 250):
+                    expected[bin_start] += 1
+            self.assertEqual(sliding.sum(axis=1).loc['chr1'].to_dict(), expected)
+
+    def test_binned_counts_merging(self):
+        bin_size = 100
+        rng = random.Random(1)
+        results = []
+        for job in range(20):
+            result = collections.defaultdict(dict)
+            for _ in range(50):
+                contig = rng.choice(['chr1', 'chr2'])
+                bin_start = rng.randrange(0, 1000, bin_size)
+                bin_id = (rng.choice(['A', 'B', None]), contig, bin_start, min(bin_start + bin_size, 950))
+                # Every job adds new samples
+                result[bin_id][f'cell_{rng.randrange(job * 5 + 5)}'] = rng.randint(1, 10)
+            results.append(dict(result))
+
+        expected = collections.defaultdict(collections.Counter)
+        counts = BinnedCounts(contig_sizes={'chr1': 950})
+        for result in results:
+            for bin_id, sample_counts in result.items():
+                expected[bin_id].update(sample_counts)
+            counts.add_blocks(_count_blocks((lambda command: command[0], (result, bin_size))))
+
+        self.assertEqual(counts.to_dict(), {bin_id: dict(sample_counts) for bin_id, sample_counts in expected.items()})
+        df = counts.to_dataframe()
+        self.assertEqual(df.sum().sum(), sum(sum(c.values()) for c in expected.values()))
+        self.assertEqual(df.loc[('A', 'chr1')].shape[1], len(counts.samples))
+        self.assertEqual(str(df.values.dtype), 'int64')
+
+        # Fractional counts, for example of multimapping reads, are not truncated
+        fractional = {(None, 'chr2', 0, 100): {'cell_0': 0.5, 'cell_1': 1.25}, ('A', 'chr1', 100, 200): {'cell_0': 0.25}}
+        counts.add_blocks(_count_blocks((lambda command: command[0], (fractional, bin_size))))
+        for bin_id, sample_counts in fractional.items():
+            expected[bin_id].update(sample_counts)
+        self.assertEqual(counts.to_dict(), {bin_id: dict(sample_counts) for bin_id, sample_counts in expected.items()})
+        df = counts.to_dataframe()
+        self.assertEqual(str(df.values.dtype), 'float64')
+        self.assertEqual(df.loc[(None, 'chr2', 0, 100), 'cell_1'], expected[(None, 'chr2', 0, 100)]['cell_1'])
+        self.assertEqual(df.sum().sum(), sum(sum(c.values()) for c in expected.values()))
 
 if __name__ == '__main__':
     unittest.main()
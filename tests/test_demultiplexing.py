@@ -176,6 +176,54 @@ class TestUmiBarcodeDemux(unittest.TestCase):
         self.assertEqual( demultiplexed_record[0].tags['BC'], 'ACACACTA')
         self.assertEqual( demultiplexed_record[0].tags['bi'], 1)
 
+    def test_multi_process_demultiplexing(self):
+        import gzip
+        import io
+        import random
+        import tempfile
+        from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle
+        from singlecellmultiomics.modularDemultiplexer.demultiplexingStrategyLoader import DemultiplexingStrategyLoader
+
+        barcode_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/barcodes/')
+        index_folder = pkg_resources.resource_filename('singlecellmultiomics','modularDemultiplexer/indices/')
+        dmx = DemultiplexingStrategyLoader(
+            barcodeParser=BarcodeParser(barcode_folder),
+            indexParser=BarcodeParser(index_folder),
+            indexFileAlias='illumina_merged_ThruPlex48S_RP')
+        strategies = dmx.getSelectedStrategiesFromStringList(['NLAIII384C8U3', 'CS2C8U6'], verbose=False)
+
+        random.seed(42)
+        with tempfile.TemporaryDirectory() as folder:
+            fastq_paths = [f'{folder}/LIB_S1_L001_R1_001.fastq.gz', f'{folder}/LIB_S1_L001_R2_001.fastq.gz']
+            with gzip.open(fastq_paths[0], 'wt') as r1, gzip.open(fastq_paths[1], 'wt') as r2:
+                for i in range(2500):
+                    # Every other read pair has a matching barcode
+                    barcode = 'ACACACTA' if i % 2 else ''.join(random.choice('ACGT') for _ in range(8))
+                    sequence = ''.join(random.choice('ACGT') for _ in range(60))
+                    r1.write(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 1:N:0:GTGAAA\nCAT{barcode}{sequence}\n+\n{"E"*71}\n')
+                    r2.write(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 2:N:0:GTGAAA\n{sequence}\n+\n{"E"*60}\n')
+
+            outputs = []
+            for threads in (1, 3):
+                handle = FastqHandle(f'{folder}/{threads}_demultiplexed', True)
+                reject_handle = FastqHandle(f'{folder}/{threads}_rejects', True)
+                log_handle = io.StringIO()
+                processed, yields = dmx.demultiplex(fastq_paths, strategies=strategies, targetFile=handle,
+                                                    rejectHandle=reject_handle, log_handle=log_handle,
+                                                    library='LIB', threads=threads, chunk_size=100,
+                                                    maxReadPairs=2400)
+                handle.close()
+                reject_handle.close()
+                files = []
+                for path in ('demultiplexedR1', 'demultiplexedR2', 'rejectsR1', 'rejectsR2'):
+                    with gzip.open(f'{folder}/{threads}_{path}.fastq.gz', 'rt') as f:
+                        files.append(f.read())
+                outputs.append((processed, yields, log_handle.getvalue(), files))
+
+            self.assertEqual(outputs[0][0], 2400)
+            self.assertGreaterEqual(outputs[0][1]['NLAIII384C8U3'], 1200)
+            self.assertEqual(outputs[0], outputs[1])
+
 
 if __name__ == '__main__':
     unittest.main()
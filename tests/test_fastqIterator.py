@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import tempfile
+from shutil import which
+from singlecellmultiomics.fastqProcessing.fastqIterator import FastqIterator, FastqRecord
+from singlecellmultiomics.fastqProcessing.fastqHandle import FastqHandle
+from singlecellmultiomics.fastqProcessing.bgzfWriter import BgzfWriter, BGZF_BLOCK_SIZE
+
+"""
+These tests check if fastq files are read and written correctly
+"""
+
+def get_records(n, read='1'):
+    return [FastqRecord(f'@NS500414:628:H7YVNBGXC:1:11101:{i}:1046 {read}:N:0:GTGAAA',
+                        'ACGTN'[i % 5] * (50 + i % 30),
+                        '+',
+                        'AE#/'[i % 4] * (50 + i % 30)) for i in range(n)]
+
+def record_to_str(record):
+    return '\n'.join(record) + '\n'
+
+
+class TestFastq(unittest.TestCase):
+
+    def test_write_read(self):
+        r1 = get_records(5000, '1')
+        r2 = get_records(5000, '2')
+        with tempfile.TemporaryDirectory() as folder:
+            handle = FastqHandle(f'{folder}/demultiplexed', True, threads=2)
+            for records in zip(r1, r2):
+                handle.write([record_to_str(record) for record in records])
+            handle.close()
+
+            # Output can be read by any gzip reader
+            with gzip.open(f'{folder}/demultiplexedR1.fastq.gz', 'rt') as f:
+                self.assertEqual(f.read(), ''.join(map(record_to_str, r1)))
+
+            for decompressor in ('thread', 'auto'):
+                for block_size in (100, 4 * 1024 * 1024):
+                    pairs = list(FastqIterator(
+                        f'{folder}/demultiplexedR1.fastq.gz',
+                        f'{folder}/demultiplexedR2.fastq.gz',
+                        decompressor=decompressor,
+                        block_size=block_size))
+                    self.assertEqual(pairs, list(zip(r1, r2)))
+
+    def test_read_plain_incomplete(self):
+        records = get_records(10)
+        with tempfile.TemporaryDirectory() as folder:
+            path = f'{folder}/reads.fastq'
+            with open(path, 'w') as f:
+                f.write(''.join(map(record_to_str, records)).rstrip('\n'))
+            self.assertEqual([rec for rec, in FastqIterator(path, block_size=7)], records)
+
+            # Stop early, the reading thread is stopped upon closing
+            with FastqIterator(path, block_size=7) as iterator:
+                self.assertEqual(next(iterator), (records[0],))
+
+    def test_close_compressed(self):
+        records = get_records(20000)
+        with tempfile.TemporaryDirectory() as folder:
+            path = f'{folder}/reads.fastq.gz'
+            with gzip.open(path, 'wt') as f:
+                f.write(''.join(map(record_to_str, records)))
+
+            for decompressor in ('thread', 'gzip') if which('gzip') is not None else ('thread',):
+                # Closing before the end of the file stops the reading thread and the decompression process
+                iterator = FastqIterator(path, decompressor=decompressor, block_size=100)
+                self.assertEqual(next(iterator), (records[0],))
+                reader, = iterator.handles
+                iterator.close()
+                self.assertFalse(reader.thread.is_alive())
+                if decompressor == 'gzip':
+                    self.assertIsNotNone(reader.process.returncode)
+
+                # An iterator which is not closed is closed when it is garbage collected
+                iterator = FastqIterator(path, decompressor=decompressor, block_size=100)
+                next(iterator)
+                reader, = iterator.handles
+                del iterator
+                self.assertFalse(reader.thread.is_alive())
+                self.assertTrue(reader.stream.closed)
+
+    def test_bgzf_blocks(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = f'{folder}/test.gz'
+            data = os.urandom(BGZF_BLOCK_SIZE * 3 + 5)
+            with BgzfWriter(path, threads=3) as f:
+                f.write(data[:10])
+                f.write(data[10:])
+            with gzip.open(path) as f:
+                self.assertEqual(f.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
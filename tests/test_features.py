@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 import unittest
 import itertools
+import os
+import random
+import tempfile
 
 from singlecellmultiomics.features import FeatureContainer
 
@@ -162,6 +165,106 @@ class TestFeatureContainer(unittest.TestCase):
         #printFormatted("[BRIGHT]Test for finding closest feature")
         self.expect(  f.findNearestFeature('chr1', 0, None ), '1')
 
+    def test_compiled_gtf(self):
+        random.seed(42)
+        with tempfile.TemporaryDirectory() as folder:
+            gtf_path = f'{folder}/test.gtf'
+            with open(gtf_path, 'w') as f:
+                f.write('#!genome-build test\n')
+                for i in range(1000):
+                    start = random.randint(1, 100000)
+                    f.write('\t'.join([
+                        random.choice(['1', '2', 'MT']), 'havana', random.choice(['gene', 'exon', 'intron']),
+                        str(start), str(start + random.randint(0, 5000)), '.', random.choice('+-'), '.',
+                        f'gene_id "G{i % 100}"; transcript_id "T{i % 300}"; exon_id "E{i}"; tag "basic"; tag "CCDS";'
+                    ]) + '\n')
+
+            for kwargs in (
+                    {},
+                    {'store_all': True, 'identifierFields': None},
+                    {'select_feature_type': ['exon'], 'identifierFields': ('exon_id', 'gene_id'), 'store_all': True},
+                    {'thirdOnly': 'gene', 'contig': '2'},
+                    {'contig': '1', 'region_start': 20000, 'region_end': 30000}):
+                features = {}
+                for compiled in (False, True):
+                    f = FeatureContainer()
+                    f.loadGTF(gtf_path, compiled=compiled, **kwargs)
+                    features[compiled] = f
+                # The compiled store yields exactly the same features
+                self.assertEqual(features[False].features, features[True].features)
+                for contig in features[False].features:
+                    self.assertTrue((features[False].fastIndex[contig] == features[True].fastIndex[contig]).all())
+            self.assertTrue(os.path.exists(f'{gtf_path}.compiled/source.json'))
+
+            # Prefetched regions contain all features overlapping the region
+            f = FeatureContainer()
+            f.preload_GTF(path=gtf_path, select_feature_type=['exon'], store_all=True)
+            region = f.prefetch('1', 50000, 60000)
+            complete = FeatureContainer()
+            complete.loadGTF(gtf_path, select_feature_type=['exon'], store_all=True, compiled=False)
+            self.assertEqual(
+                region.features['1'],
+                [feature for feature in complete.features['1'] if feature[1] >= 50000 and feature[0] <= 60000])
+
+            for position in range(50000, 60000, 7):
+                self.assertEqual(
+                    sorted(region.findFeaturesAt('1', position)),
+                    sorted(feature for feature in complete.features['1'] if feature[0] <= position <= feature[1]))
+
+    def test_compiled_gtf_concurrent(self):
+        from multiprocessing import Pool
+        from singlecellmultiomics.features.annotationStore import compile_gtf, get_store_path
+        with tempfile.TemporaryDirectory() as folder:
+            gtf_path = f'{folder}/test.gtf'
+            with open(gtf_path, 'w') as f:
+                for i in range(2000):
+                    f.write('\t'.join(['1', 'havana', 'exon', str(i * 10 + 1), str(i * 10 + 5), '.', '+', '.',
+                                       f'gene_id "G{i}";']) + '\n')
+
+            # Processes compiling the same store concurrently all end up with the same, complete store
+            with Pool(4) as workers:
+                self.assertEqual(set(workers.map(compile_gtf, [gtf_path] * 8)), {get_store_path(gtf_path)})
+            self.assertEqual(
+                [name for name in os.listdir(folder) if name.endswith('.tmp') or name.endswith('.old')], [])
+
+            # An up to date store is kept as is
+            store_path = get_store_path(gtf_path)
+            stat = os.stat(f'{store_path}/starts.npy')
+            compile_gtf(gtf_path)
+            self.assertEqual(os.stat(f'{store_path}/starts.npy').st_ino, stat.st_ino)
+
+            f = FeatureContainer()
+            f.loadGTF(gtf_path, compiled=True)
+            self.assertEqual(len(f.features['1']), 2000)
+
+    def test_batch_lookup(self):
+        random.seed(7)
+        f = FeatureContainer()
+        for i in range(500):
+            start = random.randint(0, 20000)
+            f.addFeature('chr1', start, start + random.choice([10, 100, 1000, 50000]), name=str(i),
+                         strand=random.choice('+-'), data=None)
+        f.sort()
+
+        starts = [random.randint(-100, 21000) for _ in range(300)]
+        ends = [start + random.randint(0, 500) for start in starts]
+        for strands in (None, '+', '-', [random.choice(['+', '-', None]) for _ in starts]):
+            offsets, indices = f.findFeatureIndicesBetween('chr1', starts, ends, strands=strands)
+            for i, (start, end) in enumerate(zip(starts, ends)):
+                strand = strands if strands is None or isinstance(strands, str) else strands[i]
+                self.assertEqual(
+                    [f.features['chr1'][j] for j in indices[offsets[i]:offsets[i + 1]]],
+                    sorted(f.findFeaturesBetween('chr1', start, end, strand=strand)))
+
+        # Unstranded queries do not select a strand
+        unstranded = f.findFeatureIndicesBetween('chr1', starts, ends)
+        for strands in ('.', ['.'] * len(starts)):
+            offsets, indices = f.findFeatureIndicesBetween('chr1', starts, ends, strands=strands)
+            self.assertTrue((offsets == unstranded[0]).all() and (indices == unstranded[1]).all())
+
+        offsets, indices = f.findFeatureIndicesBetween('chrX', [0, 10], [5, 20])
+        self.assertEqual(list(offsets), [0, 0, 0])
+
 
 if __name__ == '__main__':
     unittest.main()
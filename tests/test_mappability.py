@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import unittest
+import gzip
+import os
+import tempfile
+import pysam
+import numpy as np
+from singlecellmultiomics.fastaProcessing.createMappabilityIndex import digest_genome, get_site_statistics, write_mappability_index
+from singlecellmultiomics.bamProcessing import MapabilityReader
+from singlecellmultiomics.utils import reverse_complement
+
+"""
+These tests check if mappability indices are created correctly
+"""
+
+
+class TestMappabilityIndex(unittest.TestCase):
+
+    def test_create_index(self):
+        rng = np.random.default_rng(4)
+        repeat = 'CATGAAACCGGTTTCCATGGG'
+        contigs = {
+            'chr1': ''.join(rng.choice(list('ACGT'), size=400)) + repeat + 'TTTT' + repeat.lower(),
+            'chr2': ''.join(rng.choice(list('ACGT'), size=300)),
+        }
+        with tempfile.TemporaryDirectory() as folder:
+            fasta_path = f'{folder}/ref.fa'
+            with open(fasta_path, 'w') as f:
+                for contig, seq in contigs.items():
+                    f.write(f'>{contig}\n{seq}\n')
+            pysam.faidx(fasta_path)
+
+            reads = {}
+            for threads in (1, 2):
+                fastq_path = f'{folder}/reads_{threads}.fastq.gz'
+                written = digest_genome(fasta_path, fastq_path, ['CATG', 'CCGG'], minlen=4, maxlen=30, threads=threads)
+                with gzip.open(fastq_path, 'rt') as f:
+                    lines = f.read().split('\n')
+                reads[threads] = list(zip(lines[0::4], lines[1::4]))
+                self.assertEqual(written, len(reads[threads]))
+                self.assertFalse(os.path.exists(f'{fastq_path}.shards'))
+            self.assertEqual(reads[1], reads[2])
+
+            # Every read is the start of a fragment between two recognition sites
+            for name, seq in reads[1]:
+                kv = dict(kv.split(':') for kv in name[1:].split(';'))
+                contig_seq = contigs[kv['ct']].upper()
+                ds = int(kv['ds'])
+                self.assertEqual(contig_seq[ds:ds + len(kv['mt'])], kv['mt'])
+                if kv['DR'] == 'fwd':
+                    self.assertEqual(contig_seq[ds:ds + len(seq)], seq)
+                else:
+                    self.assertEqual(reverse_complement(contig_seq[ds + len(kv['mt']) - len(seq):ds + len(kv['mt'])]), seq)
+            self.assertEqual({name.split('mt:')[1] for name, _ in reads[1]}, {'CATG', 'CCGG'})
+
+            # Map the reads back to their origin, except the reads of the second copy of the repeat,
+            # which map to the first copy, and a single unmapped read
+            first_copy = len(contigs['chr1']) - 2 * len(repeat) - 4
+            second_copy = first_copy + len(repeat) + 4
+            bam_path = f'{folder}/mapped.bam'
+            unsorted_path = f'{folder}/mapped.unsorted.bam'
+            with pysam.AlignmentFile(unsorted_path, 'wb', reference_names=list(contigs),
+                                     reference_lengths=[len(seq) for seq in contigs.values()]) as bam:
+                for i, (name, seq) in enumerate(reads[1]):
+                    kv = dict(kv.split(':') for kv in name[1:].split(';'))
+                    read = pysam.AlignedSegment(bam.header)
+                    read.query_name = name[1:]
+                    read.query_sequence = seq
+                    read.query_qualities = pysam.qualitystring_to_array('E' * len(seq))
+                    if i == 0:
+                        unmapped_key = (kv['ct'], int(kv['ds']), kv['DR'] == 'rev')
+                        read.is_unmapped = True
+                        bam.write(read)
+                        continue
+                    ds = int(kv['ds'])
+                    if kv['ct'] == 'chr1' and ds >= second_copy:
+                        ds -= second_copy - first_copy
+                    read.reference_id = list(contigs).index(kv['ct'])
+                    read.is_reverse = kv['DR'] == 'rev'
+                    read.reference_start = ds + len(kv['mt']) - len(seq) if read.is_reverse else ds
+                    read.cigarstring = f'{len(seq)}M'
+                    read.mapping_quality = 60
+                    bam.write(read)
+            pysam.sort(unsorted_path, '-o', bam_path)
+            pysam.index(bam_path)
+
+            sites = get_site_statistics(bam_path, threads=1)
+            self.assertEqual(sites, get_site_statistics(bam_path, threads=2))
+            self.assertEqual(sites['CATG'][unmapped_key], [0, 1, 0])
+            self.assertEqual(sites['CATG'][('chr1', first_copy, False)], [1, 0, 1])
+            self.assertEqual(sites['CATG'][('chr1', second_copy, False)], [0, 1, 0])
+
+            prefix = f'{folder}/simulated_CATG_single_30'
+            write_mappability_index(sites['CATG'], prefix, list(contigs))
+            for path in (f'{prefix}.mappability.safe.bgzf', f'{prefix}.mappability.store'):
+                reader = MapabilityReader(path)
+                for (contig, pos, strand), (correct, lost, wrong_gain) in sites['CATG'].items():
+                    self.assertEqual(reader.site_is_mapable(contig, pos, strand),
+                                     correct == 1 and lost == 0 and wrong_gain == 0)
+                self.assertFalse(reader.site_is_mapable('chr1', first_copy, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
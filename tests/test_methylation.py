@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
-from singlecellmultiomics.methylation import MethylationCountMatrix
+import numpy as np
+import pandas as pd
+import tempfile
+from singlecellmultiomics.methylation import MethylationCountMatrix, SparseMethylationCountMatrix
+from singlecellmultiomics.methylation.methylationTable import MethylationTableWriter, MethylationTable
 
 """
 These tests check if the methylation module is working correctly
@@ -39,6 +43,92 @@ class TestMethylationCountMatrix(unittest.TestCase):
         self.assertEqual(mA.get_bulk_frame()['methylated'].sum(), 3)
         self.assertEqual(mA.get_bulk_frame()['unmethylated'].sum(), 3)
 
+    def test_bulk_frame_and_prune(self):
+        rng = np.random.default_rng(2)
+        m = MethylationCountMatrix(threads=2)
+        for _ in range(500):
+            m.add(f'cell_{rng.integers(10)}', ('chr1', int(rng.integers(50)), 0), int(rng.integers(2)))
+        m['cell_only_pruned', ('chr2', 1, 0)][1] += 1
+
+        samples = m.get_sample_list()
+        expected = np.array([m.get_bulk_column(samples, location) for location in sorted(m.sites)])
+        np.testing.assert_allclose(m.get_bulk_frame('np'), expected)
+
+        m.prune(min_samples=2, min_variance=0.05)
+        self.assertNotIn('cell_only_pruned', m.counts)
+        self.assertNotIn(('chr2', 1, 0), m.sites)
+        bulk = m.get_bulk_frame()
+        self.assertTrue((bulk['n_samples'] >= 2).all())
+        self.assertTrue((bulk['variance'] >= 0.05).all())
+        self.assertEqual(len(bulk), (expected[:-1, 3] >= 0.05).sum())
+
+    def test_sparse_matrix(self):
+        rng = np.random.default_rng(1)
+        parts = []
+        for part in range(3):
+            dict_matrix = MethylationCountMatrix()
+            sparse_matrix = SparseMethylationCountMatrix(consolidate_every=50)
+            # Every part covers a different region, as the regions of the workers in bamToMethylationCalls
+            for _ in range(300):
+                sample = f'cell_{rng.integers(8)}'
+                location = ('chr1', part * 1000 + int(rng.integers(40)) * 5, part * 1000 + int(rng.integers(40)) * 5 + 1)
+                methylated = int(rng.integers(2))
+                dict_matrix.add(sample, location, methylated)
+                sparse_matrix.add(sample, location, methylated)
+            parts.append((dict_matrix, sparse_matrix))
+
+        dict_matrix, sparse_matrix = MethylationCountMatrix(), SparseMethylationCountMatrix()
+        for dict_part, sparse_part in parts:
+            dict_matrix.update(dict_part)
+            sparse_matrix.update(sparse_part)
+
+        pd.testing.assert_frame_equal(dict_matrix.get_bulk_frame(), sparse_matrix.get_bulk_frame())
+        for dtype in ('methylated', 'unmethylated', 'beta'):
+            pd.testing.assert_frame_equal(dict_matrix.get_frame(dtype), sparse_matrix.get_frame(dtype))
+
+        matrix, samples, locations = sparse_matrix.get_sparse_matrix('methylated')
+        self.assertEqual(matrix.sum(), dict_matrix.get_bulk_frame()['methylated'].sum())
+        self.assertEqual(samples, dict_matrix.get_sample_list())
+        self.assertEqual(locations, sorted(dict_matrix.sites))
+
+        dict_matrix.prune(min_samples=3, min_variance=0.01)
+        sparse_matrix.prune(min_samples=3, min_variance=0.01)
+        self.assertEqual(len(dict_matrix.sites), len(sparse_matrix.sites))
+        self.assertEqual(dict_matrix.get_sample_list(), sparse_matrix.get_sample_list())
+        pd.testing.assert_frame_equal(dict_matrix.get_bulk_frame(), sparse_matrix.get_bulk_frame())
+
+
+    def test_methylation_table(self):
+        first, second = MethylationCountMatrix(), SparseMethylationCountMatrix()
+        first.add('cell_B', ('chr1', 20, 21), 1)
+        first.add('cell_A', ('chr1', 10, 11), 0)
+        first.add('cell_A', ('chr1', 30, 31), 1)
+        # Location at the border of both batches
+        second.add('cell_A', ('chr1', 30, 31), 0)
+        second.add('cell_A', ('chr1', 40, 41), 1, count=3)
+        second.add('cell_B', ('chr2', 5, 6), 0)
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = f'{folder}/calls.tsv.gz'
+            with MethylationTableWriter(path) as writer:
+                writer.write_matrix(first)
+                writer.write_matrix(second)
+                with self.assertRaises(ValueError):
+                    writer.write([('chr1', 50, '.', 'cell_A', 1, 0)])
+
+            with MethylationTable(path) as table:
+                self.assertEqual(table.get_contigs(), ['chr1', 'chr2'])
+                self.assertEqual(
+                    table.fetch('chr1', 20, 41).values.tolist(),
+                    [['chr1', 20, '.', 'cell_B', 1, 0],
+                     ['chr1', 30, '.', 'cell_A', 1, 1],
+                     ['chr1', 40, '.', 'cell_A', 3, 0]])
+                self.assertEqual(table.fetch('chr1', cells=['cell_B'])['pos'].tolist(), [20])
+                self.assertEqual(len(table.fetch('chr3')), 0)
+
+                betas = table.get_frame('beta', 'chr1')
+                self.assertEqual(betas.loc['cell_A', ('chr1', 30, '.')], 0.5)
+                self.assertTrue(np.isnan(betas.loc['cell_B', ('chr1', 10, '.')]))
 
 
 if __name__ == '__main__':
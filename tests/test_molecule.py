@@ -6,6 +6,7 @@ import singlecellmultiomics.fragment
 import pysam
 import pysamiterators.iterators
 import os
+from unittest.mock import patch
 
 from singlecellmultiomics.molecule import MoleculeIterator, CHICMolecule
 from singlecellmultiomics.fragment import CHICFragment
@@ -205,6 +206,191 @@ class TestMolecule(unittest.TestCase):
             )
             pass
 
+    def test_molecule_iterator_ejection_interval(self):
+        """Test if the ejection interval does not change the yielded molecules"""
+        def get_molecules(check_eject_every, pooling_method, cache_size=10_000):
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                return [ (m.chromosome, m.spanStart, m.spanEnd, m.sample, m.umi, len(m))
+                    for m in singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                    fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                    check_eject_every=check_eject_every,
+                    pooling_method=pooling_method,
+                    molecule_class_args={'cache_size': cache_size}
+                    )]
+
+        class ScanningEjectionIndex(singlecellmultiomics.molecule.iterator.EjectionIndex):
+            """Finds the molecules to eject by calling can_be_yielded on every buffered molecule"""
+            def has_ejectable(self, chromosome, position):
+                return any(m.can_be_yielded(chromosome, position) for m, _ in self.buffered.values())
+
+            def pop_ejectable(self, chromosome, position):
+                ejected = [(serial, m, hash_group) for serial, (m, hash_group) in self.buffered.items()
+                           if m.can_be_yielded(chromosome, position)]
+                for serial, _, _ in ejected:
+                    del self.buffered[serial]
+                return ejected
+
+        for pooling_method in (0,1):
+            unbuffered = get_molecules(None, pooling_method)
+            self.assertEqual(len(unbuffered),204)
+            for check_eject_every in (1,10,10_000):
+                self.assertEqual(
+                    sorted(get_molecules(check_eject_every, pooling_method)),
+                    sorted(unbuffered))
+
+            # The reads span less than the default cache size, a small cache size ejects molecules while iterating.
+            # The molecules are streamed in the same order as when scanning all buffered molecules
+            for cache_size in (20, 100):
+                for check_eject_every in (1,10,100):
+                    streamed = get_molecules(check_eject_every, pooling_method, cache_size)
+                    with patch.object(singlecellmultiomics.molecule.iterator, 'EjectionIndex', ScanningEjectionIndex):
+                        self.assertEqual(streamed, get_molecules(check_eject_every, pooling_method, cache_size))
+
+    def test_molecule_iterator_buffer_cleanup(self):
+        """Test if the buffers of the molecule iterator only hold the molecules which have not been yielded"""
+        for pooling_method in (0,1):
+            with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+                it = singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                    fragment_class=singlecellmultiomics.fragment.NlaIIIFragment,
+                    pooling_method=pooling_method
+                    )
+                for m in it:
+                    index = it.ejection_index
+                    if pooling_method == 0:
+                        self.assertEqual(len(it.molecules), len(index))
+                    else:
+                        self.assertTrue(all(len(group) > 0 for group in it.molecules_per_cell.values()))
+                        self.assertEqual(set(it.hash_group_order), set(it.molecules_per_cell))
+                        self.assertEqual(sum(len(group) for group in it.molecules_per_cell.values()), len(index))
+                    self.assertEqual(sum(index.contig_sizes.values()), len(index))
+                    for contig, heaps in index.contigs.items():
+                        for heap in heaps:
+                            self.assertLessEqual(len(heap), 2 * index.contig_sizes[contig] + 64)
+
+    def test_molecule_hash_group_umi_candidates(self):
+        """Test if the UMI index of a hash group returns all molecules with a matching UMI"""
+        from types import SimpleNamespace
+        from itertools import product
+        from singlecellmultiomics.molecule.iterator import MoleculeHashGroup
+        from singlecellmultiomics.fragment import Fragment
+
+        umis = [''.join(umi) for umi in product('ACGN', repeat=3)]
+        group = MoleculeHashGroup()
+        for serial, umi in enumerate(umis):
+            group.add(serial, SimpleNamespace(umi=umi))
+
+        for hd in (0,1,2):
+            for umi in umis:
+                read = pysam.AlignedSegment()
+                read.set_tag('SM','CELL_1')
+                read.set_tag('RX',umi)
+                fragment = Fragment([read], umi_hamming_distance=hd)
+                candidates = group.candidates(fragment)
+                serials = [serial for serial, molecule in candidates]
+                self.assertEqual(serials, sorted(serials))
+                matching = {serial for serial, molecule in group.molecules.items() if fragment.umi_eq(molecule)}
+                self.assertTrue( matching.issubset(serials) )
+
+    def test_base_observation_arrays(self):
+        """Test if the base observation arrays match the aligned pairs of the reads"""
+        from collections import Counter, defaultdict
+        import numpy as np
+        from singlecellmultiomics.utils import likelihood_to_prob
+        with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
+            for molecule in singlecellmultiomics.molecule.MoleculeIterator(
+                    alignments=f,
+                    molecule_class=singlecellmultiomics.molecule.NlaIIIMolecule,
+                    fragment_class=singlecellmultiomics.fragment.NlaIIIFragment):
+
+                for one_call_per_frag, min_bq in ((True, None), (False, 30), (False, None)):
+                    expected = []
+                    expected_obs = defaultdict(Counter)
+                    for fragment_index, fragment in enumerate(molecule):
+                        seen = set()
+                        for read in fragment:
+                            if read is None:
+                                continue
+                            for qpos, rpos, ref_base in read.get_aligned_pairs(matches_only=True, with_seq=True):
+                                base, qual = read.query_sequence[qpos], read.query_qualities[qpos]
+                                if base == 'N' or (min_bq is not None and qual < min_bq):
+                                    continue
+                                if one_call_per_frag:
+                                    if rpos in seen:
+                                        continue
+                                    seen.add(rpos)
+                                expected.append((rpos, base, qual, fragment_index, ref_base.upper()))
+                                expected_obs[(read.reference_name, rpos)][base] += 1
+
+                    observations = molecule.get_base_observation_arrays(
+                        return_refbases=True, one_call_per_frag=one_call_per_frag, min_bq=min_bq)
+                    self.assertEqual(expected, list(zip(
+                        observations.positions.tolist(),
+                        [chr(base) for base in observations.bases],
+                        observations.qualities.tolist(),
+                        observations.fragment_indices.tolist(),
+                        [chr(base) for base in observations.reference_bases])))
+
+                    self.assertEqual(expected_obs, molecule.get_base_observation_dict(
+                        use_cache=False, one_call_per_frag=one_call_per_frag, min_bq=min_bq))
+
+                # Base probabilities, computed per read as before the observations were vectorised
+                likelihoods = {}
+                for read in molecule.iter_reads():
+                    for qpos, rpos in read.get_aligned_pairs(matches_only=True):
+                        base, qual = read.query_sequence[qpos], read.query_qualities[qpos]
+                        if base == 'N':
+                            continue
+                        p = 1 - np.power(10, -qual / 10)
+                        location = likelihoods.setdefault((molecule.chromosome, rpos), {})
+                        if base not in location:
+                            location[base] = [p, 1]
+                            location['N'] = [1 - p, 1]
+                        else:
+                            location[base][0] *= p
+                            location[base][1] += 1
+                            location['N'][0] *= 1 - p
+                            location['N'][1] += 1
+                probs = molecule.base_probabilities
+                self.assertEqual(set(probs), set(likelihoods))
+                for location, base_likelihoods in likelihoods.items():
+                    expected_probs = likelihood_to_prob({base: likelihood / np.power(0.25, n - 1)
+                                                         for base, (likelihood, n) in base_likelihoods.items()})
+                    self.assertEqual(set(probs[location]), set(expected_probs))
+                    for base, prob in expected_probs.items():
+                        self.assertAlmostEqual(probs[location][base], prob)
+                    self.assertAlmostEqual(sum(probs[location].values()), 1)
+
+    def test_base_observation_arrays_spliced(self):
+        """Test if the reference bases obtained from the MD tag are correct for spliced reads"""
+        from singlecellmultiomics.molecule.molecule import get_read_base_observation_arrays
+        from singlecellmultiomics.molecule import Molecule
+        from singlecellmultiomics.fragment import Fragment
+        header = pysam.AlignmentHeader.from_references(['chr1'], [1000])
+        read = pysam.AlignedSegment(header)
+        read.query_name = 'spliced'
+        read.reference_id = 0
+        read.reference_start = 10
+        read.query_sequence = 'ACGTAACGTA'
+        read.query_qualities = pysam.qualitystring_to_array('E' * 10)
+        read.cigarstring = '5M100N2M1D3M'
+        read.set_tag('MD', '7^C0T2')
+        read.set_tag('SM', 'CELL_1')
+        read.set_tag('RX', 'CAT')
+
+        expected = [(qpos, rpos, ref_base.upper()) for qpos, rpos, ref_base in
+                    read.get_aligned_pairs(matches_only=True, with_seq=True)]
+        query_positions, reference_positions, _, _, reference_bases = get_read_base_observation_arrays(
+            read, return_refbases=True)
+        self.assertEqual(expected, list(zip(query_positions.tolist(), reference_positions.tolist(),
+                                            [chr(base) for base in reference_bases])))
+
+        molecule = Molecule([Fragment([read])])
+        self.assertEqual(molecule.get_match_mismatch_frequency(), (9, 1))
+
     def test_every_fragment_as_molecule(self):
         with pysam.AlignmentFile('./data/mini_nla_test.bam') as f:
             for i,m in enumerate(singlecellmultiomics.molecule.MoleculeIterator(
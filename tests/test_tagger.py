@@ -58,6 +58,35 @@ class TestMultiomeTaggingCHIC(unittest.TestCase):
         os.remove(write_path)
         os.remove(write_path+'.bai')
 
+    def test_write_to_read_grouped_multi_stream(self):
+        write_path = './data/write_test_chic_rg_stream.bam'
+        tm.run_multiome_tagging_cmd(f'./data/chic_test_region.bam -method chic --multiprocess --stream -o {write_path}'.split(' '))
+
+        with pysam.AlignmentFile(write_path) as f:
+            # Test program header:
+            self.assertTrue( 1==len([x for x in f.header['PG'] if 'bamtagmultiome' in x.get('PN','')]) )
+            # Test if the read groups are written to the header:
+            self.assertTrue( len(f.header['RG'])>0 )
+
+            i =0
+            previous = None
+            # Test if the file has reads.
+            for read in f:
+                if read.is_read1:
+                    i+=1
+                # Test if the reads have read groups:
+                self.assertTrue(read.has_tag('RG'))
+                # Test if the reads are sorted:
+                if previous is not None:
+                    self.assertTrue( (read.reference_id, read.reference_start) >= previous )
+                previous = (read.reference_id, read.reference_start)
+            self.assertEqual(i, 17)
+
+        self.assertTrue( os.path.exists(write_path) )
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        os.remove(write_path.replace('.bam','.status.txt'))
+
 class TestMultiomeTaggingNLA(unittest.TestCase):
 
     def test_write_to_read_grouped_sorted(self):
@@ -201,6 +230,131 @@ class TestMultiomeTaggingNLA(unittest.TestCase):
         os.remove(write_path)
         os.remove(write_path+'.bai')
 
+    def test_skip_contig_invert_multi_process_stream(self):
+        write_path = './data/write_test_rg_stream.bam'
+        tm.run_multiome_tagging_cmd(f'./data/mini_nla_test.bam --multiprocess --stream --no_rejects --allow_cycle_shift -method nla -skip_contig chr2,chr3 -o {write_path}'.split(' '))
+
+        with pysam.AlignmentFile(write_path) as f:
+            self.assertTrue( 1==len([x for x in f.header['PG'] if 'bamtagmultiome' in x.get('PN','')]) )
+
+            i =0
+            # Test if the file has reads.
+            for read in f:
+                self.assertTrue(read.has_tag('RG'))
+                if read.is_read1:
+                    i+=1
+            self.assertEqual(i, 283)
+
+        self.assertTrue( os.path.exists(write_path) )
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        os.remove(write_path.replace('.bam','.status.txt'))
+
+    def test_cut_site_index(self):
+        from singlecellmultiomics.bamProcessing.cutSiteIndex import CutSiteIndex, write_cut_site_index, open_cut_site_index, FLAG_DUPLICATE, FLAG_QCFAIL
+        from singlecellmultiomics.bamProcessing.bamBinCounts import CutPositions
+        write_path = './data/write_test_cut_sites.bam'
+        tm.run_multiome_tagging_cmd(f'./data/mini_nla_test.bam --allow_cycle_shift -method nla --cut_site_index -o {write_path}'.split(' '))
+
+        expected = []
+        with pysam.AlignmentFile(write_path) as f:
+            for read in f.fetch('chr1'):
+                if (read.is_read1 or not read.is_paired) and not read.is_secondary and not read.is_supplementary:
+                    # Reads without cut site use the start of the read
+                    position = read.get_tag('DS') if read.has_tag('DS') else (
+                        read.reference_end if read.is_reverse else read.reference_start)
+                    if position is None:
+                        continue
+                    expected.append((position, read.is_reverse, read.get_tag('SM'), read.is_duplicate,
+                                     read.is_qcfail, read.mapping_quality, read.get_tag('af') if read.has_tag('af') else 0))
+
+        index_path = write_path + '.cutsites'
+        for chunk_size in (None, 7):
+            if chunk_size is not None:
+                write_cut_site_index(write_path, chunk_size=chunk_size)
+            index = CutSiteIndex(index_path)
+            self.assertEqual(index.get_contigs(), ['chr1'])
+            rows = index.fetch('chr1')
+            observed = list(zip(rows['position'].tolist(), rows['strand'].astype(bool).tolist(),
+                                [index.samples[i] for i in rows['sample']],
+                                ((rows['flags'] & FLAG_DUPLICATE) > 0).tolist(),
+                                ((rows['flags'] & FLAG_QCFAIL) > 0).tolist(),
+                                rows['mapping_quality'].tolist(), rows['umi_count'].tolist()))
+            self.assertEqual(sorted(observed), sorted(expected))
+
+            # Region selection
+            start, end = int(rows['position'][10]), int(rows['position'][-10])
+            molecules = index.fetch('chr1', start, end, dedup=True, columns=['position'])['position']
+            self.assertEqual(sorted(molecules.tolist()), sorted(
+                position for position, _, _, duplicate, _, _, _ in expected if start <= position < end and not duplicate))
+
+        cut_positions = CutPositions.from_cut_site_index(index_path)
+        self.assertEqual(len(cut_positions), sum(not duplicate and not qcfail for _, _, _, duplicate, qcfail, _, _ in expected))
+
+        # The index is outdated when the BAM file changes after writing the index
+        stat = os.stat(write_path)
+        os.utime(write_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        with self.assertRaises(ValueError):
+            CutSiteIndex(index_path)
+        with self.assertRaises(ValueError):
+            open_cut_site_index(write_path, create=False)
+        index = open_cut_site_index(write_path)
+        self.assertEqual(index.index['bam']['mtime_ns'], os.stat(write_path).st_mtime_ns)
+        self.assertEqual(len(index.fetch('chr1')['position']), len(expected))
+
+        import shutil
+        shutil.rmtree(index_path)
+        os.remove(write_path)
+        os.remove(write_path+'.bai')
+        os.remove(write_path.replace('.bam','.status.txt'))
+
+class TestTaggingManifest(unittest.TestCase):
+
+    def test_resume(self):
+        from singlecellmultiomics.universalBamTagger.tagging import TaggingManifest
+        manifest_path = './data/test_manifest.jsonl'
+        parameters = {'input':'input.bam', 'bp_per_job':1000}
+        job_a = [('chr1', 0, 100, 0, 200), ('chr1', 100, 200, 0, 300)]
+        job_b = [('chr2', 0, 100, 0, 200)]
+
+        manifest = TaggingManifest(manifest_path, parameters=parameters)
+        manifest.record(None, {'tasks':job_a, 'total_molecules':0, 'timeout_tasks':[]})
+        # Simulate a crash while writing a record:
+        with open(manifest_path,'a') as o:
+            o.write('{"bam": "')
+
+        manifest = TaggingManifest(manifest_path, parameters=parameters, resume=True)
+        self.assertTrue( manifest.is_completed(job_a) )
+        self.assertFalse( manifest.is_completed(job_b) )
+        self.assertEqual( len(manifest.completed), 1 )
+
+        # A run with other parameters cannot be resumed
+        with self.assertRaises(ValueError):
+            TaggingManifest(manifest_path, parameters={'input':'other.bam', 'bp_per_job':1000}, resume=True)
+
+        # Not resuming starts a new manifest
+        manifest = TaggingManifest(manifest_path, parameters=parameters)
+        self.assertFalse( manifest.is_completed(job_a) )
+        manifest.remove()
+        self.assertFalse( os.path.exists(manifest_path) )
+
+    def test_run_parameters(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            vcf_path = f'{folder}/variants.vcf'
+            with open(vcf_path, 'w') as o:
+                o.write('#CHROM\n')
+            args = tm.argparser.parse_args(f'./data/mini_nla_test.bam -method nla -alleles {vcf_path} -o {folder}/out.bam -tagthreads 4'.split(' '))
+            parameters = tm.get_run_parameters(args)
+            # The output path and threads do not change the tagged reads
+            self.assertNotIn('o', parameters)
+            self.assertNotIn('tagthreads', parameters)
+            self.assertEqual(parameters, tm.get_run_parameters(args))
+
+            # A changed auxiliary input changes the parameters
+            with open(vcf_path, 'a') as o:
+                o.write('1\n')
+            self.assertNotEqual(parameters['alleles_stat'], tm.get_run_parameters(args)['alleles_stat'])
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,12 +3,15 @@
 import unittest
 import pysam
 import os
+import tempfile
 
 from singlecellmultiomics.molecule import TAPSNlaIIIMolecule, TAPS
 from singlecellmultiomics.fragment import NlaIIIFragment
 from singlecellmultiomics.utils import create_MD_tag
 
 from singlecellmultiomics.utils import complement
+from singlecellmultiomics.methylation import extract_cpgs
+from singlecellmultiomics.methylation.methylationTable import write_methylation_table, MethylationTable
 
 
 class TestTAPs(unittest.TestCase):
@@ -264,6 +267,37 @@ class TestTAPs(unittest.TestCase):
             # Check that dove tail is not included:
             self.assertNotIn(('chr1', 21), calls)
 
+        # Streaming the calls per region results in the same calls as extracting the whole contig
+        calls = extract_cpgs(alignments_path, 'chr1', NlaIIIFragment, TAPSNlaIIIMolecule,
+                             reference_path=ref_path, stranded=True)
+        with tempfile.TemporaryDirectory() as folder:
+            rows = write_methylation_table(alignments_path, f'{folder}/calls.tsv.gz', NlaIIIFragment, TAPSNlaIIIMolecule,
+                                           region_size=10, reference_path=ref_path, stranded=True)
+            self.assertEqual(rows, len(calls))
+            with MethylationTable(f'{folder}/calls.tsv.gz') as table:
+                self.assertEqual(
+                    {(row.contig, row.pos, row.strand == '-'): {row.cell: [row.unmet, row.met]}
+                     for row in table.fetch('chr1').itertuples()},
+                    {location: dict(calls_per_cell) for location, calls_per_cell in calls.items()})
+
+    def test_positions_to_context(self):
+        refseq = 'TTAATCATGAAACCGTGGAGGCAAATCGGAGTGTAAGGCTTGACTGGATTCCTACGTTGCGTAGGTTCATGGGGGG'
+
+        class Reference():
+            def fetch(self, chromosome, start, end):
+                return refseq[start:end]
+
+        taps = TAPS()
+        for ref_base, observed_bases in (('C','CTAN'), ('G','GATN')):
+            positions = [position for position in range(2, len(refseq) - 2) if refseq[position] == ref_base]
+            observed = [observed_bases[i % len(observed_bases)] for i in range(len(positions))]
+
+            contexts, letters = taps.positions_to_context('chr1', positions, ref_base, observed, reference=Reference())
+            self.assertEqual(
+                list(zip(contexts, letters)),
+                [taps.position_to_context('chr1', position, ref_base, observed_base=base, strand=False, reference=Reference())
+                 for position, base in zip(positions, observed)])
+
 
 
 if __name__ == '__main__':